@@ -1,6 +1,6 @@
 # distbuild/__init__.py -- library for Morph's distributed build plugin
 #
-# Copyright (C) 2012, 2014  Codethink Limited
+# Copyright (C) 2012, 2014, 2026  Codethink Limited
 # 
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -23,12 +23,14 @@ from socketsrc import (SocketError, NewConnection, ListeningSocketEventSource,
                        SocketReadable, SocketWriteable, SocketEventSource,
                        set_nonblocking)
 from sockbuf import (SocketBufferNewData, SocketBufferEof, 
-                     SocketBufferClosed, SocketBuffer)
+                     SocketBufferWritten, SocketBufferClosed, SocketBuffer)
 from mainloop import MainLoop
 from sockserv import ListenServer
-from jm import JsonMachine, JsonNewMessage, JsonEof
+from jm import JsonMachine, JsonNewMessage, JsonEof, JsonWritten
+from output_buffer import OutputBuffer
 
-from serialise import serialise_artifact, deserialise_artifact
+from serialise import (serialise_artifact, deserialise_artifact,
+                       GRAPH_VERSION)
 from idgen import IdentifierGenerator
 from route_map import RouteMap
 from timer_event_source import TimerEventSource, Timer
@@ -41,6 +43,7 @@ from connection_machine import (ConnectionMachine, InitiatorConnectionMachine,
                                 Reconnect, StopConnecting)
 from worker_build_scheduler import (WorkerBuildQueuer, 
                                     WorkerConnection, 
+                                    WorkerSlot,
                                     WorkerBuildRequest,
                                     WorkerCancelPending,
                                     WorkerBuildOutput,
@@ -49,7 +52,11 @@ from worker_build_scheduler import (WorkerBuildQueuer,
                                     WorkerBuildWaiting,
                                     WorkerBuildFinished,
                                     WorkerBuildFailed,
+                                    WorkerBuildRetrying,
                                     WorkerBuildStepStarted)
+from build_priority import (FifoPriority, DependentCountPriority,
+                            CriticalPathPriority, BuildDurations,
+                            duration_key, new_build_priority)
 from build_controller import (BuildController, BuildFailed, BuildProgress,
                               BuildSteps, BuildStepStarted,
                               BuildStepAlreadyStarted, BuildOutput,
@@ -1,6 +1,6 @@
 # distbuild/build_controller.py -- control the steps for one build
 #
-# Copyright (C) 2012, 2014  Codethink Limited
+# Copyright (C) 2012, 2014, 2026  Codethink Limited
 # 
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -16,6 +16,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
 
 
+import heapq
 import logging
 import httplib
 import traceback
@@ -24,6 +25,7 @@ import urlparse
 import json
 
 import distbuild
+import morphlib
 
 
 # Artifact build states
@@ -34,6 +36,7 @@ BUILT = 'built'
 
 
 class _Start(object): pass
+class _Probed(object): pass
 class _Annotated(object): pass
 class _Built(object): pass
 
@@ -160,18 +163,33 @@ class BuildController(distbuild.StateMachine):
     '''
     
     _idgen = distbuild.IdentifierGenerator('BuildController')
+
+    # Each artifact cache server's membership filter, shared by all the
+    # builds, or None for a server which does not publish one.
+    _membership = {}
+
+    # A membership filter which could not be updated for this long is
+    # not used, since it lacks whatever has been added since.
+    MEMBERSHIP_MAX_AGE = 60
     
     def __init__(self, initiator_connection, build_request_message,
-                 artifact_cache_server, morph_instance):
+                 artifact_cache_server, morph_instance, build_priority=None):
         distbuild.crash_point()
         distbuild.StateMachine.__init__(self, 'init')
         self._initiator_connection = initiator_connection
         self._request = build_request_message
         self._artifact_cache_server = artifact_cache_server
         self._morph_instance = morph_instance
+        if build_priority is None:
+            build_priority = distbuild.DependentCountPriority()
+        self._build_priority = build_priority
         self._helper_id = None
+        # The artifacts whose builds were lost with a worker, and are
+        # waiting to be started again.
+        self._retrying = set()
         self.debug_transitions = False
         self.debug_graph_state = False
+        self._index_graph([])
 
     def __repr__(self):
         return '<BuildController at 0x%x, request-id %s>' % (id(self),
@@ -191,11 +209,18 @@ class BuildController(distbuild.StateMachine):
             ('graphing', distbuild.HelperRouter, distbuild.HelperResult,
                 'graphing', self._maybe_finish_graph),
             ('graphing', self, _GotGraph,
-                'annotating', self._start_annotating),
+                'probing', self._start_probing),
             ('graphing', self, _GraphFailed, None, None),
             ('graphing', self._initiator_connection,
                 distbuild.InitiatorDisconnect, None, None),
 
+            ('probing', distbuild.HelperRouter, distbuild.HelperResult,
+                'probing', self._maybe_handle_membership_response),
+            ('probing', self, _Probed,
+                'annotating', self._start_annotating),
+            ('probing', self._initiator_connection,
+                distbuild.InitiatorDisconnect, None, None),
+
             ('annotating', distbuild.HelperRouter, distbuild.HelperResult,
                 'annotating', self._maybe_handle_cache_response),
             ('annotating', self, _AnnotationFailed, None,
@@ -234,6 +259,9 @@ class BuildController(distbuild.StateMachine):
             ('building', distbuild.WorkerConnection,
                 distbuild.WorkerBuildFailed, 'building',
                 self._maybe_notify_build_failed),
+            ('building', distbuild.WorkerConnection,
+                distbuild.WorkerBuildRetrying, 'building',
+                self._maybe_relay_build_retrying),
             ('building', self, _Abort, None, None),
             ('building', self, _Built, None, self._notify_build_done),
             ('building', distbuild.InitiatorConnection,
@@ -324,19 +352,84 @@ class BuildController(distbuild.StateMachine):
 
             notify_success(artifact)
 
-    def _start_annotating(self, event_source, event):
+    def _start_probing(self, event_source, event):
         distbuild.crash_point()
 
         self._artifact = event.artifact
+        server = self._artifact_cache_server
+        if server not in self._membership:
+            self._membership[server] = \
+                morphlib.bloomfilter.MembershipFilter()
+        membership = self._membership[server]
+        if membership is None:
+            self.mainloop.queue_event(self, _Probed())
+            return
+
+        # Bring the cache server's membership filter up to date, so that
+        # the cache server only needs to be asked about the artifacts it
+        # may have.
         self._helper_id = self._idgen.next()
+        url = urlparse.urljoin(self._artifact_cache_server,
+                               '/1.0/membership')
+        query = membership.query()
+        if query:
+            url += '?' + urllib.urlencode(query)
+        msg = distbuild.message('http-request',
+            id=self._helper_id,
+            url=url,
+            headers={},
+            body='',
+            method='GET')
+        request = distbuild.HelperRequest(msg)
+        self.mainloop.queue_event(distbuild.HelperRouter, request)
+
+    def _maybe_handle_membership_response(self, event_source, event):
+        if self._helper_id != event.msg['id']:
+            return    # this event is not for us
+
+        server = self._artifact_cache_server
+        status = event.msg['status']
+        if status == httplib.OK:
+            try:
+                self._membership[server].update(
+                    json.loads(event.msg['body']))
+            except ValueError, e:
+                logging.warning('Bad membership filter from %s: %s'
+                                % (server, e))
+        elif status == httplib.NOT_FOUND:
+            logging.info('%s publishes no membership filter' % server)
+            self._membership[server] = None
+        else:
+            logging.debug('Membership filter request failed with status: '
+                          '%s' % status)
+        self.mainloop.queue_event(self, _Probed())
+
+    def _start_annotating(self, event_source, event):
+        distbuild.crash_point()
+
+        self._helper_id = self._idgen.next()
+        membership = self._membership.get(self._artifact_cache_server)
+        if membership is not None and \
+                not membership.is_fresh(self.MEMBERSHIP_MAX_AGE):
+            membership = None
+        self._ruled_out = {}
         artifact_names = []
 
         def set_state_and_append(artifact):
             artifact.state = UNKNOWN
-            artifact_names.append(artifact.basename())
+            name = artifact.basename()
+            if membership is not None and not membership.might_contain(name):
+                self._ruled_out[name] = False
+            else:
+                artifact_names.append(name)
 
         map_build_graph(self._artifact, set_state_and_append)
 
+        if not artifact_names:
+            logging.debug('The membership filter rules out all artifacts')
+            self._set_cache_state({})
+            return
+
         url = urlparse.urljoin(self._artifact_cache_server, '/1.0/artifacts')
         msg = distbuild.message('http-request',
             id=self._helper_id,
@@ -347,15 +440,12 @@ class BuildController(distbuild.StateMachine):
 
         request = distbuild.HelperRequest(msg)
         self.mainloop.queue_event(distbuild.HelperRouter, request)
-        logging.debug('Made cache request for state of artifacts '
-            '(helper id: %s)' % self._helper_id)
+        logging.debug('Made cache request for state of %d artifacts, '
+            '%d ruled out by the membership filter (helper id: %s)'
+            % (len(artifact_names), len(self._ruled_out), self._helper_id))
 
     def _maybe_handle_cache_response(self, event_source, event):
 
-        def set_status(artifact):
-            is_in_cache = cache_state[artifact.basename()]
-            artifact.state = BUILT if is_in_cache else UNBUILT
-
         if self._helper_id != event.msg['id']:
             return    # this event is not for us
 
@@ -371,12 +461,22 @@ class BuildController(distbuild.StateMachine):
                 _AnnotationFailed(http_status_code, error_msg))
             return
 
-        cache_state = json.loads(event.msg['body'])
-        map_build_graph(self._artifact, set_status)
+        self._set_cache_state(json.loads(event.msg['body']))
+
+    def _set_cache_state(self, cache_state):
+
+        def set_status(artifact):
+            is_in_cache = cache_state[artifact.basename()]
+            artifact.state = BUILT if is_in_cache else UNBUILT
+            return artifact
+
+        cache_state.update(self._ruled_out)
+        self._index_graph(map_build_graph(self._artifact, set_status))
         self.mainloop.queue_event(self, _Annotated())
 
-        count = sum(map_build_graph(self._artifact,
-                    lambda a: 1 if a.state == UNBUILT else 0))
+        unbuilt = [a for a in self._artifacts if a.state == UNBUILT]
+        self._priorities = self._build_priority.priorities(unbuilt)
+        count = len(unbuilt)
 
         progress = BuildProgress(
             self._request['id'],
@@ -387,15 +487,55 @@ class BuildController(distbuild.StateMachine):
             logging.info('There seems to be nothing to build')
             self.mainloop.queue_event(self, _Built())
 
-    def _find_artifacts_that_are_ready_to_build(self):
-        def is_ready_to_build(artifact):
-            return (artifact.state == UNBUILT and
-                    all(a.state == BUILT
-                        for a in artifact.source.dependencies))
-
-        return [a 
-                for a in map_build_graph(self._artifact, lambda a: a)
-                if is_ready_to_build(a)]
+    def _index_graph(self, artifacts):
+        '''Index the annotated build graph, to keep track of it cheaply.
+
+        artifacts is the graph in the order map_build_graph gives it.
+        Each artifact has a count of its dependencies which are not
+        built yet, and those which are not built and have none are kept
+        in a heap of (position in artifacts, artifact), so that they
+        are built in the order they would be found in the graph.
+
+        '''
+
+        self._artifacts = artifacts
+        self._position = {}
+        self._by_cache_key = {}
+        self._by_source = {}
+        self._dependents = {}
+        self._unmet = {}
+        self._ready = []
+        self._priorities = {}
+        for i, a in enumerate(artifacts):
+            self._position[a] = i
+            self._by_cache_key.setdefault(a.source.cache_key, a)
+            self._by_source.setdefault(a.source, []).append(a)
+            self._dependents[a] = []
+        for i, a in enumerate(artifacts):
+            dependencies = set(a.source.dependencies)
+            for dependency in dependencies:
+                self._dependents[dependency].append(a)
+            self._unmet[a] = sum(1 for d in dependencies if d.state != BUILT)
+            if a.state == UNBUILT and self._unmet[a] == 0:
+                self._ready.append((i, a))
+        heapq.heapify(self._ready)
+
+    def _set_built(self, artifact):
+        if artifact.state == BUILT:
+            return
+        artifact.state = BUILT
+        for dependent in self._dependents[artifact]:
+            self._unmet[dependent] -= 1
+            if self._unmet[dependent] == 0 and dependent.state == UNBUILT:
+                heapq.heappush(self._ready,
+                               (self._position[dependent], dependent))
+
+    def _next_artifact_ready_to_build(self):
+        while self._ready:
+            position, artifact = heapq.heappop(self._ready)
+            if artifact.state == UNBUILT:
+                return artifact
+        return None
 
     def _queue_worker_builds(self, event_source, event):
         distbuild.crash_point()
@@ -417,19 +557,21 @@ class BuildController(distbuild.StateMachine):
                                 (dep.name, dep.state))
 
         while True:
-            ready = self._find_artifacts_that_are_ready_to_build()
+            artifact = self._next_artifact_ready_to_build()
 
-            if len(ready) == 0:
+            if artifact is None:
                 logging.debug('No new artifacts queued for building')
                 break
 
-            artifact = ready[0]
-
             logging.debug(
                 'Requesting worker-build of %s (%s)' %
                     (artifact.name, artifact.source.cache_key))
+            # All of a chunk's artifacts are built by the same job.
+            priority = max(self._priorities.get(a, 0)
+                           for a in self._by_source[artifact.source])
             request = distbuild.WorkerBuildRequest(artifact,
-                                                   self._request['id'])
+                                                   self._request['id'],
+                                                   priority)
             self.mainloop.queue_event(distbuild.WorkerBuildQueuer, request)
 
             artifact.state = BUILDING
@@ -438,8 +580,8 @@ class BuildController(distbuild.StateMachine):
                 # so when we're building any chunk artifact
                 # we're also building all the chunk artifacts
                 # in this source
-                for a in ready:
-                    if a.source == artifact.source:
+                for a in self._by_source[artifact.source]:
+                    if a.state == UNBUILT and self._unmet[a] == 0:
                         a.state = BUILDING
 
 
@@ -490,11 +632,36 @@ class BuildController(distbuild.StateMachine):
             return
 
         logging.debug('BC: got build step started: %s' % artifact.name)
+        if artifact in self._retrying:
+            # The initiator has been told this step started already, and
+            # its output is added to what it got the first time.
+            self._retrying.discard(artifact)
+            progress = BuildProgress(
+                self._request['id'],
+                'Started building %s again on %s' %
+                    (artifact.name, event.worker_name))
+            self.mainloop.queue_event(BuildController, progress)
+            return
         started = BuildStepStarted(
             self._request['id'], build_step_name(artifact), event.worker_name)
         self.mainloop.queue_event(BuildController, started)
         logging.debug('BC: emitted %s' % repr(started))
 
+    def _maybe_relay_build_retrying(self, event_source, event):
+        if self._request['id'] not in event.initiators:
+            return # not for us
+
+        artifact = self._find_artifact(event.artifact_cache_key)
+        if artifact is None:
+            # This is not the event you are looking for.
+            return
+
+        self._retrying.add(artifact)
+        progress = BuildProgress(
+            self._request['id'],
+            '%s: %s will be built again' % (event.reason, artifact.name))
+        self.mainloop.queue_event(BuildController, progress)
+
     def _maybe_relay_build_step_already_started(self, event_source, event):
         if event.initiator_id != self._request['id']:
             return  # not for us
@@ -542,12 +709,7 @@ class BuildController(distbuild.StateMachine):
         self.mainloop.queue_event(BuildController, progress)
 
     def _find_artifact(self, cache_key):
-        artifacts = map_build_graph(self._artifact, lambda a: a)
-        wanted = [a for a in artifacts if a.source.cache_key == cache_key]
-        if wanted:
-            return wanted[0]
-        else:
-            return None
+        return self._by_cache_key.get(cache_key)
             
     def _maybe_check_result_and_queue_more_builds(self, event_source, event):
         distbuild.crash_point()
@@ -566,18 +728,15 @@ class BuildController(distbuild.StateMachine):
             self._request['id'], build_step_name(artifact))
         self.mainloop.queue_event(BuildController, finished)
 
-        artifact.state = BUILT
-
-        def set_state(a):
-            if a.source == artifact.source:
-                a.state = BUILT
+        self._set_built(artifact)
 
         if artifact.source.morphology['kind'] == 'chunk':
             # Building a single chunk artifact
             # yields all chunk artifacts for the given source
             # so we set the state of this source's artifacts
             # to BUILT
-            map_build_graph(self._artifact, set_state)
+            for a in self._by_source[artifact.source]:
+                self._set_built(a)
 
         self._queue_worker_builds(None, event)
 
@@ -0,0 +1,204 @@
+# distbuild/build_priority.py -- which artifacts to build first
+#
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import json
+import logging
+import os
+import tempfile
+
+
+def duration_key(artifact):
+    '''Return the name the build time of an artifact is recorded under.
+
+    All the artifacts of a chunk are built at once, so they share one.
+
+    '''
+
+    morphology = artifact.source.morphology
+    if morphology['kind'] == 'chunk':
+        return 'chunk.%s' % morphology['name']
+    return '%s.%s' % (morphology['kind'], artifact.name)
+
+
+def _dependents(artifacts):
+    '''Return the artifacts which depend directly on each artifact.
+
+    Dependencies on artifacts which are not in artifacts are ignored.
+    The artifacts are also returned in an order in which each comes
+    after all of its dependencies.
+
+    '''
+
+    dependents = dict((a, []) for a in artifacts)
+    unmet = {}
+    for a in artifacts:
+        dependencies = set(d for d in a.source.dependencies
+                           if d in dependents)
+        unmet[a] = len(dependencies)
+        for dependency in dependencies:
+            dependents[dependency].append(a)
+
+    order = [a for a in artifacts if unmet[a] == 0]
+    for a in order:
+        for dependent in dependents[a]:
+            unmet[dependent] -= 1
+            if unmet[dependent] == 0:
+                order.append(dependent)
+    return dependents, order
+
+
+class FifoPriority(object):
+
+    '''Give every artifact the same priority.
+
+    Artifacts are then built in the order they are asked for.
+
+    '''
+
+    def priorities(self, artifacts):
+        '''Return the priority of each of the artifacts to be built.
+
+        artifacts is everything a build request still needs built,
+        and the result is a dict of artifacts and numbers. Those with
+        bigger numbers are built first.
+
+        '''
+
+        return dict((a, 0) for a in artifacts)
+
+    def record(self, artifact, seconds):
+        '''Note that building artifact took this many seconds.'''
+
+
+class DependentCountPriority(FifoPriority):
+
+    '''Build first what most of the other artifacts depend on.
+
+    Each artifact's priority is the number of artifacts which depend on
+    it, directly or through others, so that a toolchain chunk which
+    half the build waits for is built before a leaf chunk which nothing
+    waits for.
+
+    '''
+
+    def priorities(self, artifacts):
+        dependents, order = _dependents(artifacts)
+        bit = dict((a, 1 << i) for i, a in enumerate(artifacts))
+        # A bit set for each artifact depending on each one.
+        below = {}
+        for a in reversed(order):
+            mask = 0
+            for dependent in dependents[a]:
+                mask |= bit[dependent] | below[dependent]
+            below[a] = mask
+        return dict((a, bin(below[a]).count('1')) for a in order)
+
+
+class CriticalPathPriority(FifoPriority):
+
+    '''Build first what starts the longest chain of builds.
+
+    Each artifact's priority is the time it takes to build it and then
+    the slowest chain of artifacts which depend on it, using the times
+    in durations, a BuildDurations. Artifacts whose build time is not
+    known are taken to take the average time.
+
+    '''
+
+    def __init__(self, durations):
+        self.durations = durations
+
+    def priorities(self, artifacts):
+        dependents, order = _dependents(artifacts)
+        default = self.durations.average()
+        path = {}
+        for a in reversed(order):
+            after = max([path[d] for d in dependents[a]] or [0])
+            path[a] = self.durations.get(duration_key(a), default) + after
+        return path
+
+    def record(self, artifact, seconds):
+        self.durations.record(duration_key(artifact), seconds)
+
+
+class BuildDurations(object):
+
+    '''How long each artifact took to build the last time.
+
+    If filename is given, the times are kept there between runs.
+
+    '''
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._durations = {}
+        if filename is not None and os.path.exists(filename):
+            try:
+                with open(filename) as f:
+                    self._durations = dict(
+                        (str(k), float(v)) for k, v in json.load(f).items())
+            except (IOError, ValueError, AttributeError), e:
+                logging.warning('Ignoring build durations in %s: %s' %
+                                (filename, e))
+
+    def get(self, key, default=None):
+        return self._durations.get(key, default)
+
+    def average(self):
+        '''Return the average of the durations, or 1 if there are none.'''
+
+        if not self._durations:
+            return 1.0
+        return sum(self._durations.itervalues()) / len(self._durations)
+
+    def record(self, key, seconds):
+        self._durations[key] = seconds
+        if self.filename is not None:
+            try:
+                self._save()
+            except (IOError, OSError), e:
+                logging.warning('Could not keep the build durations in '
+                                '%s: %s' % (self.filename, e))
+
+    def _save(self):
+        handle, temp = tempfile.mkstemp(
+            dir=os.path.dirname(self.filename) or '.', prefix='.tmp.')
+        try:
+            with os.fdopen(handle, 'w') as f:
+                json.dump(self._durations, f)
+            os.rename(temp, self.filename)
+        except BaseException:
+            os.unlink(temp)
+            raise
+
+
+def new_build_priority(policy, durations_file=None):
+    '''Return the build priority policy with the given name.
+
+    The names are fifo, dependents, and critical-path. ValueError is
+    raised for any other.
+
+    '''
+
+    if policy == 'fifo':
+        return FifoPriority()
+    elif policy == 'dependents':
+        return DependentCountPriority()
+    elif policy == 'critical-path':
+        return CriticalPathPriority(BuildDurations(durations_file))
+    raise ValueError('Unknown build priority %r' % policy)
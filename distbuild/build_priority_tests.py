@@ -0,0 +1,327 @@
+# distbuild/build_priority_tests.py -- unit tests for build priorities
+#
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import heapq
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import distbuild
+from distbuild.worker_build_scheduler import Jobs
+
+
+class FakeSource(object):
+
+    def __init__(self, name, kind, dependencies):
+        self.morphology = {'name': name, 'kind': kind}
+        self.dependencies = dependencies
+        self.cache_key = '%s.cache_key' % name
+
+
+class FakeArtifact(object):
+
+    def __init__(self, name, kind='chunk', dependencies=()):
+        self.name = name
+        self.source = FakeSource(name, kind, list(dependencies))
+
+    def basename(self):
+        return '%s.%s' % (self.source.cache_key, self.name)
+
+    def __repr__(self):
+        return '<FakeArtifact %s>' % self.name
+
+
+def simulate(artifacts, build_priority, workers, durations):
+    '''Return how long it takes workers to build artifacts.
+
+    Artifacts are queued in a Jobs as soon as they are ready to build,
+    in the order they are in artifacts, as the build controller does,
+    and given to the first worker to be free.
+
+    '''
+
+    priorities = build_priority.priorities(artifacts)
+    jobs = Jobs(distbuild.IdentifierGenerator('Job'))
+    unmet = dict((a, len(a.source.dependencies)) for a in artifacts)
+    dependents = dict((a, []) for a in artifacts)
+    for a in artifacts:
+        for dependency in a.source.dependencies:
+            dependents[dependency].append(a)
+
+    for a in artifacts:
+        if unmet[a] == 0:
+            jobs.create(a, 'request', priorities[a])
+    running = []
+    order = itertools.count()
+    now = 0
+    idle = workers
+    while True:
+        while idle:
+            job = jobs.get_next_job()
+            if job is None:
+                break
+            job.who = 'worker'
+            idle -= 1
+            heapq.heappush(running, (now + durations[job.artifact.name],
+                                     next(order), job))
+        if not running:
+            return now
+        now, _, job = heapq.heappop(running)
+        idle += 1
+        jobs.remove(job)
+        for dependent in dependents[job.artifact]:
+            unmet[dependent] -= 1
+            if unmet[dependent] == 0:
+                jobs.create(dependent, 'request', priorities[dependent])
+
+
+class DurationKeyTests(unittest.TestCase):
+
+    def test_chunk_artifacts_share_a_key(self):
+        a = FakeArtifact('gcc-libs')
+        a.source.morphology['name'] = 'gcc'
+        self.assertEqual(distbuild.duration_key(a), 'chunk.gcc')
+
+    def test_other_artifacts_have_their_own(self):
+        a = FakeArtifact('core-devel', kind='stratum')
+        a.source.morphology['name'] = 'core'
+        self.assertEqual(distbuild.duration_key(a), 'stratum.core-devel')
+
+
+class FifoPriorityTests(unittest.TestCase):
+
+    def test_gives_every_artifact_the_same_priority(self):
+        a = FakeArtifact('a')
+        b = FakeArtifact('b', dependencies=[a])
+        policy = distbuild.FifoPriority()
+        policy.record(a, 10)
+        self.assertEqual(policy.priorities([a, b]), {a: 0, b: 0})
+
+
+class DependentCountPriorityTests(unittest.TestCase):
+
+    def test_counts_direct_and_indirect_dependents_once(self):
+        a = FakeArtifact('a')
+        b = FakeArtifact('b', dependencies=[a])
+        c = FakeArtifact('c', dependencies=[a])
+        d = FakeArtifact('d', dependencies=[b, c])
+        e = FakeArtifact('e')
+        priorities = distbuild.DependentCountPriority().priorities(
+            [d, c, b, a, e])
+        self.assertEqual(priorities, {a: 3, b: 1, c: 1, d: 0, e: 0})
+
+    def test_ignores_artifacts_not_to_be_built(self):
+        built = FakeArtifact('built')
+        a = FakeArtifact('a', dependencies=[built])
+        b = FakeArtifact('b', dependencies=[a, built])
+        priorities = distbuild.DependentCountPriority().priorities([a, b])
+        self.assertEqual(priorities, {a: 1, b: 0})
+
+
+class CriticalPathPriorityTests(unittest.TestCase):
+
+    def test_adds_up_the_slowest_chain(self):
+        durations = distbuild.BuildDurations()
+        durations.record('chunk.a', 10)
+        durations.record('chunk.b', 50)
+        durations.record('chunk.c', 5)
+        a = FakeArtifact('a')
+        b = FakeArtifact('b', dependencies=[a])
+        c = FakeArtifact('c', dependencies=[a])
+        priorities = distbuild.CriticalPathPriority(durations).priorities(
+            [a, b, c])
+        self.assertEqual(priorities, {a: 60, b: 50, c: 5})
+
+    def test_takes_unknown_builds_to_take_the_average_time(self):
+        durations = distbuild.BuildDurations()
+        durations.record('chunk.a', 10)
+        durations.record('chunk.b', 30)
+        a = FakeArtifact('a')
+        new = FakeArtifact('new', dependencies=[a])
+        priorities = distbuild.CriticalPathPriority(durations).priorities(
+            [a, new])
+        self.assertEqual(priorities, {a: 30, new: 20})
+
+    def test_records_durations(self):
+        durations = distbuild.BuildDurations()
+        policy = distbuild.CriticalPathPriority(durations)
+        policy.record(FakeArtifact('a'), 42)
+        self.assertEqual(durations.get('chunk.a'), 42)
+
+
+class BuildDurationsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'durations.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_average_is_one_second_when_nothing_is_known(self):
+        self.assertEqual(distbuild.BuildDurations().average(), 1)
+
+    def test_keeps_durations_in_file(self):
+        durations = distbuild.BuildDurations(self.filename)
+        durations.record('chunk.a', 12.5)
+        durations.record('chunk.a', 15)
+        again = distbuild.BuildDurations(self.filename)
+        self.assertEqual(again.get('chunk.a'), 15)
+        self.assertEqual(os.listdir(self.tempdir), ['durations.json'])
+
+    def test_ignores_broken_file(self):
+        with open(self.filename, 'w') as f:
+            f.write('{"chunk.a": ')
+        durations = distbuild.BuildDurations(self.filename)
+        self.assertEqual(durations.get('chunk.a'), None)
+
+    def test_ignores_file_which_is_not_a_dict(self):
+        with open(self.filename, 'w') as f:
+            json.dump([1, 2], f)
+        durations = distbuild.BuildDurations(self.filename)
+        self.assertEqual(durations.average(), 1)
+
+    def test_carries_on_if_file_cannot_be_written(self):
+        filename = os.path.join(self.tempdir, 'missing', 'durations.json')
+        durations = distbuild.BuildDurations(filename)
+        durations.record('chunk.a', 3)
+        self.assertEqual(durations.get('chunk.a'), 3)
+
+    def test_leaves_no_temporary_file_if_saving_fails(self):
+        durations = distbuild.BuildDurations(self.filename)
+        self.assertRaises(TypeError, durations.record, 'chunk.a', object())
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+
+class NewBuildPriorityTests(unittest.TestCase):
+
+    def test_creates_each_policy(self):
+        self.assertEqual(
+            type(distbuild.new_build_priority('fifo')),
+            distbuild.FifoPriority)
+        self.assertEqual(
+            type(distbuild.new_build_priority('dependents')),
+            distbuild.DependentCountPriority)
+        policy = distbuild.new_build_priority('critical-path', 'file')
+        self.assertEqual(type(policy), distbuild.CriticalPathPriority)
+        self.assertEqual(policy.durations.filename, 'file')
+
+    def test_rejects_unknown_policy(self):
+        self.assertRaises(ValueError, distbuild.new_build_priority, 'lifo')
+
+
+class JobsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.jobs = Jobs(distbuild.IdentifierGenerator('Job'))
+
+    def take_all(self):
+        names = []
+        while True:
+            job = self.jobs.get_next_job()
+            if job is None:
+                return names
+            job.who = 'worker'
+            names.append(job.artifact.name)
+
+    def test_gives_out_highest_priority_first(self):
+        self.jobs.create(FakeArtifact('a'), 'request', 1)
+        self.jobs.create(FakeArtifact('b'), 'request', 5)
+        self.jobs.create(FakeArtifact('c'), 'request', 3)
+        self.assertEqual(self.take_all(), ['b', 'c', 'a'])
+
+    def test_gives_out_earlier_requests_first_at_same_priority(self):
+        self.jobs.create(FakeArtifact('a1'), 'first', 0)
+        self.jobs.create(FakeArtifact('b1'), 'second', 0)
+        self.jobs.create(FakeArtifact('a2'), 'first', 0)
+        self.jobs.create(FakeArtifact('b2'), 'second', 0)
+        self.assertEqual(self.take_all(), ['a1', 'a2', 'b1', 'b2'])
+
+    def test_raises_priority(self):
+        self.jobs.create(FakeArtifact('a'), 'request', 1)
+        b = self.jobs.create(FakeArtifact('b'), 'request', 0)
+        self.jobs.raise_priority(b, 2)
+        self.jobs.raise_priority(b, 1)
+        self.assertEqual(self.take_all(), ['b', 'a'])
+
+    def test_chooses_among_next_jobs_of_the_same_priority(self):
+        self.jobs.create(FakeArtifact('a'), 'request', 1)
+        self.jobs.create(FakeArtifact('b'), 'request', 1)
+        self.jobs.create(FakeArtifact('c'), 'request', 1)
+        self.jobs.create(FakeArtifact('d'), 'request', 0)
+        scores = {'a': 0, 'b': 2, 'c': 2, 'd': 5}
+        score = lambda job: scores[job.artifact.name]
+        self.assertEqual(self.jobs.get_next_job(score, 4).artifact.name, 'b')
+        self.assertEqual(self.jobs.get_next_job(score, 1).artifact.name, 'a')
+        self.assertEqual(self.take_all(), ['c', 'd'])
+
+    def test_skips_removed_jobs(self):
+        a = self.jobs.create(FakeArtifact('a'), 'request', 1)
+        self.jobs.create(FakeArtifact('b'), 'request', 0)
+        self.jobs.remove(a)
+        self.assertEqual(self.take_all(), ['b'])
+
+
+class MakespanTests(unittest.TestCase):
+
+    '''Simulate a build whose toolchain holds up much of the rest.'''
+
+    def setUp(self):
+        leaves = [FakeArtifact('leaf%d' % i) for i in xrange(12)]
+        toolchain = []
+        for i in xrange(4):
+            toolchain.append(FakeArtifact('tool%d' % i,
+                                          dependencies=toolchain[-1:]))
+        users = [FakeArtifact('user%d' % i, dependencies=toolchain[-1:])
+                 for i in xrange(8)]
+        self.artifacts = leaves + toolchain + users
+        self.durations = dict((a.name, 10) for a in self.artifacts)
+
+    def makespan(self, build_priority):
+        return simulate(self.artifacts, build_priority, 3, self.durations)
+
+    def test_fifo_builds_the_toolchain_late(self):
+        self.assertEqual(self.makespan(distbuild.FifoPriority()), 110)
+
+    def test_dependent_count_builds_the_toolchain_first(self):
+        self.assertEqual(
+            self.makespan(distbuild.DependentCountPriority()), 80)
+
+    def test_critical_path_starts_slow_builds_first(self):
+        # A slow build which nothing depends on is left until last when
+        # counting dependents, and so finishes long after the rest.
+        leaves = [FakeArtifact('leaf%d' % i) for i in xrange(4)]
+        slow = FakeArtifact('slow')
+        first = FakeArtifact('first')
+        second = FakeArtifact('second', dependencies=[first])
+        artifacts = leaves + [slow, first, second]
+        seconds = dict((a.name, 10) for a in artifacts)
+        seconds['slow'] = 50
+
+        durations = distbuild.BuildDurations()
+        for name, value in seconds.iteritems():
+            durations.record('chunk.%s' % name, value)
+        self.assertEqual(
+            simulate(artifacts, distbuild.DependentCountPriority(), 2,
+                     seconds), 70)
+        self.assertEqual(
+            simulate(artifacts, distbuild.CriticalPathPriority(durations),
+                     2, seconds), 60)
@@ -1,6 +1,6 @@
 # distbuild/connection_machine.py -- state machine for connecting to server
 #
-# Copyright (C) 2012, 2014  Codethink Limited
+# Copyright (C) 2012, 2014, 2026  Codethink Limited
 # 
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -39,29 +39,6 @@ class ConnectError(object):
         self.exception = exception
 
 
-class ProxyEventSource(object):
-
-    '''Proxy event sources that may come and go.'''
-
-    def __init__(self):
-        self.event_source = None
-
-    def get_select_params(self):
-        if self.event_source:
-            return self.event_source.get_select_params()
-        else:
-            return [], [], [], None
-            
-    def get_events(self, r, w, x):
-        if self.event_source:
-            return self.event_source.get_events(r, w, x)
-        else:
-            return []
-            
-    def is_finished(self):
-        return False
-
-
 class ConnectionMachine(distbuild.StateMachine):
 
     def __init__(self, addr, port, machine, extra_args,
@@ -77,7 +54,7 @@ class ConnectionMachine(distbuild.StateMachine):
         self._max_retries = max_retries
 
     def setup(self):
-        self._sock_proxy = ProxyEventSource()
+        self._sock_proxy = distbuild.ProxyEventSource()
         self.mainloop.add_event_source(self._sock_proxy)
         self._start_connect()
         
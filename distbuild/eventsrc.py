@@ -1,6 +1,6 @@
 # mainloop/eventsrc.py -- interface for event sources
 #
-# Copyright (C) 2012, 2014  Codethink Limited
+# Copyright (C) 2012, 2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -24,17 +24,41 @@ class EventSource(object):
     
     An event source watches one file descriptor, and returns events
     related to it. The events may vary depending on the file descriptor.
-    The actual watching is done using select.select.
+    The main loop does the actual watching, with epoll where the system
+    has it.
+
+    The main loop asks an event source what to watch with
+    get_select_params on every iteration, and calls its get_events on
+    every iteration, unless the event source sets reports_changes.
+    Then the main loop only asks again after the event source calls
+    changed, and only calls get_events when one of its file
+    descriptors is ready, or its timeout has passed. That keeps the
+    cost of an iteration independent of how many event sources there
+    are.
     
     '''
+
+    reports_changes = False
+
+    # Set by the main loop the event source is added to, if it
+    # reports_changes.
+    on_change = None
+
+    def changed(self):
+        '''Tell the main loop that get_select_params would change.'''
+
+        if self.on_change is not None:
+            self.on_change(self)
     
     def get_select_params(self):
         '''Return parameters to use for select for this event source.
         
-        Three lists of file descriptors, and a timeout are returned.
-        The three lists and the timeout are used as arguments to the 
-        select.select function, though they may be manipulated and
-        combined with return values from other event sources.
+        Three lists of file descriptors, and a timeout are returned:
+        the file descriptors to watch for being readable, writeable,
+        and having exceptional conditions, as for the select.select
+        function, and how many seconds from now get_events should be
+        called anyway, or None. They are combined with the return
+        values from other event sources.
         
         '''
         
@@ -43,7 +67,9 @@ class EventSource(object):
     def get_events(self, r, w, x):
         '''Return events related to this file descriptor.
         
-        The arguments are the return values of select.select.
+        The arguments are collections of the file descriptors which are
+        readable, writeable, and have exceptional conditions, like the
+        return values of select.select.
         
         '''
         
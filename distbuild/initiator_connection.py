@@ -1,6 +1,6 @@
 # distbuild/initiator_connection.py -- communicate with initiator
 #
-# Copyright (C) 2012, 2014  Codethink Limited
+# Copyright (C) 2012, 2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -44,16 +44,27 @@ class InitiatorConnection(distbuild.StateMachine):
     translating messages from the initiator to the rest of the controller's
     state machines, and vice versa.
 
+    Build output can come faster than the initiator reads it. Once
+    max_unsent bytes are waiting to be sent to it, output is held back
+    instead, and sent on, joined into fewer messages, when the initiator
+    has caught up or the build step ends. Only max_held_output bytes
+    are held for each step; older output is dropped for newer.
+
     '''
+
+    max_unsent = 1024 * 1024
+    max_held_output = 256 * 1024
     
     _idgen = distbuild.IdentifierGenerator('InitiatorConnection')
     _route_map = distbuild.RouteMap()
 
-    def __init__(self, conn, artifact_cache_server, morph_instance):
+    def __init__(self, conn, artifact_cache_server, morph_instance,
+                 build_priority=None):
         distbuild.StateMachine.__init__(self, 'idle')
         self.conn = conn
         self.artifact_cache_server = artifact_cache_server
         self.morph_instance = morph_instance
+        self.build_priority = build_priority
         self.initiator_name = conn.remotename()
 
     def __repr__(self):
@@ -65,12 +76,15 @@ class InitiatorConnection(distbuild.StateMachine):
         self.mainloop.add_state_machine(self.jm)
 
         self.our_ids = set()
+        self._held = {}
         
         spec = [
             # state, source, event_class, new_state, callback
             ('idle', self.jm, distbuild.JsonNewMessage, 'idle', 
                 self._handle_msg),
             ('idle', self.jm, distbuild.JsonEof, 'closing', self._disconnect),
+            ('idle', self.jm, distbuild.JsonWritten, 'idle',
+                self._send_held_output_if_caught_up),
             ('idle', distbuild.BuildController, distbuild.BuildFinished,
                 'idle', self._send_build_finished_message),
             ('idle', distbuild.BuildController, distbuild.BuildFailed,
@@ -107,7 +121,7 @@ class InitiatorConnection(distbuild.StateMachine):
             event.msg['id'] = new_id
             build_controller = distbuild.BuildController(
                 self, event.msg, self.artifact_cache_server,
-                self.morph_instance)
+                self.morph_instance, self.build_priority)
             self.mainloop.add_state_machine(build_controller)
 
     def _disconnect(self, event_source, event):
@@ -116,6 +130,7 @@ class InitiatorConnection(distbuild.StateMachine):
                     self.initiator_name, str(id))
             self.mainloop.queue_event(InitiatorConnection,
                                       InitiatorDisconnect(id))
+        self._held = {}
         self.mainloop.queue_event(self, _Close(event_source))
 
     def _close(self, event_source, event):
@@ -138,6 +153,7 @@ class InitiatorConnection(distbuild.StateMachine):
 
     def _send_build_finished_message(self, event_source, event):
         if event.id in self.our_ids:
+            self._send_held_output(event.id)
             msg = distbuild.message('build-finished',
                 id=self._route_map.get_incoming_id(event.id),
                 urls=event.urls)
@@ -148,6 +164,7 @@ class InitiatorConnection(distbuild.StateMachine):
 
     def _send_build_failed_message(self, event_source, event):
         if event.id in self.our_ids:
+            self._send_held_output(event.id)
             msg = distbuild.message('build-failed',
                 id=self._route_map.get_incoming_id(event.id),
                 reason=event.reason)
@@ -214,18 +231,49 @@ class InitiatorConnection(distbuild.StateMachine):
             'id=%s stdout=%s stderr=%s' % 
             (repr(event.id), repr(event.stdout), repr(event.stderr)))
         if event.id in self.our_ids:
-            msg = distbuild.message('step-output',
-                id=self._route_map.get_incoming_id(event.id),
-                step_name=event.step_name,
-                stdout=event.stdout,
-                stderr=event.stderr)
-            self.jm.send(msg)
-            self._log_send(msg)
+            key = (event.id, event.step_name)
+            if key in self._held or self.jm.buffered() >= self.max_unsent:
+                if key not in self._held:
+                    self._held[key] = distbuild.OutputBuffer(
+                        self.max_held_output)
+                self._held[key].add('stdout', event.stdout)
+                self._held[key].add('stderr', event.stderr)
+                if self.jm.buffered() < self.max_unsent:
+                    self._send_held_output()
+            else:
+                self._send_step_output(
+                    event.id, event.step_name, event.stdout, event.stderr)
+
+    def _send_step_output(self, id, step_name, stdout, stderr):
+        msg = distbuild.message('step-output',
+            id=self._route_map.get_incoming_id(id),
+            step_name=step_name,
+            stdout=stdout,
+            stderr=stderr)
+        self.jm.send(msg)
+        self._log_send(msg)
+
+    def _send_held_output(self, id=None, step_name=None):
+        '''Send the output held back for a build or step, or all of it.'''
+
+        for key in self._held.keys():
+            if id is None or (key[0] == id and
+                              step_name in (None, key[1])):
+                for stream, data in self._held.pop(key).take():
+                    if stream == 'stdout':
+                        self._send_step_output(key[0], key[1], data, '')
+                    else:
+                        self._send_step_output(key[0], key[1], '', data)
+
+    def _send_held_output_if_caught_up(self, event_source, event):
+        if self._held and event.buffered < self.max_unsent:
+            self._send_held_output()
 
     def _send_build_step_finished_message(self, event_source, event):
         logging.debug('heard built step finished: event.id: %s our_ids: %s'
             % (str(event.id), str(self.our_ids)))
         if event.id in self.our_ids:
+            self._send_held_output(event.id, event.step_name)
             msg = distbuild.message('step-finished',
                 id=self._route_map.get_incoming_id(event.id),
                 step_name=event.step_name)
@@ -234,6 +282,7 @@ class InitiatorConnection(distbuild.StateMachine):
 
     def _send_build_step_failed_message(self, event_source, event):
         if event.id in self.our_ids:
+            self._send_held_output(event.id, event.step_name)
             msg = distbuild.message('step-failed',
                 id=self._route_map.get_incoming_id(event.id),
                 step_name=event.step_name)
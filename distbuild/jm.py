@@ -1,6 +1,6 @@
 # mainloop/jm.py -- state machine for JSON communication between nodes
 #
-# Copyright (C) 2012, 2014  Codethink Limited
+# Copyright (C) 2012, 2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -23,11 +23,12 @@ import os
 import socket
 import sys
 import yaml
+import zlib
 
 from sm import StateMachine 
 from stringbuffer import StringBuffer
 from sockbuf import (SocketBuffer, SocketBufferNewData, 
-                     SocketBufferEof, SocketError)
+                     SocketBufferEof, SocketBufferWritten, SocketError)
 
 
 class JsonNewMessage(object):
@@ -39,6 +40,18 @@ class JsonNewMessage(object):
 class JsonEof(object):
 
     pass
+
+
+class JsonWritten(object):
+
+    '''Some of what was sent has been written to the other side.
+
+    ``buffered`` is how many bytes are still waiting to be written.
+
+    '''
+
+    def __init__(self, buffered):
+        self.buffered = buffered
     
     
 class _Close2(object):
@@ -46,16 +59,82 @@ class _Close2(object):
     pass
 
 
+def _to_bytes(value):
+    '''Return value with its unicode strings encoded as UTF-8.'''
+
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    elif isinstance(value, list):
+        return [_to_bytes(v) for v in value]
+    elif isinstance(value, dict):
+        return dict((_to_bytes(k), _to_bytes(v)) for k, v in value.iteritems())
+    return value
+
+
+def _from_latin1(value):
+    '''Return value with its unicode strings as the bytes they encode.'''
+
+    if isinstance(value, unicode):
+        return value.encode('latin-1')
+    elif isinstance(value, list):
+        return [_from_latin1(v) for v in value]
+    elif isinstance(value, dict):
+        return dict((_from_latin1(k), _from_latin1(v))
+                    for k, v in value.iteritems())
+    return value
+
+
 class JsonMachine(StateMachine):
 
-    '''A state machine for sending/receiving JSON messages across TCP.'''
+    '''A state machine for sending/receiving JSON messages across TCP.
+
+    Messages are sent as the length of their JSON text, in decimal, a
+    colon, and the text. Strings are sent as Latin-1, so that build
+    output which is not text gets through unchanged, and are received
+    as byte strings.
+
+    If compress is set, and the other side reads them, messages are
+    sent compressed instead: a 'z', then the length and a colon as
+    before, and the JSON text compressed with zlib. There is one zlib
+    stream for each direction of the connection, so each message is
+    compressed using what came before it, which for build output is
+    much like it.
+
+    Peers from before that only read lines of JSON-quoted YAML, so
+    messages are sent like that until the other side is known to read
+    the newer framing. The first message sent says which framings the
+    sender reads, in its FRAMINGS_FIELD field. Any framing is read at
+    any time, as the other side may have sent messages the older way
+    before it learnt that it need not.
+
+    '''
 
     max_buffer = 16 * 1024
 
+    # Whether to send messages compressed, to those who read them. This
+    # costs CPU time, so it is for connections between machines.
+    compress = False
+
+    FRAMINGS_FIELD = '_framings'
+    LENGTH_PREFIXED = 'length-prefixed'
+    ZLIB = 'zlib'
+    FRAMINGS = [LENGTH_PREFIXED, ZLIB]
+
+    # Build output compresses about as well with the fastest setting.
+    _COMPRESSION_LEVEL = 1
+
+    # A length needs no more digits than this.
+    _MAX_LENGTH_DIGITS = 20
+
     def __init__(self, conn):
         StateMachine.__init__(self, 'rw')
         self.conn = conn
         self.debug_json = False
+        self.length_prefixed = False
+        self.peer_zlib = False
+        self._offered = False
+        self._compressor = None
+        self._decompressor = None
 
     def __repr__(self):
         return '<JsonMachine at 0x%x: socket %s, max_buffer %s>' % \
@@ -71,6 +150,7 @@ class JsonMachine(StateMachine):
         spec = [
             # state, source, event_class, new_state, callback
             ('rw', sockbuf, SocketBufferNewData, 'rw', self._parse),
+            ('rw', sockbuf, SocketBufferWritten, 'rw', self._written),
             ('rw', sockbuf, SocketBufferEof, 'w', self._send_eof),
             ('rw', self, _Close2, None, self._really_close),
             
@@ -82,11 +162,36 @@ class JsonMachine(StateMachine):
         '''Send a message to the other side.'''
         if self.debug_json:
             logging.debug('JsonMachine: Sending message %s' % repr(msg))
-        s = json.dumps(yaml.safe_dump(msg))
+        if not self._offered:
+            msg = dict(msg)
+            msg[self.FRAMINGS_FIELD] = self.FRAMINGS
+            self._offered = True
+        if self.length_prefixed:
+            s = json.dumps(_to_bytes(msg), encoding='latin-1',
+                           ensure_ascii=False, separators=(',', ':'))
+            if isinstance(s, unicode):
+                s = s.encode('latin-1')
+            if self.compress and self.peer_zlib:
+                s = self._compress(s)
+                s = 'z%d:%s' % (len(s), s)
+            else:
+                s = '%d:%s' % (len(s), s)
+        else:
+            s = '%s\n' % json.dumps(yaml.safe_dump(msg))
         if self.debug_json:
             logging.debug('JsonMachine: As %s' % repr(s))
-        self.sockbuf.write('%s\n' % s)
+        self.sockbuf.write(s)
     
+    def buffered(self):
+        '''Return how many bytes are waiting to be sent.'''
+        return self.sockbuf.buffered()
+
+    def _compress(self, data):
+        if self._compressor is None:
+            self._compressor = zlib.compressobj(self._COMPRESSION_LEVEL)
+        return (self._compressor.compress(data) +
+                self._compressor.flush(zlib.Z_SYNC_FLUSH))
+
     def close(self):
         '''Tell state machine it should shut down.
         
@@ -103,14 +208,63 @@ class JsonMachine(StateMachine):
         if self.debug_json:
             logging.debug('JsonMachine: Received: %s' % repr(data))
         while True:
+            msg = self._next_message()
+            if msg is None:
+                break
+            self.mainloop.queue_event(self, JsonNewMessage(msg))
+
+    def _next_message(self):
+        '''Return the next whole message received, or None.'''
+
+        first = self.receive_buf.read(1)
+        if first == '':
+            return None
+        elif first == '"':
             line = self.receive_buf.readline()
             if line is None:
-                break
+                return None
             line = line.rstrip()
             if self.debug_json:
                 logging.debug('JsonMachine: line: %s' % repr(line))
             msg = yaml.load(json.loads(line))
-            self.mainloop.queue_event(self, JsonNewMessage(msg))
+            return self._read_framings(msg)
+
+        start = 1 if first == 'z' else 0
+        head = self.receive_buf.read(start + self._MAX_LENGTH_DIGITS + 1)
+        colon = head.find(':')
+        if colon == -1:
+            if len(head) > start + self._MAX_LENGTH_DIGITS:
+                raise ValueError('Bad message length: %r' % head)
+            return None
+        length = int(head[start:colon])
+        end = colon + 1 + length
+        data = self.receive_buf.read(end)
+        if len(data) < end:
+            return None
+        self.receive_buf.remove(end)
+        text = data[colon + 1:]
+        # The other side would not send this unless it could read it.
+        self.length_prefixed = True
+        if start:
+            self.peer_zlib = True
+            if self._decompressor is None:
+                self._decompressor = zlib.decompressobj()
+            text = self._decompressor.decompress(text)
+        msg = _from_latin1(json.loads(text, encoding='latin-1'))
+        return self._read_framings(msg)
+
+    def _read_framings(self, msg):
+        '''Note which framings the other side reads, if msg says.'''
+
+        framings = msg.pop(self.FRAMINGS_FIELD, [])
+        if self.LENGTH_PREFIXED in framings:
+            self.length_prefixed = True
+        if self.ZLIB in framings:
+            self.peer_zlib = True
+        return msg
+
+    def _written(self, event_source, event):
+        self.mainloop.queue_event(self, JsonWritten(event.buffered))
 
     def _send_eof(self, event_source, event):
         self.mainloop.queue_event(self, JsonEof())
@@ -118,4 +272,3 @@ class JsonMachine(StateMachine):
     def _really_close(self, event_source, event):
         self.sockbuf.close()
         self._send_eof(event_source, event)
-
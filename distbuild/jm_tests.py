@@ -0,0 +1,314 @@
+# distbuild/jm_tests.py -- unit tests for JsonMachine
+#
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import json
+import socket
+import time
+import unittest
+
+import yaml
+import zlib
+
+import distbuild
+
+
+class Receiver(distbuild.StateMachine):
+
+    def __init__(self, jm):
+        distbuild.StateMachine.__init__(self, 'open')
+        self.jm = jm
+        self.messages = []
+        self.written = []
+        self.eof = False
+
+    def setup(self):
+        self.add_transitions([
+            ('open', self.jm, distbuild.JsonNewMessage, 'open',
+                self._received),
+            ('open', self.jm, distbuild.JsonWritten, 'open',
+                self._written),
+            ('open', self.jm, distbuild.JsonEof, None, self._eof),
+        ])
+
+    def _received(self, event_source, event):
+        self.messages.append(event.msg)
+
+    def _written(self, event_source, event):
+        self.written.append(event.buffered)
+
+    def _eof(self, event_source, event):
+        self.eof = True
+
+
+class JsonMachineTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = distbuild.MainLoop()
+        # Keep the loop from waiting for long for nothing.
+        self.timer = distbuild.TimerEventSource(0.01)
+        self.loop.add_event_source(self.timer)
+        self.timer.start()
+        self.sockets = []
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+
+    def run_until(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition():
+            self.assertTrue(time.time() < deadline, 'timed out')
+            self.loop._run_once()
+
+    def machine(self, sock):
+        distbuild.set_nonblocking(sock)
+        jm = distbuild.JsonMachine(sock)
+        self.loop.add_state_machine(jm)
+        receiver = Receiver(jm)
+        self.loop.add_state_machine(receiver)
+        return jm, receiver
+
+    def pair(self):
+        a, b = socket.socketpair()
+        self.sockets.extend([a, b])
+        return self.machine(a) + self.machine(b)
+
+    def old_peer(self):
+        '''Return a JsonMachine and a socket to talk to it the older way.'''
+
+        a, b = socket.socketpair()
+        self.sockets.extend([a, b])
+        b.settimeout(5)
+        return self.machine(a) + (b,)
+
+    def old_line(self, msg):
+        return '%s\n' % json.dumps(yaml.safe_dump(msg))
+
+    def read_lines(self, sock, count):
+        data = ''
+        while data.count('\n') < count:
+            self.loop._run_once()
+            data += sock.recv(4096)
+        return [yaml.load(json.loads(line)) for line in data.splitlines()]
+
+    def test_sends_messages_to_the_other_side(self):
+        a, a_received, b, b_received = self.pair()
+        a.send({'type': 'hello', 'n': 1})
+        a.send({'type': 'hello', 'n': 2})
+        self.run_until(lambda: len(b_received.messages) == 2)
+        self.assertEqual(b_received.messages,
+                         [{'type': 'hello', 'n': 1},
+                          {'type': 'hello', 'n': 2}])
+
+    def test_frames_messages_by_length_once_both_sides_can(self):
+        a, a_received, b, b_received = self.pair()
+        a.send({'type': 'request'})
+        self.run_until(lambda: b_received.messages)
+        self.assertTrue(b.length_prefixed)
+        self.assertFalse(a.length_prefixed)
+
+        b.send({'type': 'response'})
+        self.run_until(lambda: a_received.messages)
+        self.assertTrue(a.length_prefixed)
+        self.assertEqual(a_received.messages, [{'type': 'response'}])
+
+        a.send({'type': 'request', 'n': 2})
+        self.run_until(lambda: len(b_received.messages) == 2)
+        self.assertEqual(b_received.messages[1], {'type': 'request', 'n': 2})
+
+    def test_reads_messages_sent_the_older_way_after_newer_ones(self):
+        a, a_received, b, b_received = self.pair()
+        a.send({'type': 'first'})
+        self.run_until(lambda: b.length_prefixed)
+        b.send({'type': 'second'})
+        a.send({'type': 'third'})
+        self.run_until(lambda: a_received.messages and
+                               len(b_received.messages) == 2)
+        self.assertEqual(b_received.messages[1], {'type': 'third'})
+
+    def test_keeps_bytes_which_are_not_text(self):
+        a, a_received, b, b_received = self.pair()
+        a.send({'type': 'hello'})
+        self.run_until(lambda: b.length_prefixed)
+        msg = {'type': 'exec-output', 'stdout': 'caf\xc3\xa9 \xff\x00\n',
+               'argv': [u'caf\xe9'], u'key': {'x': [1, None, True]}}
+        b.send(msg)
+        self.run_until(lambda: a_received.messages)
+        [received] = a_received.messages
+        self.assertEqual(received['stdout'], 'caf\xc3\xa9 \xff\x00\n')
+        self.assertEqual(type(received['stdout']), str)
+        self.assertEqual(received['argv'], ['caf\xc3\xa9'])
+        self.assertEqual(received['key'], {'x': [1, None, True]})
+
+    def test_reads_messages_which_arrive_in_pieces(self):
+        jm, received, sock = self.old_peer()
+        line = self.old_line(
+            {'type': 'hello', jm.FRAMINGS_FIELD: [jm.LENGTH_PREFIXED]})
+        sock.sendall(line[:10])
+        self.loop._run_once()
+        sock.sendall(line[10:])
+        self.run_until(lambda: received.messages)
+        self.assertEqual(received.messages, [{'type': 'hello'}])
+
+        payload = json.dumps({'type': 'output', 'stdout': 'x' * 100})
+        data = '%d:%s' % (len(payload), payload)
+        for i in xrange(len(data)):
+            sock.sendall(data[i])
+            self.loop._run_once()
+        self.run_until(lambda: len(received.messages) == 2)
+        self.assertEqual(received.messages[1]['stdout'], 'x' * 100)
+
+    def test_talks_to_an_older_peer_the_older_way(self):
+        jm, received, sock = self.old_peer()
+        sock.sendall(self.old_line({'type': 'request'}))
+        self.run_until(lambda: received.messages)
+        self.assertEqual(received.messages, [{'type': 'request'}])
+
+        jm.send({'type': 'response', 'n': 1})
+        jm.send({'type': 'response', 'n': 2})
+        first, second = self.read_lines(sock, 2)
+        self.assertEqual(first, {'type': 'response', 'n': 1,
+                                 jm.FRAMINGS_FIELD: jm.FRAMINGS})
+        self.assertEqual(second, {'type': 'response', 'n': 2})
+        self.assertFalse(jm.length_prefixed)
+
+    def test_rejects_a_bad_length(self):
+        jm, received, sock = self.old_peer()
+        sock.sendall('1' * 30)
+        self.assertRaises(ValueError, self.run_until, lambda: False)
+
+    def test_rejects_a_bad_length_of_a_compressed_message(self):
+        jm, received, sock = self.old_peer()
+        sock.sendall('z' + '1' * 30)
+        self.assertRaises(ValueError, self.run_until, lambda: False)
+
+    def test_compresses_messages_when_asked_to_and_both_sides_can(self):
+        a, a_received, b, b_received = self.pair()
+        a.compress = b.compress = True
+        a.send({'type': 'request'})
+        self.run_until(lambda: b_received.messages)
+        b.send({'type': 'response'})
+        self.run_until(lambda: a_received.messages)
+        self.assertTrue(a.peer_zlib)
+        self.assertTrue(b.peer_zlib)
+
+        lines = ''.join('line %d\n' % i for i in xrange(100000))
+        chunks = [lines[i:i + 64 * 1024]
+                  for i in xrange(0, len(lines), 64 * 1024)]
+        for chunk in chunks:
+            b.send({'type': 'exec-output', 'stdout': chunk})
+        a.send({'type': 'done'})
+        self.run_until(lambda: len(a_received.messages) == 1 + len(chunks)
+                               and len(b_received.messages) == 2)
+        self.assertEqual(
+            ''.join(msg['stdout'] for msg in a_received.messages[1:]),
+            lines)
+        self.assertEqual(b_received.messages[1], {'type': 'done'})
+
+    def read_frame(self, sock):
+        '''Return the next length-prefixed frame sent to sock.'''
+
+        data = ''
+        while ':' not in data:
+            self.loop._run_once()
+            data += sock.recv(4096)
+        head, rest = data.split(':', 1)
+        while len(rest) < int(head.lstrip('z')):
+            self.loop._run_once()
+            rest += sock.recv(4096)
+        return head, rest
+
+    def test_sends_less_when_compressing(self):
+        jm, received, sock = self.old_peer()
+        jm.compress = True
+        sock.sendall(self.old_line(
+            {'type': 'hello', jm.FRAMINGS_FIELD: jm.FRAMINGS}))
+        self.run_until(lambda: received.messages)
+        jm.send({'type': 'exec-output', 'stdout': 'x' * 100000})
+
+        head, data = self.read_frame(sock)
+        self.assertTrue(head.startswith('z'))
+        self.assertTrue(len(data) < 1000)
+        self.assertEqual(json.loads(zlib.decompressobj().decompress(data)),
+                         {'type': 'exec-output', 'stdout': 'x' * 100000,
+                          jm.FRAMINGS_FIELD: jm.FRAMINGS})
+
+    def test_does_not_compress_for_a_peer_which_cannot_read_it(self):
+        jm, received, sock = self.old_peer()
+        jm.compress = True
+        sock.sendall(self.old_line(
+            {'type': 'hello', jm.FRAMINGS_FIELD: [jm.LENGTH_PREFIXED]}))
+        self.run_until(lambda: received.messages)
+        self.assertFalse(jm.peer_zlib)
+        jm.send({'type': 'response'})
+
+        head, data = self.read_frame(sock)
+        self.assertTrue(head.isdigit())
+        self.assertEqual(json.loads(data)['type'], 'response')
+
+    def test_counts_what_is_waiting_to_be_sent(self):
+        jm, received, sock = self.old_peer()
+        self.assertEqual(jm.buffered(), 0)
+        sock.sendall(self.old_line(
+            {'type': 'hello', jm.FRAMINGS_FIELD: jm.FRAMINGS}))
+        self.run_until(lambda: received.messages)
+        jm.send({'type': 'output', 'stdout': 'x' * (8 * 1024 * 1024)})
+        for i in xrange(10):
+            self.loop._run_once()
+        self.assertTrue(0 < jm.buffered() < 8 * 1024 * 1024)
+
+        sock.setblocking(False)
+        while jm.buffered() > 0:
+            self.loop._run_once()
+            try:
+                sock.recv(1024 * 1024)
+            except socket.error:
+                pass
+
+    def test_tells_how_much_is_waiting_as_it_is_written(self):
+        jm, received, sock = self.old_peer()
+        sock.sendall(self.old_line(
+            {'type': 'hello', jm.FRAMINGS_FIELD: jm.FRAMINGS}))
+        self.run_until(lambda: received.messages)
+        jm.send({'type': 'output', 'stdout': 'x' * (8 * 1024 * 1024)})
+
+        sock.setblocking(False)
+        def drained():
+            try:
+                sock.recv(1024 * 1024)
+            except socket.error:
+                pass
+            return received.written and received.written[-1] == 0
+        self.run_until(drained)
+        self.assertTrue(len(received.written) > 1)
+        self.assertEqual(received.written, sorted(received.written,
+                                                  reverse=True))
+
+    def test_tells_of_the_end_of_the_connection(self):
+        a, a_received, b, b_received = self.pair()
+        a.close()
+        self.run_until(lambda: a_received.eof and b_received.eof)
+
+    def test_logs_what_it_sends_and_receives_when_debugging(self):
+        a, a_received, b, b_received = self.pair()
+        a.debug_json = b.debug_json = True
+        self.assertTrue(repr(a).startswith('<JsonMachine at 0x'))
+        a.send({'type': 'request'})
+        self.run_until(lambda: b_received.messages)
+        b.send({'type': 'response'})
+        self.run_until(lambda: a_received.messages)
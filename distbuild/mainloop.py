@@ -1,6 +1,6 @@
-# mainloop/mainloop.py -- select-based main loop
+# mainloop/mainloop.py -- epoll-based main loop
 #
-# Copyright (C) 2012, 2014  Codethink Limited
+# Copyright (C) 2012, 2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -16,100 +16,300 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
 
 
-import fcntl
+import collections
+import errno
+import itertools
 import logging
-import os
 import select
+import time
+
+
+class Poller(object):
+
+    '''Persistent registrations of file descriptors to wait for.
+
+    This uses epoll where the system has it, and poll elsewhere, so
+    unlike select.select, the file descriptors are not passed in again
+    on every call, and there is no limit on their number.
+
+    '''
+
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self._poll = select.epoll()
+            self.READ = select.EPOLLIN
+            self.WRITE = select.EPOLLOUT
+            self.EXCEPT = select.EPOLLPRI
+            self.ERROR = select.EPOLLERR | select.EPOLLHUP
+            self._epoll = True
+        else: # pragma: no cover
+            self._poll = select.poll()
+            self.READ = select.POLLIN
+            self.WRITE = select.POLLOUT
+            self.EXCEPT = select.POLLPRI
+            self.ERROR = select.POLLERR | select.POLLHUP | select.POLLNVAL
+            self._epoll = False
+
+    def register(self, fd, mask):
+        '''Watch fd for the events in mask, instead of any others.'''
+
+        # The kernel forgets the registration of a file descriptor which
+        # was closed, and the number may have been reused since.
+        try:
+            self._poll.modify(fd, mask)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            self._poll.register(fd, mask)
+
+    def unregister(self, fd):
+        try:
+            self._poll.unregister(fd)
+        except (IOError, KeyError), e:
+            if getattr(e, 'errno', errno.ENOENT) not in (errno.ENOENT,
+                                                         errno.EBADF):
+                raise
+
+    def poll(self, timeout):
+        '''Wait up to timeout seconds, or forever if it is None.
+
+        Return a list of (fd, events) pairs.
+
+        '''
+
+        if self._epoll:
+            return self._poll.poll(-1 if timeout is None else timeout)
+        else: # pragma: no cover
+            return self._poll.poll(
+                None if timeout is None else timeout * 1000)
 
 
 class MainLoop(object):
 
-    '''A select-based main loop.
-    
-    The main loop watches a set of file descriptors wrapped in 
+    '''An epoll-based main loop.
+
+    The main loop watches a set of file descriptors wrapped in
     EventSource objects, and when something happens with them,
     asks the EventSource objects to create events, which it then
     feeds into user-supplied state machines. The state machines
-    can create further events, which are processed further.
-    
+    can create further events, which are processed further, in the
+    order they were created. Each event is only given to the state
+    machines which have a transition for its source and class.
+
     When nothing is happening, the main loop sleeps in the
-    select.select call.
-    
+    epoll_wait system call. The file descriptors stay registered with
+    it between iterations, and only change when an event source's
+    select parameters do.
+
     '''
 
     def __init__(self):
-        self._machines = []
-        self._sources = []
-        self._events = []
+        self._machines = collections.OrderedDict()
+        self._sources = collections.OrderedDict()
+        self._events = collections.deque()
         self.dump_filename = None
-        
+
+        # The machines to give events to, by event source and class.
+        self._routes = {}
+        self._machine_routes = {}
+
+        self._poller = Poller()
+        self._order = itertools.count()
+        # The sources which must be asked for their select parameters on
+        # every iteration, and those which asked to be asked again.
+        self._polled = collections.OrderedDict()
+        self._changed = set()
+        # What each source is watching, by source and by fd.
+        self._watching = {}
+        self._watchers = {}
+        # The objects each source gave for each file descriptor, which
+        # it is given back when they are ready, as select.select does.
+        self._objects = {}
+        self._masks = {}
+        self._deadlines = {}
+
     def add_state_machine(self, machine):
         logging.debug('MainLoop.add_state_machine: %s' % machine)
         machine.mainloop = self
         machine.setup()
-        self._machines.append(machine)
+        self._machines[machine] = next(self._order)
+        for event_source, event_class in machine.event_routes():
+            self.deliver_events(machine, event_source, event_class)
         if self.dump_filename:
-            filename = '%s%s.dot' % (self.dump_filename, 
+            filename = '%s%s.dot' % (self.dump_filename,
                                      machine.__class__.__name__)
             machine.dump_dot(filename)
-        
+
     def remove_state_machine(self, machine):
         logging.debug('MainLoop.remove_state_machine: %s' % machine)
-        self._machines.remove(machine)
-    
+        if machine not in self._machines:
+            raise ValueError('%r is not in the main loop' % machine)
+        del self._machines[machine]
+        for key in self._machine_routes.pop(machine, ()):
+            machines = self._routes[key]
+            machines.discard(machine)
+            if not machines:
+                del self._routes[key]
+
+    def deliver_events(self, machine, event_source, event_class):
+        '''Give events of event_class from event_source to machine.
+
+        This is called for each transition a machine has, when it is
+        added, and when it adds transitions afterwards.
+
+        '''
+
+        key = (event_source, event_class)
+        self._routes.setdefault(key, set()).add(machine)
+        self._machine_routes.setdefault(machine, set()).add(key)
+
     def add_event_source(self, event_source):
         logging.debug('MainLoop.add_event_source: %s' % event_source)
-        self._sources.append(event_source)
-    
+        self._sources[event_source] = next(self._order)
+        if getattr(event_source, 'reports_changes', False):
+            event_source.on_change = self._changed.add
+            self._changed.add(event_source)
+        else:
+            self._polled[event_source] = None
+
     def remove_event_source(self, event_source):
         logging.debug('MainLoop.remove_event_source: %s' % event_source)
-        self._sources.remove(event_source)
-    
-    def _setup_select(self):
-        r = []
-        w = []
-        x = []
-        timeout = None
+        if event_source not in self._sources:
+            raise ValueError('%r is not in the main loop' % event_source)
+        del self._sources[event_source]
+        self._polled.pop(event_source, None)
+        self._changed.discard(event_source)
+        if getattr(event_source, 'on_change', None) == self._changed.add:
+            event_source.on_change = None
+        self._watch(event_source, [], [], [], None)
 
-        self._sources = [s for s in self._sources if not s.is_finished()]
-        
-        for event_source in self._sources:
-            sr, sw, sx, st = event_source.get_select_params()
-            r.extend(sr)
-            w.extend(sw)
-            x.extend(sx)
-            if timeout is None:
-                timeout = st
-            elif st is not None:
-                timeout = min(timeout, st)
+    def _watch(self, event_source, r, w, x, timeout):
+        '''Change what is watched for event_source, if it has changed.'''
 
-        return r, w, x, timeout
+        if timeout is None:
+            self._deadlines.pop(event_source, None)
+        else:
+            self._deadlines[event_source] = time.time() + timeout
 
-    def _run_once(self):
-        r, w, x, timeout = self._setup_select()
-        assert r or w or x or timeout is not None
-        r, w, x = select.select(r, w, x, timeout)
+        masks = {}
+        objects = {}
+        for fds, flag in ((r, self._poller.READ), (w, self._poller.WRITE),
+                          (x, self._poller.EXCEPT)):
+            for obj in fds:
+                fd = obj if isinstance(obj, (int, long)) else obj.fileno()
+                masks[fd] = masks.get(fd, 0) | flag
+                if obj is not fd:
+                    objects.setdefault(fd, set()).add(obj)
+        if objects:
+            self._objects[event_source] = objects
+        else:
+            self._objects.pop(event_source, None)
+        old = self._watching.pop(event_source, {})
+        if masks:
+            self._watching[event_source] = masks
+        if masks == old:
+            return
+
+        for fd in set(old).union(masks):
+            watchers = self._watchers.setdefault(fd, {})
+            if fd in masks:
+                watchers[event_source] = masks[fd]
+            else:
+                watchers.pop(event_source, None)
+            mask = 0
+            for watcher_mask in watchers.itervalues():
+                mask |= watcher_mask
+            # A file descriptor which is newly watched may be a new file
+            # with the number of one which was closed, and which the
+            # kernel has forgotten about, so it is registered anyway.
+            newly_watched = fd in masks and fd not in old
+            if mask != self._masks.get(fd) or newly_watched:
+                if mask:
+                    self._poller.register(fd, mask)
+                    self._masks[fd] = mask
+                else:
+                    self._poller.unregister(fd)
+                    self._masks.pop(fd, None)
+                    del self._watchers[fd]
+
+    def _update_watches(self):
+        for event_source in list(self._polled):
+            if event_source.is_finished():
+                self.remove_event_source(event_source)
+            else:
+                self._watch(event_source,
+                            *event_source.get_select_params())
 
-        for event_source in self._sources:
+        while self._changed:
+            event_source = self._changed.pop()
             if event_source.is_finished():
                 self.remove_event_source(event_source)
             else:
-                for event in event_source.get_events(r, w, x):
-                    self.queue_event(event_source, event)
+                self._watch(event_source,
+                            *event_source.get_select_params())
+
+    def _run_once(self):
+        self._update_watches()
+        timeout = None
+        if self._deadlines:
+            timeout = max(0, min(self._deadlines.itervalues()) - time.time())
+        assert self._masks or timeout is not None
+        ready = self._poller.poll(timeout)
+
+        r = set()
+        w = set()
+        x = set()
+        sources = set(self._polled)
+        for fd, mask in ready:
+            watching = self._masks.get(fd, 0)
+            # select.select says a file descriptor with an error, or
+            # which has been hung up on, is readable and writeable.
+            if mask & self._poller.ERROR:
+                mask |= watching & (self._poller.READ | self._poller.WRITE)
+            given = [fd]
+            for event_source in self._watchers.get(fd, ()):
+                given.extend(self._objects.get(event_source, {}).get(fd, ()))
+                sources.add(event_source)
+            if mask & self._poller.READ:
+                r.update(given)
+            if mask & self._poller.WRITE:
+                w.update(given)
+            if mask & self._poller.EXCEPT:
+                x.update(given)
+        if self._deadlines:
+            now = time.time()
+            sources.update(event_source for event_source, deadline
+                           in self._deadlines.iteritems() if deadline <= now)
+
+        for event_source in sorted(sources, key=self._sources.get):
+            if event_source not in self._sources:
+                continue
+            if event_source.is_finished():
+                self.remove_event_source(event_source)
+                continue
+            for event in event_source.get_events(r, w, x):
+                self.queue_event(event_source, event)
+            # Its timeout has passed, so it has a new one now.
+            if event_source in self._deadlines and \
+                    event_source not in self._polled:
+                self._changed.add(event_source)
 
         for event_source, event in self._dequeue_events():
-            for machine in self._machines[:]:
+            machines = self._routes.get((event_source, event.__class__))
+            if not machines:
+                continue
+            for machine in sorted(machines, key=self._machines.get):
                 for new_event in machine.handle_event(event_source, event):
                     self.queue_event(event_source, new_event)
-                if machine.state is None:
+                if machine.state is None and machine in self._machines:
                     self.remove_state_machine(machine)
 
     def run(self):
         '''Run the main loop.
-        
+
         The main loop terminates when there are no state machines to
         run anymore.
-        
+
         '''
 
         logging.debug('MainLoop starts')
@@ -119,11 +319,11 @@ class MainLoop(object):
 
     def queue_event(self, event_source, event):
         '''Add an event to queue of events to be processed.'''
-        
+
         self._events.append((event_source, event))
 
     def _dequeue_events(self):
         while self._events:
-            event_source, event = self._events.pop(0)
+            event_source, event = self._events.popleft()
 
             yield event_source, event
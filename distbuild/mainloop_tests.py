@@ -0,0 +1,404 @@
+# distbuild/mainloop_tests.py -- unit tests for MainLoop
+#
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import errno
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+import distbuild
+from distbuild.mainloop import Poller
+
+
+class Ready(object):
+
+    def __init__(self, r, w, x):
+        self.r = r
+        self.w = w
+        self.x = x
+
+
+class Other(object):
+
+    pass
+
+
+class WatchingEventSource(distbuild.EventSource):
+
+    '''Watch whatever it is told to, and say what was ready.'''
+
+    def __init__(self, r=(), w=(), x=(), timeout=None):
+        self.r = list(r)
+        self.w = list(w)
+        self.x = list(x)
+        self.timeout = timeout
+        self.finished = False
+        self.params_asked = 0
+        self.ready = []
+
+    def get_select_params(self):
+        self.params_asked += 1
+        return self.r, self.w, self.x, self.timeout
+
+    def get_events(self, r, w, x):
+        self.ready.append((set(r), set(w), set(x)))
+        return [Ready(r, w, x)]
+
+    def is_finished(self):
+        return self.finished
+
+
+class ChangingEventSource(WatchingEventSource):
+
+    reports_changes = True
+
+
+class Recorder(distbuild.StateMachine):
+
+    '''Record the events of a class from a source.'''
+
+    def __init__(self, event_source, event_class=Ready, stop=False):
+        distbuild.StateMachine.__init__(self, 'listening')
+        self.event_source = event_source
+        self.event_class = event_class
+        self.stop = stop
+        self.events = []
+
+    def setup(self):
+        self.add_transitions([
+            ('listening', self.event_source, self.event_class,
+                None if self.stop else 'listening', self._record),
+        ])
+
+    def _record(self, event_source, event):
+        self.events.append(event)
+
+
+class PollerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.poller = Poller()
+        self.r, self.w = os.pipe()
+
+    def tearDown(self):
+        for fd in (self.r, self.w):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def test_waits_for_the_events_registered(self):
+        self.poller.register(self.r, self.poller.READ)
+        self.assertEqual(self.poller.poll(0), [])
+        os.write(self.w, 'x')
+        self.assertEqual(self.poller.poll(None),
+                         [(self.r, self.poller.READ)])
+
+    def test_changes_the_events_of_a_registered_fd(self):
+        self.poller.register(self.w, self.poller.READ)
+        self.assertEqual(self.poller.poll(0), [])
+        self.poller.register(self.w, self.poller.WRITE)
+        self.assertEqual(self.poller.poll(0),
+                         [(self.w, self.poller.WRITE)])
+
+    def test_stops_waiting_for_an_unregistered_fd(self):
+        self.poller.register(self.w, self.poller.WRITE)
+        self.poller.unregister(self.w)
+        self.assertEqual(self.poller.poll(0), [])
+
+    def test_ignores_unregistering_an_fd_which_is_not_registered(self):
+        self.poller.unregister(self.r)
+
+    def test_ignores_unregistering_an_fd_which_was_closed(self):
+        self.poller.register(self.r, self.poller.READ)
+        os.close(self.r)
+        self.poller.unregister(self.r)
+
+    def test_registers_a_new_file_with_the_number_of_a_closed_one(self):
+        self.poller.register(self.w, self.poller.READ)
+        r, w = os.pipe()
+        self.addCleanup(os.close, r)
+        os.close(self.w)
+        os.dup2(w, self.w)
+        os.close(w)
+        self.poller.register(self.w, self.poller.WRITE)
+        self.assertEqual(self.poller.poll(0),
+                         [(self.w, self.poller.WRITE)])
+
+    def test_raises_error_registering_an_fd_which_is_not_open(self):
+        os.close(self.r)
+        self.assertRaises(IOError, self.poller.register, self.r,
+                          self.poller.READ)
+
+    def test_raises_unexpected_errors_unregistering(self):
+        class BrokenPoll(object):
+            def unregister(self, fd):
+                raise IOError(errno.EINVAL, os.strerror(errno.EINVAL))
+        self.poller._poll = BrokenPoll()
+        self.assertRaises(IOError, self.poller.unregister, self.r)
+
+
+class MainLoopTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = distbuild.MainLoop()
+        self.r, self.w = os.pipe()
+        self.files = []
+
+    def tearDown(self):
+        for f in self.files:
+            f.close()
+        for fd in (self.r, self.w):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def fdopen(self, fd, mode):
+        f = os.fdopen(os.dup(fd), mode, 0)
+        self.files.append(f)
+        return f
+
+    def add(self, event_source, *machines):
+        self.loop.add_event_source(event_source)
+        for machine in machines:
+            self.loop.add_state_machine(machine)
+
+    def test_gives_back_the_file_objects_a_source_watches(self):
+        f = self.fdopen(self.r, 'rb')
+        source = WatchingEventSource(r=[f])
+        self.add(source, Recorder(source))
+        os.write(self.w, 'x')
+        self.loop._run_once()
+        r, w, x = source.ready[-1]
+        self.assertTrue(f in r)
+        self.assertEqual(w, set())
+        self.assertEqual(x, set())
+
+    def test_gives_back_the_fd_numbers_a_source_watches(self):
+        source = WatchingEventSource(w=[self.w])
+        self.add(source, Recorder(source))
+        self.loop._run_once()
+        self.assertEqual(source.ready[-1], (set(), set([self.w]), set()))
+
+    def test_gives_back_each_object_watched_for_the_same_fd(self):
+        f = self.fdopen(self.w, 'wb')
+        source = WatchingEventSource(w=[f])
+        other = WatchingEventSource(w=[self.w])
+        self.add(source, Recorder(source))
+        self.add(other, Recorder(other))
+        self.loop._run_once()
+        self.assertTrue(f in source.ready[-1][1])
+        self.assertTrue(self.w in other.ready[-1][1])
+
+    def test_says_a_hung_up_pipe_is_readable(self):
+        f = self.fdopen(self.r, 'rb')
+        source = WatchingEventSource(r=[f])
+        self.add(source, Recorder(source))
+        os.close(self.w)
+        self.loop._run_once()
+        self.assertTrue(f in source.ready[-1][0])
+        self.assertEqual(f.read(), '')
+
+    def test_reports_exceptional_conditions(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(listener.close)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        sender = socket.create_connection(listener.getsockname())
+        self.addCleanup(sender.close)
+        receiver, addr = listener.accept()
+        self.addCleanup(receiver.close)
+        sender.send('!', socket.MSG_OOB)
+
+        source = WatchingEventSource(x=[receiver])
+        self.add(source, Recorder(source))
+        self.loop._run_once()
+        self.assertTrue(receiver in source.ready[-1][2])
+
+    def test_only_gives_events_to_machines_which_handle_them(self):
+        source = WatchingEventSource(w=[self.w])
+        ready = Recorder(source)
+        other = Recorder(source, Other)
+        elsewhere = Recorder(WatchingEventSource())
+        self.add(source, ready, other, elsewhere)
+        self.loop._run_once()
+        self.assertEqual(len(ready.events), 1)
+        self.assertEqual(other.events, [])
+        self.assertEqual(elsewhere.events, [])
+
+    def test_gives_events_to_transitions_added_later(self):
+        source = WatchingEventSource(w=[self.w])
+        machine = Recorder(WatchingEventSource())
+        self.add(source, machine)
+        machine.add_transition('listening', source, Ready, 'listening',
+                               machine._record)
+        self.loop._run_once()
+        self.assertEqual(len(machine.events), 1)
+
+    def test_gives_events_queued_by_machines_to_other_machines(self):
+        source = WatchingEventSource(w=[self.w])
+        relay = distbuild.StateMachine('relaying')
+        relay.add_transition('relaying', source, Ready, 'relaying',
+                             lambda event_source, event: [Other()])
+        recorder = Recorder(source, Other)
+        self.add(source, relay, recorder)
+        self.loop._run_once()
+        self.assertEqual(len(recorder.events), 1)
+
+    def test_removes_machines_which_stop(self):
+        source = WatchingEventSource(w=[self.w])
+        machine = Recorder(source, stop=True)
+        self.add(source, machine)
+        self.loop._run_once()
+        self.assertEqual(len(machine.events), 1)
+        self.assertRaises(ValueError, self.loop.remove_state_machine,
+                          machine)
+
+    def test_stops_giving_events_to_removed_machines(self):
+        source = WatchingEventSource(w=[self.w])
+        machine = Recorder(source)
+        other = Recorder(source)
+        self.add(source, machine, other)
+        self.loop.remove_state_machine(machine)
+        self.loop._run_once()
+        self.assertEqual(machine.events, [])
+        self.assertEqual(len(other.events), 1)
+
+    def test_runs_until_there_are_no_machines(self):
+        source = WatchingEventSource(w=[self.w])
+        machine = Recorder(source, stop=True)
+        self.add(source, machine)
+        self.loop.run()
+        self.assertEqual(len(machine.events), 1)
+
+    def test_drops_events_no_machine_handles(self):
+        source = WatchingEventSource(w=[self.w])
+        machine = Recorder(source, Other)
+        self.add(source, machine)
+        self.loop._run_once()
+        self.assertEqual(len(source.ready), 1)
+        self.assertEqual(machine.events, [])
+
+    def test_skips_sources_removed_by_an_earlier_one(self):
+        class RemovingEventSource(WatchingEventSource):
+            def get_events(this, r, w, x):
+                self.loop.remove_event_source(other)
+                return WatchingEventSource.get_events(this, r, w, x)
+        source = RemovingEventSource(w=[self.w])
+        other = WatchingEventSource(w=[self.w])
+        self.add(source, Recorder(source))
+        self.add(other, Recorder(other))
+        self.loop._run_once()
+        self.assertEqual(len(source.ready), 1)
+        self.assertEqual(other.ready, [])
+
+    def test_keeps_watching_an_fd_another_source_still_wants(self):
+        source = WatchingEventSource(w=[self.w])
+        other = WatchingEventSource(w=[self.w])
+        self.add(source, Recorder(source))
+        self.add(other, Recorder(other))
+        self.loop._run_once()
+        self.loop.remove_event_source(other)
+        self.loop._run_once()
+        self.assertEqual(len(source.ready), 2)
+        self.assertEqual(source.ready[-1], (set(), set([self.w]), set()))
+
+    def test_refuses_to_remove_an_unknown_event_source(self):
+        self.assertRaises(ValueError, self.loop.remove_event_source,
+                          WatchingEventSource())
+
+    def test_stops_watching_removed_event_sources(self):
+        source = WatchingEventSource(w=[self.w])
+        other = WatchingEventSource(timeout=0)
+        self.add(source, Recorder(source))
+        self.add(other, Recorder(other))
+        self.loop._run_once()
+        self.loop.remove_event_source(source)
+        self.loop._run_once()
+        self.assertEqual(len(source.ready), 1)
+
+    def test_removes_finished_event_sources(self):
+        source = WatchingEventSource(w=[self.w])
+        other = WatchingEventSource(timeout=0)
+        self.add(source, Recorder(source))
+        self.add(other, Recorder(other))
+        source.finished = True
+        self.loop._run_once()
+        self.assertEqual(source.ready, [])
+        self.assertRaises(ValueError, self.loop.remove_event_source, source)
+
+    def test_removes_sources_which_finish_while_they_are_watched(self):
+        class FinishingEventSource(WatchingEventSource):
+            def get_select_params(self):
+                self.finished = self.params_asked > 0
+                return WatchingEventSource.get_select_params(self)
+        source = FinishingEventSource(w=[self.w])
+        self.add(source, Recorder(source))
+        self.loop._update_watches()
+        self.loop._run_once()
+        self.assertEqual(source.ready, [])
+        self.assertRaises(ValueError, self.loop.remove_event_source, source)
+
+    def test_stops_watching_an_fd_no_source_wants(self):
+        source = WatchingEventSource(w=[self.w], timeout=0)
+        self.add(source, Recorder(source))
+        self.loop._run_once()
+        source.w = []
+        self.loop._run_once()
+        self.assertEqual(source.ready[-1], (set(), set(), set()))
+
+    def test_calls_sources_back_once_their_timeout_passes(self):
+        source = ChangingEventSource(timeout=0)
+        self.add(source, Recorder(source))
+        self.loop._run_once()
+        self.loop._run_once()
+        self.assertEqual(len(source.ready), 2)
+        self.assertEqual(source.params_asked, 2)
+
+    def test_only_asks_changing_sources_again_after_they_change(self):
+        source = ChangingEventSource(w=[self.w])
+        self.add(source, Recorder(source))
+        self.loop._run_once()
+        self.loop._run_once()
+        self.assertEqual(source.params_asked, 1)
+        source.changed()
+        self.loop._run_once()
+        self.assertEqual(source.params_asked, 2)
+        self.assertEqual(len(source.ready), 3)
+
+    def test_removes_finished_changing_sources_when_they_change(self):
+        source = ChangingEventSource(w=[self.w])
+        other = WatchingEventSource(timeout=0)
+        self.add(source, Recorder(source))
+        self.add(other, Recorder(other))
+        source.finished = True
+        source.changed()
+        self.loop._run_once()
+        self.assertEqual(source.ready, [])
+        self.assertEqual(source.on_change, None)
+
+    def test_writes_dot_files_of_machines_when_asked(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        self.loop.dump_filename = os.path.join(tempdir, 'dump-')
+        source = WatchingEventSource()
+        self.add(source, Recorder(source))
+        self.assertEqual(os.listdir(tempdir), ['dump-Recorder.dot'])
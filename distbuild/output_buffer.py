@@ -0,0 +1,92 @@
+# distbuild/output_buffer.py -- build output waiting to be sent on
+#
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import time
+
+
+class OutputBuffer(object):
+
+    '''Build output waiting to be sent on.
+
+    Output is kept as runs of what was written to each stream, in the
+    order it was written. Consecutive output on the same stream is
+    joined, so that each run can be sent on as one message, rather
+    than as many as there were reads.
+
+    If max_size is given, no more than that many bytes are kept: the
+    oldest output is dropped to make room, and a note of how much was
+    dropped is put in its place.
+
+    '''
+
+    DROPPED_NOTE = ('[%d bytes of build output were dropped, as they '
+                    'could not be sent on fast enough]\n')
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+
+        # When the oldest output still held was added, or None.
+        self.since = None
+
+        self._runs = []
+        self._size = 0
+        self._dropped = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, stream, data):
+        '''Add data written to stream, which is stdout or stderr.'''
+
+        if not data:
+            return
+        if self.since is None:
+            self.since = time.time()
+        if self._runs and self._runs[-1][0] == stream:
+            self._runs[-1][1].append(data)
+        else:
+            self._runs.append((stream, [data]))
+        self._size += len(data)
+        if self.max_size is not None and self._size > self.max_size:
+            self._drop(self._size - self.max_size)
+
+    def _drop(self, excess):
+        while excess > 0:
+            stream, pieces = self._runs[0]
+            n = min(len(pieces[0]), excess)
+            if n == len(pieces[0]):
+                del pieces[0]
+                if not pieces:
+                    del self._runs[0]
+            else:
+                pieces[0] = pieces[0][n:]
+            self._size -= n
+            self._dropped += n
+            excess -= n
+
+    def take(self):
+        '''Return the output as a list of (stream, data), and forget it.'''
+
+        runs = [(stream, ''.join(pieces)) for stream, pieces in self._runs]
+        if self._dropped:
+            runs.insert(0, ('stderr', self.DROPPED_NOTE % self._dropped))
+        self._runs = []
+        self._size = 0
+        self._dropped = 0
+        self.since = None
+        return runs
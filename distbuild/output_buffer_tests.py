@@ -0,0 +1,236 @@
+# distbuild/output_buffer_tests.py -- unit tests for OutputBuffer
+#
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import os
+import socket
+import subprocess
+import sys
+import time
+import unittest
+
+import distbuild
+
+
+class OutputBufferTests(unittest.TestCase):
+
+    def setUp(self):
+        self.output = distbuild.OutputBuffer()
+
+    def test_is_empty_at_first(self):
+        self.assertEqual(len(self.output), 0)
+        self.assertEqual(self.output.since, None)
+        self.assertEqual(self.output.take(), [])
+
+    def test_joins_output_on_the_same_stream(self):
+        self.output.add('stdout', 'foo')
+        self.output.add('stdout', 'bar')
+        self.assertEqual(len(self.output), 6)
+        self.assertEqual(self.output.take(), [('stdout', 'foobar')])
+
+    def test_keeps_the_order_of_output_on_different_streams(self):
+        self.output.add('stdout', 'a')
+        self.output.add('stderr', 'b')
+        self.output.add('stderr', 'c')
+        self.output.add('stdout', 'd')
+        self.assertEqual(self.output.take(),
+                         [('stdout', 'a'), ('stderr', 'bc'), ('stdout', 'd')])
+
+    def test_ignores_no_output(self):
+        self.output.add('stdout', '')
+        self.assertEqual(self.output.since, None)
+        self.assertEqual(self.output.take(), [])
+
+    def test_knows_when_the_oldest_output_came(self):
+        before = time.time()
+        self.output.add('stdout', 'foo')
+        since = self.output.since
+        self.assertTrue(before <= since <= time.time())
+        self.output.add('stdout', 'bar')
+        self.assertEqual(self.output.since, since)
+
+    def test_forgets_what_is_taken(self):
+        self.output.add('stdout', 'foo')
+        self.output.take()
+        self.assertEqual(len(self.output), 0)
+        self.assertEqual(self.output.since, None)
+        self.assertEqual(self.output.take(), [])
+
+    def test_drops_the_oldest_output_beyond_max_size(self):
+        output = distbuild.OutputBuffer(max_size=5)
+        output.add('stdout', 'abc')
+        output.add('stderr', 'de')
+        self.assertEqual(len(output), 5)
+        output.add('stderr', 'fgh')
+        self.assertEqual(len(output), 5)
+        self.assertEqual(output.take(),
+                         [('stderr', output.DROPPED_NOTE % 3),
+                          ('stderr', 'defgh')])
+
+    def test_drops_part_of_a_piece_of_output(self):
+        output = distbuild.OutputBuffer(max_size=4)
+        output.add('stdout', 'abc')
+        output.add('stdout', 'de')
+        self.assertEqual(output.take(),
+                         [('stderr', output.DROPPED_NOTE % 1),
+                          ('stdout', 'bcde')])
+
+    def test_keeps_a_bounded_tail_of_a_lot_of_output(self):
+        output = distbuild.OutputBuffer(max_size=1024)
+        lines = ['line %d\n' % i for i in xrange(100000)]
+        for line in lines:
+            output.add('stdout', line)
+            self.assertTrue(len(output) <= 1024)
+        data = ''.join(lines)
+        note, (stream, tail) = output.take()
+        self.assertEqual(note,
+                         ('stderr', output.DROPPED_NOTE % (len(data) - 1024)))
+        self.assertEqual(tail, data[-1024:])
+
+
+class Parent(distbuild.StateMachine):
+
+    '''Stand in for the worker daemon a distbuild-helper talks to.'''
+
+    def __init__(self, conn):
+        distbuild.StateMachine.__init__(self, 'open')
+        self.conn = conn
+        self.messages = []
+
+    def setup(self):
+        self.jm = distbuild.JsonMachine(self.conn)
+        self.mainloop.add_state_machine(self.jm)
+        self.add_transitions([
+            ('open', self.jm, distbuild.JsonNewMessage, 'open',
+                self._received),
+        ])
+
+    def _received(self, event_source, event):
+        self.messages.append(event.msg)
+
+    def of_type(self, msg_type):
+        return [msg for msg in self.messages if msg['type'] == msg_type]
+
+
+class HelperOutputTests(unittest.TestCase):
+
+    '''Run commands with a lot of output in a distbuild-helper.'''
+
+    def setUp(self):
+        self.loop = distbuild.MainLoop()
+        self.timer = distbuild.TimerEventSource(0.01)
+        self.loop.add_event_source(self.timer)
+        self.timer.start()
+
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+
+        helper = os.path.join(
+            os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            'distbuild-helper')
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(sys.path)
+        self.helper = subprocess.Popen(
+            [sys.executable, helper, '--no-default-configs',
+             '--parent-address=127.0.0.1',
+             '--parent-port=%d' % listener.getsockname()[1]],
+            env=env)
+        listener.settimeout(30)
+        conn, addr = listener.accept()
+        listener.close()
+        distbuild.set_nonblocking(conn)
+        self.conn = conn
+        self.parent = Parent(conn)
+        self.loop.add_state_machine(self.parent)
+
+    def tearDown(self):
+        self.conn.close()
+        self.helper.kill()
+        self.helper.wait()
+
+    def run_until(self, condition, timeout=60):
+        deadline = time.time() + timeout
+        while not condition():
+            self.assertTrue(time.time() < deadline, 'timed out')
+            self.loop._run_once()
+
+    def run_command(self, script):
+        self.run_until(lambda: self.parent.of_type('helper-ready'))
+        self.parent.jm.send({
+            'type': 'exec-request',
+            'id': 'job',
+            'argv': [sys.executable, '-c', script],
+            'stdin_contents': '',
+        })
+        self.run_until(lambda: self.parent.of_type('exec-response'))
+        [response] = self.parent.of_type('exec-response')
+        self.assertEqual(response['exit'], 0)
+        return self.parent.of_type('exec-output')
+
+    def test_sends_a_lot_of_output_in_few_messages(self):
+        outputs = self.run_command(
+            'import sys\n'
+            'for i in xrange(200000):\n'
+            '    sys.stdout.write("line %d\\n" % i)\n'
+            '    sys.stdout.flush()\n'
+            'sys.stderr.write("done\\n")\n')
+
+        expected = ''.join('line %d\n' % i for i in xrange(200000))
+        self.assertEqual(''.join(msg['stdout'] for msg in outputs), expected)
+        self.assertEqual(''.join(msg['stderr'] for msg in outputs), 'done\n')
+        batch_size = 64 * 1024
+        self.assertTrue(len(outputs) <= len(expected) / batch_size + 2)
+        response = self.parent.of_type('exec-response')[0]
+        self.assertTrue(
+            self.parent.messages.index(outputs[-1]) <
+            self.parent.messages.index(response))
+
+    def test_keeps_the_order_of_output_on_different_streams(self):
+        outputs = self.run_command(
+            'import sys, time\n'
+            'for i in xrange(3):\n'
+            '    sys.stdout.write("out %d\\n" % i)\n'
+            '    sys.stdout.flush()\n'
+            '    time.sleep(0.1)\n'
+            '    sys.stderr.write("err %d\\n" % i)\n'
+            '    time.sleep(0.1)\n')
+
+        self.assertEqual(
+            [(msg['stdout'], msg['stderr']) for msg in outputs],
+            [('out 0\n', ''), ('', 'err 0\n'),
+             ('out 1\n', ''), ('', 'err 1\n'),
+             ('out 2\n', ''), ('', 'err 2\n')])
+
+    def test_sends_a_little_output_before_the_command_ends(self):
+        self.run_until(lambda: self.parent.of_type('helper-ready'))
+        self.parent.jm.send({
+            'type': 'exec-request',
+            'id': 'job',
+            'argv': [sys.executable, '-c',
+                     'import sys, time\n'
+                     'sys.stdout.write("hello\\n")\n'
+                     'sys.stdout.flush()\n'
+                     'time.sleep(30)\n'],
+            'stdin_contents': '',
+        })
+        self.run_until(lambda: self.parent.of_type('exec-output'), 10)
+        self.assertEqual(self.parent.of_type('exec-output')[0]['stdout'],
+                         'hello\n')
+        self.assertEqual(self.parent.of_type('exec-response'), [])
+        self.parent.jm.send({'type': 'exec-cancel', 'id': 'job'})
+        self.run_until(lambda: self.parent.of_type('exec-response'))
@@ -1,6 +1,6 @@
 # distbuild/proxy_event_source.py -- proxy for temporary event sources
 #
-# Copyright (C) 2012, 2014  Codethink Limited
+# Copyright (C) 2012, 2014, 2026  Codethink Limited
 # 
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -16,19 +16,35 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
 
 
-import errno
-import logging
-import socket
+from eventsrc import EventSource
 
-import distbuild
 
+class ProxyEventSource(EventSource):
 
-class ProxyEventSource(object):
+    '''Proxy event sources that may come and go.
 
-    '''Proxy event sources that may come and go.'''
+    The event sources it stands in for must report their changes, as
+    SocketEventSource does.
+
+    '''
+
+    reports_changes = True
 
     def __init__(self):
-        self.event_source = None
+        self._event_source = None
+
+    @property
+    def event_source(self):
+        return self._event_source
+
+    @event_source.setter
+    def event_source(self, event_source):
+        if self._event_source is not None:
+            self._event_source.on_change = None
+        self._event_source = event_source
+        if event_source is not None:
+            event_source.on_change = lambda source: self.changed()
+        self.changed()
 
     def get_select_params(self):
         if self.event_source:
@@ -44,4 +60,3 @@ class ProxyEventSource(object):
             
     def is_finished(self):
         return False
-
@@ -1,6 +1,6 @@
 # distbuild/serialise.py -- (de)serialise Artifact object graphs
 #
-# Copyright (C) 2012, 2014  Codethink Limited
+# Copyright (C) 2012, 2014, 2026  Codethink Limited
 # 
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -23,8 +23,13 @@ import morphlib
 import logging
 
 
-def serialise_artifact(artifact):
-    '''Serialise an Artifact object and its dependencies into string form.'''
+# The artifact graph encoding serialise_artifact produces by default.
+# Version 1 is the YAML one which workers which do not say which they
+# can read expect.
+GRAPH_VERSION = 2
+
+
+def _serialise_yaml(artifact):
 
     def encode_morphology(morphology):
         result = {}
@@ -114,16 +119,145 @@ def serialise_artifact(artifact):
     return json.dumps(yaml.dump(content))
 
 
-def deserialise_artifact(encoded):
-    '''Re-construct the Artifact object (and dependencies).
-    
-    The argument should be a string returned by ``serialise_artifact``.
-    The reconstructed Artifact objects will be sufficiently like the
-    originals that they can be used as a build graph, and other such
-    purposes, by Morph.
-    
+def serialise_artifact(artifact, version=GRAPH_VERSION):
+    '''Serialise an Artifact object and its dependencies into string form.
+
+    Only what building artifact needs is included: the artifacts it
+    depends on, directly or not, the other artifacts of their sources,
+    and the strata which depend on any of them. Each source and
+    morphology is encoded once, and referred to by where it is in a
+    list. The result is one line of JSON.
+
+    If version is 1, the older encoding is used, for workers which
+    cannot read any other.
+
     '''
 
+    if version == 1:
+        return _serialise_yaml(artifact)
+    elif version != GRAPH_VERSION:
+        raise ValueError('Unknown artifact graph version %r' % version)
+
+    sources = []
+    source_indexes = {}
+    artifacts = []
+    artifact_indexes = {}
+    morphologies = []
+    morphology_indexes = {}
+
+    def add_source(source):
+        source_indexes[id(source)] = len(sources)
+        sources.append(source)
+        if id(source.morphology) not in morphology_indexes:
+            morphology_indexes[id(source.morphology)] = len(morphologies)
+            morphologies.append(source.morphology)
+
+    for a in artifact.walk():
+        if id(a.source) not in source_indexes:
+            add_source(a.source)
+            for sa in a.source.artifacts.itervalues():
+                artifact_indexes[id(sa)] = len(artifacts)
+                artifacts.append(sa)
+    built = len(sources)
+
+    # The builder only looks at the sources which depend on what it
+    # installs to tell which stratum each is in, so the strata are all
+    # which are needed of those not in the graph already.
+    for a in artifacts:
+        for source in a.dependents:
+            if id(source) not in source_indexes and \
+                    source.morphology['kind'] == 'stratum':
+                add_source(source)
+
+    def encode_source(source, prune_leaf):
+        source_dic = {
+            'name': source.name,
+            'repo_name': source.repo_name,
+            'original_ref': source.original_ref,
+            'sha1': source.sha1,
+            'tree': source.tree,
+            'morphology': morphology_indexes[id(source.morphology)],
+            'filename': source.filename,
+            'artifacts': [],
+            'cache_id': source.cache_id,
+            'cache_key': source.cache_key,
+            'dependencies': [],
+        }
+        if not prune_leaf:
+            source_dic['artifacts'].extend(
+                artifact_indexes[id(a)] for a in source.artifacts.itervalues())
+            source_dic['dependencies'].extend(
+                artifact_indexes[id(d)] for d in source.dependencies)
+
+        if source.morphology['kind'] == 'chunk':
+            source_dic['build_mode'] = source.build_mode
+            source_dic['prefix'] = source.prefix
+        return source_dic
+
+    def encode_artifact(a):
+        return {
+            'source': source_indexes[id(a.source)],
+            'name': a.name,
+            'dependents': [source_indexes[id(s)] for s in a.dependents
+                           if id(s) in source_indexes],
+        }
+
+    if artifact.source.morphology['kind'] == 'system': # pragma: no cover
+        arch = artifact.source.morphology['arch']
+    else:
+        arch = artifact.arch
+
+    content = {
+        'version': GRAPH_VERSION,
+        'root': artifact_indexes[id(artifact)],
+        'arch': arch,
+        'morphologies': [dict((k, m[k]) for k in m.keys())
+                         for m in morphologies],
+        'sources': [encode_source(s, i >= built)
+                    for i, s in enumerate(sources)],
+        'artifacts': [encode_artifact(a) for a in artifacts],
+        'default_split_rules': {
+            'chunk': morphlib.artifactsplitrule.DEFAULT_CHUNK_RULES,
+            'stratum': morphlib.artifactsplitrule.DEFAULT_STRATUM_RULES,
+        },
+    }
+    return json.dumps(content, separators=(',', ':'))
+
+
+def _decode_source(le_dict, morphology, split_rules):
+    '''Convert a dict into a Source object.'''
+
+    source = morphlib.source.Source(le_dict['name'],
+                                    le_dict['repo_name'],
+                                    le_dict['original_ref'],
+                                    le_dict['sha1'],
+                                    le_dict['tree'],
+                                    morphology,
+                                    le_dict['filename'],
+                                    split_rules)
+
+    if morphology['kind'] == 'chunk':
+        source.build_mode = le_dict['build_mode']
+        source.prefix = le_dict['prefix']
+    source.cache_id = le_dict['cache_id']
+    source.cache_key = le_dict['cache_key']
+    return source
+
+
+def _split_rules(morphology, default_split_rules):
+    '''Return the split rules of a source with morphology.'''
+
+    kind = morphology['kind']
+    ruler = getattr(morphlib.artifactsplitrule, 'unify_%s_matches' % kind)
+    if kind in ('chunk', 'stratum'):
+        return ruler(morphology, default_split_rules[kind])
+    else: # pragma: no cover
+        return ruler(morphology)
+
+
+def _deserialise_yaml(encoded):
+    '''Re-construct an Artifact graph encoded with version 1.'''
+
     def decode_morphology(le_dict):
         '''Convert a dict into something that kinda acts like a Morphology.
         
@@ -134,25 +268,6 @@ def deserialise_artifact(encoded):
         
         return morphlib.morphology.Morphology(le_dict)
 
-    def decode_source(le_dict, morphology, split_rules):
-        '''Convert a dict into a Source object.'''
-
-        source = morphlib.source.Source(le_dict['name'],
-                                        le_dict['repo_name'],
-                                        le_dict['original_ref'],
-                                        le_dict['sha1'],
-                                        le_dict['tree'],
-                                        morphology,
-                                        le_dict['filename'],
-                                        split_rules)
-
-        if morphology['kind'] == 'chunk':
-            source.build_mode = le_dict['build_mode']
-            source.prefix = le_dict['prefix']
-        source.cache_id =  le_dict['cache_id']
-        source.cache_key = le_dict['cache_key']
-        return source
-        
     def decode_artifact(artifact_dict, source):
         '''Convert dict into an Artifact object.
         
@@ -166,7 +281,7 @@ def deserialise_artifact(encoded):
 
         return artifact
 
-    le_dicts = yaml.load(json.loads(encoded))
+    le_dicts = yaml.load(encoded)
     artifacts_dict = le_dicts['artifacts']
     sources_dict = le_dicts['sources']
     morphologies_dict = le_dicts['morphologies']
@@ -181,13 +296,8 @@ def deserialise_artifact(encoded):
     # Decode sources
     for source_id, source_dict in sources_dict.iteritems():
         morphology = morphologies[source_dict['morphology']]
-        kind = morphology['kind']
-        ruler = getattr(morphlib.artifactsplitrule, 'unify_%s_matches' % kind)
-        if kind in ('chunk', 'stratum'):
-            rules = ruler(morphology, le_dicts['default_split_rules'][kind])
-        else: # pragma: no cover
-            rules = ruler(morphology)
-        sources[source_id] = decode_source(source_dict, morphology, rules)
+        rules = _split_rules(morphology, le_dicts['default_split_rules'])
+        sources[source_id] = _decode_source(source_dict, morphology, rules)
 
     # decode artifacts
     for artifact_id, artifact_dict in artifacts_dict.iteritems():
@@ -215,3 +325,72 @@ def deserialise_artifact(encoded):
                                for sid in artifact_dict['dependents']]
 
     return artifacts[root_artifact]
+
+
+def _str(value):
+    '''Return value with its ASCII strings as str, as YAML gives them.'''
+
+    if isinstance(value, unicode):
+        try:
+            return value.encode('ascii')
+        except UnicodeEncodeError:
+            return value
+    elif isinstance(value, list):
+        return [_str(v) for v in value]
+    elif isinstance(value, dict):
+        return dict((_str(k), _str(v)) for k, v in value.iteritems())
+    return value
+
+
+def deserialise_artifact(encoded):
+    '''Re-construct the Artifact object (and dependencies).
+    
+    The argument should be a string returned by ``serialise_artifact``,
+    of either version. The reconstructed Artifact objects will be
+    sufficiently like the originals that they can be used as a build
+    graph, and other such purposes, by Morph. ValueError is raised if
+    the string is not one serialise_artifact returns.
+    
+    '''
+
+    content = json.loads(encoded)
+    if isinstance(content, basestring):
+        return _deserialise_yaml(content)
+    if not isinstance(content, dict) or \
+            content.get('version') != GRAPH_VERSION:
+        raise ValueError('Unknown artifact graph encoding')
+    content = _str(content)
+
+    morphologies = [morphlib.morphology.Morphology(d)
+                    for d in content['morphologies']]
+
+    # Sources with the same morphology have the same split rules.
+    split_rules = {}
+    sources = []
+    for source_dict in content['sources']:
+        index = source_dict['morphology']
+        morphology = morphologies[index]
+        if index not in split_rules:
+            split_rules[index] = _split_rules(
+                morphology, content['default_split_rules'])
+        sources.append(
+            _decode_source(source_dict, morphology, split_rules[index]))
+
+    artifacts = []
+    for artifact_dict in content['artifacts']:
+        artifact = morphlib.artifact.Artifact(
+            sources[artifact_dict['source']], artifact_dict['name'])
+        artifact.arch = content['arch']
+        artifacts.append(artifact)
+
+    for source, source_dict in zip(sources, content['sources']):
+        source.artifacts = dict((artifacts[i].name, artifacts[i])
+                                for i in source_dict['artifacts'])
+        source.dependencies = [artifacts[i]
+                               for i in source_dict['dependencies']]
+
+    for artifact, artifact_dict in zip(artifacts, content['artifacts']):
+        artifact.dependents = [sources[i]
+                               for i in artifact_dict['dependents']]
+
+    return artifacts[content['root']]
@@ -1,6 +1,6 @@
 # distbuild/serialise_tests.py -- unit tests for Artifact serialisation
 #
-# Copyright (C) 2012, 2014  Codethink Limited
+# Copyright (C) 2012, 2014, 2026  Codethink Limited
 # 
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -16,6 +16,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
 
 
+import json
 import unittest
 
 import distbuild
@@ -130,25 +131,58 @@ class SerialisationTests(unittest.TestCase):
             self.assertEqualArtifacts(a.source.dependencies[i],
                                       b.source.dependencies[i])
 
+    def assertEqualGraphs(self, a, b):
+        self.assertEqualArtifacts(a, b)
+        self.assertEqual(a.arch, b.arch)
+        self.assertEqual(getattr(a.source, 'build_mode', None),
+                         getattr(b.source, 'build_mode', None))
+        self.assertEqual(getattr(a.source, 'prefix', None),
+                         getattr(b.source, 'prefix', None))
+        self.assertEqual(sorted(a.source.split_rules.artifacts),
+                         sorted(b.source.split_rules.artifacts))
+        self.assertEqual(sorted(s.cache_key for s in a.dependents),
+                         sorted(s.cache_key for s in b.dependents))
+        for i in range(len(a.source.dependencies)):
+            self.assertEqualGraphs(a.source.dependencies[i],
+                                   b.source.dependencies[i])
+
     def verify_round_trip(self, artifact):
-        encoded = distbuild.serialise_artifact(artifact)
-        decoded = distbuild.deserialise_artifact(encoded)
-        self.assertEqualArtifacts(artifact, decoded)
-        
-        objs = {}
-        queue = [decoded]
-        while queue:
-            obj = queue.pop()
-            k = obj.source.cache_key
-            if k in objs:
-                self.assertTrue(obj is objs[k])
-            else:
-                objs[k] = obj
-            queue.extend(obj.source.dependencies)
+        for version in (1, distbuild.GRAPH_VERSION):
+            encoded = distbuild.serialise_artifact(artifact, version)
+            decoded = distbuild.deserialise_artifact(encoded)
+            self.assertEqualArtifacts(artifact, decoded)
+
+            objs = {}
+            queue = [decoded]
+            while queue:
+                obj = queue.pop()
+                k = obj.source.cache_key
+                if k in objs:
+                    self.assertTrue(obj is objs[k])
+                else:
+                    objs[k] = obj
+                queue.extend(obj.source.dependencies)
+
+        older = distbuild.deserialise_artifact(
+            distbuild.serialise_artifact(artifact, 1))
+        self.assertEqualGraphs(older, decoded)
+
+    def depend(self, artifact, *dependencies):
+        artifact.source.dependencies = list(dependencies)
+        for dependency in dependencies:
+            dependency.dependents.append(artifact.source)
 
     def test_returns_string(self):
+        for version in (1, distbuild.GRAPH_VERSION):
+            encoded = distbuild.serialise_artifact(self.art1, version)
+            self.assertEqual(type(encoded), str)
+
+    def test_returns_one_line_of_json(self):
+        self.depend(self.art1, self.art2)
         encoded = distbuild.serialise_artifact(self.art1)
-        self.assertEqual(type(encoded), str)
+        self.assertFalse('\n' in encoded)
+        self.assertEqual(json.loads(encoded)['version'],
+                         distbuild.GRAPH_VERSION)
 
     def test_works_without_dependencies(self):
         self.verify_round_trip(self.art1)
@@ -172,3 +206,43 @@ class SerialisationTests(unittest.TestCase):
         self.art1.source.dependencies = [self.art2, self.art3]
         self.verify_round_trip(self.art1)
 
+    def test_works_with_dependents(self):
+        self.depend(self.art2, self.art4)
+        self.depend(self.art3, self.art4)
+        self.depend(self.art1, self.art2, self.art3)
+        self.verify_round_trip(self.art1)
+
+    def test_encodes_a_shared_morphology_once(self):
+        self.art3.source.morphology = self.art2.source.morphology
+        self.depend(self.art1, self.art2, self.art3)
+        encoded = distbuild.serialise_artifact(self.art1)
+        self.assertEqual(len(json.loads(encoded)['morphologies']), 2)
+        decoded = distbuild.deserialise_artifact(encoded)
+        a2, a3 = decoded.source.dependencies
+        self.assertTrue(a2.source.morphology is a3.source.morphology)
+        self.assertTrue(a2.source.split_rules is a3.source.split_rules)
+
+    def test_keeps_only_strata_of_dependents_outside_the_graph(self):
+        self.depend(self.art3, self.art2)
+        self.depend(self.art1, self.art2)
+        decoded = distbuild.deserialise_artifact(
+            distbuild.serialise_artifact(self.art2))
+        [stratum] = decoded.dependents
+        self.assertEqual(stratum.cache_key, self.art1.source.cache_key)
+        self.assertEqual(stratum.morphology['kind'], 'stratum')
+        self.assertEqual((stratum.artifacts, stratum.dependencies), ({}, []))
+
+    def test_keeps_strings_which_are_not_ascii(self):
+        self.art1.source.sha1 = u'caf\xe9'
+        decoded = distbuild.deserialise_artifact(
+            distbuild.serialise_artifact(self.art1))
+        self.assertEqual(decoded.source.sha1, u'caf\xe9')
+        self.assertEqual(type(decoded.source.tree), str)
+
+    def test_rejects_an_unknown_version(self):
+        self.assertRaises(ValueError, distbuild.serialise_artifact,
+                          self.art1, distbuild.GRAPH_VERSION + 1)
+        for encoded in ['{"version": %d}' % (distbuild.GRAPH_VERSION + 1),
+                        '[]']:
+            self.assertRaises(ValueError, distbuild.deserialise_artifact,
+                              encoded)
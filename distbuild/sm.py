@@ -1,6 +1,6 @@
 # mainloop/sm.py -- state machine abstraction
 #
-# Copyright (C) 2012, 2014  Codethink Limited
+# Copyright (C) 2012, 2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -47,6 +47,9 @@ class StateMachine(object):
     state to None.
     
     '''
+
+    # Set when the machine is added to a main loop.
+    mainloop = None
     
     def __init__(self, initial_state):
         self._transitions = {}
@@ -76,6 +79,8 @@ class StateMachine(object):
         assert key not in self._transitions, \
             'Transition %s already registered' % str(key)
         self._transitions[key] = (new_state, callback)
+        if self.mainloop is not None:
+            self.mainloop.deliver_events(self, source, event_class)
 
     def add_transitions(self, specification):
         '''Add many transitions.
@@ -89,6 +94,18 @@ class StateMachine(object):
         for t in specification:
             self.add_transition(*t)
     
+    def event_routes(self):
+        '''Return the event sources and classes the machine handles.
+
+        This is a set of (event_source, event_class) pairs, one for
+        each combination there is a transition for, in any state. The
+        main loop only gives the machine events which match one.
+
+        '''
+
+        return set((source, event_class)
+                   for state, source, event_class in self._transitions)
+
     def handle_event(self, event_source, event):
         '''Handle a given event.
         
@@ -1,6 +1,6 @@
 # distbuild/sm_tests.py -- unit tests for state machine abstraction
 #
-# Copyright (C) 2012, 2014  Codethink Limited
+# Copyright (C) 2012, 2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -31,6 +31,15 @@ class DummyEvent(object):
     pass
 
 
+class DummyMainLoop(object):
+
+    def __init__(self):
+        self.routes = []
+
+    def deliver_events(self, machine, event_source, event_class):
+        self.routes.append((machine, event_source, event_class))
+
+
 class StateMachineTests(unittest.TestCase):
 
     def setUp(self):
@@ -96,3 +105,21 @@ class StateMachineTests(unittest.TestCase):
         self.assertEqual(self.event_sources, [self.event_source])
         self.assertEqual(self.events, [self.event])
 
+    def test_lists_the_events_it_handles_in_any_state(self):
+        other_source = DummyEventSource()
+        spec = [
+            ('init', self.event_source, DummyEvent, 'next', None),
+            ('next', self.event_source, DummyEvent, 'init', None),
+            ('next', other_source, str, None, None),
+        ]
+        self.sm.add_transitions(spec)
+        self.assertEqual(self.sm.event_routes(),
+                         set([(self.event_source, DummyEvent),
+                              (other_source, str)]))
+
+    def test_tells_its_main_loop_about_new_transitions(self):
+        mainloop = self.sm.mainloop = DummyMainLoop()
+        self.sm.add_transition('init', self.event_source, DummyEvent,
+                               'init', None)
+        self.assertEqual(mainloop.routes,
+                         [(self.sm, self.event_source, DummyEvent)])
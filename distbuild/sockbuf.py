@@ -1,6 +1,6 @@
 # mainloop/sockbuf.py -- a buffering, non-blocking socket I/O state machine
 #
-# Copyright (C) 2012, 2014  Codethink Limited
+# Copyright (C) 2012, 2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -37,6 +37,9 @@ is also generated if there is an error while doing I/O with the socket.
 * SocketBufferEof: socket buffer has reached EOF for reading, but
   still writes anything in the write buffer (or anything that gets added
   to the write buffer)
+* SocketBufferWritten: socket buffer has written some of its write
+  buffer to the socket; how much is still waiting is available as the
+  ``buffered`` attribute
 * SocketBufferClosed: socket is now closed
 
 The state machine starts shutting down when ``close`` method is called,
@@ -70,6 +73,14 @@ class SocketBufferEof(object):
     '''
 
 
+class SocketBufferWritten(object):
+
+    '''Socket buffer has written some of its write buffer.'''
+
+    def __init__(self, buffered):
+        self.buffered = buffered
+
+
 class SocketBufferClosed(object):
 
     '''Socket buffer has closed its socket.'''
@@ -134,6 +145,10 @@ class SocketBuffer(StateMachine):
             self._start_writing(None, None)
             self.mainloop.queue_event(self, _WriteBufferNotEmpty())
 
+    def buffered(self):
+        '''Return how many bytes are waiting to be written.'''
+        return len(self._wbuf)
+
     def close(self):
         '''Tell state machine to terminate.'''
         self.mainloop.queue_event(self, _Close())
@@ -169,6 +184,7 @@ class SocketBuffer(StateMachine):
                 '%s: _flush(): Exception %s from sock.write()', self, e)
             return [SocketError(event.sock, e)]
         self._wbuf.remove(n)
+        self.mainloop.queue_event(self, SocketBufferWritten(len(self._wbuf)))
         if len(self._wbuf) == 0:
             self.mainloop.queue_event(self, _WriteBufferIsEmpty())
 
@@ -1,6 +1,6 @@
 # mainloop/socketsrc.py -- events and event sources for sockets
 #
-# Copyright (C) 2012, 2014  Codethink Limited
+# Copyright (C) 2012, 2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -61,6 +61,8 @@ class ListeningSocketEventSource(EventSource):
 
     '''An event source for a socket that listens for connections.'''
 
+    reports_changes = True
+
     def __init__(self, addr, port):
         self.sock = distbuild.create_socket()
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -89,10 +91,14 @@ class ListeningSocketEventSource(EventSource):
         return []
 
     def start_accepting(self):
-        self._accepting = True
+        if not self._accepting:
+            self._accepting = True
+            self.changed()
         
     def stop_accepting(self):
-        self._accepting = False
+        if self._accepting:
+            self._accepting = False
+            self.changed()
 
 
 class SocketReadable(object):
@@ -126,6 +132,8 @@ class SocketEventSource(EventSource):
     
     '''
 
+    reports_changes = True
+
     def __init__(self, sock):
         self.sock = sock
         self._reading = True
@@ -154,16 +162,24 @@ class SocketEventSource(EventSource):
         return events
 
     def start_reading(self):
-        self._reading = True
+        if not self._reading:
+            self._reading = True
+            self.changed()
         
     def stop_reading(self):
-        self._reading = False
+        if self._reading:
+            self._reading = False
+            self.changed()
 
     def start_writing(self):
-        self._writing = True
+        if not self._writing:
+            self._writing = True
+            self.changed()
         
     def stop_writing(self):
-        self._writing = False
+        if self._writing:
+            self._writing = False
+            self.changed()
 
     def read(self, max_bytes):
         fd = self.sock.fileno()
@@ -178,6 +194,7 @@ class SocketEventSource(EventSource):
         self.stop_writing()
         self.sock.close()
         self.sock = None
+        self.changed()
         
     def is_finished(self):
         return self.sock is None
@@ -1,6 +1,6 @@
 # distbuild/timer_event_source.py -- event source for timer events
 #
-# Copyright (C) 2012, 2014  Codethink Limited
+# Copyright (C) 2012, 2014, 2026  Codethink Limited
 # 
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -18,13 +18,17 @@
 
 import time
 
+from eventsrc import EventSource
+
 
 class Timer(object):
 
     pass
 
 
-class TimerEventSource(object):
+class TimerEventSource(EventSource):
+
+    reports_changes = True
 
     def __init__(self, interval):
         self.interval = interval
@@ -34,9 +38,11 @@ class TimerEventSource(object):
     def start(self):
         self.enabled = True
         self.last_event = time.time()
+        self.changed()
         
     def stop(self):
         self.enabled = False
+        self.changed()
         
     def get_select_params(self):
         if self.enabled:
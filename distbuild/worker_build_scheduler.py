@@ -1,6 +1,6 @@
 # distbuild/worker_build_scheduler.py -- schedule worker-builds on workers
 #
-# Copyright (C) 2012, 2014  Codethink Limited
+# Copyright (C) 2012, 2014, 2026  Codethink Limited
 # 
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -17,20 +17,26 @@
 
 
 import collections
+import heapq
 import httplib
+import itertools
+import json
 import logging
 import socket
+import time
 import urllib
 import urlparse
 
 import distbuild
+import morphlib
 
 
 class WorkerBuildRequest(object):
 
-    def __init__(self, artifact, initiator_id):
+    def __init__(self, artifact, initiator_id, priority=0):
         self.artifact = artifact
         self.initiator_id = initiator_id
+        self.priority = priority
 
 class WorkerCancelPending(object):
     
@@ -81,6 +87,14 @@ class WorkerBuildFailed(object):
         self.msg = msg
         self.artifact_cache_key = cache_key
 
+class WorkerBuildRetrying(object):
+
+    def __init__(self, initiators, cache_key, worker_name, reason):
+        self.initiators = initiators
+        self.artifact_cache_key = cache_key
+        self.worker_name = worker_name
+        self.reason = reason
+
 
 class _NeedJob(object):
 
@@ -93,35 +107,95 @@ class _HaveAJob(object):
     def __init__(self, job):
         self.job = job
 
+
+class _Dispatch(object):
+
+    pass
+
+
 class Job(object):
 
-    def __init__(self, job_id, artifact, initiator_id):
+    def __init__(self, job_id, artifact, initiator_id, priority=0):
         self.id = job_id
         self.artifact = artifact
         self.initiators = [initiator_id]
+        self.priority = priority
         self.who = None  # we don't know who's going to do this yet
         self.running = False
         self.failed = False
+        self.started = None
+        self.dependencies = set()
+        self.retries = 0
 
 
 class Jobs(object):
 
+    '''The jobs which are waiting for a worker or being built.
+
+    Waiting jobs are given out highest priority first. Those with the
+    same priority are given out in the order of the build requests
+    which first asked for them, and then in the order they were asked
+    for, so one build's jobs do not hold up another's which were asked
+    for earlier. The waiting jobs are kept in a heap, which may hold
+    entries for jobs which have been given out, removed, or had their
+    priority raised since, which are skipped when they come up.
+
+    '''
+
     def __init__(self, idgen):
         self._idgen = idgen
         self._jobs = {}
+        self._queue = []
+        self._requests = {}
+        self._request_order = itertools.count()
+        self._job_order = itertools.count()
 
     def get(self, artifact_basename):
         return (self._jobs[artifact_basename]
             if artifact_basename in self._jobs else None)
 
-    def create(self, artifact, initiator_id):
-        job = Job(self._idgen.next(), artifact, initiator_id)
+    def create(self, artifact, initiator_id, priority=0):
+        job = Job(self._idgen.next(), artifact, initiator_id, priority)
+        if initiator_id not in self._requests:
+            self._requests[initiator_id] = next(self._request_order)
+        job.order = (self._requests[initiator_id], next(self._job_order))
         self._jobs[job.artifact.basename()] = job
+        heapq.heappush(self._queue, (-priority, job.order, job))
         return job
 
+    def raise_priority(self, job, priority):
+        '''Give a waiting job a higher priority, if it has a lower one.'''
+
+        if job.who is None and priority > job.priority:
+            job.priority = priority
+            heapq.heappush(self._queue, (-priority, job.order, job))
+
+    def put_back(self, job):
+        '''Let a job which get_next_job returned wait again.'''
+
+        heapq.heappush(self._queue, (-job.priority, job.order, job))
+
+    def retry(self, job):
+        '''Let a job which was given to a worker wait for another.
+
+        The job gets a new id, so that nothing the worker it was given
+        to says about it is taken for what the next one says.
+
+        '''
+
+        job.id = self._idgen.next()
+        job.who = None
+        job.running = False
+        job.started = None
+        job.retries += 1
+        self.put_back(job)
+
     def remove(self, job):
         if job.artifact.basename() in self._jobs:
             del self._jobs[job.artifact.basename()]
+            if not self._jobs:
+                # Nothing remembers the earlier requests now.
+                self._requests.clear()
         else:
             logging.warning("Tried to remove a job that doesn't exist "
                             "(%s)", job.artifact.basename())
@@ -136,12 +210,45 @@ class Jobs(object):
     def exists(self, artifact_basename):
         return artifact_basename in self._jobs
 
-    def get_next_job(self):
-        # for now just return the first thing we find that's not being built
-        waiting = [job for (_, job) in
-            self._jobs.iteritems() if job.who == None]
-
-        return waiting.pop() if len(waiting) > 0 else None
+    def _pop_waiting(self):
+        while self._queue:
+            entry = heapq.heappop(self._queue)
+            priority, order, job = entry
+            if (job.who is None and -priority == job.priority and
+                    self._jobs.get(job.artifact.basename()) is job):
+                return entry
+        return None
+
+    def get_next_job(self, score=None, lookahead=1):
+        '''Return the waiting job to build next, or None.
+
+        If score is given, up to lookahead jobs of the highest priority
+        are looked at, and the first of them to which score gives the
+        highest number is returned. The job is taken out of the queue,
+        so the caller must give it to a worker.
+
+        '''
+
+        entry = self._pop_waiting()
+        if entry is None:
+            return None
+        candidates = [entry]
+        while score is not None and len(candidates) < lookahead:
+            next_entry = self._pop_waiting()
+            if next_entry is None:
+                break
+            if next_entry[0] != entry[0]:
+                heapq.heappush(self._queue, next_entry)
+                break
+            candidates.append(next_entry)
+
+        best = candidates[0]
+        if len(candidates) > 1:
+            best = max(candidates, key=lambda c: score(c[2]))
+            for candidate in candidates:
+                if candidate is not best:
+                    heapq.heappush(self._queue, candidate)
+        return best[2]
 
     def __repr__(self):
         return str([job.artifact.basename()
@@ -184,6 +291,36 @@ class _JobFailed(object):
 
     def __init__(self, job):
         self.job = job
+
+
+class _JobLost(object):
+
+    def __init__(self, job, who, reason):
+        self.job = job
+        self.who = who
+        self.reason = reason
+
+
+class _WorkerLost(object):
+
+    def __init__(self, who, done=None):
+        self.who = who
+        self.done = done
+
+
+def _dependency_names(artifact):
+    '''Return the basenames of what a worker needs to build artifact.'''
+
+    names = set()
+    stack = list(artifact.source.dependencies)
+    while stack:
+        dependency = stack.pop()
+        name = dependency.basename()
+        if name not in names:
+            names.add(name)
+            stack.extend(dependency.source.dependencies)
+    return names
+
     
 class WorkerBuildQueuer(distbuild.StateMachine):
 
@@ -193,11 +330,47 @@ class WorkerBuildQueuer(distbuild.StateMachine):
     into a queue. It also catches _NeedJob events, from a
     WorkerConnection, and responds to them with _HaveAJob events,
     when it has an outstanding request.
+
+    The queue is ordered by the priority each request comes with. The
+    requests a build controller makes at once are all queued before
+    any of them is given to a worker, so that the most important go
+    first. How long each job takes is recorded with build_priority,
+    which is a policy from distbuild.build_priority.
+
+    Workers which already have more of what a job needs in their local
+    artifact cache are preferred for it, so that less is downloaded.
+    This never keeps a job or a worker waiting: when several workers
+    are free, a job goes to the one which has the most, and a worker
+    which asks for a job takes the one it has the most for among the
+    next few with the highest priority.
+
+    A worker which runs several jobs at once asks for a job for each
+    of its WorkerSlots, and a job is only given to a slot whose worker
+    has the CPUs free for it. A job which does not fit any is passed
+    over for the next which does.
+
+    A job which was being built on a worker which went away, or whose
+    results could not be fetched from it, is put back in the queue for
+    another worker, up to job_retries times, after which it fails.
+    Jobs which fail because the build itself does are not tried again.
     
     '''
+
+    # How many jobs of the same priority a worker chooses from.
+    LOCALITY_LOOKAHEAD = 4
+
+    # How many jobs which no available worker has the CPUs free for are
+    # passed over to find ones which some worker does.
+    PLACEMENT_LOOKAHEAD = 16
+
+    JOB_RETRIES = 2
     
-    def __init__(self):
+    def __init__(self, build_priority=None, job_retries=JOB_RETRIES):
         distbuild.StateMachine.__init__(self, 'idle')
+        if build_priority is None:
+            build_priority = distbuild.DependentCountPriority()
+        self._build_priority = build_priority
+        self._job_retries = job_retries
 
     def setup(self):
         distbuild.crash_point()
@@ -206,11 +379,14 @@ class WorkerBuildQueuer(distbuild.StateMachine):
         self._available_workers = []
         self._jobs = Jobs(
             distbuild.IdentifierGenerator('WorkerBuildQueuerJob'))
+        # The jobs created since the queued jobs were last given out.
+        self._undispatched = []
         
         spec = [
             # state, source, event_class, new_state, callback
             ('idle', WorkerBuildQueuer, WorkerBuildRequest, 'idle',
                 self._handle_request),
+            ('idle', self, _Dispatch, 'idle', self._dispatch),
             ('idle', WorkerBuildQueuer, WorkerCancelPending, 'idle',
                 self._handle_cancel),
 
@@ -220,7 +396,11 @@ class WorkerBuildQueuer(distbuild.StateMachine):
             ('idle', WorkerConnection, _JobFinished, 'idle',
                 self._set_job_finished),
             ('idle', WorkerConnection, _JobFailed, 'idle',
-                self._set_job_failed)
+                self._set_job_failed),
+            ('idle', WorkerConnection, _JobLost, 'idle',
+                self._handle_lost_job),
+            ('idle', WorkerConnection, _WorkerLost, 'idle',
+                self._handle_lost_worker),
         ]
         self.add_transitions(spec)
 
@@ -230,6 +410,7 @@ class WorkerBuildQueuer(distbuild.StateMachine):
                       event.job.artifact.basename(), event.job.id)
 
         event.job.running = True
+        event.job.started = time.time()
 
     def _set_job_finished(self, event_source, event):
         logging.debug('Setting job state for job %s with id %s: '
@@ -237,12 +418,74 @@ class WorkerBuildQueuer(distbuild.StateMachine):
                       event.job.artifact.basename(), event.job.id)
 
         event.job.running = False
+        if not event.job.failed and event.job.started is not None:
+            self._build_priority.record(event.job.artifact,
+                                        time.time() - event.job.started)
 
     def _set_job_failed(self, event_source, event):
         logging.debug('Job %s with id %s failed',
                       event.job.artifact.basename(), event.job.id)
         event.job.failed = True
 
+    def _handle_lost_job(self, event_source, event):
+        self._lose_job(event.job, event.who, event.reason)
+        if not self._undispatched:
+            self._give_jobs()
+
+    def _handle_lost_worker(self, event_source, event):
+        who = event.who
+        logging.debug('WBQ: Forgetting lost worker %s', who.name())
+        self._available_workers = [
+            w for w in self._available_workers if w.who is not who]
+
+        if event.done is not None:
+            self._jobs.remove(event.done)
+        lost = [job for job in self._jobs.get_jobs().itervalues()
+                if job.who is who]
+        for job in lost:
+            self._lose_job(job, who, 'Lost connection to %s' % who.name())
+        if not self._undispatched:
+            self._give_jobs()
+
+    def _lose_job(self, job, who, reason):
+        name = job.artifact.basename()
+        if self._jobs.get(name) is not job:
+            return    # it was cancelled meanwhile
+
+        if not job.initiators:
+            logging.debug('Removing job %s with job id %s, which nothing '
+                          'wants now', name, job.id)
+            self._jobs.remove(job)
+        elif not job.running:
+            # It was never started, so this is not another try.
+            logging.debug('%s: giving %s to another worker', reason, name)
+            job.who = None
+            self._jobs.put_back(job)
+        elif job.retries < self._job_retries:
+            logging.warning('%s: giving %s to another worker',
+                            reason, name)
+            retrying = WorkerBuildRetrying(job.initiators,
+                job.artifact.source.cache_key, who.name(), reason)
+            self.mainloop.queue_event(WorkerConnection, retrying)
+            self._jobs.retry(job)
+        else:
+            logging.error('%s: %s has been tried %d times, so it failed',
+                          reason, name, job.retries + 1)
+            job.running = False
+            job.failed = True
+            msg = {
+                'type': 'exec-response',
+                'id': job.id,
+                'ids': job.initiators,
+                'exit': -1,
+                'stdout': '',
+                'stderr': '%s, and %s has been tried %d times\n' %
+                    (reason, job.artifact.name, job.retries + 1),
+            }
+            failed = WorkerBuildFailed(msg, job.artifact.source.cache_key)
+            self.mainloop.queue_event(WorkerConnection, failed)
+            self._jobs.remove(job)
+
     def _handle_request(self, event_source, event):
         distbuild.crash_point()
 
@@ -257,6 +500,7 @@ class WorkerBuildQueuer(distbuild.StateMachine):
         if self._jobs.exists(event.artifact.basename()):
             job = self._jobs.get(event.artifact.basename())
             job.initiators.append(event.initiator_id)
+            self._jobs.raise_priority(job, event.priority)
 
             if job.running:
                 logging.debug('Worker build step already started: %s' %
@@ -273,15 +517,32 @@ class WorkerBuildQueuer(distbuild.StateMachine):
             self.mainloop.queue_event(WorkerConnection, progress)
         else:
             logging.debug('WBQ: Creating job for: %s' % event.artifact.name)
-            job = self._jobs.create(event.artifact, event.initiator_id)
+            job = self._jobs.create(event.artifact, event.initiator_id,
+                                    event.priority)
+            job.dependencies = _dependency_names(event.artifact)
 
             if self._available_workers:
-                self._give_job(job)
+                # The other requests made with this one are queued
+                # before any of them is given out.
+                if not self._undispatched:
+                    self.mainloop.queue_event(self, _Dispatch())
+                self._undispatched.append(job)
             else:
                 progress = WorkerBuildWaiting(event.initiator_id,
                     event.artifact.source.cache_key)
                 self.mainloop.queue_event(WorkerConnection, progress)
 
+    def _dispatch(self, event_source, event):
+        self._give_jobs()
+
+        for job in self._undispatched:
+            if job.who is None and self._jobs.get(
+                    job.artifact.basename()) is job:
+                progress = WorkerBuildWaiting(job.initiators[0],
+                    job.artifact.source.cache_key)
+                self.mainloop.queue_event(WorkerConnection, progress)
+        self._undispatched = []
+
     def _handle_cancel(self, event_source, event):
 
         def cancel_this(job):
@@ -341,14 +602,50 @@ class WorkerBuildQueuer(distbuild.StateMachine):
         logging.debug('Current jobs: %s', self._jobs)
         logging.debug('Workers available: %d', len(self._available_workers))
 
-        job = self._jobs.get_next_job()
+        if not self._undispatched:
+            # Otherwise the jobs are given out when they are all queued.
+            self._give_jobs()
 
-        if job:
-            self._give_job(job)
-            
-    def _give_job(self, job):
-        worker = self._available_workers.pop(0)
+    def _give_jobs(self):
+        '''Give the waiting jobs to the workers available for them.
+
+        A job goes to the worker which has the CPUs free for it and
+        the most of what it needs, or waits, with the jobs of lower
+        priority looked at, up to PLACEMENT_LOOKAHEAD of them, until
+        one which does fit has finished.
+
+        '''
+
+        passed_over = []
+        while self._available_workers and \
+                len(passed_over) < self.PLACEMENT_LOOKAHEAD:
+            if len(self._available_workers) == 1:
+                who = self._available_workers[0].who
+                job = self._jobs.get_next_job(
+                    lambda job: who.count_cached(job.dependencies),
+                    self.LOCALITY_LOOKAHEAD)
+            else:
+                job = self._jobs.get_next_job()
+            if job is None:
+                break
+            workers = [w for w in self._available_workers if w.who.fits(job)]
+            if not workers:
+                passed_over.append(job)
+                continue
+            worker = workers[0]
+            if len(workers) > 1:
+                worker = max(workers,
+                             key=lambda w: w.who.count_cached(
+                                 job.dependencies))
+            self._give_job(job, worker)
+
+        for job in passed_over:
+            self._jobs.put_back(job)
+
+    def _give_job(self, job, worker):
+        self._available_workers.remove(worker)
         job.who = worker.who
+        worker.who.reserve(job)
 
         logging.debug(
             'WBQ: Giving %s to %s' %
@@ -357,35 +654,143 @@ class WorkerBuildQueuer(distbuild.StateMachine):
         self.mainloop.queue_event(worker.who, _HaveAJob(job))
     
     
+class _Probed(object):
+
+    pass
+
+
 class WorkerConnection(distbuild.StateMachine):
 
-    '''Communicate with a single worker.'''
+    '''Communicate with a single worker.
+
+    When the worker connects, it is asked to run "morph worker-info",
+    which tells how many jobs it can run at once, and how many CPUs and
+    how much memory it has. A WorkerSlot is made for each of those jobs
+    which the worker has the memory for, and asks for jobs, which all
+    go to the worker over this connection. The worker also says which
+    artifact graph encoding it can read. A worker which cannot say runs
+    one job at a time, and is given the oldest encoding, as it was
+    before it could.
+
+    Each chunk is given an even share of the worker's CPUs, or as many
+    as its max-jobs says, and a slot only takes a job if the worker has
+    that many CPUs which other jobs are not using. The build is run
+    with that many as its --max-jobs.
+
+    The membership filter the worker's artifact cache server publishes
+    is fetched when the worker connects, and again after its jobs, at
+    most every MEMBERSHIP_REFRESH_INTERVAL seconds, so that jobs can be
+    given to workers which have what they need. All the slots share
+    the worker's artifact cache.
+
+    When the connection is lost, the jobs the worker was building are
+    given to other workers, and the connection is made again. The
+    kernel's TCP keepalive probes notice a worker which went away
+    without closing it.
+
+    '''
     
     _request_ids = distbuild.IdentifierGenerator('WorkerConnection')
     _initiator_request_map = collections.defaultdict(set)
 
+    MEMBERSHIP_REFRESH_INTERVAL = 60
+
+    # A slot is only used for each this much of the worker's memory.
+    MEMORY_PER_SLOT = 1024 ** 3
+
+    # A worker which goes away without closing the connection, such as
+    # one which loses power, is noticed when it does not answer this
+    # many keepalive probes, this many seconds apart, after this many
+    # seconds of silence.
+    KEEPALIVE_COUNT = 6
+    KEEPALIVE_INTERVAL = 10
+    KEEPALIVE_IDLE = 60
+
     def __init__(self, cm, conn, writeable_cache_server, 
                  worker_cache_server_port, morph_instance):
-        distbuild.StateMachine.__init__(self, 'idle')
+        distbuild.StateMachine.__init__(self, 'probing')
         self._cm = cm
         self._conn = conn
-        self._writeable_cache_server = writeable_cache_server
-        self._worker_cache_server_port = worker_cache_server_port
-        self._morph_instance = morph_instance
-        self._helper_id = None
-        self._job = None
-        self._exec_response_msg = None
+        self.writeable_cache_server = writeable_cache_server
+        self.cache_server_port = worker_cache_server_port
+        self.morph_instance = morph_instance
         self._debug_json = False
+        self._membership = morphlib.bloomfilter.MembershipFilter()
+        self._membership_id = None
+        self._membership_requested = None
+        self._info_id = None
+        self._info_output = []
+        self.slots = 1
+        self.cpus = None
+        self.memory = None
+        self.graph_version = 1
+        self._reserved = {}
+
+        self._conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for option, value in [('TCP_KEEPCNT', self.KEEPALIVE_COUNT),
+                              ('TCP_KEEPINTVL', self.KEEPALIVE_INTERVAL),
+                              ('TCP_KEEPIDLE', self.KEEPALIVE_IDLE)]:
+            if hasattr(socket, option):
+                self._conn.setsockopt(
+                    socket.IPPROTO_TCP, getattr(socket, option), value)
 
         addr, port = self._conn.getpeername()
+        self.host = addr
         name = socket.getfqdn(addr)
         self._worker_name = '%s:%s' % (name, port)
 
     def name(self):
         return self._worker_name
 
-    def job(self):
-        return self._job
+    def count_cached(self, names):
+        '''Count the names the worker's artifact cache may have.'''
+
+        if self._membership is None or self._membership.filter is None:
+            return 0
+        return sum(1 for name in names
+                   if self._membership.might_contain(name))
+
+    def add_cached(self, names):
+        '''Note names which the worker's artifact cache now has.'''
+
+        if self._membership is not None:
+            for name in names:
+                self._membership.add(name)
+
+    def job_cpus(self, job):
+        '''Return how many CPUs job would be given, or None if unknown.'''
+
+        if self.cpus is None:
+            return None
+        morphology = job.artifact.source.morphology
+        if morphology['kind'] != 'chunk':
+            return 1    # strata and systems are put together, not built
+        cpus = morphology.get('max-jobs') or max(1, self.cpus // self.slots)
+        return min(int(cpus), self.cpus)
+
+    def fits(self, job):
+        '''Say whether the worker has the CPUs free to run job.'''
+
+        cpus = self.job_cpus(job)
+        return cpus is None or \
+            sum(self._reserved.itervalues()) + cpus <= self.cpus
+
+    def reserve(self, slot, job):
+        cpus = self.job_cpus(job)
+        if cpus is not None:
+            self._reserved[slot] = cpus
+
+    def reserved(self, slot):
+        return self._reserved.get(slot)
+
+    def release(self, slot):
+        self._reserved.pop(slot, None)
+
+    def send(self, msg):
+        self._jm.send(msg)
+        if self._debug_json:
+            logging.debug('WC: sent to worker %s: %r'
+                % (self._worker_name, msg))
 
     def setup(self):
         distbuild.crash_point()
@@ -397,14 +802,163 @@ class WorkerConnection(distbuild.StateMachine):
         
         spec = [
             # state, source, event_class, new_state, callback
-            ('idle', self._jm, distbuild.JsonEof, None,  self._reconnect),
+            ('probing', self._jm, distbuild.JsonEof, None, self._reconnect),
+            ('probing', self._jm, distbuild.JsonNewMessage, 'probing',
+                self._handle_info_message),
+            ('probing', self, _Probed, 'connected', self._start_slots),
+
+            ('connected', self._jm, distbuild.JsonEof, None,
+                self._reconnect),
+            ('connected', distbuild.HelperRouter, distbuild.HelperResult,
+                'connected', self._maybe_handle_membership_response),
+        ]
+        self.add_transitions(spec)
+
+        msg = distbuild.message('exec-request',
+            id=self._request_ids.next(),
+            argv=[self.morph_instance, 'worker-info'],
+            stdin_contents='',
+        )
+        self._info_id = msg['id']
+        self.send(msg)
+
+    def _reconnect(self, event_source, event):
+        distbuild.crash_point()
+
+        logging.debug('WC: Triggering reconnect')
+        self.mainloop.queue_event(self._cm, distbuild.Reconnect())
+
+    def _handle_info_message(self, event_source, event):
+        if event.msg['id'] != self._info_id:
+            return    # not a reply to the question
+
+        if event.msg['type'] == 'exec-output':
+            self._info_output.append(event.msg['stdout'])
+            return
+
+        if event.msg['exit'] != 0:
+            logging.info('%s cannot say what it has, so it runs one job '
+                         'at a time' % self.name())
+        else:
+            try:
+                info = json.loads(''.join(self._info_output))
+                self.slots = max(1, int(info['slots']))
+                self.cpus = max(1, int(info['cpus']))
+                self.memory = int(info['memory'])
+                self.graph_version = min(int(info.get('graph-version', 1)),
+                                         distbuild.GRAPH_VERSION)
+            except (ValueError, KeyError, TypeError), e:
+                logging.warning('Bad worker information from %s: %s'
+                                % (self.name(), e))
+                self.slots = 1
+                self.cpus = None
+                self.memory = None
+                self.graph_version = 1
+            else:
+                if self.memory > 0:
+                    self.slots = min(self.slots, max(
+                        1, self.memory // self.MEMORY_PER_SLOT))
+                logging.info('%s runs %d jobs at once, with %d CPUs and '
+                             '%d MiB of memory' %
+                             (self.name(), self.slots, self.cpus,
+                              self.memory // 1024 ** 2))
+        self.mainloop.queue_event(self, _Probed())
+
+    def _start_slots(self, event_source, event):
+        for number in xrange(self.slots):
+            slot = WorkerSlot(self, self._jm, number)
+            self.mainloop.add_state_machine(slot)
+
+    def refresh_membership(self):
+        if self._membership is None or self._membership_id is not None:
+            return
+        if self._membership_requested is not None and \
+                time.time() - self._membership_requested < \
+                self.MEMBERSHIP_REFRESH_INTERVAL:
+            return
+
+        url = 'http://%s:%d/1.0/membership' % (self.host,
+                                               self.cache_server_port)
+        query = self._membership.query()
+        if query:
+            url += '?' + urllib.urlencode(query)
+        msg = distbuild.message(
+            'http-request', id=self._request_ids.next(), url=url,
+            method='GET', body=None, headers=None)
+        self._membership_id = msg['id']
+        self._membership_requested = time.time()
+        self.mainloop.queue_event(distbuild.HelperRouter,
+                                  distbuild.HelperRequest(msg))
+
+    def _maybe_handle_membership_response(self, event_source, event):
+        if event.msg['id'] != self._membership_id:
+            return    # this event is not for us
+        self._membership_id = None
+
+        status = event.msg['status']
+        if status == httplib.OK:
+            try:
+                self._membership.update(json.loads(event.msg['body']))
+            except ValueError, e:
+                logging.warning('Bad membership filter from %s: %s'
+                                % (self.name(), e))
+        elif status == httplib.NOT_FOUND:
+            logging.info('The artifact cache server of %s publishes no '
+                         'membership filter' % self.name())
+            self._membership = None
+        else:
+            logging.debug('Membership filter request to %s failed with '
+                          'status: %s' % (self.name(), status))
+
+
+class WorkerSlot(distbuild.StateMachine):
+
+    '''Run one job at a time on a worker, for a WorkerConnection.'''
+
+    def __init__(self, worker, jm, number):
+        distbuild.StateMachine.__init__(self, 'idle')
+        self._worker = worker
+        self._jm = jm
+        self._number = number
+        self._helper_id = None
+        self._job = None
+        self._cpus = None
+        self._exec_response_msg = None
+        self._lost = False
+
+    def name(self):
+        if self._worker.slots == 1:
+            return self._worker.name()
+        return '%s/%d' % (self._worker.name(), self._number)
+
+    def job(self):
+        return self._job
+
+    def count_cached(self, names):
+        return self._worker.count_cached(names)
+
+    def fits(self, job):
+        return self._worker.fits(job)
+
+    def reserve(self, job):
+        self._worker.reserve(self, job)
+
+    def setup(self):
+        distbuild.crash_point()
+
+        logging.debug('WC: Setting up slot %s' % self.name())
+
+        spec = [
+            # state, source, event_class, new_state, callback
+            ('idle', self._jm, distbuild.JsonEof, None, self._lost_worker),
             ('idle', self, _HaveAJob, 'building', self._start_build),
             
             ('building', distbuild.BuildController,
                 distbuild.BuildCancel, 'building',
                 self._maybe_cancel),
 
-            ('building', self._jm, distbuild.JsonEof, None, self._reconnect),
+            ('building', self._jm, distbuild.JsonEof, None,
+                self._lost_worker),
             ('building', self._jm, distbuild.JsonNewMessage, 'building',
                 self._handle_json_message),
             ('building', self, _BuildFailed, 'idle', self._request_job),
@@ -412,6 +966,8 @@ class WorkerConnection(distbuild.StateMachine):
             ('building', self, _BuildFinished, 'caching',
                 self._request_caching),
 
+            ('caching', self._jm, distbuild.JsonEof, 'caching',
+                self._note_lost_worker),
             ('caching', distbuild.HelperRouter, distbuild.HelperResult,
                 'caching', self._maybe_handle_helper_result),
             ('caching', self, _Cached, 'idle', self._request_job),
@@ -437,7 +993,7 @@ class WorkerConnection(distbuild.StateMachine):
                            self.name())
 
             msg = distbuild.message('exec-cancel', id=self._job.id)
-            self._jm.send(msg)
+            self._worker.send(msg)
             self.mainloop.queue_event(self, _BuildCancelled())
         else:
             logging.debug('WC: Not cancelling running job %s with job id %s, '
@@ -449,16 +1005,11 @@ class WorkerConnection(distbuild.StateMachine):
 
         self._job.initiators.remove(build_cancel.id)
 
-    def _reconnect(self, event_source, event):
-        distbuild.crash_point()
-
-        logging.debug('WC: Triggering reconnect')
-        self.mainloop.queue_event(self._cm, distbuild.Reconnect())
-
     def _start_build(self, event_source, event):
         distbuild.crash_point()
 
         self._job = event.job
+        self._cpus = self._worker.reserved(self)
         self._helper_id = None
         self._exec_response_msg = None
 
@@ -466,21 +1017,21 @@ class WorkerConnection(distbuild.StateMachine):
                       (self._job.artifact.name, self._job.initiators))
 
         argv = [
-            self._morph_instance,
+            self._worker.morph_instance,
             'worker-build',
             '--build-log-on-stdout',
-            self._job.artifact.name,
         ]
+        if self._cpus is not None:
+            argv.append('--max-jobs=%d' %
+                        morphlib.util.make_concurrency(self._cpus))
+        argv.append(self._job.artifact.name)
         msg = distbuild.message('exec-request',
             id=self._job.id,
             argv=argv,
-            stdin_contents=distbuild.serialise_artifact(self._job.artifact),
+            stdin_contents=distbuild.serialise_artifact(
+                self._job.artifact, self._worker.graph_version),
         )
-        self._jm.send(msg)
-
-        if self._debug_json:
-            logging.debug('WC: sent to worker %s: %r'
-                % (self._worker_name, msg))
+        self._worker.send(msg)
 
         started = WorkerBuildStepStarted(self._job.initiators,
             self._job.artifact.source.cache_key, self.name())
@@ -491,10 +1042,13 @@ class WorkerConnection(distbuild.StateMachine):
     def _handle_json_message(self, event_source, event):
         '''Handle JSON messages from the worker.'''
 
+        if event.msg['id'] != self._job.id:
+            return    # this message is about another slot's job
+
         distbuild.crash_point()
 
         logging.debug(
-            'WC: from worker %s: %r' % (self._worker_name, event.msg))
+            'WC: from worker %s: %r' % (self.name(), event.msg))
 
         handlers = {
             'exec-output': self._handle_exec_output,
@@ -520,7 +1074,16 @@ class WorkerConnection(distbuild.StateMachine):
         new = dict(msg)
         new['ids'] = self._job.initiators
 
-        if new['exit'] != 0:
+        if new['exit'] < 0:
+            # The build was killed by a signal, such as from the kernel
+            # running out of memory, so it did not fail by itself.
+            reason = ('The build of %s on %s was killed by signal %d' %
+                      (self._job.artifact.name, self.name(), -new['exit']))
+            self.mainloop.queue_event(WorkerConnection,
+                                      _JobLost(self._job, self, reason))
+            self._job = None
+            self.mainloop.queue_event(self, _BuildFailed())
+        elif new['exit'] != 0:
             # Build failed.
             new_event = WorkerBuildFailed(new,
                                           self._job.artifact.source.cache_key)
@@ -534,8 +1097,27 @@ class WorkerConnection(distbuild.StateMachine):
 
     def _request_job(self, event_source, event):
         distbuild.crash_point()
+        self._worker.release(self)
+        if self._lost:
+            self.state = None
+            self.mainloop.queue_event(WorkerConnection,
+                                      _WorkerLost(self, done=self._job))
+            return
+        self._worker.refresh_membership()
         self.mainloop.queue_event(WorkerConnection, _NeedJob(self))
 
+    def _lost_worker(self, event_source, event):
+        logging.error('Lost connection to %s' % self.name())
+        self._worker.release(self)
+        self.mainloop.queue_event(WorkerConnection, _WorkerLost(self))
+
+    def _note_lost_worker(self, event_source, event):
+        # The worker's artifact cache server may still be there for the
+        # shared one to fetch what it built from.
+        logging.error('Lost connection to %s while its artifacts are '
+                      'being fetched' % self.name())
+        self._lost = True
+
     def _request_caching(self, event_source, event):
         # This code should be moved into the morphlib.remoteartifactcache
         # module. It would be good to share it with morphlib.buildcommand,
@@ -561,18 +1143,16 @@ class WorkerConnection(distbuild.StateMachine):
         suffixes = [urllib.quote(x) for x in suffixes]
         suffixes = ','.join(suffixes)
 
-        worker_host = self._conn.getpeername()[0]
-        
         url = urlparse.urljoin(
-            self._writeable_cache_server, 
+            self._worker.writeable_cache_server, 
             '/1.0/fetch?host=%s:%d&cacheid=%s&artifacts=%s' %
-                (urllib.quote(worker_host),
-                 self._worker_cache_server_port,
+                (urllib.quote(self._worker.host),
+                 self._worker.cache_server_port,
                  urllib.quote(self._job.artifact.source.cache_key),
                  suffixes))
 
         msg = distbuild.message(
-            'http-request', id=self._request_ids.next(), url=url,
+            'http-request', id=WorkerConnection._request_ids.next(), url=url,
             method='GET', body=None, headers=None)
         self._helper_id = msg['id']
         req = distbuild.HelperRequest(msg)
@@ -590,30 +1170,30 @@ class WorkerConnection(distbuild.StateMachine):
             if event.msg['status'] == httplib.OK:
                 logging.debug('Shared artifact cache population done')
 
+                # The worker's own cache has what it built, and what
+                # it needed to build it, now.
+                self._worker.add_cached(self._job.dependencies)
+                self._worker.add_cached(
+                    a.basename()
+                    for a in self._job.artifact.source.artifacts.itervalues())
+
                 new_event = WorkerBuildFinished(
                     self._exec_response_msg,
                     self._job.artifact.source.cache_key)
                 self.mainloop.queue_event(WorkerConnection, new_event)
+                self.mainloop.queue_event(WorkerConnection,
+                                          _JobFinished(self._job))
                 self.mainloop.queue_event(self, _Cached())
             else:
                 logging.error(
                     'Failed to populate artifact cache: %s %s' %
                         (event.msg['status'], event.msg['body']))
 
-                # We will attempt to remove this job twice
-                # unless we mark it as failed before the BuildController
-                # processes the WorkerBuildFailed event.
-                #
-                # The BuildController will not try to cancel jobs that have
-                # been marked as failed.
+                # The build worked, so it is tried again elsewhere,
+                # rather than failed.
+                reason = ('Could not fetch the artifacts %s built' %
+                          self.name())
                 self.mainloop.queue_event(WorkerConnection,
-                                          _JobFailed(self._job))
-
-                new_event = WorkerBuildFailed(
-                    self._exec_response_msg,
-                    self._job.artifact.source.cache_key)
-                self.mainloop.queue_event(WorkerConnection, new_event)
-
+                                          _JobLost(self._job, self, reason))
+                self._job = None
                 self.mainloop.queue_event(self, _BuildFailed())
-
-        self.mainloop.queue_event(WorkerConnection, _JobFinished(self._job))
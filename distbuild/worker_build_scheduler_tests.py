@@ -0,0 +1,819 @@
+# distbuild/worker_build_scheduler_tests.py -- unit tests for the scheduler
+#
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import base64
+import json
+import socket
+import time
+import unittest
+import urlparse
+
+import distbuild
+import morphlib
+
+
+class FakeSource(object):
+
+    def __init__(self, name, kind, dependencies, max_jobs):
+        self.morphology = {'name': name, 'kind': kind, 'max-jobs': max_jobs}
+        self.dependencies = list(dependencies)
+        self.cache_key = '%s-key' % name
+        self.artifacts = {}
+
+
+class FakeArtifact(object):
+
+    def __init__(self, name, kind='chunk', dependencies=(), max_jobs=None):
+        self.name = name
+        self.arch = 'x86_64'
+        self.source = FakeSource(name, kind, dependencies, max_jobs)
+        self.source.artifacts[name] = self
+
+    def basename(self):
+        return '%s.%s.%s' % (self.source.cache_key,
+                             self.source.morphology['kind'], self.name)
+
+
+class FakeWorker(distbuild.StateMachine):
+
+    '''The worker daemon end of a connection, which tests drive.'''
+
+    def __init__(self, conn, info):
+        distbuild.StateMachine.__init__(self, 'connected')
+        self.conn = conn
+        self.info = info
+        self.builds = []
+        self.cancelled = []
+
+    def setup(self):
+        self.jm = distbuild.JsonMachine(self.conn)
+        self.mainloop.add_state_machine(self.jm)
+        self.add_transitions([
+            ('connected', self.jm, distbuild.JsonNewMessage, 'connected',
+                self._handle_message),
+            ('connected', self.jm, distbuild.JsonEof, None, None),
+        ])
+
+    def _handle_message(self, event_source, event):
+        msg = event.msg
+        if msg['type'] == 'exec-cancel':
+            self.cancelled.append(msg['id'])
+        elif msg['argv'][1] == 'worker-info':
+            if self.info is None:
+                self.respond(msg, exit=1)
+            else:
+                self.respond(msg, stdout=self.info)
+        else:
+            self.builds.append(msg)
+
+    def respond(self, request, exit=0, stdout=''):
+        if stdout:
+            self.jm.send({'type': 'exec-output', 'id': request['id'],
+                          'stdout': stdout, 'stderr': ''})
+        self.jm.send({'type': 'exec-response', 'id': request['id'],
+                      'exit': exit, 'stdout': '', 'stderr': ''})
+
+    def disconnect(self):
+        self.jm.close()
+
+
+class FakeHelperRouter(distbuild.StateMachine):
+
+    '''Take the HTTP requests the scheduler makes, for tests to answer.'''
+
+    def __init__(self):
+        distbuild.StateMachine.__init__(self, 'idle')
+        self.requests = []
+
+    def setup(self):
+        self.add_transition('idle', distbuild.HelperRouter,
+                            distbuild.HelperRequest, 'idle', self._request)
+
+    def _request(self, event_source, event):
+        self.requests.append(event.msg)
+
+    def take(self, path):
+        for msg in self.requests:
+            if urlparse.urlparse(msg['url']).path == path:
+                self.requests.remove(msg)
+                return msg
+        return None
+
+    def respond(self, request, status=200, body=''):
+        result = distbuild.HelperResult(
+            {'id': request['id'], 'status': status, 'body': body})
+        self.mainloop.queue_event(distbuild.HelperRouter, result)
+
+
+class FakeConnectionMachine(distbuild.StateMachine):
+
+    def __init__(self):
+        distbuild.StateMachine.__init__(self, 'connected')
+        self.reconnects = 0
+
+    def setup(self):
+        self.add_transition('connected', self, distbuild.Reconnect,
+                            'connected', self._reconnect)
+
+    def _reconnect(self, event_source, event):
+        self.reconnects += 1
+
+
+class Recorder(distbuild.StateMachine):
+
+    '''Collect what the scheduler tells build controllers.'''
+
+    event_classes = [
+        distbuild.WorkerBuildStepStarted,
+        distbuild.WorkerBuildStepAlreadyStarted,
+        distbuild.WorkerBuildWaiting,
+        distbuild.WorkerBuildOutput,
+        distbuild.WorkerBuildCaching,
+        distbuild.WorkerBuildFinished,
+        distbuild.WorkerBuildFailed,
+        distbuild.WorkerBuildRetrying,
+    ]
+
+    def __init__(self):
+        distbuild.StateMachine.__init__(self, 'idle')
+        self.events = []
+
+    def setup(self):
+        for event_class in self.event_classes:
+            self.add_transition('idle', distbuild.WorkerConnection,
+                                event_class, 'idle', self._record)
+
+    def _record(self, event_source, event):
+        self.events.append(event)
+
+    def of(self, event_class):
+        return [e for e in self.events if isinstance(e, event_class)]
+
+
+class SchedulerTestCase(unittest.TestCase):
+
+    '''Run the scheduler in a main loop, with workers on local sockets.'''
+
+    def setUp(self):
+        self.serialise_artifact = distbuild.serialise_artifact
+        distbuild.serialise_artifact = \
+            lambda artifact, version: '%s:%d' % (artifact.name, version)
+
+        self.loop = distbuild.MainLoop()
+        # The loop is run until something happens, so it must not wait
+        # for long for nothing.
+        self.timer = distbuild.TimerEventSource(0.01)
+        self.loop.add_event_source(self.timer)
+        self.timer.start()
+
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+        self.sockets = [self.listener]
+
+        self.recorder = Recorder()
+        self.loop.add_state_machine(self.recorder)
+        self.helper = FakeHelperRouter()
+        self.loop.add_state_machine(self.helper)
+        self.queuer = distbuild.WorkerBuildQueuer(
+            distbuild.FifoPriority(), job_retries=1)
+        self.loop.add_state_machine(self.queuer)
+
+    def tearDown(self):
+        distbuild.serialise_artifact = self.serialise_artifact
+        for sock in self.sockets:
+            sock.close()
+
+    def run_until(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition():
+            self.assertTrue(time.time() < deadline, 'timed out')
+            self.loop._run_once()
+
+    def settle(self, times=10):
+        '''Run the loop for long enough for messages to get through.'''
+
+        for i in xrange(times):
+            self.loop._run_once()
+
+    def connect(self, slots=1, cpus=4, memory=8 * 1024 ** 3, info=True):
+        if info:
+            info = json.dumps(
+                {'slots': slots, 'cpus': cpus, 'memory': memory,
+                 'graph-version': 2})
+        client = distbuild.create_socket()
+        client.connect(self.listener.getsockname())
+        server, _ = self.listener.accept()
+        self.sockets.extend([client, server])
+        for sock in (client, server):
+            distbuild.set_nonblocking(sock)
+
+        worker = FakeWorker(server, info or None)
+        self.loop.add_state_machine(worker)
+        cm = FakeConnectionMachine()
+        self.loop.add_state_machine(cm)
+        wc = distbuild.WorkerConnection(
+            cm, client, 'http://cache.example.com/', 8080, 'morph')
+        self.loop.add_state_machine(wc)
+        self.run_until(lambda: wc.state == 'connected')
+        self.settle()
+        return worker, wc, cm
+
+    def request(self, artifact, initiator='initiator', priority=0):
+        self.loop.queue_event(
+            distbuild.WorkerBuildQueuer,
+            distbuild.WorkerBuildRequest(artifact, initiator, priority))
+
+    def slots(self, wc):
+        return [m for m in self.loop._machines
+                if isinstance(m, distbuild.WorkerSlot) and
+                   m._worker is wc]
+
+    def build(self, worker, name):
+        self.run_until(lambda: any(b['argv'][-1] == name
+                                   for b in worker.builds))
+        return [b for b in worker.builds if b['argv'][-1] == name][-1]
+
+    def finish(self, worker, name, exit=0):
+        worker.respond(self.build(worker, name), exit=exit,
+                       stdout='building %s\n' % name)
+
+    def cache(self, status=200):
+        self.run_until(lambda: any('/1.0/fetch' in r['url']
+                                   for r in self.helper.requests))
+        request = self.helper.take('/1.0/fetch')
+        self.helper.respond(request, status=status, body='')
+        return request
+
+
+class WorkerConnectionTests(SchedulerTestCase):
+
+    def test_asks_the_worker_what_it_has(self):
+        worker, wc, cm = self.connect(slots=2, cpus=8)
+        self.assertEqual((wc.slots, wc.cpus, wc.memory, wc.graph_version),
+                         (2, 8, 8 * 1024 ** 3, 2))
+        self.assertEqual(sorted(s.name() for s in self.slots(wc)),
+                         ['%s/0' % wc.name(), '%s/1' % wc.name()])
+
+    def test_runs_one_job_on_a_worker_which_cannot_say(self):
+        worker, wc, cm = self.connect(info=False)
+        self.assertEqual((wc.slots, wc.cpus, wc.graph_version),
+                         (1, None, 1))
+        [slot] = self.slots(wc)
+        self.assertEqual(slot.name(), wc.name())
+
+    def test_gives_a_newer_worker_the_newest_graph_encoding_it_has(self):
+        client = distbuild.create_socket()
+        client.connect(self.listener.getsockname())
+        server, _ = self.listener.accept()
+        self.sockets.extend([client, server])
+        info = json.dumps({'slots': 1, 'cpus': 1, 'memory': 0,
+                           'graph-version': distbuild.GRAPH_VERSION + 1})
+        self.loop.add_state_machine(FakeWorker(server, info))
+        wc = distbuild.WorkerConnection(
+            None, client, 'http://cache.example.com/', 8080, 'morph')
+        self.loop.add_state_machine(wc)
+        self.run_until(lambda: wc.state == 'connected')
+        self.assertEqual(wc.graph_version, distbuild.GRAPH_VERSION)
+
+    def test_ignores_bad_worker_information(self):
+        for info in ['{', '{"slots": 2}', '{"slots": "two"}',
+                     '{"slots": 2, "cpus": 2, "memory": 0, '
+                     '"graph-version": "new"}']:
+            client = distbuild.create_socket()
+            client.connect(self.listener.getsockname())
+            server, _ = self.listener.accept()
+            self.sockets.extend([client, server])
+            worker = FakeWorker(server, info)
+            self.loop.add_state_machine(worker)
+            wc = distbuild.WorkerConnection(
+                None, client, 'http://cache.example.com/', 8080, 'morph')
+            self.loop.add_state_machine(wc)
+            self.run_until(lambda: wc.state == 'connected')
+            self.assertEqual((wc.slots, wc.cpus, wc.memory,
+                              wc.graph_version), (1, None, None, 1))
+
+    def test_uses_one_slot_for_each_gigabyte_of_memory(self):
+        worker, wc, cm = self.connect(slots=8, memory=3 * 1024 ** 3 + 1)
+        self.assertEqual(wc.slots, 3)
+        self.assertEqual(len(self.slots(wc)), 3)
+
+    def test_uses_asked_for_slots_when_memory_is_unknown(self):
+        worker, wc, cm = self.connect(slots=2, memory=0)
+        self.assertEqual(wc.slots, 2)
+
+    def test_ignores_messages_for_others_while_asking(self):
+        client = distbuild.create_socket()
+        client.connect(self.listener.getsockname())
+        server, _ = self.listener.accept()
+        self.sockets.extend([client, server])
+        worker = FakeWorker(server, '{}')
+        worker._handle_message = lambda event_source, event: None
+        self.loop.add_state_machine(worker)
+        wc = distbuild.WorkerConnection(
+            None, client, 'http://cache.example.com/', 8080, 'morph')
+        self.loop.add_state_machine(wc)
+        worker.respond({'id': 'something-else'})
+        self.settle()
+        self.assertEqual(wc.state, 'probing')
+
+    def test_reconnects_when_the_worker_goes_away_while_asked(self):
+        client = distbuild.create_socket()
+        client.connect(self.listener.getsockname())
+        server, _ = self.listener.accept()
+        self.sockets.extend([client, server])
+        worker = FakeWorker(server, '{}')
+        worker._handle_message = lambda event_source, event: None
+        self.loop.add_state_machine(worker)
+        cm = FakeConnectionMachine()
+        self.loop.add_state_machine(cm)
+        wc = distbuild.WorkerConnection(
+            cm, client, 'http://cache.example.com/', 8080, 'morph')
+        self.loop.add_state_machine(wc)
+        worker.disconnect()
+        self.run_until(lambda: cm.reconnects == 1)
+        self.assertEqual(wc.state, None)
+
+    def test_sets_keepalive_on_the_connection(self):
+        worker, wc, cm = self.connect()
+        self.assertTrue(wc._conn.getsockopt(
+            socket.SOL_SOCKET, socket.SO_KEEPALIVE))
+
+    def test_logs_what_it_sends_when_debugging(self):
+        worker, wc, cm = self.connect()
+        wc._debug_json = True
+        self.request(FakeArtifact('a'))
+        self.build(worker, 'a')
+
+    def test_estimates_cpus_for_jobs(self):
+        worker, wc, cm = self.connect(slots=2, cpus=8)
+        job = distbuild.worker_build_scheduler.Job
+        self.assertEqual(wc.job_cpus(job('1', FakeArtifact('a'), 'i')), 4)
+        self.assertEqual(
+            wc.job_cpus(job('2', FakeArtifact('b', max_jobs=1), 'i')), 1)
+        self.assertEqual(
+            wc.job_cpus(job('3', FakeArtifact('c', max_jobs=16), 'i')), 8)
+        self.assertEqual(
+            wc.job_cpus(job('4', FakeArtifact('s', kind='stratum'), 'i')),
+            1)
+
+    def test_does_not_estimate_cpus_when_it_does_not_know(self):
+        worker, wc, cm = self.connect(info=False)
+        job = distbuild.worker_build_scheduler.Job('1', FakeArtifact('a'), 'i')
+        self.assertEqual(wc.job_cpus(job), None)
+        self.assertTrue(wc.fits(job))
+        [slot] = self.slots(wc)
+        slot.reserve(job)
+        self.assertEqual(wc.reserved(slot), None)
+
+
+class MembershipTests(SchedulerTestCase):
+
+    def membership(self, names):
+        bloom = morphlib.bloomfilter.BloomFilter.for_capacity(100)
+        for name in names:
+            bloom.add(name)
+        return json.dumps({
+            'epoch': 1,
+            'version': 2,
+            'bits': bloom.bits,
+            'hashes': bloom.hashes,
+            'filter': base64.b64encode(bloom.tostring()),
+        })
+
+    def test_counts_what_the_worker_has_cached(self):
+        worker, wc, cm = self.connect()
+        self.assertEqual(wc.count_cached(['x']), 0)
+        request = self.helper.take('/1.0/membership')
+        self.assertEqual(urlparse.urlparse(request['url']).netloc,
+                         '127.0.0.1:8080')
+        self.helper.respond(request, body=self.membership(['x', 'y']))
+        self.settle()
+        self.assertEqual(wc.count_cached(['x', 'y', 'z']), 2)
+
+    def test_adds_what_the_worker_builds(self):
+        worker, wc, cm = self.connect()
+        self.helper.respond(self.helper.take('/1.0/membership'),
+                            body=self.membership(['x']))
+        dependency = FakeArtifact('d')
+        self.request(FakeArtifact('a', dependencies=[dependency]))
+        self.finish(worker, 'a')
+        self.cache()
+        self.settle()
+        self.assertEqual(
+            wc.count_cached([dependency.basename(), 'a-key.chunk.a']), 2)
+
+    def test_asks_again_for_changes_after_a_while(self):
+        worker, wc, cm = self.connect()
+        self.helper.respond(self.helper.take('/1.0/membership'),
+                            body=self.membership(['x']))
+        self.settle()
+        wc.refresh_membership()
+        self.assertEqual(self.helper.take('/1.0/membership'), None)
+        wc._membership_requested -= wc.MEMBERSHIP_REFRESH_INTERVAL
+        wc.refresh_membership()
+        wc.refresh_membership()
+        self.settle()
+        request = self.helper.take('/1.0/membership')
+        self.assertTrue('epoch=1' in request['url'])
+        self.assertEqual(self.helper.take('/1.0/membership'), None)
+
+    def test_ignores_a_bad_filter(self):
+        worker, wc, cm = self.connect()
+        self.helper.respond(self.helper.take('/1.0/membership'),
+                            body='{')
+        self.settle()
+        self.assertEqual(wc.count_cached(['x']), 0)
+
+    def test_ignores_a_failed_request(self):
+        worker, wc, cm = self.connect()
+        self.helper.respond(self.helper.take('/1.0/membership'),
+                            status=500)
+        self.settle()
+        self.assertEqual(wc.count_cached(['x']), 0)
+        self.assertNotEqual(wc._membership, None)
+
+    def test_stops_asking_a_server_without_filters(self):
+        worker, wc, cm = self.connect()
+        self.helper.respond(self.helper.take('/1.0/membership'),
+                            status=404)
+        self.settle()
+        self.assertEqual(wc.count_cached(['x']), 0)
+        wc._membership_requested = None
+        wc.refresh_membership()
+        wc.add_cached(['x'])
+        self.assertEqual(self.helper.take('/1.0/membership'), None)
+
+    def test_ignores_other_results(self):
+        worker, wc, cm = self.connect()
+        self.helper.respond({'id': 'something-else'})
+        self.settle()
+        self.assertNotEqual(wc._membership_id, None)
+
+
+class BuildTests(SchedulerTestCase):
+
+    def test_builds_and_caches_a_chunk(self):
+        worker, wc, cm = self.connect(slots=2, cpus=8)
+        self.request(FakeArtifact('a'))
+        build = self.build(worker, 'a')
+        self.assertEqual(build['argv'],
+                         ['morph', 'worker-build', '--build-log-on-stdout',
+                          '--max-jobs=6', 'a'])
+        self.assertEqual(build['stdin_contents'], 'a:2')
+        self.finish(worker, 'a')
+        request = self.cache()
+        self.assertTrue(
+            'artifacts=chunk.a,build-log' in request['url'])
+        self.assertTrue(request['url'].startswith(
+            'http://cache.example.com/1.0/fetch?host=127.0.0.1:8080&'))
+        self.settle()
+
+        [started] = self.recorder.of(distbuild.WorkerBuildStepStarted)
+        self.assertEqual(started.initiators, ['initiator'])
+        [output] = self.recorder.of(distbuild.WorkerBuildOutput)
+        self.assertEqual(output.msg['stdout'], 'building a\n')
+        self.assertEqual(len(self.recorder.of(distbuild.WorkerBuildCaching)),
+                         1)
+        [finished] = self.recorder.of(distbuild.WorkerBuildFinished)
+        self.assertEqual(finished.artifact_cache_key, 'a-key')
+        self.assertEqual(self.queuer._jobs.get_jobs(), {})
+
+    def test_caches_strata_with_their_metadata(self):
+        worker, wc, cm = self.connect()
+        self.request(FakeArtifact('s', kind='stratum'))
+        self.finish(worker, 's')
+        request = self.cache()
+        self.assertTrue('artifacts=stratum.s,stratum.s.meta'
+                        in request['url'])
+
+    def test_caches_systems(self):
+        worker, wc, cm = self.connect(info=False)
+        self.request(FakeArtifact('sys', kind='system'))
+        build = self.build(worker, 'sys')
+        self.assertFalse(any(a.startswith('--max-jobs')
+                             for a in build['argv']))
+        self.assertEqual(build['stdin_contents'], 'sys:1')
+        self.finish(worker, 'sys')
+        request = self.cache()
+        self.assertTrue(request['url'].endswith('artifacts=system.sys'))
+
+    def test_reports_a_failed_build(self):
+        worker, wc, cm = self.connect()
+        self.request(FakeArtifact('a'))
+        self.finish(worker, 'a', exit=1)
+        self.settle()
+        [failed] = self.recorder.of(distbuild.WorkerBuildFailed)
+        self.assertEqual(failed.msg['ids'], ['initiator'])
+        self.assertEqual(self.recorder.of(distbuild.WorkerBuildRetrying), [])
+        self.assertEqual(self.queuer._jobs.get_jobs(), {})
+
+    def test_ignores_messages_about_other_jobs(self):
+        worker, wc, cm = self.connect()
+        self.request(FakeArtifact('a'))
+        self.build(worker, 'a')
+        worker.respond({'id': 'something-else'}, exit=1)
+        self.settle()
+        self.assertEqual(self.recorder.of(distbuild.WorkerBuildFailed), [])
+
+    def test_runs_jobs_at_once_in_slots(self):
+        worker, wc, cm = self.connect(slots=2, cpus=8)
+        for name in 'abc':
+            self.request(FakeArtifact(name))
+        self.build(worker, 'a')
+        self.build(worker, 'b')
+        self.settle()
+        self.assertEqual(len(worker.builds), 2)
+        self.assertEqual(len(self.recorder.of(distbuild.WorkerBuildWaiting)),
+                         1)
+        self.finish(worker, 'a', exit=1)
+        self.build(worker, 'c')
+
+    def test_passes_over_jobs_which_need_more_cpus_than_are_free(self):
+        worker, wc, cm = self.connect(slots=2, cpus=8)
+        self.request(FakeArtifact('a'), priority=3)
+        self.request(FakeArtifact('big', max_jobs=8), priority=2)
+        self.request(FakeArtifact('c'), priority=1)
+        self.build(worker, 'a')
+        self.build(worker, 'c')
+        self.finish(worker, 'a', exit=1)
+        self.finish(worker, 'c', exit=1)
+        build = self.build(worker, 'big')
+        self.assertTrue('--max-jobs=12' in build['argv'])
+
+    def test_gives_a_job_to_the_worker_which_has_most_of_it(self):
+        first, first_wc, cm = self.connect()
+        second, second_wc, cm = self.connect()
+        dependency = FakeArtifact('d')
+        second_wc.add_cached = lambda names: None
+        second_wc.count_cached = lambda names: len(names)
+        self.request(FakeArtifact('a', dependencies=[dependency]))
+        self.build(second, 'a')
+        self.assertEqual(first.builds, [])
+
+    def test_tells_of_a_job_already_started(self):
+        worker, wc, cm = self.connect()
+        artifact = FakeArtifact('a')
+        self.request(artifact, initiator='first')
+        self.build(worker, 'a')
+        self.settle()
+        self.request(artifact, initiator='second')
+        self.settle()
+        [started] = self.recorder.of(distbuild.WorkerBuildStepAlreadyStarted)
+        self.assertEqual(started.initiator_id, 'second')
+
+    def test_tells_of_a_job_waiting(self):
+        artifact = FakeArtifact('a')
+        self.request(artifact, initiator='first')
+        self.request(artifact, initiator='second')
+        self.settle()
+        waiting = self.recorder.of(distbuild.WorkerBuildWaiting)
+        self.assertEqual([w.initiator_id for w in waiting],
+                         ['first', 'second'])
+
+    def test_cancels_a_job_nothing_else_wants(self):
+        worker, wc, cm = self.connect()
+        self.request(FakeArtifact('a'))
+        build = self.build(worker, 'a')
+        self.settle()
+        self.loop.queue_event(distbuild.BuildController,
+                              distbuild.BuildCancel('someone-else'))
+        self.loop.queue_event(distbuild.BuildController,
+                              distbuild.BuildCancel('initiator'))
+        self.run_until(lambda: worker.cancelled)
+        self.assertEqual(worker.cancelled, [build['id']])
+        self.settle()
+        self.assertEqual(self.queuer._jobs.get_jobs(), {})
+
+    def test_keeps_building_what_another_build_wants(self):
+        worker, wc, cm = self.connect()
+        artifact = FakeArtifact('a')
+        self.request(artifact, initiator='first')
+        self.request(artifact, initiator='second')
+        self.build(worker, 'a')
+        self.settle()
+        self.loop.queue_event(distbuild.BuildController,
+                              distbuild.BuildCancel('first'))
+        self.settle()
+        self.assertEqual(worker.cancelled, [])
+        [job] = self.queuer._jobs.get_jobs().values()
+        self.assertEqual(job.initiators, ['second'])
+
+    def test_forgets_waiting_jobs_of_cancelled_builds(self):
+        artifact = FakeArtifact('a')
+        self.request(artifact, initiator='first')
+        self.request(artifact, initiator='second')
+        self.request(FakeArtifact('b'), initiator='first')
+        self.request(FakeArtifact('c'), initiator='second')
+        self.settle()
+        self.loop.queue_event(distbuild.WorkerBuildQueuer,
+                              distbuild.WorkerCancelPending('first'))
+        self.settle()
+        jobs = self.queuer._jobs.get_jobs()
+        self.assertEqual(sorted(jobs), ['a-key.chunk.a', 'c-key.chunk.c'])
+        self.assertEqual(jobs['a-key.chunk.a'].initiators, ['second'])
+
+    def test_builds_first_what_a_later_build_wants_more(self):
+        self.request(FakeArtifact('a'), initiator='first', priority=1)
+        self.request(FakeArtifact('b'), initiator='first', priority=2)
+        self.request(FakeArtifact('a'), initiator='second', priority=3)
+        self.settle()
+        worker, wc, cm = self.connect()
+        self.build(worker, 'a')
+        self.assertEqual(len(worker.builds), 1)
+
+    def test_leaves_running_jobs_of_cancelled_builds_to_the_worker(self):
+        worker, wc, cm = self.connect()
+        self.request(FakeArtifact('a'))
+        self.build(worker, 'a')
+        self.settle()
+        self.loop.queue_event(distbuild.WorkerBuildQueuer,
+                              distbuild.WorkerCancelPending('initiator'))
+        self.settle()
+        self.assertEqual(len(self.queuer._jobs.get_jobs()), 1)
+
+    def test_records_how_long_builds_take(self):
+        recorded = []
+        self.queuer._build_priority.record = \
+            lambda artifact, seconds: recorded.append(artifact.name)
+        worker, wc, cm = self.connect()
+        self.request(FakeArtifact('a'))
+        self.finish(worker, 'a')
+        self.cache()
+        self.settle()
+        self.assertEqual(recorded, ['a'])
+
+
+class WorkerLossTests(SchedulerTestCase):
+
+    def test_gives_a_lost_job_to_another_worker(self):
+        first, first_wc, first_cm = self.connect()
+        self.request(FakeArtifact('a'))
+        lost = self.build(first, 'a')
+        second, second_wc, second_cm = self.connect()
+
+        first.disconnect()
+        build = self.build(second, 'a')
+        self.assertNotEqual(build['id'], lost['id'])
+        self.assertEqual(first_cm.reconnects, 1)
+        [retrying] = self.recorder.of(distbuild.WorkerBuildRetrying)
+        self.assertEqual(retrying.initiators, ['initiator'])
+        self.assertEqual(retrying.worker_name, first_wc.name())
+
+        self.finish(second, 'a')
+        self.cache()
+        self.settle()
+        self.assertEqual(len(self.recorder.of(distbuild.WorkerBuildFinished)),
+                         1)
+        self.assertEqual(self.recorder.of(distbuild.WorkerBuildFailed), [])
+
+    def test_fails_a_job_lost_too_many_times(self):
+        first, first_wc, cm = self.connect()
+        self.request(FakeArtifact('a'))
+        self.build(first, 'a')
+        first.disconnect()
+        second, second_wc, cm = self.connect()
+        self.build(second, 'a')
+        second.disconnect()
+        self.run_until(
+            lambda: self.recorder.of(distbuild.WorkerBuildFailed))
+        [failed] = self.recorder.of(distbuild.WorkerBuildFailed)
+        self.assertEqual(failed.msg['ids'], ['initiator'])
+        self.assertTrue('tried 2 times' in failed.msg['stderr'])
+        self.assertEqual(self.queuer._jobs.get_jobs(), {})
+
+    def test_tries_again_a_build_which_was_killed(self):
+        worker, wc, cm = self.connect()
+        self.request(FakeArtifact('a'))
+        self.finish(worker, 'a', exit=-9)
+        self.run_until(lambda: len(worker.builds) == 2)
+        [retrying] = self.recorder.of(distbuild.WorkerBuildRetrying)
+        self.assertTrue('signal 9' in retrying.reason)
+
+    def test_tries_again_a_build_whose_results_could_not_be_fetched(self):
+        worker, wc, cm = self.connect()
+        self.request(FakeArtifact('a'))
+        self.finish(worker, 'a')
+        self.cache(status=500)
+        self.run_until(lambda: len(worker.builds) == 2)
+        self.assertEqual(self.recorder.of(distbuild.WorkerBuildFailed), [])
+        self.assertEqual(len(self.recorder.of(distbuild.WorkerBuildRetrying)),
+                         1)
+
+    def test_keeps_a_build_whose_worker_goes_while_it_is_fetched(self):
+        worker, wc, cm = self.connect()
+        self.request(FakeArtifact('a'))
+        self.request(FakeArtifact('b'))
+        self.finish(worker, 'a')
+        self.run_until(lambda: any('/1.0/fetch' in r['url']
+                                   for r in self.helper.requests))
+        worker.disconnect()
+        self.run_until(lambda: cm.reconnects == 1)
+        self.cache()
+        self.settle()
+        self.assertEqual(len(self.recorder.of(distbuild.WorkerBuildFinished)),
+                         1)
+        self.assertEqual(self.slots(wc), [])
+        self.assertEqual(self.queuer._available_workers, [])
+        [job] = self.queuer._jobs.get_jobs().values()
+        self.assertEqual(job.artifact.name, 'b')
+
+    def test_forgets_idle_slots_of_a_lost_worker(self):
+        worker, wc, cm = self.connect(slots=2)
+        self.assertEqual(len(self.queuer._available_workers), 2)
+        worker.disconnect()
+        self.run_until(lambda: not self.queuer._available_workers)
+        self.request(FakeArtifact('a'))
+        self.settle()
+        self.assertEqual(len(self.recorder.of(distbuild.WorkerBuildWaiting)),
+                         1)
+
+    def test_puts_back_a_job_given_to_a_slot_which_was_lost(self):
+        worker, wc, cm = self.connect()
+        [slot] = self.slots(wc)
+        job = self.queuer._jobs.create(FakeArtifact('a'), 'initiator')
+        self.queuer._jobs.get_next_job()
+        job.who = slot
+        self.loop.queue_event(
+            distbuild.WorkerConnection,
+            distbuild.worker_build_scheduler._WorkerLost(slot))
+        self.settle()
+        self.assertEqual(job.who, None)
+        self.assertEqual(job.retries, 0)
+        self.assertEqual(self.queuer._jobs.get_next_job(), job)
+
+    def test_forgets_a_lost_job_nothing_wants(self):
+        worker, wc, cm = self.connect()
+        self.request(FakeArtifact('a'))
+        self.build(worker, 'a')
+        self.settle()
+        [job] = self.queuer._jobs.get_jobs().values()
+        job.initiators.remove('initiator')
+        worker.disconnect()
+        self.run_until(lambda: cm.reconnects == 1)
+        self.settle()
+        self.assertEqual(self.queuer._jobs.get_jobs(), {})
+        self.assertEqual(self.recorder.of(distbuild.WorkerBuildRetrying), [])
+
+    def test_ignores_a_lost_job_which_was_cancelled(self):
+        worker, wc, cm = self.connect()
+        [slot] = self.slots(wc)
+        job = distbuild.worker_build_scheduler.Job(
+            'old', FakeArtifact('a'), 'initiator')
+        self.loop.queue_event(
+            distbuild.WorkerConnection,
+            distbuild.worker_build_scheduler._JobLost(job, slot, 'Lost'))
+        self.settle()
+        self.assertEqual(self.recorder.of(distbuild.WorkerBuildRetrying), [])
+
+
+class WorkerBuildQueuerTests(unittest.TestCase):
+
+    def test_builds_first_what_most_depends_on_by_default(self):
+        queuer = distbuild.WorkerBuildQueuer()
+        self.assertTrue(isinstance(queuer._build_priority,
+                                   distbuild.DependentCountPriority))
+        self.assertEqual(queuer._job_retries, queuer.JOB_RETRIES)
+
+
+class JobsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.jobs = distbuild.worker_build_scheduler.Jobs(
+            distbuild.IdentifierGenerator('Job'))
+
+    def test_retries_a_job_with_a_new_id(self):
+        job = self.jobs.create(FakeArtifact('a'), 'initiator')
+        old_id = job.id
+        self.assertEqual(self.jobs.get_next_job(), job)
+        job.who = object()
+        job.running = True
+        self.jobs.retry(job)
+        self.assertNotEqual(job.id, old_id)
+        self.assertEqual((job.who, job.running, job.retries),
+                         (None, False, 1))
+        self.assertEqual(self.jobs.get_next_job(), job)
+
+    def test_warns_of_removing_a_job_which_does_not_exist(self):
+        self.jobs.remove(
+            distbuild.worker_build_scheduler.Job('1', FakeArtifact('a'), 'i'))
+        self.assertEqual(self.jobs.get_jobs(), {})
+
+    def test_lists_jobs(self):
+        self.jobs.create(FakeArtifact('a'), 'initiator')
+        self.assertEqual(repr(self.jobs), "['a-key.chunk.a']")
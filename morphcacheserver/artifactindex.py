@@ -0,0 +1,465 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import errno
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+DEFAULT_RESCAN_INTERVAL = 300
+
+# Access times of served artifacts are written to the index in batches.
+FLUSH_INTERVAL = 10
+MAX_PENDING = 1000
+
+# The membership filter starts a new epoch, sized for twice as many
+# artifacts as there are, once more artifacts than it was sized for
+# have been added, or this fraction of that many have been removed
+# again, since each leaves its bits behind.
+MIN_MEMBERSHIP_CAPACITY = 1024
+MAX_REMOVED_FRACTION = 0.25
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS artifacts (
+    name TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    used INTEGER NOT NULL,
+    atime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS artifacts_by_atime ON artifacts (atime, name);
+CREATE INDEX IF NOT EXISTS artifacts_by_kind ON artifacts (kind, name);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS additions (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pins (
+    name TEXT NOT NULL,
+    prefix TEXT NOT NULL,
+    PRIMARY KEY (name, prefix)
+);
+CREATE TABLE IF NOT EXISTS digests (
+    name TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    digest TEXT NOT NULL
+);
+'''
+
+
+def default_index_file(artifact_dir):
+    """Return where to keep the index of artifact_dir, if not told.
+
+    The index is kept in a directory of its own in artifact_dir, so
+    that writing to it, and to the journal SQLite keeps beside it, does
+    not change the modification time of artifact_dir itself, which
+    ArtifactIndex.refresh looks at to tell whether to scan it.
+
+    """
+    index_dir = os.path.join(artifact_dir, '.index')
+    try:
+        os.mkdir(index_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    return os.path.join(index_dir, 'artifacts.sqlite')
+
+
+def split_name(name):
+    """Return the (cache key, kind) of an artifact file name.
+
+    Artifacts are called <cache key>.<kind>.<name>, and their metadata
+    the same with a further suffix. Metadata for a whole source is
+    called <cache key>.<metadata name>, which is taken as the kind.
+
+    """
+    parts = name.split('.', 2)
+    return parts[0], parts[1] if len(parts) > 1 else ''
+
+
+class ArtifactIndex(object):
+
+    """An index of the files in the artifact directory.
+
+    The index is an SQLite database, which the server keeps up to date
+    as it adds, removes and serves artifacts, so that listing them needs
+    neither a walk of the directory nor a stat of every file. Changes
+    made to the directory behind the server's back are picked up by
+    scanning it again, at most every rescan_interval seconds, when it
+    has changed.
+
+    Names starting with a '.' are left out. These are downloads in
+    progress and the index itself.
+
+    The index also keeps the SHA-256 digest of each file, once it is
+    known, so that the server processes need not each work it out.
+
+    """
+
+    def __init__(self, artifact_dir, index_file,
+                 rescan_interval=DEFAULT_RESCAN_INTERVAL):
+        self.artifact_dir = artifact_dir
+        self.index_file = index_file
+        self.rescan_interval = rescan_interval
+        self._lock = threading.RLock()
+        self._scan_lock = threading.Lock()
+        self._db = None
+        self._pid = None
+        self._pending = {}
+        self._flushed = time.time()
+
+    def _connection(self):
+        # Connections cannot be shared with forked processes.
+        if self._db is None or self._pid != os.getpid():
+            self._db = sqlite3.connect(self.index_file, timeout=60,
+                                       check_same_thread=False)
+            self._db.executescript(SCHEMA)
+            self._pid = os.getpid()
+        return self._db
+
+    def _row(self, name, stinfo=None):
+        if stinfo is None:
+            stinfo = os.stat(os.path.join(self.artifact_dir, name))
+        return (name, split_name(name)[1], stinfo.st_size,
+                stinfo.st_blocks * 512, max(stinfo.st_atime, stinfo.st_mtime))
+
+    def add(self, name, digest=None):
+        """Add or update the entry for a file in the artifact directory.
+
+        digest is the base64 SHA-256 digest of the file, if the caller
+        worked it out as it wrote the file.
+
+        """
+        stinfo = os.stat(os.path.join(self.artifact_dir, name))
+        with self._lock:
+            db = self._connection()
+            with db:
+                db.execute('INSERT OR REPLACE INTO artifacts '
+                           'VALUES (?, ?, ?, ?, ?)', self._row(name, stinfo))
+                db.execute('INSERT INTO additions (name) VALUES (?)',
+                           (name,))
+                if digest is None:
+                    db.execute('DELETE FROM digests WHERE name = ?', (name,))
+                else:
+                    self._set_digest(db, name, stinfo, digest)
+
+    def remove(self, name):
+        with self._lock:
+            self._pending.pop(name, None)
+            db = self._connection()
+            with db:
+                db.execute('DELETE FROM digests WHERE name = ?', (name,))
+                if db.execute('DELETE FROM artifacts WHERE name = ?',
+                              (name,)).rowcount:
+                    self._count_removed(db, 1)
+
+    def digest(self, name, stinfo):
+        """Return the recorded digest of a file, or None.
+
+        stinfo is the os.stat() of the file. The digest is only returned
+        if the file still has the size and modification time it had
+        when the digest was recorded.
+
+        """
+        with self._lock:
+            row = self._connection().execute(
+                'SELECT size, mtime, digest FROM digests WHERE name = ?',
+                (name,)).fetchone()
+        if row is None or row[:2] != (stinfo.st_size, stinfo.st_mtime):
+            return None
+        return row[2]
+
+    def set_digest(self, name, stinfo, digest):
+        """Record the digest of a file whose os.stat() is stinfo."""
+        with self._lock:
+            db = self._connection()
+            with db:
+                self._set_digest(db, name, stinfo, digest)
+
+    def _set_digest(self, db, name, stinfo, digest):
+        db.execute('INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?)',
+                   (name, stinfo.st_size, stinfo.st_mtime, digest))
+
+    def _count_removed(self, db, count):
+        db.execute("INSERT OR REPLACE INTO state VALUES ('removed', "
+                   "IFNULL((SELECT value FROM state WHERE key = 'removed'), "
+                   "0) + ?)", (count,))
+
+    def touch(self, name):
+        """Record that a file has just been served."""
+        with self._lock:
+            self._pending[name] = time.time()
+            if (len(self._pending) >= MAX_PENDING or
+                    time.time() - self._flushed >= FLUSH_INTERVAL):
+                self.flush()
+
+    def flush(self):
+        """Write the access times recorded by touch to the index."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._flushed = time.time()
+            if not pending:
+                return
+            db = self._connection()
+            with db:
+                db.executemany(
+                    'UPDATE artifacts SET atime = max(atime, ?) '
+                    'WHERE name = ?',
+                    [(atime, name) for name, atime in pending.iteritems()])
+
+    def refresh(self):
+        """Scan the directory if it may have changed since the last scan.
+
+        A directory which has never been scanned is always scanned.
+
+        """
+        mtime = os.stat(self.artifact_dir).st_mtime
+        with self._lock:
+            state = dict(self._connection().execute(
+                'SELECT key, value FROM state'))
+        scanned = state.get('scanned')
+        if scanned is not None:
+            if state.get('mtime') == mtime:
+                return
+            if time.time() - scanned < self.rescan_interval:
+                return
+        self.scan()
+
+    def scan(self):
+        """Bring the index into line with the directory.
+
+        The directory is listed, and new files looked at, without
+        holding the lock which serving artifacts needs.
+
+        """
+        with self._scan_lock:
+            started = time.time()
+            mtime = os.stat(self.artifact_dir).st_mtime
+            # Files added to the index after this are in the listing, or
+            # were added after it and are left alone.
+            with self._lock:
+                indexed = set(row[0] for row in self._connection().execute(
+                    'SELECT name FROM artifacts'))
+            present = set(name for name in os.listdir(self.artifact_dir)
+                          if not name.startswith('.'))
+            rows = []
+            for name in present - indexed:
+                try:
+                    rows.append(self._row(name))
+                except OSError:
+                    # It has already gone again.
+                    present.discard(name)
+            self._update(started, mtime, indexed, present, rows)
+
+    def _update(self, started, mtime, indexed, present, rows):
+        with self._lock:
+            # A file may have been put back since the directory was read.
+            gone = [name for name in indexed - present
+                    if not os.path.exists(
+                        os.path.join(self.artifact_dir, name))]
+            db = self._connection()
+            with db:
+                db.executemany('INSERT OR REPLACE INTO artifacts '
+                               'VALUES (?, ?, ?, ?, ?)', rows)
+                db.executemany('INSERT INTO additions (name) VALUES (?)',
+                               [(row[0],) for row in rows])
+                db.executemany('DELETE FROM artifacts WHERE name = ?',
+                               [(name,) for name in gone])
+                db.executemany('DELETE FROM digests WHERE name = ?',
+                               [(name,) for name in gone])
+                self._count_removed(db, len(gone))
+                db.executemany('INSERT OR REPLACE INTO state VALUES (?, ?)',
+                               [('scanned', started), ('mtime', mtime)])
+        logging.info('Scanned %s: %d files added to the index, '
+                     '%d removed' % (self.artifact_dir, len(rows), len(gone)))
+
+    def stats(self):
+        """Return the number of indexed files, and the space they use."""
+        with self._lock:
+            row = self._connection().execute(
+                'SELECT COUNT(*), SUM(used) FROM artifacts').fetchone()
+        return row[0], row[1] or 0
+
+    def total_used(self):
+        """Return the disk space the indexed files take up, in bytes."""
+        return self.stats()[1]
+
+    def pins(self):
+        """Return a dict of the cache key prefixes in each pinned set."""
+        with self._lock:
+            rows = self._connection().execute(
+                'SELECT name, prefix FROM pins ORDER BY name, prefix')
+            pins = {}
+            for name, prefix in rows:
+                pins.setdefault(name, []).append(prefix)
+        return pins
+
+    def set_pins(self, name, prefixes):
+        """Pin the artifacts whose cache keys start with prefixes.
+
+        This replaces whatever the set called name pinned before.
+
+        """
+        with self._lock:
+            db = self._connection()
+            with db:
+                db.execute('DELETE FROM pins WHERE name = ?', (name,))
+                db.executemany('INSERT OR REPLACE INTO pins VALUES (?, ?)',
+                               [(name, prefix) for prefix in prefixes])
+
+    def remove_pins(self, name):
+        with self._lock:
+            db = self._connection()
+            with db:
+                db.execute('DELETE FROM pins WHERE name = ?', (name,))
+
+    def membership(self, epoch=None, since=None):
+        """Return what is needed to bring a membership filter up to date.
+
+        The filter holds the names of all the artifacts in the index. It
+        is versioned by the sequence number of the last name added to
+        it, and within an epoch, which starts when the filter needs to
+        be made again from scratch.
+
+        Returns (epoch, capacity, version, names, complete). capacity is
+        how many names the filter is to be sized for. If epoch is the
+        current epoch and since a version in it, names are those added
+        since that version and complete is False. Otherwise, names are
+        all of them and complete is True.
+
+        """
+        with self._lock:
+            db = self._connection()
+            # Starting a new epoch removes the names added in the last
+            # one, so this must not interleave with another process.
+            # The sqlite3 module does not know about transactions it did
+            # not begin itself, so they are left entirely to SQLite.
+            db.isolation_level = None
+            try:
+                db.execute('BEGIN IMMEDIATE')
+                try:
+                    result = self._membership(db, epoch, since)
+                except BaseException:
+                    db.execute('ROLLBACK')
+                    raise
+                db.execute('COMMIT')
+            finally:
+                db.isolation_level = ''
+        return result
+
+    def _membership(self, db, epoch, since):
+        state = dict(db.execute('SELECT key, value FROM state'))
+        count = db.execute('SELECT COUNT(*) FROM artifacts').fetchone()[0]
+        row = db.execute("SELECT seq FROM sqlite_sequence "
+                         "WHERE name = 'additions'").fetchone()
+        version = int(row[0]) if row else 0
+
+        current = state.get('epoch')
+        capacity = state.get('capacity')
+        if (current is None or count > capacity or
+                state.get('removed', 0) > capacity * MAX_REMOVED_FRACTION):
+            current = version
+            capacity = max(MIN_MEMBERSHIP_CAPACITY, 2 * count)
+            db.executemany('INSERT OR REPLACE INTO state VALUES (?, ?)',
+                           [('epoch', current), ('capacity', capacity),
+                            ('removed', 0)])
+            db.execute('DELETE FROM additions WHERE seq <= ?', (current,))
+        current, capacity = int(current), int(capacity)
+
+        if epoch == current and since is not None and \
+                current <= since <= version:
+            names = [row[0] for row in db.execute(
+                'SELECT name FROM additions WHERE seq > ? ORDER BY seq',
+                (since,))]
+            return current, capacity, version, names, False
+        names = [row[0] for row in db.execute('SELECT name FROM artifacts')]
+        return current, capacity, version, names, True
+
+    def list(self, prefix='', kind=None, min_age=None, max_age=None,
+             order='name', after=None, limit=None):
+        """Return (entries, cursor) for the files matching a query.
+
+        prefix is the start of the cache key, kind the part of the name
+        after it, and min_age and max_age bound the seconds since each
+        file was last used. Files are ordered by name, or with order
+        'atime' by when they were last used, least recently first.
+
+        Each entry is a dict of name, kind, size, used (the space it
+        takes on disk) and atime. If limit stopped the listing short,
+        cursor is a string to pass as after to get the next page, and
+        otherwise it is None. ValueError is raised for a limit less
+        than 1, or an order which is neither of these.
+
+        """
+        if limit is not None and limit < 1:
+            raise ValueError('limit must be positive')
+        self.flush()
+        clauses = []
+        params = []
+        if prefix:
+            clauses.append('name >= ? AND name < ?')
+            params.extend([prefix, prefix[:-1] + unichr(ord(prefix[-1]) + 1)])
+        if kind:
+            clauses.append('kind = ?')
+            params.append(kind)
+        now = time.time()
+        if min_age is not None:
+            clauses.append('atime <= ?')
+            params.append(now - min_age)
+        if max_age is not None:
+            clauses.append('atime >= ?')
+            params.append(now - max_age)
+
+        if order == 'atime':
+            columns = 'atime, name'
+            if after is not None:
+                atime, _, name = after.partition(' ')
+                clauses.append('(atime > ? OR (atime = ? AND name > ?))')
+                params.extend([float(atime), float(atime), name])
+        elif order == 'name':
+            columns = 'name'
+            if after is not None:
+                clauses.append('name > ?')
+                params.append(after)
+        else:
+            raise ValueError('cannot order artifacts by %s' % order)
+
+        query = 'SELECT name, kind, size, used, atime FROM artifacts'
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+        query += ' ORDER BY ' + columns
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(limit + 1)
+
+        with self._lock:
+            rows = self._connection().execute(query, params).fetchall()
+        cursor = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            cursor = last[0] if order == 'name' else \
+                '%r %s' % (last[4], last[0])
+        entries = [dict(zip(('name', 'kind', 'size', 'used', 'atime'), row))
+                   for row in rows]
+        return entries, cursor
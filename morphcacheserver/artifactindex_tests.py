@@ -0,0 +1,459 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from morphcacheserver import artifactindex
+from morphcacheserver.artifactindex import ArtifactIndex
+
+
+class SplitNameTests(unittest.TestCase):
+
+    def test_splits_an_artifact_name(self):
+        self.assertEqual(artifactindex.split_name('abc.chunk.foo-misc'),
+                         ('abc', 'chunk'))
+
+    def test_takes_the_metadata_name_of_a_source_as_its_kind(self):
+        self.assertEqual(artifactindex.split_name('abc.meta'),
+                         ('abc', 'meta'))
+
+    def test_gives_a_name_without_a_dot_no_kind(self):
+        self.assertEqual(artifactindex.split_name('abc'), ('abc', ''))
+
+
+class DefaultIndexFileTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_makes_a_directory_for_the_index(self):
+        index_file = artifactindex.default_index_file(self.tempdir)
+        self.assertEqual(os.path.dirname(index_file),
+                         os.path.join(self.tempdir, '.index'))
+        self.assertTrue(os.path.isdir(os.path.dirname(index_file)))
+
+    def test_uses_the_directory_it_made_before(self):
+        self.assertEqual(artifactindex.default_index_file(self.tempdir),
+                         artifactindex.default_index_file(self.tempdir))
+
+    def test_fails_without_the_artifact_directory(self):
+        self.assertRaises(OSError, artifactindex.default_index_file,
+                          os.path.join(self.tempdir, 'missing'))
+
+
+class ArtifactIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.artifact_dir = os.path.join(self.tempdir, 'artifacts')
+        os.mkdir(self.artifact_dir)
+        self.index_file = artifactindex.default_index_file(self.artifact_dir)
+        self.index = ArtifactIndex(self.artifact_dir, self.index_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def create(self, name, size=10, atime=None):
+        filename = os.path.join(self.artifact_dir, name)
+        with open(filename, 'w') as f:
+            f.write('x' * size)
+        if atime is not None:
+            os.utime(filename, (atime, atime))
+        return filename
+
+    def names(self, **kwargs):
+        entries, cursor = self.index.list(**kwargs)
+        return [entry['name'] for entry in entries], cursor
+
+    def test_is_empty_at_first(self):
+        self.assertEqual(self.index.stats(), (0, 0))
+        self.assertEqual(self.index.total_used(), 0)
+        self.assertEqual(self.index.list(), ([], None))
+
+    def test_lists_an_added_file(self):
+        self.create('abc.chunk.foo', 100, atime=1000)
+        self.index.add('abc.chunk.foo')
+        entries, cursor = self.index.list()
+        self.assertEqual(cursor, None)
+        self.assertEqual(len(entries), 1)
+        entry = entries[0]
+        self.assertEqual(entry['name'], 'abc.chunk.foo')
+        self.assertEqual(entry['kind'], 'chunk')
+        self.assertEqual(entry['size'], 100)
+        self.assertEqual(entry['atime'], 1000)
+        self.assertEqual(self.index.stats(), (1, entry['used']))
+        self.assertEqual(self.index.total_used(), entry['used'])
+
+    def test_updates_a_file_added_again(self):
+        self.create('abc.chunk.foo', 100)
+        self.index.add('abc.chunk.foo')
+        self.create('abc.chunk.foo', 200)
+        self.index.add('abc.chunk.foo')
+        [entry], cursor = self.index.list()
+        self.assertEqual(entry['size'], 200)
+
+    def test_forgets_a_removed_file(self):
+        self.create('abc.chunk.foo')
+        self.index.add('abc.chunk.foo')
+        self.index.touch('abc.chunk.foo')
+        self.index.remove('abc.chunk.foo')
+        self.index.remove('abc.chunk.foo')
+        self.assertEqual(self.names(), ([], None))
+
+    def test_records_when_files_were_served(self):
+        self.create('abc.chunk.foo', atime=1000)
+        self.index.add('abc.chunk.foo')
+        before = time.time()
+        self.index.touch('abc.chunk.foo')
+        [entry], cursor = self.index.list()
+        self.assertTrue(entry['atime'] >= before)
+
+    def test_writes_access_times_in_batches(self):
+        self.create('abc.chunk.foo', atime=1000)
+        self.index.add('abc.chunk.foo')
+        self.index.touch('abc.chunk.foo')
+        other = ArtifactIndex(self.artifact_dir, self.index_file)
+        [entry], cursor = other.list()
+        self.assertEqual(entry['atime'], 1000)
+        self.index.flush()
+        [entry], cursor = other.list()
+        self.assertTrue(entry['atime'] > 1000)
+
+    def test_writes_access_times_once_enough_are_waiting(self):
+        names = ['%03d.chunk.foo' % i
+                 for i in xrange(artifactindex.MAX_PENDING)]
+        for name in names:
+            self.create(name, atime=1000)
+            self.index.add(name)
+        for name in names:
+            self.index.touch(name)
+        other = ArtifactIndex(self.artifact_dir, self.index_file)
+        entries, cursor = other.list()
+        self.assertTrue(all(entry['atime'] > 1000 for entry in entries))
+
+    def test_writes_access_times_after_a_while(self):
+        self.create('abc.chunk.foo', atime=1000)
+        self.index.add('abc.chunk.foo')
+        self.index._flushed -= artifactindex.FLUSH_INTERVAL
+        self.index.touch('abc.chunk.foo')
+        other = ArtifactIndex(self.artifact_dir, self.index_file)
+        [entry], cursor = other.list()
+        self.assertTrue(entry['atime'] > 1000)
+
+    def test_scans_a_directory_it_has_never_scanned(self):
+        self.create('abc.chunk.foo')
+        self.create('.dl.abc.chunk.bar')
+        self.index.refresh()
+        self.assertEqual(self.names(), (['abc.chunk.foo'], None))
+
+    def test_does_not_scan_an_unchanged_directory(self):
+        os.utime(self.artifact_dir, (1000, 1000))
+        self.index.scan()
+        self.create('abc.chunk.foo')
+        os.utime(self.artifact_dir, (1000, 1000))
+        self.index.rescan_interval = 0
+        self.index.refresh()
+        self.assertEqual(self.names(), ([], None))
+
+    def test_does_not_change_the_directory_by_writing_the_index(self):
+        self.create('abc.chunk.foo')
+        self.index.refresh()
+        os.utime(self.artifact_dir, (1000, 1000))
+        self.index.add('abc.chunk.foo')
+        self.index.set_pins('release', ['abc'])
+        self.index.touch('abc.chunk.foo')
+        self.index.flush()
+        self.assertEqual(os.stat(self.artifact_dir).st_mtime, 1000)
+
+    def test_waits_for_the_rescan_interval_to_scan_again(self):
+        self.index.refresh()
+        self.create('abc.chunk.foo')
+        os.utime(self.artifact_dir, (1000, 1000))
+        self.index.refresh()
+        self.assertEqual(self.names(), ([], None))
+        self.index.rescan_interval = 0
+        self.index.refresh()
+        self.assertEqual(self.names(), (['abc.chunk.foo'], None))
+
+    def test_scan_finds_added_and_removed_files(self):
+        self.create('abc.chunk.foo')
+        self.index.add('abc.chunk.foo')
+        os.remove(os.path.join(self.artifact_dir, 'abc.chunk.foo'))
+        self.create('def.chunk.foo')
+        self.index.scan()
+        self.assertEqual(self.names(), (['def.chunk.foo'], None))
+
+    def test_scan_skips_files_which_vanish_while_it_looks(self):
+        os.symlink('missing', os.path.join(self.artifact_dir, 'abc.chunk'))
+        self.index.scan()
+        self.assertEqual(self.names(), ([], None))
+
+    def list_artifact_dir_with(self, function):
+        listdir = os.listdir
+        def list_and_call(path):
+            names = listdir(path)
+            function()
+            return names
+        os.listdir = list_and_call
+        try:
+            self.index.scan()
+        finally:
+            os.listdir = listdir
+
+    def test_answers_lookups_while_it_lists_the_directory(self):
+        def look_up():
+            thread = threading.Thread(target=self.index.stats)
+            thread.start()
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+        self.list_artifact_dir_with(look_up)
+
+    def test_scan_keeps_files_put_back_while_it_looks(self):
+        self.create('abc.chunk.foo')
+        self.index.add('abc.chunk.foo')
+        os.rename(os.path.join(self.artifact_dir, 'abc.chunk.foo'),
+                  os.path.join(self.artifact_dir, '.abc.chunk.foo'))
+        self.list_artifact_dir_with(
+            lambda: os.rename(
+                os.path.join(self.artifact_dir, '.abc.chunk.foo'),
+                os.path.join(self.artifact_dir, 'abc.chunk.foo')))
+        self.assertEqual(self.names(), (['abc.chunk.foo'], None))
+
+    def test_has_no_digest_for_a_file_at_first(self):
+        filename = self.create('abc.chunk.foo')
+        self.index.add('abc.chunk.foo')
+        self.assertEqual(
+            self.index.digest('abc.chunk.foo', os.stat(filename)), None)
+
+    def test_records_the_digest_of_an_added_file(self):
+        filename = self.create('abc.chunk.foo')
+        self.index.add('abc.chunk.foo', 'digest')
+        other = ArtifactIndex(self.artifact_dir, self.index_file)
+        self.assertEqual(
+            other.digest('abc.chunk.foo', os.stat(filename)), 'digest')
+
+    def test_records_the_digest_of_a_file_later(self):
+        filename = self.create('abc.chunk.foo')
+        self.index.add('abc.chunk.foo')
+        self.index.set_digest('abc.chunk.foo', os.stat(filename), 'digest')
+        self.assertEqual(
+            self.index.digest('abc.chunk.foo', os.stat(filename)), 'digest')
+
+    def test_forgets_the_digest_of_a_changed_file(self):
+        filename = self.create('abc.chunk.foo', 10)
+        self.index.add('abc.chunk.foo', 'digest')
+        self.create('abc.chunk.foo', 20)
+        self.assertEqual(
+            self.index.digest('abc.chunk.foo', os.stat(filename)), None)
+        os.utime(filename, (1000, 1000))
+        self.index.set_digest('abc.chunk.foo', os.stat(filename), 'digest')
+        os.utime(filename, (2000, 2000))
+        self.assertEqual(
+            self.index.digest('abc.chunk.foo', os.stat(filename)), None)
+
+    def test_forgets_the_digest_of_a_file_added_again(self):
+        filename = self.create('abc.chunk.foo')
+        self.index.add('abc.chunk.foo', 'digest')
+        self.index.add('abc.chunk.foo')
+        self.assertEqual(
+            self.index.digest('abc.chunk.foo', os.stat(filename)), None)
+
+    def test_forgets_the_digest_of_a_removed_file(self):
+        filename = self.create('abc.chunk.foo')
+        stinfo = os.stat(filename)
+        self.index.add('abc.chunk.foo', 'digest')
+        self.index.remove('abc.chunk.foo')
+        self.assertEqual(self.index.digest('abc.chunk.foo', stinfo), None)
+
+    def test_scan_forgets_the_digests_of_files_which_are_gone(self):
+        filename = self.create('abc.chunk.foo')
+        stinfo = os.stat(filename)
+        self.index.add('abc.chunk.foo', 'digest')
+        os.remove(filename)
+        self.index.scan()
+        self.assertEqual(self.index.digest('abc.chunk.foo', stinfo), None)
+
+    def test_keeps_pinned_sets(self):
+        self.assertEqual(self.index.pins(), {})
+        self.index.set_pins('release', ['abc', 'def', 'abc'])
+        self.index.set_pins('other', ['123'])
+        self.assertEqual(self.index.pins(),
+                         {'release': ['abc', 'def'], 'other': ['123']})
+        self.index.set_pins('release', ['ghi'])
+        self.assertEqual(self.index.pins()['release'], ['ghi'])
+        self.index.remove_pins('release')
+        self.assertEqual(self.index.pins(), {'other': ['123']})
+
+    def test_lists_by_prefix(self):
+        for name in ('ab.chunk.foo', 'abc.chunk.foo', 'ac.chunk.foo'):
+            self.create(name)
+            self.index.add(name)
+        self.assertEqual(self.names(prefix='ab'),
+                         (['ab.chunk.foo', 'abc.chunk.foo'], None))
+
+    def test_lists_by_kind(self):
+        for name in ('abc.chunk.foo', 'abc.stratum.foo', 'abc.meta'):
+            self.create(name)
+            self.index.add(name)
+        self.assertEqual(self.names(kind='stratum'),
+                         (['abc.stratum.foo'], None))
+
+    def test_lists_by_age(self):
+        now = time.time()
+        for name, age in (('a.chunk', 10), ('b.chunk', 100),
+                          ('c.chunk', 1000)):
+            self.create(name, atime=now - age)
+            self.index.add(name)
+        self.assertEqual(self.names(min_age=50), (['b.chunk', 'c.chunk'],
+                                                 None))
+        self.assertEqual(self.names(max_age=500), (['a.chunk', 'b.chunk'],
+                                                  None))
+        self.assertEqual(self.names(min_age=50, max_age=500),
+                         (['b.chunk'], None))
+
+    def test_lists_least_recently_used_first(self):
+        for name, atime in (('a.chunk', 300), ('b.chunk', 100),
+                            ('c.chunk', 200)):
+            self.create(name, atime=atime)
+            self.index.add(name)
+        self.assertEqual(self.names(order='atime'),
+                         (['b.chunk', 'c.chunk', 'a.chunk'], None))
+
+    def test_pages_through_names(self):
+        names = ['%d.chunk' % i for i in xrange(5)]
+        for name in names:
+            self.create(name)
+            self.index.add(name)
+        listed = []
+        cursor = None
+        while True:
+            page, cursor = self.names(limit=2, after=cursor)
+            self.assertTrue(len(page) <= 2)
+            listed.extend(page)
+            if cursor is None:
+                break
+        self.assertEqual(listed, names)
+
+    def test_pages_through_access_times(self):
+        for i in xrange(5):
+            # Two files were last used at each time.
+            self.create('%d.chunk' % i, atime=1000 + i // 2)
+            self.index.add('%d.chunk' % i)
+        listed = []
+        cursor = None
+        while True:
+            page, cursor = self.names(order='atime', limit=2, after=cursor)
+            listed.extend(page)
+            if cursor is None:
+                break
+        self.assertEqual(listed, ['%d.chunk' % i for i in xrange(5)])
+
+    def test_gives_no_cursor_for_the_last_full_page(self):
+        for name in ('a.chunk', 'b.chunk'):
+            self.create(name)
+            self.index.add(name)
+        self.assertEqual(self.names(limit=2), (['a.chunk', 'b.chunk'], None))
+
+    def test_rejects_a_limit_less_than_one(self):
+        self.create('a.chunk')
+        self.index.add('a.chunk')
+        self.assertRaises(ValueError, self.index.list, limit=0)
+        self.assertRaises(ValueError, self.index.list, limit=-1)
+
+    def test_rejects_an_unknown_order(self):
+        self.assertRaises(ValueError, self.index.list, order='size')
+
+    def test_reconnects_in_a_forked_process(self):
+        db = self.index._connection()
+        self.index._pid = -1
+        self.assertNotEqual(self.index._connection(), db)
+
+
+class MembershipTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.index = ArtifactIndex(self.tempdir,
+                                   os.path.join(self.tempdir, '.index'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def add(self, *names):
+        for name in names:
+            open(os.path.join(self.tempdir, name), 'w').close()
+            self.index.add(name)
+
+    def test_starts_with_everything(self):
+        self.add('a.chunk', 'b.chunk')
+        epoch, capacity, version, names, complete = self.index.membership()
+        self.assertEqual(capacity, artifactindex.MIN_MEMBERSHIP_CAPACITY)
+        self.assertEqual(version, 2)
+        self.assertEqual(sorted(names), ['a.chunk', 'b.chunk'])
+        self.assertTrue(complete)
+
+    def test_gives_the_names_added_since_a_version(self):
+        self.add('a.chunk')
+        epoch, capacity, version, names, complete = self.index.membership()
+        self.add('b.chunk', 'c.chunk')
+        result = self.index.membership(epoch, version)
+        self.assertEqual(result,
+                         (epoch, capacity, version + 2,
+                          ['b.chunk', 'c.chunk'], False))
+
+    def test_gives_everything_for_another_epoch(self):
+        self.add('a.chunk')
+        epoch, capacity, version, names, complete = self.index.membership()
+        result = self.index.membership(epoch + 1, version)
+        self.assertEqual(result[3:], (['a.chunk'], True))
+
+    def test_starts_a_new_epoch_once_too_many_are_added(self):
+        self.index.membership()
+        self.add(*['%d.chunk' % i for i in
+                   xrange(artifactindex.MIN_MEMBERSHIP_CAPACITY + 1)])
+        epoch, capacity, version, names, complete = self.index.membership()
+        self.assertEqual(epoch, version)
+        self.assertEqual(capacity,
+                         2 * (artifactindex.MIN_MEMBERSHIP_CAPACITY + 1))
+        self.assertTrue(complete)
+
+    def test_starts_a_new_epoch_once_too_many_are_removed(self):
+        names = ['%d.chunk' % i for i in xrange(300)]
+        self.add(*names)
+        epoch, capacity, version, listed, complete = self.index.membership()
+        for name in names:
+            self.index.remove(name)
+        self.add('a.chunk')
+        result = self.index.membership(epoch, version)
+        self.assertNotEqual(result[0], epoch)
+        self.assertEqual(result[3:], (['a.chunk'], True))
+
+    def test_rolls_back_when_it_fails(self):
+        def fail(db, epoch, since):
+            raise RuntimeError('failed')
+        self.index._membership = fail
+        self.assertRaises(RuntimeError, self.index.membership)
+        del self.index._membership
+        self.add('a.chunk')
+        self.assertEqual(self.index.membership()[3], ['a.chunk'])
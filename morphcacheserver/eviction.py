@@ -0,0 +1,155 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import fcntl
+import logging
+import os
+import threading
+import time
+
+
+DEFAULT_INTERVAL = 60
+
+# Evicting stops once this fraction of the quota is in use, so that it
+# is not needed again after every new artifact.
+LOW_WATER = 0.9
+
+# Candidates are read from the index this many at a time.
+BATCH_SIZE = 1000
+
+LOCK_FILE = '.evict.lock'
+
+
+class Evictor(threading.Thread):
+
+    """Keep the artifact directory within a disk quota.
+
+    Every interval seconds, if the artifacts indexed in the ArtifactIndex
+    take up more than quota bytes, the least recently used ones are
+    removed until they take up no more than LOW_WATER of it.
+
+    Artifacts whose cache keys start with a pinned prefix are never
+    removed, nor are files which are being read through
+    staticfile.open_shared. Files being written are named with a
+    leading '.' until they are complete, so they are not in the index
+    and are never candidates. Files a front end web server is sending
+    for X-Sendfile can be removed, but stay readable until it is done.
+
+    Several server processes may each run an Evictor on the same
+    directory: a lock file makes sure only one of them evicts at once.
+
+    """
+
+    def __init__(self, index, quota, interval=DEFAULT_INTERVAL,
+                 metrics=None):
+        threading.Thread.__init__(self, name='evictor')
+        self.daemon = True
+        self.index = index
+        self.quota = quota
+        self.interval = interval
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.counter('evicted_artifacts_total',
+                            'Artifacts removed to meet the quota')
+            metrics.counter('evicted_bytes_total',
+                            'Disk space freed to meet the quota')
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.evict()
+            except Exception:
+                logging.exception('Evicting artifacts failed')
+
+    def evict(self):
+        """Remove artifacts until the quota is met.
+
+        Returns the number of files removed.
+
+        """
+        lock_file = os.path.join(self.index.artifact_dir, LOCK_FILE)
+        with open(lock_file, 'a') as lock:
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                # Another process is evicting already.
+                return 0
+            return self._evict()
+
+    def _evict(self):
+        self.index.refresh()
+        used = self.index.total_used()
+        if used <= self.quota:
+            return 0
+
+        target = self.quota * LOW_WATER
+        pinned = tuple(prefix for prefixes in self.index.pins().itervalues()
+                       for prefix in prefixes)
+        removed = freed = skipped = 0
+        cursor = None
+        while used > target:
+            entries, cursor = self.index.list(order='atime', after=cursor,
+                                              limit=BATCH_SIZE)
+            for entry in entries:
+                if used <= target:
+                    break
+                if pinned and entry['name'].startswith(pinned):
+                    continue
+                if self._remove(entry['name']):
+                    removed += 1
+                    freed += entry['used']
+                    used -= entry['used']
+                else:
+                    skipped += 1
+            if cursor is None:
+                break
+
+        if self.metrics is not None:
+            self.metrics.inc('evicted_artifacts_total', removed)
+            self.metrics.inc('evicted_bytes_total', freed)
+        logging.info('Evicted %d artifacts, freeing %d bytes; %d in use '
+                     'were kept; %d bytes used of a quota of %d' %
+                     (removed, freed, skipped, used, self.quota))
+        if used > self.quota:
+            logging.warning('Artifacts still use %d bytes, more than the '
+                            'quota of %d: the rest are pinned or in use' %
+                            (used, self.quota))
+        return removed
+
+    def _remove(self, name):
+        """Remove an artifact unless it is in use.
+
+        Returns True if it was removed, or had gone already.
+
+        """
+        filename = os.path.join(self.index.artifact_dir, name)
+        try:
+            f = open(filename, 'rb')
+        except IOError:
+            self.index.remove(name)
+            return True
+        with f:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return False
+            # Readers which open the file now wait for this lock, and
+            # then read the file, which stays readable after removal.
+            os.unlink(filename)
+        self.index.remove(name)
+        logging.debug('Evicted %s' % name)
+        return True
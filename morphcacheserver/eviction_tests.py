@@ -0,0 +1,164 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import fcntl
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from morphcacheserver import eviction, staticfile
+from morphcacheserver.artifactindex import ArtifactIndex
+from morphcacheserver.eviction import Evictor
+from morphcacheserver.metrics import Metrics
+
+
+class LogRecorder(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class EvictorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.artifact_dir = os.path.join(self.tempdir, 'artifacts')
+        os.mkdir(self.artifact_dir)
+        self.index = ArtifactIndex(self.artifact_dir,
+                                   os.path.join(self.artifact_dir, '.index'))
+        # Ten artifacts, k0 the least recently used, each taking up one
+        # unit of disk space.
+        self.names = ['k%d.chunk.foo' % i for i in xrange(10)]
+        for i, name in enumerate(self.names):
+            filename = os.path.join(self.artifact_dir, name)
+            with open(filename, 'w') as f:
+                f.write('x' * 4096)
+            os.utime(filename, (1000 + i, 1000 + i))
+            self.index.add(name)
+        self.unit = self.index.total_used() / len(self.names)
+        self.metrics = Metrics()
+
+        self.log = LogRecorder()
+        self.level = logging.getLogger().level
+        logging.getLogger().addHandler(self.log)
+        logging.getLogger().setLevel(logging.INFO)
+
+    def tearDown(self):
+        logging.getLogger().removeHandler(self.log)
+        logging.getLogger().setLevel(self.level)
+        shutil.rmtree(self.tempdir)
+
+    def evictor(self, units, **kwargs):
+        return Evictor(self.index, units * self.unit, **kwargs)
+
+    def remaining(self):
+        return [name for name in self.names
+                if os.path.exists(os.path.join(self.artifact_dir, name))]
+
+    def test_removes_nothing_within_the_quota(self):
+        self.assertEqual(self.evictor(10).evict(), 0)
+        self.assertEqual(self.remaining(), self.names)
+
+    def test_removes_the_least_recently_used_down_to_low_water(self):
+        # 90% of 8 units is 7.2, so three artifacts must go.
+        evictor = self.evictor(8, metrics=self.metrics)
+        self.assertEqual(evictor.evict(), 3)
+        self.assertEqual(self.remaining(), self.names[3:])
+        self.assertEqual(self.index.total_used(), 7 * self.unit)
+        text = self.metrics.render_text()
+        self.assertTrue(
+            'morph_cache_server_evicted_artifacts_total 3' in text)
+        self.assertTrue(
+            'morph_cache_server_evicted_bytes_total %d' % (3 * self.unit)
+            in text)
+
+    def test_reads_candidates_a_batch_at_a_time(self):
+        batch_size = eviction.BATCH_SIZE
+        eviction.BATCH_SIZE = 2
+        try:
+            self.assertEqual(self.evictor(8).evict(), 3)
+        finally:
+            eviction.BATCH_SIZE = batch_size
+        self.assertEqual(self.remaining(), self.names[3:])
+
+    def test_keeps_pinned_artifacts(self):
+        self.index.set_pins('release', ['k0', 'k2'])
+        self.assertEqual(self.evictor(8).evict(), 3)
+        self.assertEqual(self.remaining(),
+                         self.names[:1] + self.names[2:3] + self.names[5:])
+
+    def test_skips_and_counts_artifacts_being_read(self):
+        f = staticfile.open_shared(
+            os.path.join(self.artifact_dir, self.names[0]))
+        with f:
+            self.assertEqual(self.evictor(8).evict(), 3)
+        self.assertEqual(self.remaining(),
+                         self.names[:1] + self.names[4:])
+        self.assertTrue(
+            'Evicted 3 artifacts, freeing %d bytes; 1 in use were kept; '
+            '%d bytes used of a quota of %d' %
+            (3 * self.unit, 7 * self.unit, 8 * self.unit)
+            in self.log.messages)
+
+    def test_drops_artifacts_which_have_gone_from_the_index(self):
+        # The index is not scanned again so soon, so it still has k0.
+        self.index.scan()
+        os.remove(os.path.join(self.artifact_dir, self.names[0]))
+        self.assertEqual(self.evictor(8).evict(), 3)
+        self.assertEqual(self.remaining(), self.names[3:])
+        names = [entry['name'] for entry in self.index.list(limit=100)[0]]
+        self.assertEqual(sorted(names), self.names[3:])
+
+    def test_warns_if_it_cannot_meet_the_quota(self):
+        self.index.set_pins('everything', ['k'])
+        self.assertEqual(self.evictor(8).evict(), 0)
+        self.assertEqual(self.remaining(), self.names)
+        self.assertTrue(
+            'Artifacts still use %d bytes, more than the quota of %d: the '
+            'rest are pinned or in use' % (10 * self.unit, 8 * self.unit)
+            in self.log.messages)
+
+    def test_only_one_evicts_at_once(self):
+        with open(os.path.join(self.artifact_dir, eviction.LOCK_FILE),
+                  'a') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self.assertEqual(self.evictor(8).evict(), 0)
+            self.assertEqual(self.remaining(), self.names)
+        self.assertEqual(self.evictor(8).evict(), 3)
+
+    def test_keeps_evicting_every_interval_after_a_failure(self):
+        evictor = self.evictor(8, interval=0.01)
+        calls = []
+        done = threading.Event()
+        def evict():
+            calls.append(None)
+            if len(calls) == 1:
+                raise Exception('evicting failed')
+            done.set()
+            # The thread cannot be stopped, so it waits here for good.
+            threading.Event().wait()
+        evictor.evict = evict
+        evictor.start()
+        done.wait(10)
+        self.assertTrue(len(calls) >= 2)
+        self.assertTrue('Evicting artifacts failed' in self.log.messages)
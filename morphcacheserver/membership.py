@@ -0,0 +1,86 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import base64
+import threading
+
+from morphlib.bloomfilter import BloomFilter
+
+
+class MembershipPublisher(object):
+
+    """Publish a Bloom filter of the artifacts in an ArtifactIndex.
+
+    Clients which have a copy of the filter ask for what has changed
+    since their version, and get the names added since, unless that
+    would be bigger than the whole filter, or their copy is from an
+    earlier epoch, when they get the whole filter again. The replies
+    are what morphlib.bloomfilter.MembershipFilter.update() expects.
+
+    The whole filter is kept in memory, and brought up to date with the
+    names added to the index since it was made, so that it only needs
+    making from scratch once per epoch.
+
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self._lock = threading.Lock()
+        self._epoch = None
+        self._version = None
+        self._filter = None
+        self._encoded = None
+
+    def reply(self, epoch=None, since=None):
+        """Return the reply to a client with a copy from since in epoch.
+
+        With no epoch or since, the whole filter is returned.
+
+        """
+        with self._lock:
+            if epoch is not None and since is not None:
+                current, capacity, version, names, complete = \
+                    self.index.membership(epoch, since)
+                if not complete and self._is_small(names, capacity):
+                    return {
+                        'epoch': current,
+                        'version': version,
+                        'added': names,
+                    }
+            return self._whole()
+
+    def _is_small(self, names, capacity):
+        # The whole filter takes about 1.2 bytes for each name it is
+        # sized for, and a third more once it is base64 encoded.
+        return sum(len(name) + 4 for name in names) < capacity * 8 / 5
+
+    def _whole(self):
+        current, capacity, version, names, complete = \
+            self.index.membership(self._epoch, self._version)
+        if complete:
+            self._filter = BloomFilter.for_capacity(capacity)
+        for name in names:
+            self._filter.add(name)
+        if complete or names or self._encoded is None:
+            self._encoded = base64.b64encode(self._filter.tostring())
+        self._epoch, self._version = current, version
+        return {
+            'epoch': current,
+            'version': version,
+            'bits': self._filter.bits,
+            'hashes': self._filter.hashes,
+            'filter': self._encoded,
+        }
@@ -0,0 +1,308 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import collections
+import contextlib
+import logging
+import threading
+import time
+import types
+
+from morphcacheserver import staticfile
+
+
+# Upper bounds, in seconds, of the buckets request and git lookup times
+# are counted in.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+TEXT_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, (int, long)):
+        return str(value)
+    return repr(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', r'\\')
+                     .replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in labels)
+
+
+class Metrics(object):
+
+    """Counters, gauges and histograms of how the server is doing.
+
+    Metrics are declared with counter(), gauge() and histogram(), and
+    then given values, each set of labels separately, with inc(), set()
+    and observe(). Functions added with add_collector() are called
+    before the values are read, to set gauges for things which are
+    cheaper to look at than to keep track of, and counters for things
+    which something else counts already.
+
+    The values can be read in the Prometheus text format, which most
+    monitoring systems can scrape, or as JSON. Each server process
+    keeps its own.
+
+    """
+
+    def __init__(self, prefix='morph_cache_server'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._declared = collections.OrderedDict()
+        self._values = {}
+        self._collectors = []
+
+    def _declare(self, name, kind, help, buckets=None):
+        self._declared[name] = (kind, help, buckets)
+        self._values.setdefault(name, {})
+
+    def counter(self, name, help):
+        self._declare(name, 'counter', help)
+
+    def gauge(self, name, help):
+        self._declare(name, 'gauge', help)
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        self._declare(name, 'histogram', help, tuple(buckets))
+
+    def add_collector(self, function):
+        self._collectors.append(function)
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.iteritems()))
+        with self._lock:
+            values = self._values[name]
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = tuple(sorted(labels.iteritems()))
+        with self._lock:
+            self._values[name][key] = value
+
+    def observe(self, name, value, **labels):
+        buckets = self._declared[name][2]
+        key = tuple(sorted(labels.iteritems()))
+        with self._lock:
+            values = self._values[name]
+            counts = values.get(key)
+            if counts is None:
+                # A count for each bucket, then the sum and the count.
+                counts = values[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Observe how long the body of a with statement takes."""
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - started, **labels)
+
+    def _collect(self):
+        for collector in self._collectors:
+            try:
+                collector(self)
+            except Exception:
+                logging.exception('Collecting metrics failed')
+        with self._lock:
+            return [(name, kind, help, buckets,
+                     sorted((labels, list(value) if kind == 'histogram'
+                             else value)
+                            for labels, value
+                            in self._values[name].iteritems()))
+                    for name, (kind, help, buckets)
+                    in self._declared.iteritems()]
+
+    def render_text(self):
+        """Return the metrics in the Prometheus text format."""
+        lines = []
+        for name, kind, help, buckets, samples in self._collect():
+            full_name = '%s_%s' % (self.prefix, name)
+            lines.append('# HELP %s %s' % (full_name, help))
+            lines.append('# TYPE %s %s' % (full_name, kind))
+            for labels, value in samples:
+                if kind != 'histogram':
+                    lines.append('%s%s %s' % (full_name,
+                                              _format_labels(labels),
+                                              _format_value(value)))
+                    continue
+                for bound, count in zip(buckets + (float('inf'),),
+                                        value[:-2] + [value[-1]]):
+                    lines.append('%s_bucket%s %d' % (
+                        full_name,
+                        _format_labels(labels + (('le',
+                                                  _format_value(bound)),)),
+                        count))
+                lines.append('%s_sum%s %s' % (
+                    full_name, _format_labels(labels),
+                    _format_value(value[-2])))
+                lines.append('%s_count%s %d' % (
+                    full_name, _format_labels(labels), value[-1]))
+        return '\n'.join(lines) + '\n'
+
+    def render_json(self):
+        """Return the metrics as a dict which can be dumped as JSON."""
+        metrics = {}
+        for name, kind, help, buckets, samples in self._collect():
+            entries = []
+            for labels, value in samples:
+                entry = {'labels': dict(labels)}
+                if kind == 'histogram':
+                    entry['buckets'] = [[bound, count] for bound, count
+                                        in zip(buckets, value[:-2])]
+                    entry['sum'] = value[-2]
+                    entry['count'] = value[-1]
+                else:
+                    entry['value'] = value
+                entries.append(entry)
+            metrics[name] = {'type': kind, 'help': help, 'samples': entries}
+        return metrics
+
+
+class MetricsMiddleware(object):
+
+    """WSGI middleware which counts and times the requests to an app.
+
+    Requests are labelled by route, which is their path if it is one
+    of routes, and 'other' if not. A request is timed until its whole
+    response has been sent, including any file body sent by a server
+    which provides staticfile.SENDFILE_KEY. Requests which take at
+    least slow_threshold seconds are logged, unless it is zero.
+
+    """
+
+    def __init__(self, app, metrics, routes, slow_threshold=0):
+        self.app = app
+        self.metrics = metrics
+        self.routes = set(routes)
+        self.slow_threshold = slow_threshold
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+        metrics.counter('requests_total',
+                        'Requests handled, by route, method and status')
+        metrics.histogram('request_duration_seconds',
+                          'Time taken to handle and send each response')
+        metrics.counter('response_bytes_total',
+                        'Bytes of response bodies sent')
+        metrics.gauge('requests_in_flight',
+                      'Requests being handled now')
+        metrics.add_collector(self._collect)
+
+    def _collect(self, metrics):
+        metrics.set('requests_in_flight', self._in_flight)
+
+    def __call__(self, environ, start_response):
+        started = time.time()
+        path = environ.get('PATH_INFO', '')
+        route = path if path in self.routes else 'other'
+        method = environ.get('REQUEST_METHOD', 'GET')
+        state = {'status': '500', 'bytes': 0, 'done': False}
+
+        def finish():
+            if state['done']:
+                return
+            state['done'] = True
+            with self._lock:
+                self._in_flight -= 1
+            self._record(environ, route, method, state['status'],
+                         state['bytes'], time.time() - started)
+
+        def recording_start_response(status, headers, exc_info=None):
+            state['status'] = status.split(' ', 1)[0]
+            return start_response(status, headers, exc_info)
+
+        send_file = environ.get(staticfile.SENDFILE_KEY)
+        if send_file is not None:
+            def recording_send_file(f):
+                region = staticfile.file_region(f)
+                if region is not None:
+                    state['bytes'] += region[2]
+                send_file(f)
+            environ[staticfile.SENDFILE_KEY] = recording_send_file
+
+        with self._lock:
+            self._in_flight += 1
+        try:
+            result = self.app(environ, recording_start_response)
+        except BaseException:
+            finish()
+            raise
+
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if isinstance(file_wrapper, (type, types.ClassType)) and \
+                isinstance(result, file_wrapper):
+            # Left alone, so that the server can still send it with
+            # sendfile(2). Its time is that taken to be ready to send.
+            region = staticfile.file_region(getattr(result, 'filelike',
+                                                    None))
+            if region is not None:
+                state['bytes'] += region[2]
+            finish()
+            return result
+        return _RecordingIterable(result, state, finish)
+
+    def _record(self, environ, route, method, status, size, seconds):
+        metrics = self.metrics
+        metrics.inc('requests_total', route=route, method=method,
+                    status=status)
+        metrics.observe('request_duration_seconds', seconds, route=route,
+                        method=method)
+        metrics.inc('response_bytes_total', size, route=route,
+                    method=method)
+        if self.slow_threshold > 0 and seconds >= self.slow_threshold:
+            url = environ.get('PATH_INFO', '')
+            if environ.get('QUERY_STRING'):
+                url += '?' + environ['QUERY_STRING']
+            logging.warning('Slow request: %s %s from %s: %s after %.3f s, '
+                            '%d bytes' % (method, url,
+                                          environ.get('REMOTE_ADDR', '-'),
+                                          status, seconds, size))
+
+
+class _RecordingIterable(object):
+
+    def __init__(self, result, state, finish):
+        self.result = result
+        self.state = state
+        self.finish = finish
+
+    def __iter__(self):
+        for data in self.result:
+            self.state['bytes'] += len(data)
+            yield data
+
+    def close(self):
+        try:
+            if hasattr(self.result, 'close'):
+                self.result.close()
+        finally:
+            self.finish()
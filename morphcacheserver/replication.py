@@ -0,0 +1,325 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import fcntl
+import hashlib
+import json
+import logging
+import multiprocessing.pool
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urllib
+import urllib2
+
+from morphcacheserver.eviction import LOW_WATER
+from morphlib import contentdigest
+from morphlib.savefile import ResumableSaveFile
+
+
+DEFAULT_INTERVAL = 300
+DEFAULT_JOBS = 4
+
+# Artifacts are listed by the upstream server this many at a time.
+MANIFEST_PAGE_SIZE = 1000
+
+# Give up on an upstream server which sends nothing for this many
+# seconds.
+TIMEOUT = 300
+
+# Partly downloaded artifacts are kept under this prefix, so that the
+# download can carry on from where it stopped. Ones left alone for
+# longer than PARTIAL_MAX_AGE seconds are removed.
+PARTIAL_PREFIX = '.part.'
+PARTIAL_MAX_AGE = 24 * 60 * 60
+
+LOCK_FILE = '.replicate.lock'
+
+# Replicas keep the branches and tags of the upstream repositories.
+REFSPECS = ['+refs/heads/*:refs/heads/*', '+refs/tags/*:refs/tags/*']
+
+
+def is_artifact_name(name):
+    return bool(name) and '/' not in name and not name.startswith('.')
+
+
+def is_repo_path(path):
+    parts = path.split('/')
+    return bool(path) and not path.startswith('/') and all(
+        part and not part.startswith('.') for part in parts)
+
+
+class Replicator(threading.Thread):
+
+    """Keep this cache server a replica of an upstream one.
+
+    Every interval seconds, the upstream server's /1.0/manifest is
+    compared with the artifact directory, a page at a time, and the
+    artifacts missing here are downloaded, jobs at once. Downloads are
+    checked against the Digest the upstream server sends. A download
+    which is interrupted is kept, and carried on with a Range request
+    the next time round.
+
+    If git_url is given, the upstream server's /1.0/repos is compared
+    with the repositories here too, and those whose branches and tags
+    differ are fetched, or cloned, from git_url followed by the path
+    of the repository, such as a git daemon serving the upstream
+    server's repository directory.
+
+    If the artifact directory has a quota of quota bytes, artifacts are
+    only copied while the indexed artifacts take up less than the
+    LOW_WATER fraction of it, which is what an Evictor removes artifacts
+    down to. Otherwise each artifact the Evictor removed would be copied
+    again the next time round, only to be removed again.
+
+    A lock file makes sure only one server process replicates at once.
+
+    """
+
+    def __init__(self, app, index, repo_cache, upstream, git_url=None,
+                 interval=DEFAULT_INTERVAL, jobs=DEFAULT_JOBS, metrics=None,
+                 quota=None):
+        threading.Thread.__init__(self, name='replicator')
+        self.daemon = True
+        self.app = app
+        self.index = index
+        self.repo_cache = repo_cache
+        self.upstream = upstream
+        self.git_url = git_url
+        self.interval = interval
+        self.jobs = jobs
+        self.metrics = metrics
+        self.quota = quota
+        if metrics is not None:
+            metrics.counter('replicated_artifacts_total',
+                            'Artifacts copied from the upstream server, '
+                            'by result')
+            metrics.counter('replicated_repos_total',
+                            'Repositories updated from upstream, by result')
+
+    def run(self):
+        while True:
+            try:
+                self.replicate()
+            except Exception:
+                logging.exception('Replicating from %s failed'
+                                  % self.upstream)
+            time.sleep(self.interval)
+
+    def replicate(self):
+        """Copy what is missing here from the upstream server.
+
+        Returns False if another process is replicating already.
+
+        """
+        lock_file = os.path.join(self.index.artifact_dir, LOCK_FILE)
+        with open(lock_file, 'a') as lock:
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return False
+            pool = multiprocessing.pool.ThreadPool(max(1, self.jobs))
+            try:
+                if self.git_url:
+                    self._replicate_repos(pool)
+                self._replicate_artifacts(pool)
+            finally:
+                pool.close()
+                pool.join()
+        return True
+
+    def _get_json(self, path, **query):
+        url = 'http://%s/1.0/%s' % (self.upstream, path)
+        if query:
+            url += '?' + urllib.urlencode(query)
+        response = urllib2.urlopen(url, timeout=TIMEOUT)
+        try:
+            return json.load(response)
+        finally:
+            response.close()
+
+    def _replicate_repos(self, pool):
+        upstream = self._get_json('repos')
+        local = self.repo_cache.list_repos()
+        changed = sorted(path for path, digest in upstream.iteritems()
+                         if is_repo_path(path) and local.get(path) != digest)
+        results = pool.map(self._update_repo, changed)
+        self._count('replicated_repos_total', results)
+        logging.info('Updated %d of %d repositories from %s, %d failed'
+                     % (results.count(True), len(upstream), self.git_url,
+                        results.count(False)))
+
+    def _update_repo(self, path):
+        url = '%s/%s' % (self.git_url.rstrip('/'), path)
+        repo_dir = os.path.join(self.repo_cache.repo_cache_dir, path)
+        try:
+            if os.path.exists(repo_dir):
+                self.app.runcmd(['git', 'fetch', '--quiet', '--prune', url]
+                                + REFSPECS, cwd=repo_dir)
+            else:
+                # Cloning into a hidden directory and renaming it means a
+                # clone which is interrupted is never taken for a
+                # repository.
+                parent = os.path.dirname(repo_dir)
+                if not os.path.isdir(parent):
+                    os.makedirs(parent)
+                tempdir = tempfile.mkdtemp(dir=parent, prefix='.clone.')
+                try:
+                    self.app.runcmd(['git', 'clone', '--quiet', '--bare',
+                                     url, tempdir])
+                    os.rename(tempdir, repo_dir)
+                except BaseException:
+                    shutil.rmtree(tempdir, ignore_errors=True)
+                    raise
+        except Exception, e:
+            logging.error('Failed to update %s from %s: %s'
+                          % (repo_dir, url, e))
+            return False
+        logging.debug('Updated %s from %s' % (repo_dir, url))
+        return True
+
+    def _replicate_artifacts(self, pool):
+        self._remove_stale_partials()
+        artifact_dir = self.index.artifact_dir
+        room = None
+        if self.quota is not None:
+            room = self.quota * LOW_WATER - self.index.total_used()
+        listed = fetched = failed = left_out = 0
+        cursor = None
+        while True:
+            query = {'limit': MANIFEST_PAGE_SIZE}
+            if cursor is not None:
+                query['after'] = cursor
+            manifest = self._get_json('manifest', **query)
+            missing = []
+            for name, size in manifest['artifacts']:
+                if (not is_artifact_name(name) or
+                        os.path.exists(os.path.join(artifact_dir, name))):
+                    continue
+                if room is not None:
+                    if size > room:
+                        left_out += 1
+                        continue
+                    room -= size
+                missing.append(name)
+            results = pool.map(self._fetch, missing)
+            self._count('replicated_artifacts_total', results)
+            listed += len(manifest['artifacts'])
+            fetched += results.count(True)
+            failed += results.count(False)
+            cursor = manifest.get('next')
+            if cursor is None:
+                break
+        logging.info('Replicated %d of %d artifacts from %s, %d failed'
+                     % (fetched, listed, self.upstream, failed))
+        if left_out:
+            logging.warning('Left out %d artifacts from %s, to stay within '
+                            'the quota of %d bytes'
+                            % (left_out, self.upstream, self.quota))
+
+    def _count(self, name, results):
+        if self.metrics is not None:
+            self.metrics.inc(name, results.count(True), result='ok')
+            self.metrics.inc(name, results.count(False), result='failed')
+
+    def _remove_stale_partials(self):
+        artifact_dir = self.index.artifact_dir
+        for name in os.listdir(artifact_dir):
+            if not name.startswith(PARTIAL_PREFIX):
+                continue
+            partial = os.path.join(artifact_dir, name)
+            try:
+                if time.time() - os.stat(partial).st_mtime > PARTIAL_MAX_AGE:
+                    os.remove(partial)
+            except OSError:
+                pass
+
+    def _fetch(self, name):
+        try:
+            self._download(name)
+        except Exception, e:
+            logging.error('Failed to replicate %s from %s: %s'
+                          % (name, self.upstream, e))
+            return False
+        logging.debug('Replicated %s from %s' % (name, self.upstream))
+        return True
+
+    def _download(self, name):
+        artifact_dir = self.index.artifact_dir
+        url = 'http://%s/1.0/artifacts?filename=%s' % (
+            self.upstream, urllib.quote(name))
+        local = ResumableSaveFile(
+            os.path.join(artifact_dir, name),
+            os.path.join(artifact_dir, PARTIAL_PREFIX + name))
+        try:
+            response = self._open_rest(url, local)
+            try:
+                headers = response.info()
+                length = headers.getheader('Content-Length')
+                expected = (local.offset + int(length)
+                            if length is not None else None)
+                checksum = self._checksum_partial(local)
+                while True:
+                    data = response.read(1024 * 1024)
+                    if not data:
+                        break
+                    local.write(data)
+                    checksum.update(data)
+                size = local.tell()
+            finally:
+                response.close()
+            if expected is not None and size < expected:
+                raise IOError('download stopped %d bytes short, and will be '
+                              'carried on next time' % (expected - size))
+        except BaseException:
+            if local.tell() > 0:
+                local.suspend()
+            else:
+                local.abort()
+            raise
+
+        digest = contentdigest.parse_header(headers.getheader('Digest'))
+        if digest is not None and digest != contentdigest.encode(checksum):
+            local.abort()
+            raise IOError('download does not match its digest')
+        os.fchmod(local.fileno(), 0644)
+        local.close()
+        self.index.add(name, digest)
+
+    def _open_rest(self, url, local):
+        """Ask for the part of an artifact which local does not have."""
+        request = urllib2.Request(url)
+        if local.offset > 0:
+            request.add_header('Range', 'bytes=%d-' % local.offset)
+        try:
+            response = urllib2.urlopen(request, timeout=TIMEOUT)
+        except urllib2.HTTPError, e:
+            if e.code != 416 or local.offset == 0:
+                raise
+            # What was downloaded is no longer a part of the file.
+            local.restart()
+            return urllib2.urlopen(url, timeout=TIMEOUT)
+        if local.offset > 0 and response.getcode() != 206:
+            local.restart()
+        return response
+
+    def _checksum_partial(self, local):
+        if local.offset == 0:
+            return hashlib.sha256()
+        with open(local.name, 'rb') as f:
+            return contentdigest.checksum_file(f)
@@ -0,0 +1,419 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import base64
+import cliapp
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import urlparse
+import wsgiref.simple_server
+
+from morphcacheserver import replication, staticfile
+from morphcacheserver.artifactindex import ArtifactIndex
+from morphcacheserver.metrics import Metrics
+from morphcacheserver.replication import Replicator
+from morphcacheserver.repocache import RepoCache
+
+
+def git(cwd, *args):
+    return cliapp.runcmd(
+        ['git', '-c', 'user.name=Tester', '-c', 'user.email=tester@test']
+        + list(args), cwd=cwd)
+
+
+class QuietRequestHandler(wsgiref.simple_server.WSGIRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+class Upstream(object):
+
+    """A cache server with just what a Replicator asks it for.
+
+    Artifacts are served with staticfile.serve_file, unless the
+    attributes say to get them wrong. Each request is recorded.
+
+    """
+
+    def __init__(self, artifact_dir, repo_cache):
+        self.artifact_dir = artifact_dir
+        self.repo_cache = repo_cache
+        self.extra_repos = {}
+        self.extra_artifacts = []
+        self.requests = []
+        # Send only this many bytes of the next artifact, but give the
+        # whole length in its Content-Length.
+        self.cut_short = None
+        self.wrong_digest = False
+        self.ignore_range = False
+
+    def __call__(self, environ, start_response):
+        query = dict(urlparse.parse_qsl(environ.get('QUERY_STRING', '')))
+        path = environ['PATH_INFO']
+        self.requests.append((path, query, environ.get('HTTP_RANGE')))
+        if path == '/1.0/manifest':
+            return self._json(start_response, self._manifest(**query))
+        elif path == '/1.0/repos':
+            repos = self.repo_cache.list_repos()
+            repos.update(self.extra_repos)
+            return self._json(start_response, repos)
+        else:
+            return self._artifact(environ, start_response,
+                                  query['filename'])
+
+    def _json(self, start_response, value):
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        return [json.dumps(value)]
+
+    def _manifest(self, limit, after=''):
+        names = sorted(name for name in
+                       os.listdir(self.artifact_dir) + self.extra_artifacts
+                       if name > after)
+        page = names[:int(limit)]
+        manifest = {'artifacts': [[name, self._size(name)] for name in page]}
+        if len(names) > len(page):
+            manifest['next'] = page[-1]
+        return manifest
+
+    def _size(self, name):
+        filename = os.path.join(self.artifact_dir, name)
+        return os.path.getsize(filename) if os.path.exists(filename) else 0
+
+    def _artifact(self, environ, start_response, name):
+        filename = os.path.join(self.artifact_dir, name)
+        if not os.path.exists(filename):
+            start_response('404 Not Found', [])
+            return []
+        if self.ignore_range:
+            environ.pop('HTTP_RANGE', None)
+        status, headers, body = staticfile.serve_file(filename, environ)
+        with open(filename, 'rb') as f:
+            data = f.read()
+        if self.wrong_digest:
+            data += 'wrong'
+        headers.append(('Digest', 'SHA-256=%s' % base64.b64encode(
+            hashlib.sha256(data).digest())))
+        start_response('%d Status' % status, headers)
+        if status not in (200, 206):
+            return []
+        if self.cut_short is not None:
+            data = body.read(self.cut_short)
+            body.close()
+            self.cut_short = None
+            return [data]
+        return environ['wsgi.file_wrapper'](body)
+
+
+class LogRecorder(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class ReplicatorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.app = cliapp.Application()
+
+        self.upstream_dir = self.mkdir('upstream', 'artifacts')
+        self.upstream_gits = self.mkdir('upstream', 'gits')
+        self.upstream = Upstream(
+            self.upstream_dir,
+            RepoCache(self.app, self.upstream_gits, None, True))
+        self.server = wsgiref.simple_server.make_server(
+            '127.0.0.1', 0, self.upstream,
+            handler_class=QuietRequestHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       args=(0.01,))
+        self.thread.start()
+
+        self.artifact_dir = self.mkdir('artifacts')
+        self.gits = self.mkdir('gits')
+        self.index = ArtifactIndex(self.artifact_dir,
+                                   os.path.join(self.artifact_dir, '.index'))
+        self.repo_cache = RepoCache(self.app, self.gits, None, True)
+        self.metrics = Metrics()
+        self.replicator = Replicator(
+            self.app, self.index, self.repo_cache,
+            '127.0.0.1:%d' % self.server.server_port, metrics=self.metrics)
+
+        self.data = ''.join('%d\n' % i for i in xrange(100000))
+        self.name = 'abc.chunk.foo'
+        self.partial = os.path.join(self.artifact_dir,
+                                    replication.PARTIAL_PREFIX + self.name)
+        self.write(os.path.join(self.upstream_dir, self.name), self.data)
+
+        self.log = LogRecorder()
+        self.level = logging.getLogger().level
+        logging.getLogger().addHandler(self.log)
+        logging.getLogger().setLevel(logging.INFO)
+
+    def tearDown(self):
+        logging.getLogger().removeHandler(self.log)
+        logging.getLogger().setLevel(self.level)
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.tempdir)
+
+    def mkdir(self, *path):
+        dirname = os.path.join(self.tempdir, *path)
+        os.makedirs(dirname)
+        return dirname
+
+    def write(self, filename, data):
+        with open(filename, 'w') as f:
+            f.write(data)
+
+    def read(self, filename):
+        with open(filename) as f:
+            return f.read()
+
+    def artifact_requests(self):
+        return [(query['filename'], byte_range)
+                for path, query, byte_range in self.upstream.requests
+                if path == '/1.0/artifacts']
+
+    def counted(self, result):
+        return ('morph_cache_server_replicated_artifacts_total'
+                '{result="%s"}' % result)
+
+    def test_copies_missing_artifacts(self):
+        self.write(os.path.join(self.upstream_dir, 'def.chunk.bar'), 'bar')
+        self.write(os.path.join(self.artifact_dir, 'def.chunk.bar'), 'bar')
+        self.assertTrue(self.replicator.replicate())
+        self.assertEqual(self.read(os.path.join(self.artifact_dir,
+                                                self.name)), self.data)
+        self.assertEqual(self.artifact_requests(), [(self.name, None)])
+        self.assertFalse(os.path.exists(self.partial))
+        self.assertEqual(
+            os.stat(os.path.join(self.artifact_dir, self.name)).st_mode
+            & 0777, 0644)
+        [entry] = self.index.list(limit=10)[0]
+        self.assertEqual(entry['name'], self.name)
+        stinfo = os.stat(os.path.join(self.artifact_dir, self.name))
+        self.assertEqual(
+            self.index.digest(self.name, stinfo),
+            base64.b64encode(hashlib.sha256(self.data).digest()))
+        self.assertTrue(self.counted('ok') + ' 1'
+                        in self.metrics.render_text())
+
+    def test_lists_artifacts_a_page_at_a_time(self):
+        names = ['%s.chunk.foo' % i for i in xrange(5)]
+        for name in names:
+            self.write(os.path.join(self.upstream_dir, name), name)
+        page_size = replication.MANIFEST_PAGE_SIZE
+        replication.MANIFEST_PAGE_SIZE = 2
+        try:
+            self.replicator.replicate()
+        finally:
+            replication.MANIFEST_PAGE_SIZE = page_size
+        for name in names:
+            self.assertEqual(self.read(os.path.join(self.artifact_dir,
+                                                    name)), name)
+        manifests = [query for path, query, byte_range
+                     in self.upstream.requests if path == '/1.0/manifest']
+        self.assertEqual(len(manifests), 3)
+        self.assertEqual(manifests[1]['after'], names[1])
+
+    def test_copies_only_as_many_as_fit_within_the_quota(self):
+        for name in ['a.chunk.foo', 'b.chunk.foo', 'c.chunk.foo']:
+            self.write(os.path.join(self.upstream_dir, name), 'x' * 100)
+        self.write(os.path.join(self.artifact_dir, 'local.chunk.foo'),
+                   'x' * 4096)
+        self.index.add('local.chunk.foo')
+        # There is room for the big artifact and one of the small ones.
+        self.replicator.quota = (self.index.total_used() + len(self.data) +
+                                 150) / replication.LOW_WATER
+        self.replicator.replicate()
+        self.assertEqual(sorted(self.artifact_requests()),
+                         [('a.chunk.foo', None), (self.name, None)])
+        self.assertTrue('Left out 2 artifacts from %s, to stay within the '
+                        'quota of %d bytes' % (self.replicator.upstream,
+                                               self.replicator.quota)
+                        in self.log.messages)
+
+    def test_skips_names_which_are_not_artifacts(self):
+        self.write(os.path.join(self.upstream_dir, '.hidden'), 'hidden')
+        self.replicator.replicate()
+        self.assertFalse(
+            os.path.exists(os.path.join(self.artifact_dir, '.hidden')))
+        self.assertEqual(self.artifact_requests(), [(self.name, None)])
+
+    def test_keeps_a_short_download_for_next_time(self):
+        self.upstream.cut_short = 1000
+        self.replicator.replicate()
+        self.assertFalse(
+            os.path.exists(os.path.join(self.artifact_dir, self.name)))
+        self.assertEqual(self.read(self.partial), self.data[:1000])
+        self.assertTrue(self.counted('failed') + ' 1'
+                        in self.metrics.render_text())
+
+        self.replicator.replicate()
+        self.assertEqual(self.read(os.path.join(self.artifact_dir,
+                                                self.name)), self.data)
+        self.assertEqual(self.artifact_requests(),
+                         [(self.name, None), (self.name, 'bytes=1000-')])
+        self.assertFalse(os.path.exists(self.partial))
+
+    def test_carries_on_a_partial_download(self):
+        self.write(self.partial, self.data[:5000])
+        self.replicator.replicate()
+        self.assertEqual(self.read(os.path.join(self.artifact_dir,
+                                                self.name)), self.data)
+        self.assertEqual(self.artifact_requests(),
+                         [(self.name, 'bytes=5000-')])
+
+    def test_starts_again_if_the_partial_download_is_too_long(self):
+        self.write(self.partial, self.data + 'more')
+        self.replicator.replicate()
+        self.assertEqual(self.read(os.path.join(self.artifact_dir,
+                                                self.name)), self.data)
+        self.assertEqual(self.artifact_requests(),
+                         [(self.name, 'bytes=%d-' % (len(self.data) + 4)),
+                          (self.name, None)])
+
+    def test_starts_again_if_upstream_sends_the_whole_artifact(self):
+        self.write(self.partial, 'wrong')
+        self.upstream.ignore_range = True
+        self.replicator.replicate()
+        self.assertEqual(self.read(os.path.join(self.artifact_dir,
+                                                self.name)), self.data)
+
+    def test_removes_a_download_which_does_not_match_its_digest(self):
+        self.write(self.partial, self.data[:5000])
+        self.upstream.wrong_digest = True
+        self.replicator.replicate()
+        self.assertFalse(os.path.exists(self.partial))
+        self.assertFalse(
+            os.path.exists(os.path.join(self.artifact_dir, self.name)))
+        self.assertTrue(
+            'Failed to replicate %s from %s: download does not match its '
+            'digest' % (self.name, self.replicator.upstream)
+            in self.log.messages)
+
+    def test_leaves_nothing_of_a_download_which_got_nowhere(self):
+        self.upstream.extra_artifacts = ['def.chunk.bar']
+        self.replicator.replicate()
+        self.assertFalse(os.path.exists(os.path.join(
+            self.artifact_dir, replication.PARTIAL_PREFIX + 'def.chunk.bar')))
+        self.assertTrue(self.counted('failed') + ' 1'
+                        in self.metrics.render_text())
+
+    def test_removes_old_partial_downloads(self):
+        old = time.time() - replication.PARTIAL_MAX_AGE - 60
+        for name in ('old', 'new', 'olddir'):
+            if name == 'olddir':
+                os.mkdir(os.path.join(self.artifact_dir,
+                                      replication.PARTIAL_PREFIX + name))
+            else:
+                self.write(os.path.join(self.artifact_dir,
+                                        replication.PARTIAL_PREFIX + name),
+                           name)
+            if name.startswith('old'):
+                os.utime(os.path.join(self.artifact_dir,
+                                      replication.PARTIAL_PREFIX + name),
+                         (old, old))
+        self.replicator.replicate()
+        self.assertEqual(
+            sorted(name for name in os.listdir(self.artifact_dir)
+                   if name.startswith(replication.PARTIAL_PREFIX)),
+            [replication.PARTIAL_PREFIX + 'new',
+             replication.PARTIAL_PREFIX + 'olddir'])
+
+    def test_only_one_replicates_at_once(self):
+        with open(os.path.join(self.artifact_dir, replication.LOCK_FILE),
+                  'a') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self.assertFalse(self.replicator.replicate())
+        self.assertEqual(self.upstream.requests, [])
+
+    def make_upstream_repo(self, path):
+        repo_dir = os.path.join(self.upstream_gits, path)
+        os.makedirs(repo_dir)
+        git(repo_dir, 'init', '-q', '--bare')
+        work = tempfile.mkdtemp(dir=self.tempdir)
+        git(work, 'init', '-q')
+        self.write(os.path.join(work, 'file'), path)
+        git(work, 'add', 'file')
+        git(work, 'commit', '-q', '-m', path)
+        git(work, 'push', '-q', repo_dir, 'HEAD:refs/heads/master')
+        return repo_dir, work
+
+    def test_copies_repositories(self):
+        self.make_upstream_repo('baserock/foo')
+        bar_dir, bar_work = self.make_upstream_repo('bar')
+        self.replicator.git_url = self.upstream_gits
+        self.replicator.replicate()
+        self.assertEqual(self.repo_cache.list_repos(),
+                         self.upstream.repo_cache.list_repos())
+
+        self.write(os.path.join(bar_work, 'file'), 'changed')
+        git(bar_work, 'commit', '-q', '-a', '-m', 'changed')
+        git(bar_work, 'push', '-q', bar_dir, 'HEAD:refs/heads/master')
+        self.replicator.replicate()
+        self.assertEqual(self.repo_cache.list_repos(),
+                         self.upstream.repo_cache.list_repos())
+        self.assertTrue(
+            'morph_cache_server_replicated_repos_total{result="ok"} 3'
+            in self.metrics.render_text())
+
+    def test_skips_paths_which_are_not_repositories(self):
+        self.upstream.extra_repos = {'../escape': 'x', 'a/.hidden': 'y'}
+        self.replicator.git_url = self.upstream_gits
+        self.replicator.replicate()
+        self.assertEqual(os.listdir(self.gits), [])
+
+    def test_leaves_nothing_of_a_repository_it_cannot_clone(self):
+        self.upstream.extra_repos = {'missing': 'x'}
+        self.replicator.git_url = self.upstream_gits
+        self.replicator.replicate()
+        self.assertEqual(os.listdir(self.gits), [])
+        self.assertTrue(
+            'morph_cache_server_replicated_repos_total{result="failed"} 1'
+            in self.metrics.render_text())
+
+    def test_keeps_replicating_every_interval_after_a_failure(self):
+        self.replicator.interval = 0.01
+        calls = []
+        done = threading.Event()
+        def replicate():
+            calls.append(None)
+            if len(calls) == 1:
+                raise Exception('replicating failed')
+            done.set()
+            # The thread cannot be stopped, so it waits here for good.
+            threading.Event().wait()
+        self.replicator.replicate = replicate
+        self.replicator.start()
+        done.wait(10)
+        self.assertTrue(len(calls) >= 2)
+        self.assertTrue('Replicating from %s failed' %
+                        self.replicator.upstream in self.log.messages)
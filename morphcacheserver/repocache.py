@@ -1,4 +1,4 @@
-# Copyright (C) 2013,2014 Codethink Limited
+# Copyright (C) 2013,2014, 2026 Codethink Limited
 # 
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -15,12 +15,23 @@
 
 
 import cliapp
+import collections
+import hashlib
+import logging
 import os
-import re
 import string
+import subprocess
+import threading
 import urlparse
 
 
+# Results for a SHA-1 never change, so they are kept in memory for as
+# long as there is room. Blobs larger than this are not kept at all.
+DEFAULT_OBJECT_CACHE_SIZE = 64 * 1024 * 1024
+MAX_CACHED_BLOB_SIZE = 1024 * 1024
+DEFAULT_MAX_READERS = 32
+
+
 class RepositoryNotFoundError(cliapp.AppException):
 
     def __init__(self, repo):
@@ -44,76 +55,227 @@ class UnresolvedNamedReferenceError(cliapp.AppException):
                 (ref, repo))
 
 
+class PathNotFoundError(cliapp.AppException):
+
+    def __init__(self, repo, ref, path):
+        cliapp.AppException.__init__(
+                self, 'File %s does not exist in ref %s of repo %s' %
+                (path, ref, repo))
+
+
+class LRUCache(object):
+
+    """A mapping which forgets the least recently used entries.
+
+    Each entry has a size, 1 unless given, and entries are dropped once
+    the sizes add up to more than max_size. on_evict is called with the
+    value of each dropped entry. It is safe to use from several threads.
+
+    """
+
+    def __init__(self, max_size, on_evict=None):
+        self.max_size = max_size
+        self.on_evict = on_evict
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                entry = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size=1):
+        evicted = []
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                old_value, old_size = self._entries.popitem(last=False)[1]
+                self.size -= old_size
+                evicted.append(old_value)
+        if self.on_evict is not None:
+            for old_value in evicted:
+                self.on_evict(old_value)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class GitObjectReader(object):
+
+    """A long-running `git cat-file --batch` for one repository.
+
+    This saves starting git for every object that is looked up. Lookups
+    from several threads take turns, and git is started again if it
+    has gone away.
+
+    """
+
+    def __init__(self, repo_dir):
+        self.repo_dir = repo_dir
+        self._process = None
+        self._lock = threading.Lock()
+
+    def lookup(self, name):
+        """Return (sha1, kind, data) for the object name refers to.
+
+        name is anything git understands as an object name, such as a
+        ref, a SHA-1, or SHA-1:path. None is returned if there is no
+        such object.
+
+        """
+        if '\n' in name:
+            return None
+        with self._lock:
+            try:
+                return self._lookup(name)
+            except (IOError, OSError, ValueError):
+                self._stop()
+                return self._lookup(name)
+
+    def _lookup(self, name):
+        if self._process is None:
+            self._process = subprocess.Popen(
+                ['git', 'cat-file', '--batch'], cwd=self.repo_dir,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                close_fds=True)
+        self._process.stdin.write(name + '\n')
+        self._process.stdin.flush()
+        header = self._process.stdout.readline()
+        if not header:
+            raise IOError('git cat-file in %s exited' % self.repo_dir)
+        fields = header.split()
+        if fields[-1] in ('missing', 'ambiguous'):
+            return None
+        sha1, kind, size = fields
+        data = self._process.stdout.read(int(size))
+        self._process.stdout.read(1)
+        return sha1, kind, data
+
+    def close(self):
+        with self._lock:
+            self._stop()
+
+    def _stop(self):
+        if self._process is not None:
+            process, self._process = self._process, None
+            try:
+                process.stdin.close()
+                process.wait()
+            except (IOError, OSError):
+                pass
+
+
 class RepoCache(object):
     
-    def __init__(self, app, repo_cache_dir, bundle_cache_dir, direct_mode):
+    def __init__(self, app, repo_cache_dir, bundle_cache_dir, direct_mode,
+                 object_cache_size=DEFAULT_OBJECT_CACHE_SIZE,
+                 max_readers=DEFAULT_MAX_READERS, metrics=None):
         self.app = app
         self.repo_cache_dir = repo_cache_dir
         self.bundle_cache_dir = bundle_cache_dir
         self.direct_mode = direct_mode
+        self.objects = LRUCache(object_cache_size)
+        self._readers = LRUCache(max_readers,
+                                 on_evict=lambda reader: reader.close())
+        self._readers_lock = threading.Lock()
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.histogram('git_lookup_seconds',
+                              'Time taken by git to look up objects the '
+                              'object cache did not have, by operation')
+            metrics.counter('object_cache_hits_total',
+                            'Lookups answered by the object cache')
+            metrics.counter('object_cache_misses_total',
+                            'Lookups the object cache could not answer')
+            metrics.gauge('object_cache_bytes',
+                          'Size of the results in the object cache')
+            metrics.gauge('object_cache_entries',
+                          'Results in the object cache')
+            metrics.add_collector(self._collect)
+
+    def _collect(self, metrics):
+        metrics.set('object_cache_hits_total', self.objects.hits)
+        metrics.set('object_cache_misses_total', self.objects.misses)
+        metrics.set('object_cache_bytes', self.objects.size)
+        metrics.set('object_cache_entries', len(self.objects))
+
+    def _timed(self, operation, function, *args):
+        if self.metrics is None:
+            return function(*args)
+        with self.metrics.timer('git_lookup_seconds', operation=operation):
+            return function(*args)
 
     def resolve_ref(self, repo_url, ref):
-        quoted_url = self._quote_url(repo_url)
-        repo_dir = os.path.join(self.repo_cache_dir, quoted_url)
-        if not os.path.exists(repo_dir):
-            repo_dir = "%s.git" % repo_dir
-            if not os.path.exists(repo_dir):
-                raise RepositoryNotFoundError(repo_url)
-        try:
-            if re.match('^[0-9a-fA-F]{40}$', ref):
-                sha1 = ref
-            else:
-                if (not self.direct_mode and
-                    not ref.startswith('refs/origin/')):
-                    ref = 'refs/origin/' + ref
-                sha1 = self._rev_parse(repo_dir, ref)
-            return sha1, self._tree_from_commit(repo_dir, sha1)
-
-        except cliapp.AppException:
-            raise
+        repo_dir = self._find_repo_dir(repo_url)
+        if self._is_valid_sha1(ref):
+            sha1 = ref
+        else:
+            if (not self.direct_mode and
+                not ref.startswith('refs/origin/')):
+                ref = 'refs/origin/' + ref
+            sha1 = self._timed('rev-parse', self._rev_parse, repo_dir, ref)
+        tree = None
+        if sha1 is not None:
+            tree = self._tree_from_commit(repo_dir, sha1)
+        if tree is None:
+            raise InvalidReferenceError(repo_url, ref)
+        return sha1, tree
 
     def _tree_from_commit(self, repo_dir, commitsha):
-        commit_info = self.app.runcmd(['git', 'log', '-1',
-                                       '--format=format:%T', commitsha],
-                                      cwd=repo_dir)
-        return commit_info.strip()
+        key = ('tree', repo_dir, commitsha)
+        tree = self.objects.get(key)
+        if tree is None:
+            found = self._timed('tree', self._reader(repo_dir).lookup,
+                                '%s^{tree}' % commitsha)
+            if found is None:
+                return None
+            tree = found[0]
+            self.objects.put(key, tree, len(tree))
+        return tree
 
     def cat_file(self, repo_url, ref, filename):
-        quoted_url = self._quote_url(repo_url)
-        repo_dir = os.path.join(self.repo_cache_dir, quoted_url)
-        if not os.path.exists(repo_dir):
-            repo_dir = "%s.git" % repo_dir
-            if not os.path.exists(repo_dir):
-                raise RepositoryNotFoundError(repo_url)
+        repo_dir = self._find_repo_dir(repo_url)
         if not self._is_valid_sha1(ref):
             raise UnresolvedNamedReferenceError(repo_url, ref)
-        if not os.path.exists(repo_dir):
-            raise RepositoryNotFoundError(repo_url)
-        try:
-            sha1 = self._rev_parse(repo_dir, ref)
-        except BaseException:
-            raise InvalidReferenceError(repo_url, ref)
-
-        return self._cat_file(repo_dir, sha1, filename)
+        key = ('blob', repo_dir, ref, filename)
+        data = self.objects.get(key)
+        if data is None:
+            if self._tree_from_commit(repo_dir, ref) is None:
+                raise InvalidReferenceError(repo_url, ref)
+            data = self._timed('cat-file', self._cat_file, repo_dir, ref,
+                               filename)
+            if data is None:
+                raise PathNotFoundError(repo_url, ref, filename)
+            if len(data) <= MAX_CACHED_BLOB_SIZE:
+                self.objects.put(key, data, len(data))
+        return data
 
     def ls_tree(self, repo_url, ref, path):
-        quoted_url = self._quote_url(repo_url)
-        repo_dir = os.path.join(self.repo_cache_dir, quoted_url)
-        if not os.path.exists(repo_dir):
-            repo_dir = "%s.git" % repo_dir
-            if not os.path.exists(repo_dir):
-                raise RepositoryNotFoundError(repo_url)
+        repo_dir = self._find_repo_dir(repo_url)
         if not self._is_valid_sha1(ref):
             raise UnresolvedNamedReferenceError(repo_url, ref)
-        if not os.path.exists(repo_dir):
-            raise RepositoryNotFoundError(repo_url)
-
-        try:
-            sha1 = self._rev_parse(repo_dir, ref)
-        except BaseException:
+        key = ('ls-tree', repo_dir, ref, path)
+        data = self.objects.get(key)
+        if data is not None:
+            return data
+        if self._tree_from_commit(repo_dir, ref) is None:
             raise InvalidReferenceError(repo_url, ref)
 
-        lines = self._ls_tree(repo_dir, sha1, path).strip()
+        lines = self._timed('ls-tree', self._ls_tree, repo_dir, ref,
+                            path).strip()
         lines = lines.splitlines()
         data = {}
         for line in lines:
@@ -124,8 +286,43 @@ class RepoCache(object):
                 'kind': elements[1],
                 'sha1': elements[2],
             }
+        self.objects.put(key, data, sum(len(line) for line in lines))
         return data
 
+    def list_repos(self):
+        """Return the refs_digest of each bare repository in the cache.
+
+        The dict is keyed by the path of each repository relative to the
+        repository cache directory. Names starting with a '.' are left
+        out, since they are clones in progress.
+
+        """
+        repos = {}
+        for dirpath, dirnames, filenames in os.walk(self.repo_cache_dir):
+            dirnames[:] = [name for name in dirnames
+                           if not name.startswith('.')]
+            if 'objects' in dirnames and 'HEAD' in filenames:
+                dirnames[:] = []
+                path = os.path.relpath(dirpath, self.repo_cache_dir)
+                try:
+                    repos[path] = self.refs_digest(dirpath)
+                except cliapp.AppException, e:
+                    logging.warning('Cannot list the refs of %s: %s'
+                                    % (dirpath, e))
+        return repos
+
+    def refs_digest(self, repo_dir):
+        """Return a SHA-1 of the branches and tags of a repository.
+
+        Two repositories with the same digest have the same branches and
+        tags, pointing at the same commits.
+
+        """
+        refs = self.app.runcmd(
+            ['git', 'for-each-ref', '--format=%(objectname) %(refname)',
+             'refs/heads', 'refs/tags'], cwd=repo_dir)
+        return hashlib.sha1(refs).hexdigest()
+
     def get_bundle_filename(self, repo_url):
         quoted_url = self._quote_url(repo_url, True)
         return os.path.join(self.bundle_cache_dir, '%s.bndl' % quoted_url)
@@ -141,14 +338,33 @@ class RepoCache(object):
             transl = lambda x: x if x in valid_chars else '_'
             return ''.join([transl(x) for x in url])
 
+    def _find_repo_dir(self, repo_url):
+        repo_dir = os.path.join(self.repo_cache_dir,
+                                self._quote_url(repo_url))
+        if not os.path.exists(repo_dir):
+            repo_dir = "%s.git" % repo_dir
+            if not os.path.exists(repo_dir):
+                raise RepositoryNotFoundError(repo_url)
+        return repo_dir
+
+    def _reader(self, repo_dir):
+        with self._readers_lock:
+            reader = self._readers.get(repo_dir)
+            if reader is None:
+                reader = GitObjectReader(repo_dir)
+                self._readers.put(repo_dir, reader)
+            return reader
+
     def _rev_parse(self, repo_dir, ref):
-        return self.app.runcmd(['git', 'rev-parse', '--verify', ref],
-                               cwd=repo_dir)[0:40]
+        # Refs move, so unlike objects they are looked up every time.
+        found = self._reader(repo_dir).lookup(ref)
+        return found[0] if found is not None else None
 
     def _cat_file(self, repo_dir, sha1, filename):
-        return self.app.runcmd(
-                ['git', 'cat-file', 'blob', '%s:%s' % (sha1, filename)],
-                cwd=repo_dir)
+        found = self._reader(repo_dir).lookup('%s:%s' % (sha1, filename))
+        if found is None or found[1] != 'blob':
+            return None
+        return found[2]
 
     def _ls_tree(self, repo_dir, sha1, path):
         return self.app.runcmd(['git', 'ls-tree', sha1, path], cwd=repo_dir)
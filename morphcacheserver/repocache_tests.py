@@ -0,0 +1,339 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import cliapp
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from morphcacheserver import repocache
+from morphcacheserver.metrics import Metrics
+from morphcacheserver.repocache import GitObjectReader, LRUCache, RepoCache
+
+
+def git(cwd, *args):
+    return cliapp.runcmd(
+        ['git', '-c', 'user.name=Tester', '-c', 'user.email=tester@test',
+         '-c', 'init.defaultBranch=master'] + list(args), cwd=cwd)
+
+
+def make_repo(tempdir, files):
+    """Commit files to a new repository, and return (dirname, sha1)."""
+    dirname = os.path.join(tempdir, 'work')
+    os.mkdir(dirname)
+    git(dirname, 'init', '-q')
+    for name, data in files.iteritems():
+        filename = os.path.join(dirname, name)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'w') as f:
+            f.write(data)
+    git(dirname, 'add', '.')
+    git(dirname, 'commit', '-q', '-m', 'Initial commit')
+    return dirname, git(dirname, 'rev-parse', 'HEAD').strip()
+
+
+class LRUCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.evicted = []
+        self.cache = LRUCache(10, on_evict=self.evicted.append)
+
+    def test_counts_a_miss(self):
+        self.assertEqual(self.cache.get('foo'), None)
+        self.assertEqual(self.cache.get('foo', 'default'), 'default')
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 2))
+
+    def test_counts_a_hit(self):
+        self.cache.put('foo', 'bar')
+        self.assertEqual(self.cache.get('foo'), 'bar')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 0))
+
+    def test_adds_up_the_sizes_of_its_entries(self):
+        self.cache.put('foo', 'bar', 3)
+        self.cache.put('baz', 'qux')
+        self.assertEqual(self.cache.size, 4)
+        self.assertEqual(len(self.cache), 2)
+
+    def test_replaces_an_entry(self):
+        self.cache.put('foo', 'bar', 3)
+        self.cache.put('foo', 'baz', 5)
+        self.assertEqual(self.cache.get('foo'), 'baz')
+        self.assertEqual(self.cache.size, 5)
+        self.assertEqual(len(self.cache), 1)
+
+    def test_evicts_the_least_recently_used_entries_over_its_size(self):
+        self.cache.put('a', 'A', 4)
+        self.cache.put('b', 'B', 4)
+        self.cache.get('a')
+        self.cache.put('c', 'C', 4)
+        self.assertEqual(self.evicted, ['B'])
+        self.assertEqual(self.cache.get('b'), None)
+        self.assertEqual(self.cache.size, 8)
+        self.cache.put('d', 'D', 9)
+        self.assertEqual(self.evicted, ['B', 'A', 'C'])
+        self.assertEqual(self.cache.size, 9)
+
+    def test_evicts_an_entry_bigger_than_its_size_at_once(self):
+        self.cache.put('a', 'A', 11)
+        self.assertEqual(self.evicted, ['A'])
+        self.assertEqual((len(self.cache), self.cache.size), (0, 0))
+
+    def test_works_without_on_evict(self):
+        cache = LRUCache(1)
+        cache.put('a', 'A')
+        cache.put('b', 'B')
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('b'), 'B')
+
+
+class GitObjectReaderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.repo_dir, self.sha1 = make_repo(
+            self.tempdir, {'foo': 'hello\n', 'dir/bar': 'world\n'})
+        self.reader = GitObjectReader(self.repo_dir)
+
+    def tearDown(self):
+        self.reader.close()
+        shutil.rmtree(self.tempdir)
+
+    def test_looks_up_a_commit(self):
+        sha1, kind, data = self.reader.lookup('HEAD')
+        self.assertEqual((sha1, kind), (self.sha1, 'commit'))
+        self.assertTrue(data.startswith('tree '))
+
+    def test_looks_up_a_file(self):
+        self.assertEqual(self.reader.lookup('%s:foo' % self.sha1),
+                         (hashlib.sha1('blob 6\0hello\n').hexdigest(),
+                          'blob', 'hello\n'))
+        self.assertEqual(self.reader.lookup('HEAD:dir/bar')[2], 'world\n')
+
+    def test_gives_none_for_a_missing_object(self):
+        self.assertEqual(self.reader.lookup('HEAD:nothing'), None)
+        self.assertEqual(self.reader.lookup('0' * 40), None)
+        self.assertEqual(self.reader.lookup('HEAD:foo')[2], 'hello\n')
+
+    def test_gives_none_for_a_name_containing_a_newline(self):
+        self.assertEqual(self.reader.lookup('HEAD\nHEAD:foo'), None)
+        self.assertEqual(self.reader.lookup('HEAD:foo')[2], 'hello\n')
+
+    def test_restarts_git_after_it_dies(self):
+        self.reader.lookup('HEAD')
+        process = self.reader._process
+        process.kill()
+        process.wait()
+        self.assertEqual(self.reader.lookup('HEAD:foo')[2], 'hello\n')
+        self.assertNotEqual(self.reader._process, process)
+
+    def test_restarts_git_if_it_exits_without_answering(self):
+        self.reader._process = subprocess.Popen(
+            ['sh', '-c', 'read line'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.assertEqual(self.reader.lookup('HEAD:foo')[2], 'hello\n')
+
+    def test_closes_a_git_which_has_died(self):
+        # With a buffered pipe to git, closing it fails, as what is
+        # left in the buffer cannot be written.
+        self.reader._process = subprocess.Popen(
+            ['git', 'cat-file', '--batch'], cwd=self.repo_dir,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=-1)
+        self.reader._process.kill()
+        self.reader._process.wait()
+        self.reader._process.stdin.write('HEAD\n')
+        self.reader.close()
+        self.assertEqual(self.reader._process, None)
+
+    def test_can_be_closed_before_it_is_used(self):
+        self.reader.close()
+        self.assertEqual(self.reader._process, None)
+
+
+class RepoCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.work_dir, self.sha1 = make_repo(
+            self.tempdir, {'foo': 'hello\n', 'dir/bar': 'world\n',
+                           'big': 'x' * (repocache.MAX_CACHED_BLOB_SIZE + 1)})
+        self.tree = git(self.work_dir, 'rev-parse', 'HEAD^{tree}').strip()
+        self.dir_tree = git(self.work_dir, 'rev-parse', 'HEAD:dir').strip()
+        self.repo_cache_dir = os.path.join(self.tempdir, 'gits')
+        self.bundle_cache_dir = os.path.join(self.tempdir, 'bundles')
+        os.mkdir(self.repo_cache_dir)
+        self.metrics = Metrics()
+        self.app = cliapp.Application()
+        self.caches = []
+
+    def tearDown(self):
+        for cache in self.caches:
+            for reader, size in cache._readers._entries.itervalues():
+                reader.close()
+        shutil.rmtree(self.tempdir)
+
+    def clone(self, path):
+        repo_dir = os.path.join(self.repo_cache_dir, path)
+        git(self.tempdir, 'clone', '-q', '--bare', self.work_dir, repo_dir)
+        return repo_dir
+
+    def repo_cache(self, direct_mode=True, **kwargs):
+        cache = RepoCache(self.app, self.repo_cache_dir,
+                          self.bundle_cache_dir, direct_mode, **kwargs)
+        self.caches.append(cache)
+        return cache
+
+    def test_resolves_a_branch(self):
+        self.clone('foo.git')
+        cache = self.repo_cache(metrics=self.metrics)
+        self.assertEqual(cache.resolve_ref('git://example.com/foo', 'master'),
+                         (self.sha1, self.tree))
+        self.assertTrue(
+            'morph_cache_server_git_lookup_seconds_count'
+            '{operation="rev-parse"} 1' in self.metrics.render_text())
+
+    def test_resolves_a_remote_branch_when_not_in_direct_mode(self):
+        repo_dir = self.clone('git___example_com_foo')
+        git(repo_dir, 'update-ref', 'refs/origin/stable', self.sha1)
+        cache = self.repo_cache(direct_mode=False)
+        for ref in ('stable', 'refs/origin/stable'):
+            self.assertEqual(
+                cache.resolve_ref('git://example.com/foo', ref),
+                (self.sha1, self.tree))
+        self.assertRaises(repocache.InvalidReferenceError,
+                          cache.resolve_ref, 'git://example.com/foo',
+                          'master')
+
+    def test_resolves_a_sha1_to_its_tree_once(self):
+        self.clone('foo')
+        cache = self.repo_cache()
+        for i in xrange(2):
+            self.assertEqual(cache.resolve_ref('foo', self.sha1),
+                             (self.sha1, self.tree))
+        self.assertEqual((cache.objects.hits, cache.objects.misses), (1, 1))
+
+    def test_refuses_to_resolve_an_unknown_ref(self):
+        self.clone('foo')
+        cache = self.repo_cache()
+        self.assertRaises(repocache.InvalidReferenceError,
+                          cache.resolve_ref, 'foo', 'nothing')
+        self.assertRaises(repocache.InvalidReferenceError,
+                          cache.resolve_ref, 'foo', '0' * 40)
+
+    def test_refuses_an_unknown_repository(self):
+        cache = self.repo_cache()
+        self.assertRaises(repocache.RepositoryNotFoundError,
+                          cache.resolve_ref, 'foo', 'master')
+
+    def test_gets_a_file_and_keeps_it(self):
+        self.clone('foo')
+        cache = self.repo_cache(metrics=self.metrics)
+        for i in xrange(2):
+            self.assertEqual(cache.cat_file('foo', self.sha1, 'dir/bar'),
+                             'world\n')
+        self.assertEqual(cache.objects.hits, 1)
+        text = self.metrics.render_text()
+        self.assertTrue(
+            'morph_cache_server_object_cache_hits_total 1' in text)
+        self.assertTrue(
+            'morph_cache_server_object_cache_misses_total 2' in text)
+        self.assertTrue(
+            '# TYPE morph_cache_server_object_cache_hits_total counter'
+            in text)
+        self.assertTrue('morph_cache_server_object_cache_entries 2' in text)
+
+    def test_does_not_keep_a_big_file(self):
+        self.clone('foo')
+        cache = self.repo_cache()
+        data = cache.cat_file('foo', self.sha1, 'big')
+        self.assertEqual(len(data), repocache.MAX_CACHED_BLOB_SIZE + 1)
+        self.assertEqual(cache.objects.size, len(self.tree))
+
+    def test_refuses_to_get_a_file_which_is_not_there(self):
+        self.clone('foo')
+        cache = self.repo_cache()
+        self.assertRaises(repocache.UnresolvedNamedReferenceError,
+                          cache.cat_file, 'foo', 'master', 'foo')
+        self.assertRaises(repocache.InvalidReferenceError,
+                          cache.cat_file, 'foo', '0' * 40, 'foo')
+        self.assertRaises(repocache.PathNotFoundError,
+                          cache.cat_file, 'foo', self.sha1, 'nothing')
+        self.assertRaises(repocache.PathNotFoundError,
+                          cache.cat_file, 'foo', self.sha1, 'dir')
+
+    def test_lists_a_tree(self):
+        self.clone('foo')
+        cache = self.repo_cache()
+        self.assertEqual(cache.ls_tree('foo', self.sha1, 'dir'),
+                         {'dir': {'mode': '040000', 'kind': 'tree',
+                                  'sha1': self.dir_tree}})
+        data = cache.ls_tree('foo', self.sha1, 'dir/')
+        self.assertEqual(sorted(data), ['dir/bar'])
+        self.assertEqual(data['dir/bar']['kind'], 'blob')
+        self.assertEqual(data['dir/bar']['mode'], '100644')
+
+    def test_keeps_a_tree_listing(self):
+        self.clone('foo')
+        cache = self.repo_cache()
+        data = cache.ls_tree('foo', self.sha1, 'dir/')
+        hits = cache.objects.hits
+        self.assertEqual(cache.ls_tree('foo', self.sha1, 'dir/'), data)
+        self.assertEqual(cache.objects.hits, hits + 1)
+
+    def test_refuses_to_list_a_tree_which_is_not_there(self):
+        self.clone('foo')
+        cache = self.repo_cache()
+        self.assertRaises(repocache.UnresolvedNamedReferenceError,
+                          cache.ls_tree, 'foo', 'master', 'dir')
+        self.assertRaises(repocache.InvalidReferenceError,
+                          cache.ls_tree, 'foo', '0' * 40, 'dir')
+
+    def test_closes_the_least_recently_used_readers(self):
+        self.clone('foo')
+        self.clone('bar')
+        cache = self.repo_cache(max_readers=1)
+        cache.resolve_ref('foo', 'master')
+        reader = cache._reader(os.path.join(self.repo_cache_dir, 'foo'))
+        cache.resolve_ref('bar', 'master')
+        self.assertEqual(reader._process, None)
+
+    def test_lists_repositories_with_their_refs(self):
+        self.clone('foo.git')
+        self.clone('baserock/bar')
+        self.clone('.tmp')
+        os.makedirs(os.path.join(self.repo_cache_dir, 'broken', 'objects'))
+        with open(os.path.join(self.repo_cache_dir, 'broken', 'HEAD'),
+                  'w'):
+            pass
+        repos = self.repo_cache().list_repos()
+        self.assertEqual(sorted(repos), ['baserock/bar', 'foo.git'])
+        self.assertEqual(repos['foo.git'], repos['baserock/bar'])
+
+    def test_has_a_digest_of_the_refs_of_a_repository(self):
+        repo_dir = self.clone('foo')
+        cache = self.repo_cache()
+        before = cache.refs_digest(repo_dir)
+        self.assertEqual(cache.refs_digest(repo_dir), before)
+        git(repo_dir, 'tag', 'v1', self.sha1)
+        self.assertNotEqual(cache.refs_digest(repo_dir), before)
+
+    def test_names_a_bundle_after_the_repository_url(self):
+        self.assertEqual(
+            self.repo_cache().get_bundle_filename('git://example.com/foo'),
+            os.path.join(self.bundle_cache_dir, 'git___example_com_foo.bndl'))
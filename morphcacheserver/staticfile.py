@@ -0,0 +1,311 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import ctypes
+import ctypes.util
+import email.utils
+import errno
+import fcntl
+import os
+import select
+import wsgiref.simple_server
+import wsgiref.util
+
+
+def _find_sendfile():
+    """Return the C library's 64-bit sendfile(2), if there is one."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        function = libc.sendfile64
+    except (OSError, AttributeError):
+        return None
+    function.argtypes = [ctypes.c_int, ctypes.c_int,
+                         ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    function.restype = ctypes.c_ssize_t
+    return function
+
+
+_sendfile = _find_sendfile()
+
+
+def sendfile(out_fd, in_fd, offset, count):
+    """Copy up to count bytes from in_fd at offset to out_fd.
+
+    The data is copied by the kernel, without passing through Python.
+    Returns the number of bytes copied, which may be fewer than asked
+    for, as with os.write.
+
+    """
+    position = ctypes.c_int64(offset)
+    while True:
+        sent = _sendfile(out_fd, in_fd, ctypes.byref(position), count)
+        if sent >= 0:
+            return sent
+        error = ctypes.get_errno()
+        if error == errno.EAGAIN:
+            # Sockets with a timeout are non-blocking underneath.
+            select.select([], [out_fd], [])
+        elif error != errno.EINTR:
+            raise OSError(error, os.strerror(error))
+
+
+class RangeNotSatisfiable(Exception):
+
+    pass
+
+
+def parse_range(header, size):
+    """Return the (start, end) byte positions an HTTP Range asks for.
+
+    end is inclusive, as in the header. Only a single range is
+    supported: None is returned for several ranges, or a header that
+    cannot be parsed, which means the whole file is to be sent.
+    RangeNotSatisfiable is raised if the range is outside the file.
+
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip() != 'bytes' or ',' in spec:
+        return None
+    first, _, last = spec.strip().partition('-')
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+        else:
+            start = size - int(last)
+            end = size - 1
+            if int(last) == 0:
+                raise RangeNotSatisfiable()
+    except ValueError:
+        return None
+    if start < 0:
+        start = 0
+    if start >= size:
+        raise RangeNotSatisfiable()
+    if end < start:
+        return None
+    return start, min(end, size - 1)
+
+
+class FileRange(object):
+
+    """A file object which reads length bytes from offset onwards only."""
+
+    def __init__(self, f, offset, length):
+        self.f = f
+        self.offset = offset
+        self.length = length
+        self._remaining = length
+        f.seek(offset)
+
+    def read(self, size=-1):
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self.f.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def close(self):
+        self.f.close()
+
+
+# Content addressed by a SHA-1 or a cache key never changes, so any
+# HTTP cache may keep it for as long as it likes.
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+def not_modified(environ, etag, mtime=None):
+    """Return True if a conditional request already has this version."""
+    if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return etag in tags or '*' in tags
+    if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since is not None and mtime is not None:
+        parsed = email.utils.parsedate_tz(if_modified_since.split(';')[0])
+        if parsed is not None:
+            return int(mtime) <= email.utils.mktime_tz(parsed)
+    return False
+
+
+def _range_applies(environ, etag, last_modified):
+    if_range = environ.get('HTTP_IF_RANGE')
+    return if_range is None or if_range.strip() in (etag, last_modified)
+
+
+def open_shared(filename):
+    """Open a file for reading, so that it will not be evicted.
+
+    The file is held with a shared flock(2) lock until it is closed.
+    The eviction.Evictor only removes files it can lock exclusively, so
+    a file which is being served is left alone, by this process or any
+    other.
+
+    """
+    f = open(filename, 'rb')
+    fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+    return f
+
+
+def serve_file(filename, environ):
+    """Work out the response to a GET or HEAD request for a file.
+
+    Returns (status, headers, body). Requests made conditional on the
+    ETag or modification time of the file get a 304 Not Modified
+    response when it has not changed, and a single byte range can be
+    asked for with the Range header.
+
+    The body is the open file, or a FileRange of it, which servers that
+    provide SENDFILE_KEY can send without copying it through Python.
+    It is opened with open_shared.
+
+    """
+    f = open_shared(filename)
+    stinfo = os.fstat(f.fileno())
+    size = stinfo.st_size
+    etag = '"%x-%x"' % (size, int(stinfo.st_mtime))
+    last_modified = email.utils.formatdate(stinfo.st_mtime, usegmt=True)
+    headers = [
+        ('Content-Type', 'application/octet-stream'),
+        ('Accept-Ranges', 'bytes'),
+        ('ETag', etag),
+        ('Last-Modified', last_modified),
+    ]
+
+    if not_modified(environ, etag, stinfo.st_mtime):
+        f.close()
+        return 304, headers, ''
+
+    byte_range = None
+    if ('HTTP_RANGE' in environ and
+            _range_applies(environ, etag, last_modified)):
+        try:
+            byte_range = parse_range(environ['HTTP_RANGE'], size)
+        except RangeNotSatisfiable:
+            f.close()
+            headers.append(('Content-Range', 'bytes */%d' % size))
+            return 416, headers, ''
+
+    if byte_range is None:
+        headers.append(('Content-Length', str(size)))
+        return 200, headers, f
+
+    start, end = byte_range
+    headers.append(('Content-Range', 'bytes %d-%d/%d' % (start, end, size)))
+    headers.append(('Content-Length', str(end - start + 1)))
+    return 206, headers, FileRange(f, start, end - start + 1)
+
+
+def file_region(f):
+    """Return the (fd, offset, length) of the rest of a file, or None."""
+    try:
+        fd = f.fileno()
+    except (AttributeError, IOError, ValueError):
+        return None
+    if isinstance(f, FileRange):
+        return fd, f.offset, f.length
+    offset = f.tell()
+    return fd, offset, os.fstat(fd).st_size - offset
+
+
+# Servers which can send a file after the response headers themselves
+# put a function under this key in the WSGI environment. Applications
+# pass it a file object, or FileRange, and return an empty body with
+# the Content-Length of the file. This works even where the framework
+# turns file bodies into iterators, as Bottle does for mounted apps.
+SENDFILE_KEY = 'morphcacheserver.sendfile'
+
+
+class SendfileServerHandler(wsgiref.simple_server.ServerHandler):
+
+    """wsgiref handler which sends file responses with sendfile(2)."""
+
+    def setup_environ(self):
+        wsgiref.simple_server.ServerHandler.setup_environ(self)
+        self._file = None
+        self.environ[SENDFILE_KEY] = self._set_file
+
+    def _set_file(self, f):
+        self._file = f
+
+    def finish_response(self):
+        if self._file is None:
+            return wsgiref.simple_server.ServerHandler.finish_response(self)
+        try:
+            for data in self.result:
+                self.write(data)
+            if not self.headers_sent:
+                self.send_headers()
+            if not self._send_region(file_region(self._file)):
+                for data in wsgiref.util.FileWrapper(self._file,
+                                                     1024 * 1024):
+                    self._write(data)
+                    self.bytes_sent += len(data)
+            self.finish_content()
+        finally:
+            self._file.close()
+            self.close()
+
+    def sendfile(self):
+        return self._send_region(file_region(self.result.filelike))
+
+    def _send_region(self, region):
+        if _sendfile is None or region is None:
+            return False
+        try:
+            out_fd = self.stdout.fileno()
+        except (AttributeError, IOError, ValueError):
+            return False
+        fd, offset, length = region
+
+        if not self.headers_sent:
+            self.send_headers()
+        self._flush()
+        while length > 0:
+            sent = sendfile(out_fd, fd, offset, length)
+            if sent == 0:
+                # The file was truncated under us, so the response will
+                # be short. There is nothing better to do than stop.
+                break
+            offset += sent
+            length -= sent
+            self.bytes_sent += sent
+        return True
+
+
+class SendfileRequestHandler(wsgiref.simple_server.WSGIRequestHandler):
+
+    """wsgiref request handler which uses SendfileServerHandler."""
+
+    def handle(self):
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+
+        if not self.parse_request():
+            return
+
+        handler = SendfileServerHandler(
+            self.rfile, self.wfile, self.get_stderr(), self.get_environ())
+        handler.request_handler = self
+        handler.run(self.server.get_app())
@@ -0,0 +1,496 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import email.utils
+import errno
+import fcntl
+import os
+import shutil
+import socket
+import StringIO
+import tempfile
+import threading
+import time
+import unittest
+import wsgiref.simple_server
+
+from morphcacheserver import staticfile
+from morphcacheserver.staticfile import RangeNotSatisfiable
+
+
+class FindSendfileTests(unittest.TestCase):
+
+    def setUp(self):
+        self.CDLL = staticfile.ctypes.CDLL
+
+    def tearDown(self):
+        staticfile.ctypes.CDLL = self.CDLL
+
+    def test_finds_sendfile_in_the_c_library(self):
+        self.assertNotEqual(staticfile._find_sendfile(), None)
+
+    def test_does_without_a_c_library(self):
+        def fail(*args, **kwargs):
+            raise OSError(errno.ENOENT, 'no C library')
+        staticfile.ctypes.CDLL = fail
+        self.assertEqual(staticfile._find_sendfile(), None)
+
+
+class SendfileTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'file')
+        with open(self.filename, 'w') as f:
+            f.write('0123456789' * 100000)
+        self.f = open(self.filename)
+        self.read_fd, self.write_fd = os.pipe()
+
+    def tearDown(self):
+        self.f.close()
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+        shutil.rmtree(self.tempdir)
+
+    def test_copies_part_of_a_file(self):
+        sent = staticfile.sendfile(self.write_fd, self.f.fileno(), 3, 4)
+        self.assertEqual(sent, 4)
+        self.assertEqual(os.read(self.read_fd, 10), '3456')
+        self.assertEqual(self.f.tell(), 0)
+
+    def test_waits_for_a_non_blocking_file_to_be_writeable(self):
+        flags = fcntl.fcntl(self.write_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.write_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        size = os.path.getsize(self.filename)
+        sent = staticfile.sendfile(self.write_fd, self.f.fileno(), 0, size)
+        self.assertTrue(0 < sent < size)
+
+        received = []
+        def drain():
+            time.sleep(0.1)
+            received.append(os.read(self.read_fd, sent))
+        thread = threading.Thread(target=drain)
+        thread.start()
+        more = staticfile.sendfile(self.write_fd, self.f.fileno(), sent, 10)
+        thread.join()
+        self.assertEqual(more, 10)
+        self.assertEqual(len(received[0]), sent)
+
+    def test_raises_oserror_for_a_bad_file_descriptor(self):
+        os.close(self.write_fd)
+        try:
+            staticfile.sendfile(self.write_fd, self.f.fileno(), 0, 10)
+        except OSError, e:
+            self.assertEqual(e.errno, errno.EBADF)
+        else:
+            self.fail('sendfile to a closed file descriptor worked')
+        self.read_fd, self.write_fd = os.pipe()
+
+
+class ParseRangeTests(unittest.TestCase):
+
+    def test_parses_a_closed_range(self):
+        self.assertEqual(staticfile.parse_range('bytes=10-19', 100),
+                         (10, 19))
+
+    def test_parses_an_open_ended_range(self):
+        self.assertEqual(staticfile.parse_range('bytes=10-', 100), (10, 99))
+
+    def test_parses_a_suffix_range(self):
+        self.assertEqual(staticfile.parse_range('bytes=-10', 100), (90, 99))
+
+    def test_gives_all_of_a_file_shorter_than_a_suffix(self):
+        self.assertEqual(staticfile.parse_range('bytes=-1000', 100),
+                         (0, 99))
+
+    def test_stops_a_range_at_the_end_of_the_file(self):
+        self.assertEqual(staticfile.parse_range('bytes=90-1000', 100),
+                         (90, 99))
+
+    def test_allows_space_around_the_range(self):
+        self.assertEqual(staticfile.parse_range('bytes = 10-19 ', 100),
+                         (10, 19))
+
+    def test_ignores_multiple_ranges(self):
+        self.assertEqual(staticfile.parse_range('bytes=0-9,20-29', 100),
+                         None)
+
+    def test_ignores_other_units(self):
+        self.assertEqual(staticfile.parse_range('lines=0-9', 100), None)
+
+    def test_ignores_a_range_which_is_not_numbers(self):
+        self.assertEqual(staticfile.parse_range('bytes=a-b', 100), None)
+
+    def test_ignores_a_range_which_ends_before_it_starts(self):
+        self.assertEqual(staticfile.parse_range('bytes=20-10', 100), None)
+
+    def test_rejects_a_range_starting_past_the_end(self):
+        self.assertRaises(RangeNotSatisfiable,
+                          staticfile.parse_range, 'bytes=100-', 100)
+
+    def test_rejects_an_empty_suffix(self):
+        self.assertRaises(RangeNotSatisfiable,
+                          staticfile.parse_range, 'bytes=-0', 100)
+
+    def test_rejects_any_range_of_an_empty_file(self):
+        self.assertRaises(RangeNotSatisfiable,
+                          staticfile.parse_range, 'bytes=0-', 0)
+
+
+class FileRangeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.f = StringIO.StringIO('0123456789')
+        self.range = staticfile.FileRange(self.f, 2, 5)
+
+    def test_reads_only_the_range(self):
+        self.assertEqual(self.range.read(), '23456')
+        self.assertEqual(self.range.read(), '')
+
+    def test_reads_the_range_in_pieces(self):
+        self.assertEqual(self.range.read(3), '234')
+        self.assertEqual(self.range.read(3), '56')
+        self.assertEqual(self.range.read(3), '')
+
+    def test_has_the_file_number_of_its_file(self):
+        with tempfile.TemporaryFile() as f:
+            self.assertEqual(staticfile.FileRange(f, 0, 0).fileno(),
+                             f.fileno())
+
+    def test_closes_its_file(self):
+        self.range.close()
+        self.assertTrue(self.f.closed)
+
+
+class NotModifiedTests(unittest.TestCase):
+
+    etag = '"a-1"'
+    mtime = 1000000000
+
+    def date(self, when):
+        return email.utils.formatdate(when, usegmt=True)
+
+    def test_is_false_for_an_unconditional_request(self):
+        self.assertFalse(staticfile.not_modified({}, self.etag, self.mtime))
+
+    def test_is_true_for_a_matching_etag(self):
+        environ = {'HTTP_IF_NONE_MATCH': '"b-2", %s' % self.etag}
+        self.assertTrue(staticfile.not_modified(environ, self.etag))
+
+    def test_is_true_for_any_etag(self):
+        environ = {'HTTP_IF_NONE_MATCH': '*'}
+        self.assertTrue(staticfile.not_modified(environ, self.etag))
+
+    def test_is_false_for_another_etag(self):
+        environ = {'HTTP_IF_NONE_MATCH': '"b-2"'}
+        self.assertFalse(staticfile.not_modified(environ, self.etag))
+
+    def test_is_true_if_not_modified_since(self):
+        environ = {'HTTP_IF_MODIFIED_SINCE': self.date(self.mtime)}
+        self.assertTrue(
+            staticfile.not_modified(environ, self.etag, self.mtime))
+
+    def test_is_false_if_modified_since(self):
+        environ = {'HTTP_IF_MODIFIED_SINCE': self.date(self.mtime - 1)}
+        self.assertFalse(
+            staticfile.not_modified(environ, self.etag, self.mtime))
+
+    def test_ignores_the_length_old_browsers_send(self):
+        environ = {'HTTP_IF_MODIFIED_SINCE':
+                   self.date(self.mtime) + '; length=10'}
+        self.assertTrue(
+            staticfile.not_modified(environ, self.etag, self.mtime))
+
+    def test_ignores_a_date_it_cannot_parse(self):
+        environ = {'HTTP_IF_MODIFIED_SINCE': 'yesterday'}
+        self.assertFalse(
+            staticfile.not_modified(environ, self.etag, self.mtime))
+
+    def test_ignores_if_modified_since_without_a_modification_time(self):
+        environ = {'HTTP_IF_MODIFIED_SINCE': self.date(self.mtime)}
+        self.assertFalse(staticfile.not_modified(environ, self.etag))
+
+    def test_prefers_if_none_match_to_if_modified_since(self):
+        environ = {'HTTP_IF_NONE_MATCH': '"b-2"',
+                   'HTTP_IF_MODIFIED_SINCE': self.date(self.mtime)}
+        self.assertFalse(
+            staticfile.not_modified(environ, self.etag, self.mtime))
+        environ = {'HTTP_IF_NONE_MATCH': self.etag,
+                   'HTTP_IF_MODIFIED_SINCE': self.date(self.mtime - 1)}
+        self.assertTrue(
+            staticfile.not_modified(environ, self.etag, self.mtime))
+
+
+class ServeFileTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'file')
+        with open(self.filename, 'w') as f:
+            f.write('0123456789')
+        self.mtime = 1000000000
+        os.utime(self.filename, (self.mtime, self.mtime))
+        self.etag = '"a-%x"' % self.mtime
+        self.last_modified = email.utils.formatdate(self.mtime, usegmt=True)
+        self.bodies = []
+
+    def tearDown(self):
+        for body in self.bodies:
+            if hasattr(body, 'close'):
+                body.close()
+        shutil.rmtree(self.tempdir)
+
+    def serve(self, **environ):
+        status, headers, body = staticfile.serve_file(self.filename, environ)
+        self.bodies.append(body)
+        return status, dict(headers), body
+
+    def test_serves_the_whole_file(self):
+        status, headers, body = self.serve()
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['Content-Length'], '10')
+        self.assertEqual(headers['ETag'], self.etag)
+        self.assertEqual(headers['Last-Modified'], self.last_modified)
+        self.assertEqual(headers['Accept-Ranges'], 'bytes')
+        self.assertEqual(body.read(), '0123456789')
+
+    def test_holds_a_shared_lock_on_the_file(self):
+        status, headers, body = self.serve()
+        with open(self.filename) as f:
+            self.assertRaises(IOError, fcntl.flock, f.fileno(),
+                              fcntl.LOCK_EX | fcntl.LOCK_NB)
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+
+    def test_serves_a_range(self):
+        status, headers, body = self.serve(HTTP_RANGE='bytes=2-5')
+        self.assertEqual(status, 206)
+        self.assertEqual(headers['Content-Range'], 'bytes 2-5/10')
+        self.assertEqual(headers['Content-Length'], '4')
+        self.assertEqual(body.read(), '2345')
+
+    def test_serves_a_suffix_range(self):
+        status, headers, body = self.serve(HTTP_RANGE='bytes=-3')
+        self.assertEqual(status, 206)
+        self.assertEqual(headers['Content-Range'], 'bytes 7-9/10')
+        self.assertEqual(body.read(), '789')
+
+    def test_serves_the_whole_file_for_multiple_ranges(self):
+        status, headers, body = self.serve(HTTP_RANGE='bytes=0-1,4-5')
+        self.assertEqual(status, 200)
+        self.assertEqual(body.read(), '0123456789')
+
+    def test_refuses_an_unsatisfiable_range(self):
+        status, headers, body = self.serve(HTTP_RANGE='bytes=10-')
+        self.assertEqual(status, 416)
+        self.assertEqual(headers['Content-Range'], 'bytes */10')
+        self.assertEqual(body, '')
+
+    def test_says_a_matching_etag_is_not_modified(self):
+        status, headers, body = self.serve(HTTP_IF_NONE_MATCH=self.etag,
+                                           HTTP_RANGE='bytes=2-5')
+        self.assertEqual(status, 304)
+        self.assertEqual(headers['ETag'], self.etag)
+        self.assertEqual(body, '')
+
+    def test_says_an_old_enough_date_is_not_modified(self):
+        status, headers, body = self.serve(
+            HTTP_IF_MODIFIED_SINCE=self.last_modified)
+        self.assertEqual(status, 304)
+
+    def test_serves_a_range_if_the_etag_matches(self):
+        status, headers, body = self.serve(HTTP_RANGE='bytes=2-5',
+                                           HTTP_IF_RANGE=self.etag)
+        self.assertEqual(status, 206)
+
+    def test_serves_a_range_if_the_date_matches(self):
+        status, headers, body = self.serve(HTTP_RANGE='bytes=2-5',
+                                           HTTP_IF_RANGE=self.last_modified)
+        self.assertEqual(status, 206)
+
+    def test_serves_the_whole_file_if_it_has_changed_since_a_range(self):
+        status, headers, body = self.serve(HTTP_RANGE='bytes=2-5',
+                                           HTTP_IF_RANGE='"b-2"')
+        self.assertEqual(status, 200)
+        self.assertEqual(body.read(), '0123456789')
+
+    def test_ignores_an_unsatisfiable_range_if_the_file_has_changed(self):
+        status, headers, body = self.serve(HTTP_RANGE='bytes=10-',
+                                           HTTP_IF_RANGE='"b-2"')
+        self.assertEqual(status, 200)
+
+
+class FileRegionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.f = tempfile.TemporaryFile()
+        self.f.write('0123456789')
+        self.f.seek(3)
+
+    def tearDown(self):
+        self.f.close()
+
+    def test_gives_the_rest_of_a_file(self):
+        self.assertEqual(staticfile.file_region(self.f),
+                         (self.f.fileno(), 3, 7))
+
+    def test_gives_a_file_range(self):
+        file_range = staticfile.FileRange(self.f, 2, 5)
+        self.assertEqual(staticfile.file_region(file_range),
+                         (self.f.fileno(), 2, 5))
+
+    def test_gives_none_for_something_without_a_file(self):
+        self.assertEqual(
+            staticfile.file_region(StringIO.StringIO('0123456789')), None)
+
+    def test_gives_none_for_a_closed_file(self):
+        self.f.close()
+        self.assertEqual(staticfile.file_region(self.f), None)
+
+
+class RequestHandler(object):
+
+    """Stand in for the request handler a ServerHandler logs to."""
+
+    def log_request(self, status, size):
+        self.logged = (status, size)
+
+
+class QuietRequestHandler(staticfile.SendfileRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+class SendfileHandlerTests(unittest.TestCase):
+
+    """Serve files with SendfileRequestHandler, over a real socket."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'file')
+        with open(self.filename, 'w') as f:
+            f.write('0123456789' * 1000)
+        self.app = None
+        self.server = wsgiref.simple_server.make_server(
+            '127.0.0.1', 0, lambda environ, start: self.app(environ, start),
+            handler_class=QuietRequestHandler)
+        self._sendfile = staticfile._sendfile
+
+    def tearDown(self):
+        self.server.server_close()
+        staticfile._sendfile = self._sendfile
+        shutil.rmtree(self.tempdir)
+
+    def request(self, request_line, app=None):
+        self.app = app
+        thread = threading.Thread(target=self.server.handle_request)
+        thread.start()
+        sock = socket.create_connection(self.server.server_address)
+        sock.sendall(request_line + '\r\n\r\n')
+        response = []
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            response.append(data)
+        sock.close()
+        thread.join()
+        return ''.join(response)
+
+    def get(self, app):
+        head, _, body = self.request('GET / HTTP/1.0', app).partition(
+            '\r\n\r\n')
+        return head.split()[1], body
+
+    def send_file(self, body=None, length=None, result=()):
+        def app(environ, start_response):
+            f = open(self.filename)
+            if body is not None:
+                f = body(f)
+            size = length
+            if size is None:
+                size = staticfile.file_region(f)[2]
+            start_response('200 OK', [('Content-Length', str(size))])
+            environ[staticfile.SENDFILE_KEY](f)
+            return list(result)
+        return self.get(app)
+
+    def test_serves_other_responses_as_usual(self):
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Length', '5')])
+            return ['hello']
+        self.assertEqual(self.get(app), ('200', 'hello'))
+
+    def test_sends_a_file(self):
+        self.assertEqual(self.send_file(), ('200', '0123456789' * 1000))
+
+    def test_sends_a_file_range(self):
+        self.assertEqual(
+            self.send_file(lambda f: staticfile.FileRange(f, 5, 10)),
+            ('200', '5678901234'))
+
+    def test_sends_a_body_before_the_file(self):
+        self.assertEqual(
+            self.send_file(length=10005, result=['hello']),
+            ('200', 'hello' + '0123456789' * 1000))
+
+    def test_stops_at_the_end_of_a_truncated_file(self):
+        self.assertEqual(
+            self.send_file(lambda f: staticfile.FileRange(f, 9995, 10)),
+            ('200', '56789'))
+
+    def test_copies_a_file_without_sendfile(self):
+        staticfile._sendfile = None
+        self.assertEqual(
+            self.send_file(lambda f: staticfile.FileRange(f, 5, 10)),
+            ('200', '5678901234'))
+
+    def test_copies_a_file_without_a_file_number(self):
+        self.assertEqual(
+            self.send_file(lambda f: StringIO.StringIO(f.read(10)),
+                           length=10),
+            ('200', '0123456789'))
+
+    def test_sends_a_wrapped_file(self):
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Length', '10000')])
+            return environ['wsgi.file_wrapper'](open(self.filename))
+        self.assertEqual(self.get(app), ('200', '0123456789' * 1000))
+
+    def test_copies_a_file_if_the_connection_has_no_file_number(self):
+        environ = {'REQUEST_METHOD': 'GET', 'SERVER_PROTOCOL': 'HTTP/1.0'}
+        stdout = StringIO.StringIO()
+        handler = staticfile.SendfileServerHandler(
+            StringIO.StringIO(), stdout, StringIO.StringIO(), environ)
+        handler.request_handler = RequestHandler()
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Length', '10000')])
+            environ[staticfile.SENDFILE_KEY](open(self.filename))
+            return []
+        handler.run(app)
+        self.assertTrue(
+            stdout.getvalue().endswith('\r\n\r\n' + '0123456789' * 1000))
+        self.assertEqual(handler.request_handler.logged, ('200', 10000))
+
+    def test_refuses_a_very_long_request_line(self):
+        response = self.request('GET /%s HTTP/1.0' % ('x' * 65536))
+        self.assertTrue(response.startswith('HTTP/1.0 414 '))
+
+    def test_refuses_a_bad_request_line(self):
+        # The version is not known, so the response is HTTP/0.9, which
+        # has no status line.
+        response = self.request('GET / HTTP/one')
+        self.assertTrue('Error code 400' in response)
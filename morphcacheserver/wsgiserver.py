@@ -0,0 +1,104 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import logging
+import os
+import Queue
+import signal
+import sys
+import threading
+import wsgiref.simple_server
+
+
+class PooledWSGIServer(wsgiref.simple_server.WSGIServer):
+
+    """wsgiref server which handles several requests at once.
+
+    Accepted connections are handed to a fixed pool of pool_size
+    threads, so a slow git lookup or a long download only ties up one of
+    them. When the pool is busy, further connections wait to be accepted
+    rather than each getting a thread of its own.
+
+    If processes is more than one, that many processes are forked once
+    the listening socket is open, each with its own pool of threads, and
+    the kernel shares the connections out between them. The original
+    process only looks after the others, and stops them when it is
+    terminated.
+
+    """
+
+    pool_size = 16
+    processes = 1
+    request_queue_size = 128
+
+    def serve_forever(self, poll_interval=0.5):
+        if self.processes > 1:
+            self._serve_forked(poll_interval)
+        else:
+            self._serve(poll_interval)
+
+    def _serve(self, poll_interval):
+        # The threads are only started here, since they would not
+        # survive being forked.
+        self._requests = Queue.Queue(self.pool_size)
+        for i in xrange(self.pool_size):
+            thread = threading.Thread(target=self._handle_requests)
+            thread.daemon = True
+            thread.start()
+        wsgiref.simple_server.WSGIServer.serve_forever(self, poll_interval)
+
+    def _serve_forked(self, poll_interval):
+        def terminate(signum, frame):
+            sys.exit(128 + signum)
+
+        children = []
+        for i in xrange(self.processes):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    self._serve(poll_interval)
+                finally:
+                    os._exit(1)
+            children.append(pid)
+
+        previous = signal.signal(signal.SIGTERM, terminate)
+        try:
+            while children:
+                pid, status = os.wait()
+                children.remove(pid)
+                logging.warning('Server process %d exited with status %d, '
+                                '%d left' % (pid, status, len(children)))
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+            for pid in children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                    os.waitpid(pid, 0)
+                except OSError:
+                    pass
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+    def _handle_requests(self):
+        while True:
+            request, client_address = self._requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
@@ -1,4 +1,4 @@
-# Copyright (C) 2011-2014  Codethink Limited
+# Copyright (C) 2011-2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -48,10 +48,13 @@ class Error(cliapp.AppException):
 
 import artifact
 import artifactcachereference
+import artifactdownloader
 import artifactresolver
 import artifactsplitrule
+import artifactuploader
 import branchmanager
 import bins
+import bloomfilter
 import buildbranch
 import buildcommand
 import buildenvironment
@@ -59,12 +62,14 @@ import buildsystem
 import builder
 import cachedrepo
 import cachekeycomputer
+import contentdigest
 import extensions
 import extractedtarball
 import fsutils
 import git
 import gitdir
 import gitindex
+import httpcache
 import localartifactcache
 import localrepocache
 import mountableimage
@@ -84,6 +89,7 @@ import stagingarea
 import stopwatch
 import sysbranchdir
 import systemmetadatadir
+import tieredartifactcache
 import util
 import workspace
 
@@ -1,4 +1,4 @@
-# Copyright (C) 2011-2015  Codethink Limited
+# Copyright (C) 2011-2015, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -47,7 +47,9 @@ defaults = {
             'ssh://git@github.com/%s'),
     ],
     'cachedir': os.path.expanduser('~/.cache/morph'),
-    'max-jobs': morphlib.util.make_concurrency()
+    'max-jobs': morphlib.util.make_concurrency(),
+    'artifact-download-streams':
+        morphlib.artifactdownloader.DEFAULT_STREAMS,
 }
 
 
@@ -107,6 +109,61 @@ class Morph(cliapp.Application):
             metavar='URL',
             default=None,
             group=group_advanced)
+        self.settings.string_list(
+            ['artifact-cache-servers'],
+            'list of HTTP URLs of artifact cache servers, nearest first, '
+            'which are tried in turn for each artifact; if not set, then '
+            'the artifact-cache-server setting is used instead',
+            metavar='URL,...',
+            default=[],
+            group=group_advanced)
+        self.settings.integer(
+            ['artifact-cache-timeout'],
+            'give up on an artifact cache server which does not respond '
+            'within SECONDS, and move on to the next one; 0 means wait '
+            'for as long as the network does',
+            metavar='SECONDS',
+            default=0,
+            group=group_advanced)
+        self.settings.boolean(
+            ['artifact-cache-mirror'],
+            'copy artifacts found in a farther artifact cache server into '
+            'the nearest one, which must accept uploads',
+            group=group_advanced)
+        self.settings.integer(
+            ['http-cache-size'],
+            'keep up to SIZE MiB of small responses from cache servers in '
+            'the cache directory, and reuse them for as long as the '
+            'servers allow; 0 turns this off',
+            metavar='SIZE',
+            default=64,
+            group=group_advanced)
+        self.settings.boolean(
+            ['no-membership-filter'],
+            'ask artifact cache servers about every artifact, rather than '
+            'first checking the membership filters they publish',
+            group=group_advanced)
+        self.settings.integer(
+            ['artifact-download-streams'],
+            'fetch up to N artifact files from the artifact cache server '
+            'at the same time',
+            metavar='N',
+            default=defaults['artifact-download-streams'],
+            group=group_advanced)
+        self.settings.string(
+            ['artifact-upload-server'],
+            'HTTP URL of the writeable artifact cache server that '
+            'push-artifacts uploads to; if not set, then the '
+            'artifact-cache-server setting is used instead',
+            metavar='URL',
+            default=None,
+            group=group_advanced)
+        self.settings.string(
+            ['artifact-upload-token'],
+            'send TOKEN to the artifact upload server to authorise uploads',
+            metavar='TOKEN',
+            default='',
+            group=group_advanced)
         self.settings.string(
             ['git-resolve-cache-server'],
             'HTTP URL for the git ref resolving cache server; '
@@ -139,6 +196,10 @@ class Morph(cliapp.Application):
                               'always push temporary build branches to the '
                               'remote repository',
                               group=group_build)
+        self.settings.boolean(['push-artifacts'],
+                              'upload the artifacts built locally to the '
+                              'artifact upload server, in the background',
+                              group=group_build)
 
         group_storage = 'Storage Options'
         self.settings.string(['tempdir'],
@@ -0,0 +1,370 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import collections
+import functools
+import hashlib
+import httplib
+import logging
+import Queue
+import socket
+import sys
+import tarfile
+import threading
+import time
+
+import morphlib
+
+
+DEFAULT_STREAMS = 4
+DEFAULT_BUFSIZE = 1024 * 1024
+DEFAULT_RETRIES = 3
+
+# Errors that can interrupt a transfer once it has started.
+TRANSFER_ERRORS = (IOError, socket.error, httplib.HTTPException)
+
+
+Transfer = collections.namedtuple(
+    'Transfer', ('description', 'open_remote', 'open_local'))
+
+SmallFile = collections.namedtuple(
+    'SmallFile', ('filename', 'open_remote', 'open_local', 'required'))
+
+
+def _header(remote, name):
+    info = getattr(remote, 'info', None)
+    if info is None:
+        return None
+    return info().getheader(name)
+
+
+def _is_partial_content(remote):
+    getcode = getattr(remote, 'getcode', None)
+    return getcode is not None and getcode() == 206
+
+
+def _content_size(remote, offset):
+    '''Return the full size of the file being read, if the server says.'''
+
+    length = _header(remote, 'Content-Length')
+    if length is None or not length.isdigit():
+        return None
+    return offset + int(length)
+
+
+def _content_digest(remote):
+    '''Return the base64 SHA-256 digest the server publishes, if any.
+
+    The digest is sent in an RFC 3230 ``Digest`` header, and is always
+    that of the whole file, even for a partial response.
+
+    '''
+
+    return morphlib.contentdigest.parse_header(_header(remote, 'Digest'))
+
+
+class ArtifactDownloader(object):
+
+    '''Copy a set of files from a remote artifact cache to the local one.
+
+    Files are queued with the ``add_*`` methods and then transferred
+    by ``fetch``, using up to ``streams`` concurrent connections to the
+    remote cache and ``bufsize`` byte reads.
+
+    Each file is committed atomically: it is written to a temporary
+    file, which is renamed into place as soon as its own transfer has
+    succeeded, so no more than one local file per stream is open at
+    once. If any transfer fails, no more are started, the files which
+    were already fetched are kept, and the first error is re-raised.
+
+    Artifacts are written with ``put_resumable``, so the data of an
+    artifact whose transfer was interrupted is kept, and the next
+    attempt asks the server for the rest of it only. Artifacts are
+    checked against the size and digest the server publishes before
+    they are committed, and fetched again if they do not match.
+
+    Metadata files are small and there can be hundreds of them, so
+    they are all fetched in one request as a tar archive, see
+    RemoteArtifactCache.get_files.
+
+    '''
+
+    def __init__(self, lac, rac, streams=DEFAULT_STREAMS,
+                 bufsize=DEFAULT_BUFSIZE, retries=DEFAULT_RETRIES,
+                 status_cb=None):
+        self.lac = lac
+        self.rac = rac
+        self.streams = max(1, streams)
+        self.bufsize = bufsize
+        self.retries = retries
+        self.status = status_cb or (lambda **kwargs: None)
+        self._transfers = []
+        self._small_files = []
+
+    def __len__(self):
+        return len(self._transfers) + len(self._small_files)
+
+    def add_artifact(self, artifact):
+        self._transfers.append(Transfer(
+            artifact.basename(),
+            lambda offset: self.rac.get(artifact, offset=offset),
+            lambda: self.lac.put_resumable(artifact)))
+
+    def add_artifact_metadata(self, artifact, name, required=True):
+        '''Queue a metadata file of an artifact.
+
+        Metadata files are small, so they are all fetched together as
+        one archive. If ``required`` is false, it is not an error for
+        the remote cache not to have the file.
+
+        '''
+
+        self._small_files.append(SmallFile(
+            artifact.metadata_basename(name),
+            lambda: self.rac.get_artifact_metadata(artifact, name),
+            lambda: self.lac.put_artifact_metadata(artifact, name),
+            required))
+
+    def fetch(self):
+        '''Transfer every queued file, returning the number of bytes.'''
+
+        transfers, self._transfers = self._transfers, []
+        small_files, self._small_files = self._small_files, []
+        count = len(transfers) + len(small_files)
+        if count == 0:
+            return 0
+
+        todo = Queue.Queue()
+        for transfer in transfers:
+            todo.put(functools.partial(self._fetch_one, transfer))
+        if small_files:
+            todo.put(functools.partial(self._fetch_archive, small_files))
+
+        failures = []
+        totals = []
+        lock = threading.Lock()
+
+        def worker():
+            while not failures:
+                try:
+                    job = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    size = job()
+                except BaseException:
+                    with lock:
+                        failures.append(sys.exc_info())
+                    return
+                with lock:
+                    totals.append(size)
+
+        start = time.time()
+        threads = [threading.Thread(target=worker)
+                   for i in xrange(min(self.streams, todo.qsize()))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.time() - start
+
+        if failures:
+            exc_type, exc_value, exc_traceback = failures[0]
+            raise exc_type, exc_value, exc_traceback
+
+        total = sum(totals)
+        self._report(count, total, duration)
+        return total
+
+    def _fetch_one(self, transfer):
+        local = transfer.open_local()
+        try:
+            size = self._transfer(transfer, local)
+        except BaseException:
+            logging.debug('Failed to fetch %s' % transfer.description)
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            self._discard(local, exc_value)
+            raise exc_type, exc_value, exc_traceback
+        local.close()
+        return size
+
+    def _fetch_archive(self, small_files):
+        '''Fetch many small files with a single request.'''
+
+        try:
+            remote = self.rac.get_files([f.filename for f in small_files])
+        except morphlib.remoteartifactcache.GetError:
+            logging.debug('Fetching %d files one at a time instead' %
+                          len(small_files))
+            return self._fetch_separately(small_files)
+
+        wanted = dict((f.filename, f) for f in small_files)
+        size = 0
+        try:
+            archive = tarfile.open(fileobj=remote, mode='r|')
+            for member in archive:
+                if member.isfile() and member.name in wanted:
+                    small_file = wanted.pop(member.name)
+                    size += self._save(small_file,
+                                       archive.extractfile(member))
+            archive.close()
+            # Asking for the missing files on their own raises the right
+            # error for any that the server really does not have.
+            missing = [f for f in wanted.itervalues() if f.required]
+            if missing:
+                size += self._fetch_separately(missing)
+        finally:
+            remote.close()
+        return size
+
+    def _fetch_separately(self, small_files):
+        size = 0
+        for small_file in small_files:
+            try:
+                remote = small_file.open_remote()
+            except morphlib.remoteartifactcache.GetError:
+                if small_file.required:
+                    raise
+            else:
+                try:
+                    size += self._save(small_file, remote)
+                finally:
+                    remote.close()
+        return size
+
+    def _save(self, small_file, remote):
+        '''Copy all of ``remote`` into the local file, and commit it.'''
+
+        local = small_file.open_local()
+        try:
+            size = self._copy(remote, local)
+        except BaseException:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            self._discard(local)
+            raise exc_type, exc_value, exc_traceback
+        local.close()
+        return size
+
+    def _copy(self, remote, local):
+        size = 0
+        while True:
+            data = remote.read(self.bufsize)
+            if not data:
+                return size
+            local.write(data)
+            size += len(data)
+
+    def _transfer(self, transfer, local):
+        '''Copy one file into ``local``, returning the bytes transferred.
+
+        Transfers to resumable files are retried up to ``retries`` times:
+        an interrupted or short transfer carries on from the data already
+        written, and one that does not match the published digest starts
+        again from scratch.
+
+        '''
+
+        resumable = hasattr(local, 'restart')
+        offset = getattr(local, 'offset', 0)
+        checksum = self._hash_partial(local, offset)
+        transferred = 0
+        attempts = 0
+
+        while True:
+            try:
+                remote = transfer.open_remote(offset)
+            except morphlib.remoteartifactcache.GetError:
+                if not offset:
+                    raise
+                # The server may not have a file as long as the partial
+                # data we have, which means that data is not worth keeping.
+                local.restart()
+                offset = 0
+                checksum = hashlib.sha256()
+                remote = transfer.open_remote(offset)
+
+            try:
+                if offset and not _is_partial_content(remote):
+                    local.restart()
+                    offset = 0
+                    checksum = hashlib.sha256()
+                size = _content_size(remote, offset)
+                digest = _content_digest(remote)
+
+                while True:
+                    data = remote.read(self.bufsize)
+                    if not data:
+                        break
+                    local.write(data)
+                    checksum.update(data)
+                    offset += len(data)
+                    transferred += len(data)
+
+                failure = None
+                if size is not None and offset < size:
+                    failure = IOError('Transfer of %s stopped after %d of '
+                                      '%d bytes' %
+                                      (transfer.description, offset, size))
+                elif ((size is not None and offset > size) or
+                      (digest is not None and
+                       digest != morphlib.contentdigest.encode(checksum))):
+                    failure = morphlib.remoteartifactcache.ChecksumError(
+                        self.rac, transfer.description)
+                    if resumable:
+                        local.restart()
+                        offset = 0
+                        checksum = hashlib.sha256()
+            except TRANSFER_ERRORS, e:
+                failure = e
+            finally:
+                remote.close()
+
+            if failure is None:
+                return transferred
+            if not resumable or attempts >= self.retries:
+                raise failure
+            attempts += 1
+            logging.warning('Retrying transfer of %s from byte %d: %s' %
+                            (transfer.description, offset, failure))
+
+    def _hash_partial(self, local, offset):
+        if not offset:
+            return hashlib.sha256()
+        with open(local.name, 'rb') as f:
+            return morphlib.contentdigest.checksum_file(
+                f, bufsize=self.bufsize)
+
+    def _discard(self, local, exception=None):
+        '''Throw away a file, keeping resumable data after a failure.'''
+
+        if (exception is not None and hasattr(local, 'suspend') and
+                local.tell() > 0 and
+                not isinstance(exception,
+                               morphlib.remoteartifactcache.ChecksumError)):
+            local.suspend()
+        elif hasattr(local, 'abort'):
+            local.abort()
+        else:
+            local.close()
+
+    def _report(self, count, total, duration):
+        mebibytes = total / float(1024 * 1024)
+        rate = mebibytes / duration if duration > 0 else 0.0
+        self.status(msg='Fetched %(count)d files, %(size).1f MiB at '
+                        '%(rate).1f MiB/s using %(streams)d streams',
+                    count=count, size=mebibytes, rate=rate,
+                    streams=min(self.streams, count), chatty=True)
@@ -0,0 +1,487 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import base64
+import hashlib
+import os
+import StringIO
+import tarfile
+import threading
+import unittest
+
+import fs.tempfs
+
+import morphlib
+
+
+class FakeArtifact(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def basename(self):
+        return '%s.chunk.%s' % ('0' * 64, self.name)
+
+    def metadata_basename(self, name):
+        return '%s.%s' % (self.basename(), name)
+
+
+class FakeHeaders(dict):
+
+    def getheader(self, name):
+        return self.get(name)
+
+
+class FakeResponse(StringIO.StringIO):
+
+    def __init__(self, data, code=200, headers={}, fail_after=None):
+        StringIO.StringIO.__init__(self, data)
+        self.code = code
+        self.headers = FakeHeaders(headers)
+        self.fail_after = fail_after
+
+    def getcode(self):
+        return self.code
+
+    def info(self):
+        return self.headers
+
+    def read(self, size=-1):
+        if self.fail_after is not None and self.tell() >= self.fail_after:
+            raise IOError('connection reset')
+        return StringIO.StringIO.read(self, size)
+
+
+class FakeRemoteArtifactCache(object):
+
+    def __init__(self, files):
+        self.files = files
+        self.digests = {}
+        self.ranges = True
+        self.archives = True
+        self.corrupt = {}
+        self.fail_after = {}
+        self.requests = []
+
+    def publish_digests(self):
+        for filename, data in self.files.iteritems():
+            self.digests[filename] = base64.b64encode(
+                hashlib.sha256(data).digest())
+
+    def _get_file(self, filename, offset=0):
+        self.requests.append((filename, offset))
+        if filename not in self.files:
+            raise morphlib.remoteartifactcache.GetError(
+                self, FakeArtifact(filename))
+        data = self.files[filename]
+        if filename in self.corrupt:
+            data = self.corrupt.pop(filename)
+        code = 200
+        if offset and self.ranges:
+            data = data[offset:]
+            code = 206
+        headers = {'Content-Length': str(len(data))}
+        if filename in self.digests:
+            headers['Digest'] = 'SHA-256=%s' % self.digests[filename]
+        return FakeResponse(data, code, headers,
+                            self.fail_after.pop(filename, None))
+
+    def get(self, artifact, offset=0):
+        return self._get_file(artifact.basename(), offset)
+
+    def get_files(self, filenames):
+        self.requests.append(('archive', len(filenames)))
+        if not self.archives:
+            raise morphlib.remoteartifactcache.GetFilesError(self, filenames)
+        handle = StringIO.StringIO()
+        tar = tarfile.open(fileobj=handle, mode='w|')
+        for filename in filenames:
+            if filename in self.files:
+                data = self.files[filename]
+                info = tarfile.TarInfo(filename)
+                info.size = len(data)
+                tar.addfile(info, StringIO.StringIO(data))
+        tar.close()
+        handle.seek(0)
+        return handle
+
+    def get_artifact_metadata(self, artifact, name):
+        return self._get_file(artifact.metadata_basename(name))
+
+
+class ArtifactDownloaderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempfs = fs.tempfs.TempFS()
+        self.artifacts = [FakeArtifact(name) for name in 'abcdef']
+        remote_files = {}
+        for a in self.artifacts:
+            remote_files[a.basename()] = a.name * 1000
+            remote_files[a.metadata_basename('meta')] = 'meta ' + a.name
+        self.lac = morphlib.localartifactcache.LocalArtifactCache(
+            self.tempfs)
+        self.rac = FakeRemoteArtifactCache(remote_files)
+        self.messages = []
+
+    def tearDown(self):
+        self.tempfs.close()
+
+    def status(self, **kwargs):
+        self.messages.append(kwargs['msg'] % kwargs)
+
+    def new_downloader(self, **kwargs):
+        return morphlib.artifactdownloader.ArtifactDownloader(
+            self.lac, self.rac, status_cb=self.status, **kwargs)
+
+    def local_files(self):
+        return dict((filename, self.tempfs.getcontents(filename))
+                    for filename in self.tempfs.listdir())
+
+    def write_partial(self, artifact, data):
+        handle = self.lac.put_resumable(artifact)
+        handle.write(data)
+        handle.suspend()
+
+    def test_fetching_nothing_does_nothing(self):
+        downloader = self.new_downloader()
+        self.assertEqual(downloader.fetch(), 0)
+        self.assertEqual(self.local_files(), {})
+        self.assertEqual(self.messages, [])
+
+    def test_counts_queued_files(self):
+        downloader = self.new_downloader()
+        downloader.add_artifact(self.artifacts[0])
+        downloader.add_artifact_metadata(self.artifacts[0], 'meta')
+        self.assertEqual(len(downloader), 2)
+
+    def test_fetches_all_artifacts(self):
+        downloader = self.new_downloader(streams=3, bufsize=7)
+        for a in self.artifacts:
+            downloader.add_artifact(a)
+            downloader.add_artifact_metadata(a, 'meta')
+        total = downloader.fetch()
+        self.assertEqual(self.local_files(), self.rac.files)
+        self.assertEqual(total, sum(len(d) for d in self.rac.files.values()))
+        self.assertEqual(len(downloader), 0)
+
+    def test_reports_throughput(self):
+        downloader = self.new_downloader()
+        downloader.add_artifact(self.artifacts[0])
+        downloader.fetch()
+        self.assertEqual(len(self.messages), 1)
+        self.assertTrue('Fetched 1 files' in self.messages[0])
+        self.assertTrue('MiB/s' in self.messages[0])
+
+    def test_never_uses_fewer_than_one_stream(self):
+        downloader = self.new_downloader(streams=0)
+        downloader.add_artifact(self.artifacts[0])
+        downloader.fetch()
+        self.assertEqual(self.local_files().keys(),
+                         [self.artifacts[0].basename()])
+
+    def test_keeps_files_fetched_before_a_transfer_fails(self):
+        missing = FakeArtifact('missing')
+        downloader = self.new_downloader(streams=1)
+        downloader.add_artifact_metadata(self.artifacts[0], 'meta')
+        downloader.add_artifact(self.artifacts[1])
+        downloader.add_artifact(missing)
+        downloader.add_artifact(self.artifacts[2])
+        self.assertRaises(morphlib.remoteartifactcache.GetError,
+                          downloader.fetch)
+        self.assertEqual(self.local_files().keys(),
+                         [self.artifacts[1].basename()])
+
+    def test_closes_handles_without_abort_on_failure(self):
+        closed = []
+        local = StringIO.StringIO()
+        local.close = lambda: closed.append(local)
+        self.lac.put_resumable = lambda artifact: local
+        downloader = self.new_downloader()
+        downloader.add_artifact(FakeArtifact('missing'))
+        self.assertRaises(morphlib.remoteartifactcache.GetError,
+                          downloader.fetch)
+        self.assertEqual(closed, [local])
+
+    def test_keeps_a_finished_artifact_if_another_is_interrupted(self):
+        self.rac.publish_digests()
+        self.rac.fail_after[self.artifacts[1].basename()] = 400
+        downloader = self.new_downloader(streams=2, bufsize=100, retries=0)
+        downloader.add_artifact(self.artifacts[0])
+        downloader.add_artifact(self.artifacts[1])
+        self.assertRaises(IOError, downloader.fetch)
+        self.assertEqual(self.local_files(), {
+            self.artifacts[0].basename(): 'a' * 1000,
+            self.artifacts[1].basename() + '.partial': 'b' * 400,
+        })
+
+    def fetch_concurrently(self, orders, streams):
+        # The first request of each fetch waits for the other's, so
+        # that each has a file of its own on the go when it asks for
+        # the other's.
+        original_get = self.rac.get
+        lock = threading.Lock()
+        requested = []
+        both_requested = threading.Event()
+        def get(artifact, offset=0):
+            with lock:
+                requested.append(artifact)
+                if len(requested) == len(orders):
+                    both_requested.set()
+            both_requested.wait(1)
+            return original_get(artifact, offset)
+        self.rac.get = get
+
+        threads = []
+        for order in orders:
+            downloader = self.new_downloader(streams=streams)
+            for i in order:
+                downloader.add_artifact(self.artifacts[i])
+            thread = threading.Thread(target=downloader.fetch)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+        self.assertEqual(self.local_files(), {
+            self.artifacts[0].basename(): 'a' * 1000,
+            self.artifacts[1].basename(): 'b' * 1000,
+        })
+
+    def test_concurrent_fetches_in_opposite_orders_finish(self):
+        self.fetch_concurrently([[0, 1], [1, 0]], streams=1)
+
+    def test_concurrent_fetches_in_the_same_order_finish(self):
+        self.fetch_concurrently([[0, 1], [0, 1]], streams=2)
+
+    def test_fetches_metadata_in_one_request(self):
+        downloader = self.new_downloader()
+        for a in self.artifacts:
+            downloader.add_artifact_metadata(a, 'meta')
+        downloader.fetch()
+        self.assertEqual(self.rac.requests, [('archive', 6)])
+        self.assertEqual(sorted(self.local_files().keys()),
+                         sorted(a.metadata_basename('meta')
+                                for a in self.artifacts))
+
+    def test_skips_missing_optional_metadata(self):
+        downloader = self.new_downloader()
+        downloader.add_artifact_metadata(self.artifacts[0], 'meta')
+        downloader.add_artifact_metadata(self.artifacts[0], 'other',
+                                         required=False)
+        downloader.fetch()
+        self.assertEqual(self.local_files().keys(),
+                         [self.artifacts[0].metadata_basename('meta')])
+
+    def test_falls_back_to_separate_requests_without_archives(self):
+        self.rac.archives = False
+        downloader = self.new_downloader()
+        downloader.add_artifact_metadata(self.artifacts[0], 'meta')
+        downloader.add_artifact_metadata(self.artifacts[1], 'meta')
+        downloader.add_artifact_metadata(self.artifacts[1], 'other',
+                                         required=False)
+        downloader.fetch()
+        self.assertEqual(len(self.rac.requests), 4)
+        self.assertEqual(sorted(self.local_files().keys()),
+                         [self.artifacts[0].metadata_basename('meta'),
+                          self.artifacts[1].metadata_basename('meta')])
+
+    def test_keeps_archive_files_if_a_separate_fetch_fails(self):
+        original_get_files = self.rac.get_files
+        def get_files(filenames):
+            return original_get_files(filenames[:1])
+        self.rac.get_files = get_files
+        downloader = self.new_downloader()
+        downloader.add_artifact_metadata(self.artifacts[0], 'meta')
+        downloader.add_artifact_metadata(FakeArtifact('missing'), 'meta')
+        self.assertRaises(morphlib.remoteartifactcache.GetError,
+                          downloader.fetch)
+        self.assertEqual(self.local_files().keys(),
+                         [self.artifacts[0].metadata_basename('meta')])
+
+    def test_keeps_earlier_files_if_a_separate_fetch_fails(self):
+        self.rac.archives = False
+        downloader = self.new_downloader()
+        downloader.add_artifact_metadata(self.artifacts[0], 'meta')
+        downloader.add_artifact_metadata(FakeArtifact('missing'), 'meta')
+        self.assertRaises(morphlib.remoteartifactcache.GetError,
+                          downloader.fetch)
+        self.assertEqual(self.local_files().keys(),
+                         [self.artifacts[0].metadata_basename('meta')])
+
+    def test_discards_a_file_cut_short_in_the_archive(self):
+        original_get_files = self.rac.get_files
+        def get_files(filenames):
+            handle = original_get_files(filenames)
+            handle.truncate(514)
+            return handle
+        self.rac.get_files = get_files
+        downloader = self.new_downloader()
+        downloader.add_artifact_metadata(self.artifacts[0], 'meta')
+        self.assertRaises(tarfile.TarError, downloader.fetch)
+        self.assertEqual(self.local_files(), {})
+
+    def test_ignores_unwanted_archive_members(self):
+        def get_files(filenames):
+            handle = StringIO.StringIO()
+            tar = tarfile.open(fileobj=handle, mode='w|')
+            info = tarfile.TarInfo(filenames[0])
+            info.type = tarfile.DIRTYPE
+            tar.addfile(info)
+            tar.addfile(tarfile.TarInfo('unwanted'), StringIO.StringIO())
+            tar.close()
+            handle.seek(0)
+            return handle
+        self.rac.get_files = get_files
+        downloader = self.new_downloader()
+        downloader.add_artifact_metadata(self.artifacts[0], 'meta')
+        downloader.fetch()
+        self.assertEqual(self.local_files().keys(),
+                         [self.artifacts[0].metadata_basename('meta')])
+
+    def test_fetches_from_responses_without_headers(self):
+        data = self.rac.files[self.artifacts[0].basename()]
+        self.rac.get = lambda artifact, offset=0: StringIO.StringIO(data)
+        downloader = self.new_downloader()
+        downloader.add_artifact(self.artifacts[0])
+        self.assertEqual(downloader.fetch(), 1000)
+
+    def test_fetches_from_responses_without_content_length(self):
+        data = self.rac.files[self.artifacts[0].basename()]
+        self.rac.get = lambda artifact, offset=0: FakeResponse(data)
+        downloader = self.new_downloader()
+        downloader.add_artifact(self.artifacts[0])
+        self.assertEqual(downloader.fetch(), 1000)
+
+    def test_fetches_files_left_out_of_the_archive(self):
+        original_get_files = self.rac.get_files
+        def get_files(filenames):
+            return original_get_files(filenames[:1])
+        self.rac.get_files = get_files
+        downloader = self.new_downloader()
+        downloader.add_artifact_metadata(self.artifacts[0], 'meta')
+        downloader.add_artifact_metadata(self.artifacts[1], 'meta')
+        downloader.fetch()
+        self.assertEqual(sorted(self.local_files().keys()),
+                         [self.artifacts[0].metadata_basename('meta'),
+                          self.artifacts[1].metadata_basename('meta')])
+
+    def test_resumes_from_partial_data(self):
+        artifact = self.artifacts[0]
+        self.write_partial(artifact, 'a' * 300)
+        self.rac.publish_digests()
+        downloader = self.new_downloader()
+        downloader.add_artifact(artifact)
+        self.assertEqual(downloader.fetch(), 700)
+        self.assertEqual(self.rac.requests, [(artifact.basename(), 300)])
+        self.assertEqual(self.local_files(),
+                         {artifact.basename(): 'a' * 1000})
+
+    def test_restarts_when_server_ignores_range(self):
+        artifact = self.artifacts[0]
+        self.write_partial(artifact, 'a' * 300)
+        self.rac.ranges = False
+        downloader = self.new_downloader()
+        downloader.add_artifact(artifact)
+        self.assertEqual(downloader.fetch(), 1000)
+        self.assertEqual(self.local_files(),
+                         {artifact.basename(): 'a' * 1000})
+
+    def test_restarts_when_partial_data_is_too_long(self):
+        artifact = self.artifacts[0]
+        self.write_partial(artifact, 'a' * 2000)
+        self.rac.publish_digests()
+        self.rac.ranges = False
+        original_get = self.rac.get
+        def get(artifact, offset=0):
+            if offset >= 1000:
+                raise morphlib.remoteartifactcache.GetError(self.rac, artifact)
+            return original_get(artifact, offset)
+        self.rac.get = get
+        downloader = self.new_downloader()
+        downloader.add_artifact(artifact)
+        downloader.fetch()
+        self.assertEqual(self.local_files(),
+                         {artifact.basename(): 'a' * 1000})
+
+    def test_resumes_an_interrupted_transfer(self):
+        artifact = self.artifacts[0]
+        self.rac.publish_digests()
+        self.rac.fail_after[artifact.basename()] = 400
+        downloader = self.new_downloader(bufsize=100)
+        downloader.add_artifact(artifact)
+        self.assertEqual(downloader.fetch(), 1000)
+        self.assertEqual(self.rac.requests, [(artifact.basename(), 0),
+                                             (artifact.basename(), 400)])
+        self.assertEqual(self.local_files(),
+                         {artifact.basename(): 'a' * 1000})
+
+    def test_resumes_a_truncated_transfer(self):
+        artifact = self.artifacts[0]
+        self.rac.publish_digests()
+        original_get = self.rac.get
+        def get(artifact, offset=0):
+            response = original_get(artifact, offset)
+            if offset == 0:
+                response.truncate(600)
+            return response
+        self.rac.get = get
+        downloader = self.new_downloader()
+        downloader.add_artifact(artifact)
+        downloader.fetch()
+        self.assertEqual(self.local_files(),
+                         {artifact.basename(): 'a' * 1000})
+
+    def test_keeps_partial_data_if_transfer_keeps_failing(self):
+        artifact = self.artifacts[0]
+        self.rac.fail_after[artifact.basename()] = 400
+        downloader = self.new_downloader(bufsize=100, retries=0)
+        downloader.add_artifact(artifact)
+        self.assertRaises(IOError, downloader.fetch)
+        self.assertEqual(self.local_files(),
+                         {artifact.basename() + '.partial': 'a' * 400})
+
+    def test_fetches_again_if_digest_does_not_match(self):
+        artifact = self.artifacts[0]
+        self.rac.publish_digests()
+        self.rac.corrupt[artifact.basename()] = 'b' * 1000
+        downloader = self.new_downloader()
+        downloader.add_artifact(artifact)
+        downloader.fetch()
+        self.assertEqual(self.local_files(),
+                         {artifact.basename(): 'a' * 1000})
+
+    def test_discards_data_that_never_matches_digest(self):
+        artifact = self.artifacts[0]
+        self.rac.digests[artifact.basename()] = 'bogus'
+        downloader = self.new_downloader(retries=1)
+        downloader.add_artifact(artifact)
+        self.assertRaises(morphlib.remoteartifactcache.ChecksumError,
+                          downloader.fetch)
+        self.assertEqual(self.local_files(), {})
+
+    def test_detects_a_file_longer_than_advertised(self):
+        artifact = self.artifacts[0]
+        original_get = self.rac.get
+        def get(artifact, offset=0):
+            response = original_get(artifact, offset)
+            response.headers['Content-Length'] = '10'
+            return response
+        self.rac.get = get
+        downloader = self.new_downloader(retries=0)
+        downloader.add_artifact(artifact)
+        self.assertRaises(morphlib.remoteartifactcache.ChecksumError,
+                          downloader.fetch)
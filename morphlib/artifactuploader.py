@@ -0,0 +1,143 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import collections
+import logging
+import os
+import Queue
+import threading
+
+
+Upload = collections.namedtuple('Upload', ('basename', 'filename', 'put'))
+
+
+class ArtifactUploader(object):
+
+    '''Push locally built artifacts to a writeable artifact cache.
+
+    Files are queued with the ``add_*`` methods. Each call to ``upload``
+    hands the queued files to a background thread, so that the build can
+    carry on while they are sent, and ``wait`` waits for all of them to
+    be done.
+
+    The server is asked which of the files it already has, with one
+    request per batch, and only the files it lacks are sent.
+
+    A failed upload does not make the build fail, since the artifacts
+    are still in the local cache. Failures are logged and counted.
+
+    '''
+
+    def __init__(self, lac, rac, status_cb=None):
+        self.lac = lac
+        self.rac = rac
+        self.status = status_cb or (lambda **kwargs: None)
+        self.uploaded = 0
+        self.skipped = 0
+        self.failed = 0
+        self.size = 0
+        self._uploads = []
+        self._batches = Queue.Queue()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._uploads)
+
+    def add_artifact(self, artifact):
+        '''Queue an artifact, and its metadata if there is any.'''
+
+        self._uploads.append(Upload(
+            artifact.basename(), self.lac.artifact_filename(artifact),
+            lambda filename: self.rac.put(artifact, filename)))
+        if self.lac.has_artifact_metadata(artifact, 'meta'):
+            self._uploads.append(Upload(
+                artifact.metadata_basename('meta'),
+                self.lac.get_artifact_metadata_filename(artifact, 'meta'),
+                lambda filename: self.rac.put_artifact_metadata(
+                    artifact, 'meta', filename)))
+
+    def add_source_metadata(self, source, cachekey, name):
+        '''Queue a source metadata file, if the local cache has it.'''
+
+        if not self.lac.has_source_metadata(source, cachekey, name):
+            return
+        self._uploads.append(Upload(
+            '%s.%s' % (cachekey, name),
+            self.lac.get_source_metadata_filename(source, cachekey, name),
+            lambda filename: self.rac.put_source_metadata(
+                source, cachekey, name, filename)))
+
+    def upload(self):
+        '''Start sending the queued files in the background.'''
+
+        uploads, self._uploads = self._uploads, []
+        if not uploads:
+            return
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+        self._batches.put(uploads)
+
+    def wait(self):
+        '''Wait for every upload to finish, and report on them.'''
+
+        self.upload()
+        if self._thread is None:
+            return
+        self._batches.put(None)
+        self._thread.join()
+        self._thread = None
+        self.status(msg='Uploaded %(uploaded)d files (%(size).1f MiB) to '
+                        '%(cache)s, %(skipped)d were already there',
+                    uploaded=self.uploaded, skipped=self.skipped,
+                    size=self.size / float(1024 * 1024), cache=self.rac,
+                    chatty=True)
+        if self.failed:
+            self.status(msg='Failed to upload %(failed)d files to '
+                            '%(cache)s, see the log for details',
+                        failed=self.failed, cache=self.rac, error=True)
+
+    def _run(self):
+        while True:
+            uploads = self._batches.get()
+            if uploads is None:
+                return
+            self._upload_batch(uploads)
+
+    def _upload_batch(self, uploads):
+        try:
+            present = self.rac.has_files([u.basename for u in uploads])
+        except Exception, e:
+            # Without the existence check everything is sent, and the
+            # server simply replaces the files it had.
+            logging.warning('Could not ask %s which files it has: %s' %
+                            (self.rac, e))
+            present = {}
+
+        for upload in uploads:
+            if present.get(upload.basename):
+                self.skipped += 1
+                continue
+            try:
+                upload.put(upload.filename)
+            except Exception, e:
+                logging.warning('Failed to upload %s: %s' %
+                                (upload.basename, e))
+                self.failed += 1
+                continue
+            self.uploaded += 1
+            self.size += os.path.getsize(upload.filename)
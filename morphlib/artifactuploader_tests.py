@@ -0,0 +1,158 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+
+import fs.tempfs
+
+import morphlib
+
+
+class FakeArtifact(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def basename(self):
+        return '%s.chunk.%s' % ('0' * 64, self.name)
+
+    def metadata_basename(self, name):
+        return '%s.%s' % (self.basename(), name)
+
+
+class FakeRemoteArtifactCache(object):
+
+    def __init__(self, files=()):
+        self.files = dict((f, None) for f in files)
+        self.queries = []
+        self.refuse = set()
+        self.can_query = True
+
+    def has_files(self, filenames):
+        self.queries.append(filenames)
+        if not self.can_query:
+            raise morphlib.remoteartifactcache.GetError(
+                self, FakeArtifact('query'))
+        return dict((f, f in self.files) for f in filenames)
+
+    def _put(self, basename, filename):
+        if basename in self.refuse:
+            raise morphlib.remoteartifactcache.PutError(self, basename)
+        with open(filename) as f:
+            self.files[basename] = f.read()
+
+    def put(self, artifact, filename):
+        self._put(artifact.basename(), filename)
+
+    def put_artifact_metadata(self, artifact, name, filename):
+        self._put(artifact.metadata_basename(name), filename)
+
+    def put_source_metadata(self, source, cachekey, name, filename):
+        self._put('%s.%s' % (cachekey, name), filename)
+
+    def __str__(self):
+        return 'fake'
+
+
+class ArtifactUploaderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempfs = fs.tempfs.TempFS()
+        self.lac = morphlib.localartifactcache.LocalArtifactCache(
+            self.tempfs)
+        self.rac = FakeRemoteArtifactCache()
+        self.messages = []
+        self.uploader = morphlib.artifactuploader.ArtifactUploader(
+            self.lac, self.rac, status_cb=self.status)
+
+    def tearDown(self):
+        self.tempfs.close()
+
+    def status(self, **kwargs):
+        self.messages.append(kwargs)
+
+    def put_artifact(self, name, meta=False):
+        artifact = FakeArtifact(name)
+        with self.lac.put(artifact) as f:
+            f.write('data of %s' % name)
+        if meta:
+            with self.lac.put_artifact_metadata(artifact, 'meta') as f:
+                f.write('meta of %s' % name)
+        return artifact
+
+    def test_uploads_artifacts_and_their_metadata(self):
+        self.uploader.add_artifact(self.put_artifact('foo', meta=True))
+        self.uploader.add_artifact(self.put_artifact('bar'))
+        self.assertEqual(len(self.uploader), 3)
+        self.uploader.wait()
+        foo = FakeArtifact('foo')
+        self.assertEqual(self.rac.files, {
+            foo.basename(): 'data of foo',
+            foo.metadata_basename('meta'): 'meta of foo',
+            FakeArtifact('bar').basename(): 'data of bar',
+        })
+        self.assertEqual(self.uploader.uploaded, 3)
+        self.assertEqual(len(self.uploader), 0)
+
+    def test_uploads_source_metadata_the_local_cache_has(self):
+        with self.lac.put_source_metadata(None, 'key', 'build-log') as f:
+            f.write('log')
+        self.uploader.add_source_metadata(None, 'key', 'build-log')
+        self.uploader.add_source_metadata(None, 'key', 'meta')
+        self.uploader.wait()
+        self.assertEqual(self.rac.files, {'key.build-log': 'log'})
+
+    def test_skips_files_the_server_already_has(self):
+        bar = FakeArtifact('bar')
+        self.rac.files[bar.basename()] = None
+        self.uploader.add_artifact(self.put_artifact('foo'))
+        self.uploader.add_artifact(self.put_artifact('bar'))
+        self.uploader.wait()
+        self.assertEqual(self.rac.files[bar.basename()], None)
+        self.assertEqual(self.uploader.uploaded, 1)
+        self.assertEqual(self.uploader.skipped, 1)
+        self.assertEqual(self.rac.queries, [
+            [FakeArtifact('foo').basename(), bar.basename()]])
+
+    def test_uploads_everything_if_the_server_cannot_be_asked(self):
+        self.rac.can_query = False
+        self.uploader.add_artifact(self.put_artifact('foo'))
+        self.uploader.wait()
+        self.assertEqual(self.uploader.uploaded, 1)
+
+    def test_checks_each_batch_separately(self):
+        self.uploader.add_artifact(self.put_artifact('foo'))
+        self.uploader.upload()
+        self.uploader.add_artifact(self.put_artifact('bar'))
+        self.uploader.upload()
+        self.uploader.wait()
+        self.assertEqual(len(self.rac.queries), 2)
+        self.assertEqual(self.uploader.uploaded, 2)
+
+    def test_carries_on_after_a_failed_upload(self):
+        foo = self.put_artifact('foo')
+        self.rac.refuse.add(foo.basename())
+        self.uploader.add_artifact(foo)
+        self.uploader.add_artifact(self.put_artifact('bar'))
+        self.uploader.wait()
+        self.assertEqual(self.uploader.failed, 1)
+        self.assertEqual(self.uploader.uploaded, 1)
+        self.assertTrue(self.messages[-1].get('error'))
+
+    def test_does_nothing_without_files(self):
+        self.uploader.wait()
+        self.assertEqual(self.rac.queries, [])
+        self.assertEqual(self.messages, [])
@@ -0,0 +1,198 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import base64
+import hashlib
+import json
+import logging
+import math
+import os
+import struct
+import tempfile
+import time
+
+
+DEFAULT_ERROR_RATE = 0.01
+
+
+class BloomFilter(object):
+
+    '''A set of strings which can only say for sure what is not in it.
+
+    ``key in bloom_filter`` is always True for a key which was added,
+    and is False for most others, with a rate of false positives which
+    depends on how full the filter is. The filter is ``bits`` bits, and
+    each key sets ``hashes`` of them, chosen from the SHA-256 of the key
+    by double hashing, so that cache servers and their clients agree on
+    them.
+
+    '''
+
+    def __init__(self, bits, hashes, data=None):
+        if bits <= 0 or bits % 8 or hashes <= 0:
+            raise ValueError('A Bloom filter needs a positive number of '
+                             'bytes and of hashes')
+        if data is None:
+            data = '\0' * (bits / 8)
+        if len(data) != bits / 8:
+            raise ValueError('Bloom filter data is %d bytes, not %d' %
+                             (len(data), bits / 8))
+        self.bits = bits
+        self.hashes = hashes
+        self._data = bytearray(data)
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate=DEFAULT_ERROR_RATE):
+        '''Return an empty filter sized for ``capacity`` keys.
+
+        Once that many keys have been added, about ``error_rate`` of
+        other keys are wrongly said to be in it.
+
+        '''
+        capacity = max(1, capacity)
+        bits = int(math.ceil(-capacity * math.log(error_rate) /
+                             math.log(2) ** 2))
+        bits += -bits % 8
+        hashes = max(1, int(round(float(bits) / capacity * math.log(2))))
+        return cls(bits, hashes)
+
+    def _positions(self, key):
+        h1, h2 = struct.unpack('>QQ', hashlib.sha256(key).digest()[:16])
+        h2 |= 1
+        return [(h1 + i * h2) % self.bits for i in xrange(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self._data[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self._data[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(key))
+
+    def tostring(self):
+        return str(self._data)
+
+
+class MembershipFilter(object):
+
+    '''A copy of the membership filter a cache server publishes.
+
+    The server's filter holds the names of all its artifacts, so a name
+    which is not in it is definitely not in the cache. It is versioned:
+    ``query()`` gives the parameters to ask the server for what has
+    changed since this copy was made, and ``update()`` applies the
+    reply, which is either the names added since or, when the server
+    has started a new epoch of its filter, the whole filter.
+
+    If ``filename`` is given, the copy is kept there between runs, so
+    that only the changes need to be downloaded next time.
+
+    '''
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.epoch = None
+        self.version = None
+        self.filter = None
+        self.updated = None
+        if filename is not None and os.path.exists(filename):
+            self._load()
+
+    def query(self):
+        '''Return the query parameters asking for an update.'''
+
+        if self.filter is None:
+            return {}
+        return {'epoch': self.epoch, 'since': self.version}
+
+    def update(self, reply):
+        '''Apply the server's reply to a request made with ``query()``.
+
+        ValueError is raised if the reply does not make sense.
+
+        '''
+        self._apply(reply)
+        self.updated = time.time()
+        if self.filename is not None:
+            try:
+                self._save()
+            except (IOError, OSError), e:
+                logging.warning('Could not keep the membership filter in '
+                                '%s: %s' % (self.filename, e))
+
+    def _apply(self, reply):
+        try:
+            if 'filter' in reply:
+                bloom_filter = BloomFilter(
+                    int(reply['bits']), int(reply['hashes']),
+                    base64.b64decode(reply['filter']))
+            elif self.filter is not None and reply['epoch'] == self.epoch:
+                bloom_filter = self.filter
+                for name in reply['added']:
+                    bloom_filter.add(str(name))
+            else:
+                raise ValueError('The changes to the membership filter are '
+                                 'for a different epoch')
+            epoch, version = reply['epoch'], reply['version']
+        except (KeyError, TypeError), e:
+            raise ValueError('Bad membership filter reply: %s' % e)
+        self.filter = bloom_filter
+        self.epoch = epoch
+        self.version = version
+
+    def add(self, name):
+        '''Record a name which has just been added to the cache.'''
+
+        if self.filter is not None:
+            self.filter.add(name)
+
+    def is_fresh(self, max_age):
+        '''Say whether this copy was updated in the last max_age seconds.
+
+        A copy made longer ago is missing whatever has been added to the
+        cache since, so it should not be trusted until it is updated.
+
+        '''
+        return self.updated is not None and \
+            time.time() - self.updated < max_age
+
+    def might_contain(self, name):
+        return self.filter is None or name in self.filter
+
+    def _load(self):
+        try:
+            with open(self.filename) as f:
+                self._apply(json.load(f))
+        except (IOError, ValueError):
+            pass
+
+    def _save(self):
+        saved = {
+            'epoch': self.epoch,
+            'version': self.version,
+            'bits': self.filter.bits,
+            'hashes': self.filter.hashes,
+            'filter': base64.b64encode(self.filter.tostring()),
+        }
+        handle, temp = tempfile.mkstemp(
+            dir=os.path.dirname(self.filename) or '.', prefix='.tmp.')
+        try:
+            with os.fdopen(handle, 'w') as f:
+                json.dump(saved, f)
+            os.rename(temp, self.filename)
+        except BaseException:
+            os.unlink(temp)
+            raise
@@ -0,0 +1,155 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import base64
+import os
+import shutil
+import tempfile
+import unittest
+
+import morphlib
+
+
+def full_reply(epoch, version, names, capacity=100):
+    bloom_filter = morphlib.bloomfilter.BloomFilter.for_capacity(capacity)
+    for name in names:
+        bloom_filter.add(name)
+    return {
+        'epoch': epoch,
+        'version': version,
+        'bits': bloom_filter.bits,
+        'hashes': bloom_filter.hashes,
+        'filter': base64.b64encode(bloom_filter.tostring()),
+    }
+
+
+class BloomFilterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.filter = morphlib.bloomfilter.BloomFilter.for_capacity(1000)
+        self.names = ['%040x.chunk.foo-%d' % (i, i) for i in xrange(1000)]
+        for name in self.names:
+            self.filter.add(name)
+
+    def test_is_sized_for_its_capacity(self):
+        self.assertEqual(self.filter.bits % 8, 0)
+        self.assertTrue(9000 < self.filter.bits < 10000)
+        self.assertEqual(self.filter.hashes, 7)
+
+    def test_contains_everything_added(self):
+        self.assertTrue(all(name in self.filter for name in self.names))
+
+    def test_contains_few_other_keys(self):
+        others = ['%040x.chunk.bar' % i for i in xrange(1000)]
+        wrong = sum(1 for name in others if name in self.filter)
+        self.assertTrue(wrong < 30)
+
+    def test_round_trips_through_a_string(self):
+        copy = morphlib.bloomfilter.BloomFilter(
+            self.filter.bits, self.filter.hashes, self.filter.tostring())
+        self.assertTrue(all(name in copy for name in self.names))
+        self.assertEqual(copy.tostring(), self.filter.tostring())
+
+    def test_refuses_bad_sizes(self):
+        BloomFilter = morphlib.bloomfilter.BloomFilter
+        self.assertRaises(ValueError, BloomFilter, 12, 3)
+        self.assertRaises(ValueError, BloomFilter, 16, 0)
+        self.assertRaises(ValueError, BloomFilter, 16, 3, 'abc')
+
+
+class MembershipFilterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'membership')
+        self.membership = morphlib.bloomfilter.MembershipFilter()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_might_contain_anything_until_updated(self):
+        self.assertEqual(self.membership.query(), {})
+        self.assertTrue(self.membership.might_contain('foo'))
+        self.assertFalse(self.membership.is_fresh(60))
+
+    def test_applies_a_whole_filter(self):
+        self.membership.update(full_reply(3, 7, ['foo']))
+        self.assertTrue(self.membership.might_contain('foo'))
+        self.assertFalse(self.membership.might_contain('bar'))
+        self.assertEqual(self.membership.query(), {'epoch': 3, 'since': 7})
+        self.assertTrue(self.membership.is_fresh(60))
+        self.assertFalse(self.membership.is_fresh(0))
+
+    def test_applies_changes(self):
+        self.membership.update(full_reply(3, 7, ['foo']))
+        self.membership.update({'epoch': 3, 'version': 9,
+                                'added': [u'bar', u'baz']})
+        for name in ('foo', 'bar', 'baz'):
+            self.assertTrue(self.membership.might_contain(name))
+        self.assertEqual(self.membership.query(), {'epoch': 3, 'since': 9})
+
+    def test_refuses_changes_to_another_epoch(self):
+        self.assertRaises(ValueError, self.membership.update,
+                          {'epoch': 3, 'version': 9, 'added': ['bar']})
+        self.membership.update(full_reply(3, 7, ['foo']))
+        self.assertRaises(ValueError, self.membership.update,
+                          {'epoch': 4, 'version': 9, 'added': ['bar']})
+        self.assertEqual(self.membership.version, 7)
+
+    def test_refuses_nonsense(self):
+        self.membership.update(full_reply(3, 7, ['foo']))
+        self.assertRaises(ValueError, self.membership.update,
+                          {'epoch': 3, 'added': []})
+        self.assertRaises(ValueError, self.membership.update,
+                          dict(full_reply(3, 7, []), filter='not base64'))
+        self.assertRaises(ValueError, self.membership.update,
+                          dict(full_reply(3, 7, []), bits=8))
+
+    def test_records_names_added_here(self):
+        self.membership.add('bar')
+        self.membership.update(full_reply(3, 7, ['foo']))
+        self.membership.add('bar')
+        self.assertTrue(self.membership.might_contain('bar'))
+
+    def test_keeps_its_copy_between_runs(self):
+        membership = morphlib.bloomfilter.MembershipFilter(self.filename)
+        membership.update(full_reply(3, 7, ['foo']))
+        again = morphlib.bloomfilter.MembershipFilter(self.filename)
+        self.assertEqual(again.query(), {'epoch': 3, 'since': 7})
+        self.assertTrue(again.might_contain('foo'))
+        self.assertFalse(again.might_contain('bar'))
+        # It may be out of date, so it needs updating before it is used.
+        self.assertFalse(again.is_fresh(60))
+        self.assertEqual(os.listdir(self.tempdir), ['membership'])
+
+    def test_ignores_a_broken_copy(self):
+        with open(self.filename, 'w') as f:
+            f.write('not json')
+        membership = morphlib.bloomfilter.MembershipFilter(self.filename)
+        self.assertEqual(membership.query(), {})
+
+    def test_carries_on_if_it_cannot_keep_its_copy(self):
+        membership = morphlib.bloomfilter.MembershipFilter(
+            os.path.join(self.tempdir, 'missing', 'membership'))
+        membership.update(full_reply(3, 7, ['foo']))
+        self.assertEqual(membership.query(), {'epoch': 3, 'since': 7})
+
+    def test_cleans_up_after_failing_to_save(self):
+        membership = morphlib.bloomfilter.MembershipFilter(self.filename)
+        membership.update(full_reply(3, 7, ['foo']))
+        membership.epoch = object()
+        self.assertRaises(TypeError, membership._save)
+        self.assertEqual(os.listdir(self.tempdir), ['membership'])
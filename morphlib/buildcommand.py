@@ -1,4 +1,4 @@
-# Copyright (C) 2011-2015  Codethink Limited
+# Copyright (C) 2011-2015, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -16,7 +16,6 @@
 
 import itertools
 import os
-import shutil
 import logging
 import tempfile
 import datetime
@@ -49,6 +48,8 @@ class BuildCommand(object):
         self.app = app
         self.lac, self.rac = self.new_artifact_caches()
         self.lrc, self.rrc = self.new_repo_caches()
+        self.uploader = None
+        self.mirror = None
 
     def build(self, repo_name, ref, filename, original_ref=None):
         '''Build a given system morphology.'''
@@ -62,7 +63,12 @@ class BuildCommand(object):
             repo_name, ref, filename, original_ref)
         self.validate_sources(srcpool)
         root_artifact = self.resolve_artifacts(srcpool)
-        self.build_in_order(root_artifact)
+        self.uploader = self.new_artifact_uploader()
+        self.mirror = self.new_artifact_mirror()
+        try:
+            self.build_in_order(root_artifact)
+        finally:
+            self.wait_for_uploads()
 
         self.app.status(
             msg='Build of %(repo_name)s %(ref)s %(filename)s ended '
@@ -77,6 +83,48 @@ class BuildCommand(object):
         '''
         return morphlib.util.new_artifact_caches(self.app.settings)
 
+    def new_artifact_uploader(self):
+        '''Create the uploader for the push-artifacts setting, if it is set.
+
+        Artifacts are uploaded to a separate cache object, since only
+        the upload server needs to be writeable.
+
+        '''
+        if not self.app.settings['push-artifacts']:
+            return None
+        url = morphlib.util.get_artifact_upload_server(self.app.settings)
+        if not url:
+            raise morphlib.Error(
+                'push-artifacts is set, but there is no artifact cache '
+                'server to upload to')
+        rac = morphlib.remoteartifactcache.RemoteArtifactCache(
+            url, upload_token=self.app.settings['artifact-upload-token'])
+        return morphlib.artifactuploader.ArtifactUploader(
+            self.lac, rac, status_cb=self.app.status)
+
+    def new_artifact_mirror(self):
+        '''Create the uploader for the artifact-cache-mirror setting.
+
+        Artifacts which had to be fetched from a farther artifact cache
+        server are copied into the nearest one, so that the next build
+        finds them there.
+
+        '''
+        if not self.app.settings['artifact-cache-mirror']:
+            return None
+        if not isinstance(self.rac,
+                          morphlib.tieredartifactcache.TieredArtifactCache):
+            return None
+        return morphlib.artifactuploader.ArtifactUploader(
+            self.lac, self.rac.caches[0], status_cb=self.app.status)
+
+    def wait_for_uploads(self):
+        uploaders = [u for u in (self.uploader, self.mirror) if u is not None]
+        if uploaders:
+            self.app.status(msg='Waiting for artifact uploads to finish')
+        for uploader in uploaders:
+            uploader.wait()
+
     def new_repo_caches(self):
         return morphlib.util.new_repo_caches(self.app)
 
@@ -365,6 +413,7 @@ class BuildCommand(object):
 
         self.build_and_cache(staging_area, source, setup_mounts)
         self.remove_staging_area(staging_area)
+        self.push_artifacts(source)
 
         td = datetime.datetime.now() - starttime
         hours, remainder = divmod(int(td.total_seconds()), 60*60)
@@ -372,6 +421,19 @@ class BuildCommand(object):
         td_string = "%02d:%02d:%02d" % (hours, minutes, seconds)
         self.app.status(msg="Elapsed time %(duration)s", duration=td_string)
 
+    def push_artifacts(self, source):
+        '''Start uploading the artifacts just built, if asked to.'''
+
+        if self.uploader is None:
+            return
+        for artifact in source.artifacts.itervalues():
+            self.uploader.add_artifact(artifact)
+        for name in ('meta', 'build-log'):
+            self.uploader.add_source_metadata(source, source.cache_key, name)
+        self.app.status(msg='Uploading %(count)d files in the background',
+                        count=len(self.uploader), chatty=True)
+        self.uploader.upload()
+
     def get_recursive_deps(self, artifacts):
         deps = set()
         ordered_deps = []
@@ -421,48 +483,46 @@ class BuildCommand(object):
             source.sha1, done)
 
     def cache_artifacts_locally(self, artifacts):
-        '''Get artifacts missing from local cache from remote cache.'''
+        '''Get artifacts missing from local cache from remote cache.
 
-        def fetch_files(to_fetch):
-            '''Fetch a set of files atomically.
+        Each missing file is put in the local cache once its own
+        transfer has succeeded, so if the transfer of any of them fails,
+        those which were already fetched need not be fetched again.
 
-            If an error occurs during the transfer of any files, all downloaded
-            data is deleted, to ensure integrity of the local cache.
+        '''
 
-            '''
-            try:
-                for remote, local in to_fetch:
-                    shutil.copyfileobj(remote, local)
-            except BaseException:
-                for remote, local in to_fetch:
-                    local.abort()
-                raise
-            else:
-                for remote, local in to_fetch:
-                    remote.close()
-                    local.close()
+        downloader = morphlib.artifactdownloader.ArtifactDownloader(
+            self.lac, self.rac,
+            streams=self.app.settings['artifact-download-streams'],
+            status_cb=self.app.status)
 
         for artifact in artifacts:
-            # This block should fetch all artifact files in one go, using the
-            # 1.0/artifacts method of morph-cache-server. The code to do that
-            # needs bringing in from the distbuild.worker_build_connection
-            # module into morphlib.remoteartififactcache first.
-            to_fetch = []
+            queued = len(downloader)
             if not self.lac.has(artifact):
-                to_fetch.append((self.rac.get(artifact),
-                                 self.lac.put(artifact)))
+                downloader.add_artifact(artifact)
 
             if artifact.source.morphology.needs_artifact_metadata_cached:
                 if not self.lac.has_artifact_metadata(artifact, 'meta'):
-                    to_fetch.append((
-                        self.rac.get_artifact_metadata(artifact, 'meta'),
-                        self.lac.put_artifact_metadata(artifact, 'meta')))
+                    downloader.add_artifact_metadata(artifact, 'meta')
 
-            if len(to_fetch) > 0:
+            if len(downloader) > queued:
                 self.app.status(
                     msg='Fetching to local cache: artifact %(name)s',
                     name=artifact.name)
-                fetch_files(to_fetch)
+
+        downloader.fetch()
+        self.mirror_artifacts(artifacts)
+
+    def mirror_artifacts(self, artifacts):
+        '''Copy artifacts got from a farther cache into the nearest one.'''
+
+        if self.mirror is None:
+            return
+        for artifact in artifacts:
+            tier = self.rac.tier_of(artifact.basename())
+            if tier is not None and tier > 0:
+                self.mirror.add_artifact(artifact)
+        self.mirror.upload()
 
     def create_staging_area(self, build_env, use_chroot=True, extra_env={},
                             extra_path=[]):
@@ -557,6 +617,8 @@ class InitiatorBuildCommand(BuildCommand):
         '''Initiate a distributed build on a controller'''
 
         distbuild.add_crash_conditions(self.app.settings['crash-condition'])
+        distbuild.JsonMachine.compress = \
+            self.app.settings['compress-messages']
 
         if self.addr == '':
             raise morphlib.Error(
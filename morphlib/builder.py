@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2014  Codethink Limited
+# Copyright (C) 2012-2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -126,23 +126,20 @@ def ldconfig(runcmd, rootdir):  # pragma: no cover
         logging.debug('No %s, not running ldconfig' % conf)
 
 
-def download_depends(constituents, lac, rac, metadatas=None):
+def download_depends(constituents, lac, rac, metadatas=None,
+                     streams=morphlib.artifactdownloader.DEFAULT_STREAMS,
+                     status_cb=None):
+    downloader = morphlib.artifactdownloader.ArtifactDownloader(
+        lac, rac, streams=streams, status_cb=status_cb)
     for constituent in constituents:
         if not lac.has(constituent):
-            source = rac.get(constituent)
-            target = lac.put(constituent)
-            shutil.copyfileobj(source, target)
-            target.close()
-            source.close()
+            downloader.add_artifact(constituent)
         if metadatas is not None:
             for metadata in metadatas:
                 if not lac.has_artifact_metadata(constituent, metadata):
-                    if rac.has_artifact_metadata(constituent, metadata):
-                        src = rac.get_artifact_metadata(constituent, metadata)
-                        dst = lac.put_artifact_metadata(constituent, metadata)
-                        shutil.copyfileobj(src, dst)
-                        dst.close()
-                        src.close()
+                    downloader.add_artifact_metadata(constituent, metadata,
+                                                     required=False)
+    downloader.fetch()
 
 
 def get_chunk_files(f):  # pragma: no cover
@@ -260,6 +257,13 @@ class BuilderBase(object):
         json.dump(meta, f, indent=4, sort_keys=True, encoding='unicode-escape')
         f.close()
 
+    def download_options(self):  # pragma: no cover
+        '''Keyword arguments to pass on to download_depends.'''
+        return {
+            'streams': self.app.settings['artifact-download-streams'],
+            'status_cb': self.app.status,
+        }
+
     def runcmd(self, *args, **kwargs):
         return self.staging_area.runcmd(*args, **kwargs)
 
@@ -520,7 +524,8 @@ class StratumBuilder(BuilderBase):
                     # download the chunk artifact if necessary
                     download_depends(constituents,
                                      self.local_artifact_cache,
-                                     self.remote_artifact_cache)
+                                     self.remote_artifact_cache,
+                                     **self.download_options())
 
             with self.build_watch('create-chunk-list'):
                 lac = self.local_artifact_cache
@@ -613,7 +618,7 @@ class SystemBuilder(BuilderBase):  # pragma: no cover
                 download_depends(self.source.dependencies,
                                  self.local_artifact_cache,
                                  self.remote_artifact_cache,
-                                 ('meta',))
+                                 ('meta',), **self.download_options())
 
                 # download the chunk artifacts if necessary
                 for stratum_artifact in self.source.dependencies:
@@ -621,7 +626,8 @@ class SystemBuilder(BuilderBase):  # pragma: no cover
                     chunks = [ArtifactCacheReference(c) for c in json.load(f)]
                     download_depends(chunks,
                                      self.local_artifact_cache,
-                                     self.remote_artifact_cache)
+                                     self.remote_artifact_cache,
+                                     **self.download_options())
                     f.close()
 
                 # unpack it from the local artifact cache
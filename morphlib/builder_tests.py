@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2015  Codethink Limited
+# Copyright (C) 2012-2015, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -68,6 +68,12 @@ class FakeArtifact(object):
         self.cache_key = 'blahblah'
         self.cache_id = {}
 
+    def basename(self):
+        return '%s.%s' % (self.cache_key, self.name)
+
+    def metadata_basename(self, metadata_name):
+        return '%s.%s' % (self.basename(), metadata_name)
+
 
 class FakeBuildEnv(object):
 
@@ -109,15 +115,18 @@ class FakeArtifactCache(object):
     def put(self, artifact):
         return FakeFileHandle(self, (artifact.cache_key, artifact.name))
 
+    def put_resumable(self, artifact):
+        return self.put(artifact)
+
     def put_artifact_metadata(self, artifact, name):
         return FakeFileHandle(self, (artifact.cache_key, artifact.name, name))
 
     def put_source_metadata(self, source, cachekey, name):
         return FakeFileHandle(self, (cachekey, name))
 
-    def get(self, artifact):
+    def get(self, artifact, offset=0):
         return StringIO.StringIO(
-            self._cached[(artifact.cache_key, artifact.name)])
+            self._cached[(artifact.cache_key, artifact.name)][offset:])
 
     def get_artifact_metadata(self, artifact, name):
         return StringIO.StringIO(
@@ -126,6 +135,9 @@ class FakeArtifactCache(object):
     def get_source_metadata(self, source, cachekey, name):
         return StringIO.StringIO(self._cached[(cachekey, name)])
 
+    def get_files(self, filenames):
+        raise morphlib.remoteartifactcache.GetFilesError(self, filenames)
+
     def has(self, artifact):
         return (artifact.cache_key, artifact.name) in self._cached
 
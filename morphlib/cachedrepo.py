@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2014  Codethink Limited
+# Copyright (C) 2012-2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -15,11 +15,15 @@
 
 
 import cliapp
+import fcntl
 import os
 
 import morphlib
 
 
+UPDATE_LOCK_FILE = 'morph-update.lock'
+
+
 class CheckoutDirectoryExistsError(cliapp.AppException):
 
     def __init__(self, repo, target_dir):
@@ -204,12 +208,17 @@ class CachedRepo(object):
         if not self.is_mirror:
             return
 
-        try:
-            self._gitdir.update_remotes(
-                echo_stderr=self.app.settings['verbose'])
-            self.already_updated = True
-        except cliapp.AppException:
-            raise UpdateError(self)
+        # Builds running at once on one machine share the repository
+        # cache, and git fails to lock refs another fetch is updating.
+        lock_file = os.path.join(self.path, UPDATE_LOCK_FILE)
+        with open(lock_file, 'a') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            try:
+                self._gitdir.update_remotes(
+                    echo_stderr=self.app.settings['verbose'])
+                self.already_updated = True
+            except cliapp.AppException:
+                raise UpdateError(self)
 
     def _runcmd(self, *args, **kwargs):  # pragma: no cover
         if not 'cwd' in kwargs:
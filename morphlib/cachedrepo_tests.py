@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2014  Codethink Limited
+# Copyright (C) 2012-2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -142,10 +142,14 @@ class CachedRepoTests(unittest.TestCase):
         self.assertTrue(os.path.exists(morph_filename))
 
     def test_successful_update(self):
+        self.repo.path = self.tempfs.getsyspath('/')
         self.repo._gitdir.update_remotes = self.update_successfully
         self.repo.update()
+        self.assertTrue(self.tempfs.exists(
+            morphlib.cachedrepo.UPDATE_LOCK_FILE))
 
     def test_failing_update(self):
+        self.repo.path = self.tempfs.getsyspath('/')
         self.repo._gitdir.update_remotes = self.update_with_failure
         self.assertRaises(morphlib.cachedrepo.UpdateError, self.repo.update)
 
@@ -177,6 +181,7 @@ class CachedRepoTests(unittest.TestCase):
         self.assertTrue(self.repo.requires_update_for_ref('named_ref'))
 
     def test_no_need_to_update_repo_if_already_updated(self):
+        self.repo.path = self.tempfs.getsyspath('/')
         self.repo._gitdir.update_remotes = self.update_successfully
         self.repo._gitdir._rev_parse = self.rev_parse
 
@@ -0,0 +1,75 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+'''SHA-256 digests of files, as sent in HTTP ``Digest`` headers.
+
+Artifact cache servers and their clients send the digest of a file in
+an RFC 3230 ``Digest: SHA-256=<base64>`` header, so that whoever
+receives the file can check it arrived intact.
+
+'''
+
+
+import base64
+import hashlib
+
+
+DEFAULT_BUFSIZE = 1024 * 1024
+
+
+def parse_header(header):
+    '''Return the base64 SHA-256 digest in a Digest header, or None.
+
+    The header may list digests made with several algorithms, or be
+    None if there was no such header.
+
+    '''
+
+    for value in (header or '').split(','):
+        algorithm, _, digest = value.strip().partition('=')
+        if algorithm.lower() == 'sha-256':
+            return digest
+    return None
+
+
+def format_header(digest):
+    '''Return the value of a Digest header for a base64 SHA-256 digest.'''
+
+    return 'SHA-256=%s' % digest
+
+
+def checksum_file(f, checksum=None, bufsize=DEFAULT_BUFSIZE):
+    '''Add the rest of the open file ``f`` to a SHA-256 checksum.
+
+    A new checksum is started unless one is given. It is returned, so
+    that more data can be added to it, such as the rest of a file of
+    which only part has been downloaded so far.
+
+    '''
+
+    if checksum is None:
+        checksum = hashlib.sha256()
+    while True:
+        data = f.read(bufsize)
+        if not data:
+            return checksum
+        checksum.update(data)
+
+
+def encode(checksum):
+    '''Return the base64 digest of a checksum, as sent in Digest headers.'''
+
+    return base64.b64encode(checksum.digest())
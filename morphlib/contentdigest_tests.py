@@ -0,0 +1,67 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import base64
+import hashlib
+import StringIO
+import unittest
+
+import morphlib
+
+
+class ContentDigestTests(unittest.TestCase):
+
+    def setUp(self):
+        self.data = 'x' * 1000 + 'y' * 1000
+        self.digest = base64.b64encode(hashlib.sha256(self.data).digest())
+
+    def test_parses_a_sha256_digest_header(self):
+        self.assertEqual(
+            morphlib.contentdigest.parse_header('SHA-256=%s' % self.digest),
+            self.digest)
+
+    def test_parses_a_digest_among_others(self):
+        self.assertEqual(
+            morphlib.contentdigest.parse_header(
+                'MD5=Zm9v, sha-256=%s' % self.digest),
+            self.digest)
+
+    def test_finds_no_digest_in_other_algorithms(self):
+        self.assertEqual(morphlib.contentdigest.parse_header('MD5=Zm9v'),
+                         None)
+
+    def test_finds_no_digest_without_a_header(self):
+        self.assertEqual(morphlib.contentdigest.parse_header(None), None)
+
+    def test_formats_a_header_it_can_parse(self):
+        header = morphlib.contentdigest.format_header(self.digest)
+        self.assertEqual(header, 'SHA-256=%s' % self.digest)
+        self.assertEqual(morphlib.contentdigest.parse_header(header),
+                         self.digest)
+
+    def test_checksums_a_file(self):
+        checksum = morphlib.contentdigest.checksum_file(
+            StringIO.StringIO(self.data), bufsize=300)
+        self.assertEqual(morphlib.contentdigest.encode(checksum),
+                         self.digest)
+
+    def test_carries_on_a_checksum(self):
+        f = StringIO.StringIO(self.data)
+        checksum = morphlib.contentdigest.checksum_file(
+            StringIO.StringIO(f.read(1500)))
+        morphlib.contentdigest.checksum_file(f, checksum)
+        self.assertEqual(morphlib.contentdigest.encode(checksum),
+                         self.digest)
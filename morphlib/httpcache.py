@@ -0,0 +1,232 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import hashlib
+import json
+import logging
+import mimetools
+import os
+import StringIO
+import tempfile
+import time
+import urllib
+import urllib2
+
+
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+DEFAULT_MAX_ENTRY_SIZE = 1024 * 1024
+
+
+def _cache_control(headers):
+    '''Return the Cache-Control directives of a response as a dict.'''
+
+    directives = {}
+    for directive in (headers.getheader('Cache-Control') or '').split(','):
+        name, _, value = directive.strip().partition('=')
+        if name:
+            directives[name.lower()] = value.strip('"')
+    return directives
+
+
+def _max_age(headers):
+    directives = _cache_control(headers)
+    if 'no-cache' in directives:
+        return 0
+    try:
+        return int(directives.get('max-age', 0))
+    except ValueError:
+        return 0
+
+
+class HTTPCache(object):
+
+    '''Keep small HTTP GET responses in a directory.
+
+    Responses are kept if their Cache-Control header lets them be
+    reused for a while, or they have an ETag or Last-Modified header to
+    check them with, and they are no bigger than ``max_entry_size``.
+
+    A kept response is used without asking the server for as long as
+    its max-age says. After that, the server is asked whether it has
+    changed, and a 304 Not Modified reply means the kept copy is used
+    again. Once the responses add up to more than ``max_size`` bytes,
+    the least recently used ones are removed.
+
+    Several processes can share the directory.
+
+    '''
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE,
+                 max_entry_size=DEFAULT_MAX_ENTRY_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_entry_size = max_entry_size
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self._size = None
+
+    def open(self, request, urlopen=urllib2.urlopen):
+        '''Return a response for ``request``, from the cache if possible.
+
+        ``request`` is a URL or a urllib2.Request, which ``urlopen`` is
+        called with when the server needs to be asked. Requests other
+        than plain GETs, such as POSTs and requests for a byte range,
+        are passed straight on.
+
+        '''
+        if not isinstance(request, urllib2.Request):
+            request = urllib2.Request(request)
+        if request.get_method() != 'GET' or request.has_header('Range'):
+            return urlopen(request)
+
+        url = request.get_full_url()
+        key = self._key(url)
+        entry = self._load(key)
+        if entry is not None:
+            meta, headers, body = entry
+            if time.time() < meta['stored'] + _max_age(headers):
+                self.hits += 1
+                return urllib.addinfourl(body, headers, meta['url'], 200)
+            if headers.getheader('ETag'):
+                request.add_header('If-None-Match', headers['ETag'])
+            if headers.getheader('Last-Modified'):
+                request.add_header('If-Modified-Since',
+                                   headers['Last-Modified'])
+
+        try:
+            response = urlopen(request)
+        except urllib2.HTTPError, e:
+            if entry is None or e.code != 304:
+                if entry is not None:
+                    body.close()
+                raise
+            e.close()
+            self.revalidated += 1
+            for name in ('Cache-Control', 'ETag', 'Last-Modified'):
+                if e.info().getheader(name):
+                    headers[name] = e.info()[name]
+            meta['stored'] = time.time()
+            self._save_meta(key, meta, headers)
+            return urllib.addinfourl(body, headers, meta['url'], 200)
+
+        if entry is not None:
+            body.close()
+        self.misses += 1
+        return self._store(key, url, response)
+
+    def _key(self, url):
+        return hashlib.sha1(url).hexdigest()
+
+    def _store(self, key, url, response):
+        headers = response.info()
+        length = headers.getheader('Content-Length')
+        storable = (
+            response.getcode() == 200 and
+            'no-store' not in _cache_control(headers) and
+            (_max_age(headers) > 0 or headers.getheader('ETag') or
+             headers.getheader('Last-Modified')) and
+            length is not None and length.isdigit() and
+            int(length) <= self.max_entry_size)
+        if not storable:
+            return response
+
+        try:
+            body = response.read()
+        finally:
+            response.close()
+        meta = {'url': url, 'stored': time.time()}
+        try:
+            self._write(key, body)
+            self._save_meta(key, meta, headers)
+        except (IOError, OSError), e:
+            logging.warning('Could not keep the response for %s: %s' %
+                            (url, e))
+        else:
+            self._added(len(body))
+        return urllib.addinfourl(StringIO.StringIO(body), headers, url, 200)
+
+    def _load(self, key):
+        # The body is opened straight away, so that it can still be read
+        # if another process removes it. Its modification time says when
+        # it was last used.
+        path = os.path.join(self.directory, key)
+        try:
+            with open(path + '.meta') as f:
+                meta = json.load(f)
+            body = open(path, 'rb')
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        headers = mimetools.Message(StringIO.StringIO(meta.pop('headers')))
+        return meta, headers, body
+
+    def _save_meta(self, key, meta, headers):
+        meta = dict(meta, headers=''.join(headers.headers))
+        self._write(key + '.meta', json.dumps(meta))
+
+    def _write(self, name, data):
+        handle, temp = tempfile.mkstemp(dir=self.directory, prefix='.tmp.')
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                f.write(data)
+            os.rename(temp, os.path.join(self.directory, name))
+        except BaseException:
+            os.unlink(temp)
+            raise
+
+    def _entries(self):
+        '''Return (last used, size, key) for each kept response.'''
+
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.startswith('.') or name.endswith('.meta'):
+                continue
+            try:
+                stinfo = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                # Another process has just removed it.
+                pass
+            else:
+                entries.append((stinfo.st_mtime, stinfo.st_size, name))
+        return entries
+
+    def _added(self, size):
+        if self._size is None:
+            self._size = sum(entry[1] for entry in self._entries())
+        else:
+            self._size += size
+        if self._size > self.max_size:
+            self._trim()
+
+    def _trim(self):
+        '''Remove the least recently used responses.
+
+        Enough are removed to leave some room, so that the directory
+        does not need to be scanned again for every new response.
+
+        '''
+        entries = sorted(self._entries())
+        self._size = sum(entry[1] for entry in entries)
+        for used, size, key in entries:
+            if self._size <= self.max_size * 3 / 4:
+                break
+            for name in (key, key + '.meta'):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+            self._size -= size
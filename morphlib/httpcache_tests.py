@@ -0,0 +1,218 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import json
+import mimetools
+import os
+import shutil
+import StringIO
+import tempfile
+import unittest
+import urllib
+import urllib2
+
+import morphlib
+
+
+URL = 'http://cache.example.com/1.0/files?repo=foo&ref=%s&filename=bar'
+
+
+class FakeServer(object):
+
+    '''Answer requests with canned responses, and remember the requests.'''
+
+    def __init__(self):
+        self.responses = {}
+        self.requests = []
+
+    def respond(self, url, body, code=200, **headers):
+        headers = dict((name.replace('_', '-'), value)
+                       for name, value in headers.iteritems())
+        headers.setdefault('Content-Length', str(len(body)))
+        self.responses[url] = (code, body, headers)
+
+    def urlopen(self, request):
+        self.requests.append(request)
+        url = request.get_full_url()
+        code, body, headers = self.responses[url]
+        text = ''.join('%s: %s\n' % header for header in headers.iteritems())
+        message = mimetools.Message(StringIO.StringIO(text))
+        etag = message.getheader('ETag')
+        if etag is not None and \
+                request.get_header('If-none-match') == etag:
+            raise urllib2.HTTPError(url, 304, 'Not Modified', message,
+                                    StringIO.StringIO(''))
+        if code != 200 and code != 206:
+            raise urllib2.HTTPError(url, code, 'Error', message,
+                                    StringIO.StringIO(body))
+        return urllib.addinfourl(StringIO.StringIO(body), message, url, code)
+
+
+class HTTPCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.server = FakeServer()
+        self.cache = morphlib.httpcache.HTTPCache(self.tempdir)
+        self.immutable = URL % ('a' * 40)
+        self.server.respond(self.immutable, 'immutable data',
+                            Cache_Control='public, max-age=3600, immutable',
+                            ETag='"imm"')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def get(self, request):
+        return self.cache.open(request, self.server.urlopen)
+
+    def stored(self):
+        return sorted(name for name in os.listdir(self.tempdir)
+                      if not name.endswith('.meta'))
+
+    def test_serves_fresh_responses_from_the_cache(self):
+        self.assertEqual(self.get(self.immutable).read(), 'immutable data')
+        response = self.get(self.immutable)
+        self.assertEqual(response.read(), 'immutable data')
+        self.assertEqual(response.getcode(), 200)
+        self.assertEqual(response.info().getheader('ETag'), '"imm"')
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_revalidates_stale_responses(self):
+        url = URL % 'master'
+        self.server.respond(url, 'data', Cache_Control='no-cache',
+                            ETag='"v1"')
+        self.get(url).read()
+        self.server.respond(url, 'data', Cache_Control='max-age=3600',
+                            ETag='"v1"')
+        self.assertEqual(self.get(url).read(), 'data')
+        self.assertEqual(self.server.requests[-1].get_header(
+            'If-none-match'), '"v1"')
+        self.assertEqual(self.cache.revalidated, 1)
+        # The 304 reply said the response can now be reused for an hour.
+        self.assertEqual(self.get(url).read(), 'data')
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_sends_last_modified_when_revalidating(self):
+        url = URL % 'master'
+        date = 'Mon, 19 Oct 2026 10:00:00 GMT'
+        self.server.respond(url, 'data', Last_Modified=date)
+        self.get(url).read()
+        self.get(url).read()
+        self.assertEqual(self.server.requests[-1].get_header(
+            'If-modified-since'), date)
+
+    def test_replaces_a_changed_response(self):
+        url = URL % 'master'
+        self.server.respond(url, 'old', ETag='"v1"')
+        self.get(url).read()
+        self.server.respond(url, 'new', ETag='"v2"')
+        self.assertEqual(self.get(url).read(), 'new')
+        self.assertEqual(self.get(url).read(), 'new')
+        self.assertEqual(self.cache.misses, 2)
+        self.assertEqual(self.cache.revalidated, 1)
+
+    def test_passes_errors_on(self):
+        url = URL % 'missing'
+        self.server.respond(url, 'not found', code=404)
+        self.assertRaises(urllib2.HTTPError, self.get, url)
+        self.server.respond(url, 'gone', code=410, ETag='"v1"')
+        self.assertRaises(urllib2.HTTPError, self.get, url)
+        self.assertEqual(self.stored(), [])
+
+    def test_passes_errors_on_when_revalidating(self):
+        url = URL % 'master'
+        self.server.respond(url, 'data', ETag='"v1"')
+        self.get(url).read()
+        self.server.respond(url, 'not found', code=404)
+        self.assertRaises(urllib2.HTTPError, self.get, url)
+
+    def test_does_not_keep_responses_it_may_not_reuse(self):
+        self.server.respond(URL % 'no-store', 'data',
+                            Cache_Control='no-store', ETag='"v1"')
+        self.server.respond(URL % 'no-validator', 'data',
+                            Cache_Control='max-age=nonsense')
+        self.server.respond(URL % 'no-length', 'data', ETag='"v1"',
+                            Content_Length='unknown')
+        self.server.respond(URL % 'too-big', 'x' * 100, ETag='"v1"')
+        self.cache.max_entry_size = 10
+        for ref in ('no-store', 'no-validator', 'no-length', 'too-big'):
+            self.get(URL % ref).read()
+            self.get(URL % ref).read()
+        self.assertEqual(self.stored(), [])
+        self.assertEqual(len(self.server.requests), 8)
+
+    def test_passes_other_requests_on(self):
+        self.server.respond(self.immutable, 'part',
+                            Cache_Control='max-age=3600', ETag='"v1"')
+        request = urllib2.Request(self.immutable)
+        request.add_header('Range', 'bytes=10-')
+        self.get(request).read()
+        self.get(urllib2.Request(self.immutable, 'POST data')).read()
+        self.assertEqual(self.stored(), [])
+
+    def test_removes_the_least_recently_used_responses(self):
+        self.cache.max_size = 35
+        for i in xrange(3):
+            self.server.respond(URL % i, '%d' % i * 10, ETag='"v1"')
+            self.get(URL % i).read()
+            path = os.path.join(self.tempdir, self.cache._key(URL % i))
+            os.utime(path, (i, i))
+        # Using a response makes it the most recently used one.
+        self.assertEqual(self.get(URL % 0).read(), '0' * 10)
+        self.server.respond(URL % 3, '3' * 10, ETag='"v1"')
+        self.get(URL % 3).read()
+        self.assertEqual(self.stored(), sorted(
+            [self.cache._key(URL % 0), self.cache._key(URL % 3)]))
+
+    def test_counts_what_other_processes_have_stored(self):
+        other = morphlib.httpcache.HTTPCache(self.tempdir, max_size=30)
+        for i in xrange(3):
+            self.server.respond(URL % i, '%d' % i * 10, ETag='"v1"')
+            other.open(URL % i, self.server.urlopen).read()
+        self.cache.max_size = 30
+        self.server.respond(URL % 3, '3' * 10, ETag='"v1"')
+        self.get(URL % 3).read()
+        self.assertTrue(len(self.stored()) < 4)
+
+    def test_copes_with_files_it_cannot_remove_or_read(self):
+        os.mkdir(os.path.join(self.tempdir, '0' * 40))
+        os.symlink('nowhere', os.path.join(self.tempdir, '1' * 40))
+        self.cache.max_size = 5
+        self.get(self.immutable).read()
+        self.assertTrue(os.path.isdir(os.path.join(self.tempdir, '0' * 40)))
+
+    def test_ignores_broken_entries(self):
+        self.get(self.immutable).read()
+        key = self.cache._key(self.immutable)
+        with open(os.path.join(self.tempdir, key + '.meta'), 'w') as f:
+            f.write('not json')
+        self.assertEqual(self.get(self.immutable).read(), 'immutable data')
+        self.assertEqual(self.cache.misses, 2)
+        with open(os.path.join(self.tempdir, key + '.meta')) as f:
+            self.assertEqual(json.load(f)['url'], self.immutable)
+
+    def test_serves_responses_it_could_not_keep(self):
+        os.rmdir(self.tempdir)
+        try:
+            self.assertEqual(self.get(self.immutable).read(),
+                             'immutable data')
+        finally:
+            os.mkdir(self.tempdir)
+
+    def test_cleans_up_after_failing_to_write(self):
+        self.assertRaises(TypeError, self.cache._write, 'foo', None)
+        self.assertEqual(os.listdir(self.tempdir), [])
@@ -1,4 +1,4 @@
-# Copyright (C) 2012, 2013, 2014  Codethink Limited
+# Copyright (C) 2012, 2013, 2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -52,6 +52,17 @@ class LocalArtifactCache(object):
         filename = self.artifact_filename(artifact)
         return morphlib.savefile.SaveFile(filename, mode='w')
 
+    def put_resumable(self, artifact):
+        '''Like put, but carry on from any data left by an earlier put.
+
+        Data written by an interrupted download is kept beside the
+        artifact until the download is resumed, see
+        morphlib.savefile.ResumableSaveFile.
+
+        '''
+        filename = self.artifact_filename(artifact)
+        return morphlib.savefile.ResumableSaveFile(filename)
+
     def put_artifact_metadata(self, artifact, name):
         filename = self._artifact_metadata_filename(artifact, name)
         return morphlib.savefile.SaveFile(filename, mode='w')
@@ -88,6 +99,9 @@ class LocalArtifactCache(object):
         os.utime(filename, None)
         return open(filename)
 
+    def get_artifact_metadata_filename(self, artifact, name):
+        return self._artifact_metadata_filename(artifact, name)
+
     def get_source_metadata_filename(self, source, cachekey, name):
         return self._source_metadata_filename(source, cachekey, name)
 
@@ -1,4 +1,4 @@
-# Copyright (C) 2012,2014  Codethink Limited
+# Copyright (C) 2012,2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -59,6 +59,14 @@ class LocalArtifactCacheTests(unittest.TestCase):
         expected_name = self.tempfs.getsyspath(self.devel_artifact.basename())
         self.assertEqual(filename, expected_name)
 
+    def test_get_artifact_metadata_filename(self):
+        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+        filename = cache.get_artifact_metadata_filename(
+            self.devel_artifact, 'meta')
+        expected_name = self.tempfs.getsyspath(
+            self.devel_artifact.metadata_basename('meta'))
+        self.assertEqual(filename, expected_name)
+
     def test_get_source_metadata_filename(self):
         cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
         artifact = self.devel_artifact
@@ -71,6 +79,22 @@ class LocalArtifactCacheTests(unittest.TestCase):
                                                (source.cache_key, name))
         self.assertEqual(filename, expected_name)
 
+    def test_resumes_an_interrupted_put(self):
+        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+
+        handle = cache.put_resumable(self.runtime_artifact)
+        handle.write('run')
+        handle.suspend()
+        self.assertFalse(cache.has(self.runtime_artifact))
+
+        handle = cache.put_resumable(self.runtime_artifact)
+        self.assertEqual(handle.offset, 3)
+        handle.write('time')
+        handle.close()
+
+        handle = cache.get(self.runtime_artifact)
+        self.assertEqual(handle.read(), 'runtime')
+
     def test_put_artifacts_and_check_whether_the_cache_has_them(self):
         cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
 
@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2014  Codethink Limited
+# Copyright (C) 2012-2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -24,6 +24,7 @@ import sys
 import tempfile
 
 import cliapp
+import fs.errors
 import fs.osfs
 
 import morphlib
@@ -170,15 +171,12 @@ class LocalRepoCache(object):
         tarball_url = urlparse.urljoin(self._tarball_base_url,
                                        self._escape(repourl)) + '.tar'
         try:
-            self.fs.makedir(path)
             self._fetch(tarball_url, path)
             self._git(['config', 'remote.origin.url', repourl], cwd=path)
             self._git(['config', 'remote.origin.mirror', 'true'], cwd=path)
             self._git(['config', 'remote.origin.fetch', '+refs/*:refs/*'],
                       cwd=path)
         except BaseException, e:  # pragma: no cover
-            if self.fs.exists(path):
-                self.fs.removedir(path, force=True)
             return False, 'Unable to extract tarball %s: %s' % (
                 tarball_url, e)
 
@@ -202,10 +200,13 @@ class LocalRepoCache(object):
         repourl = self._resolver.pull_url(reponame)
         path = self._cache_name(repourl)
         if self._tarball_base_url:
-            ok, error = self._clone_with_tarball(repourl, path)
+            target = self._mkdtemp(self._cachedir)
+            ok, error = self._clone_with_tarball(repourl, target)
             if ok:
+                self._install(target, path)
                 return self.get_repo(reponame)
             else:
+                self.fs.removedir(target, force=True)
                 errors.append(error)
                 self._app.status(
                     msg='Using git clone.')
@@ -219,12 +220,29 @@ class LocalRepoCache(object):
             errors.append('Unable to clone from %s to %s: %s' %
                           (repourl, target, e))
             if self.fs.exists(target):
-                self.fs.removedir(target, recursive=True, force=True)
+                self.fs.removedir(target, force=True)
             raise NoRemote(reponame, errors)
 
-        self.fs.rename(target, path)
+        self._install(target, path)
         return self.get_repo(reponame)
 
+    def _install(self, target, path):
+        '''Move a new clone into place in the cache.
+
+        Repositories are cloned under a temporary name, so that builds
+        running at once on one machine, which share the cache, never
+        see one half cloned. If one of them cloned the same repository
+        meanwhile, that one is used, and this one is thrown away.
+
+        '''
+
+        try:
+            self.fs.rename(target, path)
+        except fs.errors.FSError:
+            if not self.fs.exists(path):
+                raise
+            self.fs.removedir(target, force=True)
+
     def _new_cached_repo_instance(self, reponame, repourl,
                                   path):  # pragma: no cover
         return morphlib.cachedrepo.CachedRepo(
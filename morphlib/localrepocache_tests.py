@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2014  Codethink Limited
+# Copyright (C) 2012-2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -19,6 +19,7 @@ import urllib2
 import os
 
 import cliapp
+import fs.errors
 import fs.memoryfs
 
 import morphlib
@@ -66,7 +67,7 @@ class LocalRepoCacheTests(unittest.TestCase):
             remote = args[3]
             local = args[4]
             self.remotes['origin'] = {'url': remote, 'updates': 0}
-            self.lrc.fs.makedir(local, recursive=True)
+            self.lrc.fs.makedir(local, recursive=True, allow_recreate=True)
         elif args[0:2] == ['remote', 'set-url']:
             remote = args[2]
             url = args[3]
@@ -86,7 +87,7 @@ class LocalRepoCacheTests(unittest.TestCase):
         thing = "foo"+str(self._mkdtemp_count)
         self._mkdtemp_count += 1
         self.lrc.fs.makedir(dirname+"/"+thing)
-        return thing
+        return dirname+"/"+thing
 
     def new_cached_repo_instance(self, *args):
         with morphlib.gitdir_tests.allow_nonexistant_git_repos():
@@ -123,9 +124,26 @@ class LocalRepoCacheTests(unittest.TestCase):
         self.lrc.cache_repo(self.repourl)
         self.lrc.cache_repo(self.repourl)
 
+    def test_uses_repo_cloned_meanwhile_by_another_build(self):
+        def clone_twice(args, **kwargs):
+            self.fake_git(args, **kwargs)
+            self.lrc.fs.makedir(self.cache_path + '/objects', recursive=True)
+        self.lrc._git = clone_twice
+        self.lrc.cache_repo(self.repourl)
+        self.assertTrue(self.lrc.has_repo(self.repourl))
+        self.assertEqual(self.lrc.fs.listdir(self.cachedir),
+                         [os.path.basename(self.cache_path)])
+
+    def test_fails_when_clone_cannot_be_moved_into_place(self):
+        def lose_clone(args, **kwargs):
+            self.lrc.fs.removedir(args[4], force=True)
+        self.lrc._git = lose_clone
+        self.assertRaises(fs.errors.FSError,
+                          self.lrc.cache_repo, self.repourl)
+
     def test_fails_to_cache_when_remote_does_not_exist(self):
         def fail(args, **kwargs):
-            self.lrc.fs.makedir(args[4])
+            self.lrc.fs.makedir(args[4], allow_recreate=True)
             raise cliapp.AppException('')
         self.lrc._git = fail
         self.assertRaises(morphlib.localrepocache.NoRemote,
@@ -1,6 +1,6 @@
 # distbuild_plugin.py -- Morph distributed build plugin
 #
-# Copyright (C) 2014  Codethink Limited
+# Copyright (C) 2014, 2026  Codethink Limited
 # 
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -17,7 +17,10 @@
 
 
 import cliapp
+import fcntl
+import json
 import logging
+import os
 import re
 import sys
 
@@ -36,6 +39,11 @@ class DistbuildOptionsPlugin(cliapp.Plugin):
                 '(this is for testing only)',
             metavar='FILENAME:FUNCNAME:MAXCALLS',
             group=group_distbuild)
+        self.app.settings.boolean(
+            ['compress-messages'],
+            'compress messages to other distbuild nodes, if they can '
+                'read them, which uses less network for more CPU time',
+            group=group_distbuild)
 
     def disable(self):
         pass
@@ -100,6 +108,25 @@ class WorkerBuild(cliapp.Plugin):
         
         bc = morphlib.buildcommand.BuildCommand(self.app)
 
+        # A worker may run several builds at once, which share the
+        # caches. Every build holds a shared lock on them, and the caches
+        # are only garbage collected by a build which finds no others.
+        lock_file = os.path.join(self.app.settings['cachedir'],
+                                 'worker-build.lock')
+        with open(lock_file, 'a') as lock:
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                logging.debug('Other builds are running, so the caches '
+                              'are not garbage collected')
+            else:
+                self.collect_garbage(bc)
+            fcntl.flock(lock.fileno(), fcntl.LOCK_SH)
+
+            arch = artifact.arch
+            bc.build_source(artifact.source, bc.new_build_env(arch))
+
+    def collect_garbage(self, bc):
         # Now, before we start the build, we garbage collect the caches
         # to ensure we have room.  First we remove all system artifacts
         # since we never need to recover those from workers post-hoc
@@ -111,9 +138,6 @@ class WorkerBuild(cliapp.Plugin):
 
         self.app.subcommands['gc']([])
 
-        arch = artifact.arch
-        bc.build_source(artifact.source, bc.new_build_env(arch))
-
     def is_system_artifact(self, filename):
         return re.match(r'^[0-9a-fA-F]{64}\.system\.', filename)
 
@@ -135,10 +159,21 @@ class WorkerDaemon(cliapp.Plugin):
             'write port used by worker-daemon to FILE',
             default='',
             group=group_distbuild)
+        self.app.settings.integer(
+            ['worker-slots'],
+            'run up to N builds at once, which need as many '
+                'distbuild-helper processes',
+            metavar='N',
+            default=1,
+            group=group_distbuild)
         self.app.add_subcommand(
             'worker-daemon',
             self.worker_daemon,
             arg_synopsis='')
+        self.app.add_subcommand(
+            'worker-info',
+            self.worker_info,
+            arg_synopsis='')
     
     def disable(self):
         pass
@@ -147,6 +182,8 @@ class WorkerDaemon(cliapp.Plugin):
         '''Daemon that controls builds on a single worker node.'''
 
         distbuild.add_crash_conditions(self.app.settings['crash-condition'])
+        distbuild.JsonMachine.compress = \
+            self.app.settings['compress-messages']
 
         address = self.app.settings['worker-daemon-address']
         port = self.app.settings['worker-daemon-port']
@@ -157,6 +194,24 @@ class WorkerDaemon(cliapp.Plugin):
         loop.add_state_machine(router)
         loop.run()
 
+    def worker_info(self, args):
+        '''Internal use only: Describe what this worker can build with.
+
+        The controller asks for this when the worker connects, to know
+        how many builds to run on it at once, how many CPUs to give
+        each, and how to encode the artifact graphs it sends.
+
+        '''
+
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        info = {
+            'slots': max(1, self.app.settings['worker-slots']),
+            'cpus': morphlib.util.cpu_count(),
+            'memory': memory,
+            'graph-version': distbuild.GRAPH_VERSION,
+        }
+        self.app.output.write('%s\n' % json.dumps(info))
+
 
 class ControllerDaemon(cliapp.Plugin):
 
@@ -227,6 +282,30 @@ class ControllerDaemon(cliapp.Plugin):
             default='morph',
             group=group_distbuild)
 
+        self.app.settings.string(
+            ['build-priority'],
+            'build first what most else depends on (dependents), what '
+                'starts the slowest chain of builds (critical-path), or '
+                'what was asked for first (fifo) (default: %default)',
+            metavar='POLICY',
+            default='dependents',
+            group=group_distbuild)
+        self.app.settings.string(
+            ['build-durations-file'],
+            'keep how long each artifact took to build in FILE, for '
+                '--build-priority=critical-path (default: '
+                'build-durations.json in the cache directory)',
+            metavar='FILE',
+            default='',
+            group=group_distbuild)
+        self.app.settings.integer(
+            ['job-retries'],
+            'build an artifact again on another worker up to N times, if '
+                'the worker it was building on is lost (default: %default)',
+            metavar='N',
+            default=distbuild.WorkerBuildQueuer.JOB_RETRIES,
+            group=group_distbuild)
+
         self.app.add_subcommand(
             'controller-daemon', self.controller_daemon, arg_synopsis='')
 
@@ -237,6 +316,8 @@ class ControllerDaemon(cliapp.Plugin):
         '''Daemon that gives jobs to worker daemons.'''
         
         distbuild.add_crash_conditions(self.app.settings['crash-condition'])
+        distbuild.JsonMachine.compress = \
+            self.app.settings['compress-messages']
 
         artifact_cache_server = (
             self.app.settings['artifact-cache-server'] or
@@ -246,6 +327,17 @@ class ControllerDaemon(cliapp.Plugin):
             self.app.settings['worker-cache-server-port']
         morph_instance = self.app.settings['morph-instance']
 
+        durations_file = (
+            self.app.settings['build-durations-file'] or
+            os.path.join(self.app.settings['cachedir'],
+                         'build-durations.json'))
+        try:
+            build_priority = distbuild.new_build_priority(
+                self.app.settings['build-priority'], durations_file)
+        except ValueError, e:
+            raise cliapp.AppException(
+                '%s: use dependents, critical-path or fifo' % e)
+
         listener_specs = [
             # address, port, class to initiate on connection, class init args
             ('controller-helper-address', 'controller-helper-port', 
@@ -254,12 +346,13 @@ class ControllerDaemon(cliapp.Plugin):
             ('controller-initiator-address', 'controller-initiator-port',
              'controller-initiator-port-file',
              distbuild.InitiatorConnection, 
-             [artifact_cache_server, morph_instance]),
+             [artifact_cache_server, morph_instance, build_priority]),
         ]
 
         loop = distbuild.MainLoop()
         
-        queuer = distbuild.WorkerBuildQueuer()
+        queuer = distbuild.WorkerBuildQueuer(
+            build_priority, self.app.settings['job-retries'])
         loop.add_state_machine(queuer)
 
         for addr, port, port_file, sm, extra_args in listener_specs:
@@ -334,5 +427,8 @@ class GraphStateMachines(cliapp.Plugin):
     def add_state_machine(self, sm):
         pass
 
+    def deliver_events(self, *args, **kwargs):
+        pass
+
     def status(self, *args, **kwargs):
         pass
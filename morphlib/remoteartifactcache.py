@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2014  Codethink Limited
+# Copyright (C) 2012-2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -15,11 +15,14 @@
 
 
 import cliapp
+import json
 import logging
 import urllib
 import urllib2
 import urlparse
 
+import morphlib
+
 
 class HeadRequest(urllib2.Request):  # pragma: no cover
 
@@ -27,6 +30,12 @@ class HeadRequest(urllib2.Request):  # pragma: no cover
         return 'HEAD'
 
 
+class PutRequest(urllib2.Request):  # pragma: no cover
+
+    def get_method(self):
+        return 'PUT'
+
+
 class GetError(cliapp.AppException):
 
     def __init__(self, cache, artifact):
@@ -54,64 +63,284 @@ class GetSourceMetadataError(GetError):
                   (name, source, cache_key, cache))
 
 
+class GetFilesError(GetError):
+
+    def __init__(self, cache, filenames):
+        cliapp.AppException.__init__(
+            self, 'Failed to get an archive of %d files '
+                  'from the artifact cache %s' %
+                  (len(filenames), cache))
+
+
+class ChecksumError(GetError):
+
+    def __init__(self, cache, filename):
+        cliapp.AppException.__init__(
+            self, 'Downloaded file %s does not match the checksum '
+                  'published by the artifact cache %s' %
+                  (filename, cache))
+
+
+class PutError(cliapp.AppException):
+
+    def __init__(self, cache, filename):
+        cliapp.AppException.__init__(
+            self, 'Failed to upload %s to the artifact cache %s' %
+                  (filename, cache))
+
+
 class RemoteArtifactCache(object):
 
-    def __init__(self, server_url):
+    '''An artifact cache server, as seen by its clients.
+
+    If ``membership`` is a morphlib.bloomfilter.MembershipFilter, the
+    copy of the server's membership filter it holds is brought up to
+    date at most every MEMBERSHIP_REFRESH_INTERVAL seconds, and used to
+    answer questions about files the server definitely does not have
+    without asking it. Only files which may be there are asked about.
+
+    '''
+
+    MEMBERSHIP_REFRESH_INTERVAL = 10
+
+    def __init__(self, server_url, upload_token=None, timeout=None,
+                 http_cache=None, membership=None):
         self.server_url = server_url
+        self.upload_token = upload_token
+        self.timeout = timeout
+        self.http_cache = http_cache
+        self.membership = membership
+        self.connection_failures = 0
 
     def has(self, artifact):
-        return self._has_file(artifact.basename())
+        return self._might_have(artifact.basename()) and \
+            self._has_file(artifact.basename())
 
     def has_artifact_metadata(self, artifact, name):
-        return self._has_file(artifact.metadata_basename(name))
+        filename = artifact.metadata_basename(name)
+        return self._might_have(filename) and self._has_file(filename)
 
     def has_source_metadata(self, source, cachekey, name):
         filename = '%s.%s' % (cachekey, name)
-        return self._has_file(filename)
+        return self._might_have(filename) and self._has_file(filename)
+
+    def has_files(self, filenames):
+        '''Return a dict saying which of ``filenames`` the server has.
 
-    def get(self, artifact, log=logging.error):
+        This asks about all of the files with a single request, and
+        only about those the membership filter does not rule out.
+
+        '''
+        present = dict((filename, False) for filename in filenames)
+        wanted = [filename for filename in filenames
+                  if self._might_have(filename)]
+        if not wanted:
+            return present
         try:
-            return self._get_file(artifact.basename())
+            present.update(self._succeeded(self._has_files(wanted)))
         except urllib2.URLError, e:
+            self._failed(e)
+            raise
+        return present
+
+    def _might_have(self, filename):
+        '''Return False if the server definitely does not have a file.'''
+
+        if self.membership is None:
+            return True
+        if not self.membership.is_fresh(self.MEMBERSHIP_REFRESH_INTERVAL):
+            try:
+                self.membership.update(
+                    self._get_membership(self.membership.query()))
+            except urllib2.HTTPError, e:
+                # The server does not publish a filter.
+                logging.debug('No membership filter from %s: %s' %
+                              (self, e))
+                self.membership = None
+                return True
+            except (urllib2.URLError, ValueError), e:
+                logging.debug('Could not update the membership filter '
+                              'from %s: %s' % (self, e))
+                return True
+        return self.membership.might_contain(filename)
+
+    def get(self, artifact, log=logging.error, offset=0):
+        '''Return a file handle to read an artifact from.
+
+        If ``offset`` is given, ask the server for the contents from
+        that byte onwards only. Servers that cannot do so return the
+        whole file, so callers should check the response code, which
+        is 206 (Partial Content) for a partial response.
+
+        '''
+        try:
+            return self._succeeded(self._get_file(artifact.basename(), offset))
+        except urllib2.URLError, e:
+            self._failed(e)
             log(str(e))
             raise GetError(self, artifact)
 
     def get_artifact_metadata(self, artifact, name, log=logging.error):
         try:
-            return self._get_file(artifact.metadata_basename(name))
+            return self._succeeded(
+                self._get_file(artifact.metadata_basename(name)))
         except urllib2.URLError, e:
+            self._failed(e)
             log(str(e))
             raise GetArtifactMetadataError(self, artifact, name)
 
     def get_source_metadata(self, source, cachekey, name):
         filename = '%s.%s' % (cachekey, name)
         try:
-            return self._get_file(filename)
-        except urllib2.URLError:
+            return self._succeeded(self._get_file(filename))
+        except urllib2.URLError, e:
+            self._failed(e)
             raise GetSourceMetadataError(self, source, cachekey, name)
 
+    def get_files(self, filenames, log=logging.debug):
+        '''Return a tar stream of those of ``filenames`` the server has.
+
+        This fetches all the files with a single request, so it is much
+        quicker than getting lots of small files one at a time. Files
+        the server does not have are left out of the archive.
+
+        '''
+        try:
+            return self._succeeded(self._get_archive(filenames))
+        except urllib2.URLError, e:
+            self._failed(e)
+            log(str(e))
+            raise GetFilesError(self, filenames)
+
+    def put(self, artifact, filename, log=logging.error):
+        '''Upload the local file ``filename`` as an artifact.
+
+        The server needs to have writes enabled. The file is streamed
+        rather than read into memory, and the server only adds it to the
+        cache once all of it has arrived intact.
+
+        '''
+        self._put(artifact.basename(), filename, log)
+
+    def put_artifact_metadata(self, artifact, name, filename,
+                              log=logging.error):
+        self._put(artifact.metadata_basename(name), filename, log)
+
+    def put_source_metadata(self, source, cachekey, name, filename,
+                            log=logging.error):
+        self._put('%s.%s' % (cachekey, name), filename, log)
+
+    def _put(self, basename, filename, log):
+        with open(filename, 'rb') as f:
+            checksum = morphlib.contentdigest.checksum_file(f)
+            size = f.tell()
+            f.seek(0)
+            try:
+                self._put_file(basename, f, size,
+                               morphlib.contentdigest.encode(checksum))
+            except urllib2.URLError, e:
+                log(str(e))
+                raise PutError(self, basename)
+        if self.membership is not None:
+            self.membership.add(basename)
+
+    def _succeeded(self, result):
+        self.connection_failures = 0
+        return result
+
+    def _failed(self, e):
+        '''Count the times in a row the server could not be reached.
+
+        An HTTP error response means the server is working, and just
+        does not have the file, so it is not counted.
+
+        '''
+        if isinstance(e, urllib2.HTTPError):
+            self.connection_failures = 0
+        else:
+            self.connection_failures += 1
+
     def _has_file(self, filename):  # pragma: no cover
         url = self._request_url(filename)
         logging.debug('RemoteArtifactCache._has_file: url=%s' % url)
         request = HeadRequest(url)
         try:
-            urllib2.urlopen(request)
-            return True
-        except (urllib2.HTTPError, urllib2.URLError):
+            self._urlopen(request).close()
+        except urllib2.URLError, e:
+            self._failed(e)
             return False
+        self.connection_failures = 0
+        return True
+
+    def _get_file(self, filename, offset=0):  # pragma: no cover
+        url = self._request_url(filename)
+        logging.debug('RemoteArtifactCache._get_file: url=%s offset=%d' %
+                      (url, offset))
+        request = urllib2.Request(url)
+        if offset:
+            request.add_header('Range', 'bytes=%d-' % offset)
+        if self.http_cache is not None:
+            return self.http_cache.open(request, self._urlopen)
+        return self._urlopen(request)
+
+    def _has_files(self, filenames):  # pragma: no cover
+        url = self._service_url('/1.0/artifacts')
+        logging.debug('RemoteArtifactCache._has_files: url=%s files=%d' %
+                      (url, len(filenames)))
+        request = urllib2.Request(url, json.dumps(filenames),
+                                  {'Content-Type': 'application/json'})
+        return json.load(self._urlopen(request))
+
+    def _get_membership(self, query):  # pragma: no cover
+        url = self._service_url('/1.0/membership')
+        if query:
+            url += '?' + urllib.urlencode(query)
+        logging.debug('RemoteArtifactCache._get_membership: url=%s' % url)
+        response = self._urlopen(urllib2.Request(url))
+        try:
+            return json.load(response)
+        finally:
+            response.close()
 
-    def _get_file(self, filename):  # pragma: no cover
+    def _put_file(self, filename, handle, size,
+                  digest):  # pragma: no cover
         url = self._request_url(filename)
-        logging.debug('RemoteArtifactCache._get_file: url=%s' % url)
-        return urllib2.urlopen(url)
+        logging.debug('RemoteArtifactCache._put_file: url=%s size=%d' %
+                      (url, size))
+        # httplib sends a file object body a block at a time, as long as
+        # the length is given up front.
+        request = PutRequest(url, handle, {
+            'Content-Type': 'application/octet-stream',
+            'Content-Length': str(size),
+            'Digest': morphlib.contentdigest.format_header(digest),
+        })
+        if self.upload_token:
+            request.add_header('Authorization',
+                               'Token %s' % self.upload_token)
+        self._urlopen(request).close()
+
+    def _get_archive(self, filenames):  # pragma: no cover
+        url = self._service_url('/1.0/archive')
+        logging.debug('RemoteArtifactCache._get_archive: url=%s files=%d' %
+                      (url, len(filenames)))
+        request = urllib2.Request(url, json.dumps(filenames),
+                                  {'Content-Type': 'application/json'})
+        return self._urlopen(request)
+
+    def _urlopen(self, request):  # pragma: no cover
+        if self.timeout:
+            return urllib2.urlopen(request, timeout=self.timeout)
+        return urllib2.urlopen(request)
 
     def _request_url(self, filename):  # pragma: no cover
+        return self._service_url(
+            '/1.0/artifacts?filename=%s' % urllib.quote(filename))
+
+    def _service_url(self, path):  # pragma: no cover
         server_url = self.server_url
         if not server_url.endswith('/'):
             server_url += '/'
-        return urlparse.urljoin(
-            server_url, '/1.0/artifacts?filename=%s' % 
-            urllib.quote(filename))
+        return urlparse.urljoin(server_url, path)
 
     def __str__(self):  # pragma: no cover
         return self.server_url
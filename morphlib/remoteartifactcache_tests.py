@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2014  Codethink Limited
+# Copyright (C) 2012-2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -14,7 +14,13 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import base64
+import hashlib
+import os
+import shutil
 import StringIO
+import tarfile
+import tempfile
 import unittest
 import urllib2
 
@@ -69,16 +75,45 @@ class RemoteArtifactCacheTests(unittest.TestCase):
             self.server_url)
         self.cache._has_file = self._has_file
         self.cache._get_file = self._get_file
+        self.cache._get_archive = self._get_archive
+        self.cache._has_files = self._has_files
+        self.cache._put_file = self._put_file
+        self.uploads = {}
+        self.asked = []
 
     def _has_file(self, filename):
+        self.asked.append(filename)
         return filename in self.existing_files
 
-    def _get_file(self, filename):
+    def _get_file(self, filename, offset=0):
         if filename in self.existing_files:
-            return StringIO.StringIO('%s' % filename)
+            return StringIO.StringIO(('%s' % filename)[offset:])
         else:
             raise urllib2.URLError('foo')
 
+    def _has_files(self, filenames):
+        self.asked.extend(filenames)
+        return dict((f, f in self.existing_files) for f in filenames)
+
+    def _put_file(self, filename, handle, size, digest):
+        if filename.startswith('/'):
+            raise urllib2.HTTPError('url', 400, 'bad name', {}, None)
+        self.uploads[filename] = (handle.read(), size, digest)
+
+    def _get_archive(self, filenames):
+        if any(f.startswith('/') for f in filenames):
+            raise urllib2.HTTPError('url', 500, 'bad name', {}, None)
+        handle = StringIO.StringIO()
+        tar = tarfile.open(fileobj=handle, mode='w|')
+        for filename in filenames:
+            if filename in self.existing_files:
+                info = tarfile.TarInfo(filename)
+                info.size = len(filename)
+                tar.addfile(info, StringIO.StringIO(filename))
+        tar.close()
+        handle.seek(0)
+        return handle
+
     def test_sets_server_url(self):
         self.assertEqual(self.cache.server_url, self.server_url)
 
@@ -116,6 +151,11 @@ class RemoteArtifactCacheTests(unittest.TestCase):
         data = handle.read()
         self.assertEqual(data, self.runtime_artifact.basename())
 
+    def test_get_existing_artifact_from_offset(self):
+        handle = self.cache.get(self.runtime_artifact, offset=5)
+        data = handle.read()
+        self.assertEqual(data, self.runtime_artifact.basename()[5:])
+
     def test_get_a_different_existing_artifact(self):
         handle = self.cache.get(self.devel_artifact)
         data = handle.read()
@@ -158,7 +198,169 @@ class RemoteArtifactCacheTests(unittest.TestCase):
             self.runtime_artifact.cache_key,
             'non-existent-meta')
 
+    def test_get_files_returns_archive_of_existing_files(self):
+        wanted = [self.runtime_artifact.basename(),
+                  self.doc_artifact.basename(),
+                  self.runtime_artifact.metadata_basename('meta')]
+        handle = self.cache.get_files(wanted)
+        tar = tarfile.open(fileobj=handle, mode='r|')
+        contents = dict((member.name, tar.extractfile(member).read())
+                        for member in tar)
+        self.assertEqual(contents, {
+            wanted[0]: wanted[0],
+            wanted[2]: wanted[2],
+        })
+
+    def test_fails_to_get_files_the_server_refuses(self):
+        self.assertRaises(
+            morphlib.remoteartifactcache.GetFilesError,
+            self.cache.get_files, ['/etc/passwd'],
+            log=lambda *args: None)
+
     def test_escapes_pluses_in_request_urls(self):
         returned_url = self.cache._request_url('gtk+')
         correct_url = '%s/1.0/artifacts?filename=gtk%%2B' % self.server_url
         self.assertEqual(returned_url, correct_url)
+
+    def test_has_files_says_which_files_exist(self):
+        wanted = [self.runtime_artifact.basename(),
+                  self.doc_artifact.basename()]
+        self.assertEqual(self.cache.has_files(wanted), {
+            wanted[0]: True,
+            wanted[1]: False,
+        })
+
+    def use_membership(self, error=None):
+        bloom_filter = morphlib.bloomfilter.BloomFilter.for_capacity(100)
+        for filename in self.existing_files:
+            bloom_filter.add(filename)
+        self.membership_queries = []
+
+        def get_membership(query):
+            self.membership_queries.append(query)
+            if error is not None:
+                raise error
+            return {
+                'epoch': 1,
+                'version': 5,
+                'bits': bloom_filter.bits,
+                'hashes': bloom_filter.hashes,
+                'filter': base64.b64encode(bloom_filter.tostring()),
+            }
+
+        self.cache._get_membership = get_membership
+        self.cache.membership = morphlib.bloomfilter.MembershipFilter()
+
+    def test_only_asks_about_files_the_membership_filter_allows(self):
+        self.use_membership()
+        self.assertFalse(self.cache.has(self.doc_artifact))
+        self.assertFalse(self.cache.has_artifact_metadata(
+            self.doc_artifact, 'meta'))
+        self.assertFalse(self.cache.has_source_metadata(
+            self.source, 'OTHER', 'meta'))
+        self.assertTrue(self.cache.has(self.runtime_artifact))
+        wanted = [self.runtime_artifact.basename(),
+                  self.doc_artifact.basename()]
+        self.assertEqual(self.cache.has_files(wanted), {
+            wanted[0]: True,
+            wanted[1]: False,
+        })
+        self.assertEqual(self.asked, [wanted[0], wanted[0]])
+
+    def test_does_not_ask_at_all_if_the_membership_filter_rules_out_all(self):
+        self.use_membership()
+        wanted = [self.doc_artifact.basename(), 'OTHER.meta']
+        self.assertEqual(self.cache.has_files(wanted), {
+            wanted[0]: False,
+            wanted[1]: False,
+        })
+        self.assertEqual(self.asked, [])
+
+    def test_updates_the_membership_filter_when_it_is_stale(self):
+        self.use_membership()
+        self.cache.has(self.doc_artifact)
+        self.cache.has(self.doc_artifact)
+        self.assertEqual(self.membership_queries, [{}])
+        self.cache.membership.updated -= \
+            self.cache.MEMBERSHIP_REFRESH_INTERVAL
+        self.cache.has(self.doc_artifact)
+        self.assertEqual(self.membership_queries,
+                         [{}, {'epoch': 1, 'since': 5}])
+
+    def test_asks_the_server_if_it_has_no_membership_filter(self):
+        self.use_membership(
+            urllib2.HTTPError('url', 404, 'Not Found', {}, None))
+        self.assertFalse(self.cache.has(self.doc_artifact))
+        self.assertEqual(self.cache.membership, None)
+        self.assertFalse(self.cache.has(self.doc_artifact))
+        self.assertEqual(len(self.membership_queries), 1)
+        self.assertEqual(self.asked, [self.doc_artifact.basename()] * 2)
+
+    def test_asks_the_server_if_the_membership_filter_is_unavailable(self):
+        self.use_membership(urllib2.URLError('timed out'))
+        self.assertFalse(self.cache.has(self.doc_artifact))
+        self.assertNotEqual(self.cache.membership, None)
+        self.assertEqual(self.asked, [self.doc_artifact.basename()])
+
+    def test_remembers_files_it_puts_in_the_membership_filter(self):
+        self.use_membership()
+        self.assertFalse(self.cache.has(self.doc_artifact))
+        self.put_files((self.cache.put, (self.doc_artifact,)))
+        self.existing_files.add(self.doc_artifact.basename())
+        self.assertTrue(self.cache.has(self.doc_artifact))
+
+    def put_files(self, *put_args):
+        tempdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tempdir, 'upload')
+            with open(filename, 'w') as f:
+                f.write('contents')
+            for put, args in put_args:
+                put(*(args + (filename,)), log=lambda *args: None)
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_puts_artifact_and_metadata_with_size_and_digest(self):
+        self.put_files(
+            (self.cache.put, (self.doc_artifact,)),
+            (self.cache.put_artifact_metadata, (self.doc_artifact, 'meta')),
+            (self.cache.put_source_metadata,
+             (self.source, 'CHUNK', 'build-log')))
+        digest = base64.b64encode(hashlib.sha256('contents').digest())
+        self.assertEqual(self.uploads, {
+            self.doc_artifact.basename(): ('contents', 8, digest),
+            self.doc_artifact.metadata_basename('meta'):
+                ('contents', 8, digest),
+            'CHUNK.build-log': ('contents', 8, digest),
+        })
+
+    def test_fails_to_put_files_the_server_refuses(self):
+        self.assertRaises(
+            morphlib.remoteartifactcache.PutError,
+            self.put_files,
+            (self.cache.put_source_metadata, (self.source, '/etc', 'x')))
+
+    def test_counts_failures_to_reach_the_server(self):
+        for i in xrange(2):
+            self.assertRaises(morphlib.remoteartifactcache.GetError,
+                              self.cache.get, self.doc_artifact,
+                              log=lambda *args: None)
+        self.assertEqual(self.cache.connection_failures, 2)
+        self.cache.get(self.runtime_artifact)
+        self.assertEqual(self.cache.connection_failures, 0)
+
+    def test_does_not_count_error_responses_as_failures(self):
+        self.cache.connection_failures = 1
+        self.assertRaises(
+            morphlib.remoteartifactcache.GetFilesError,
+            self.cache.get_files, ['/etc/passwd'],
+            log=lambda *args: None)
+        self.assertEqual(self.cache.connection_failures, 0)
+
+    def test_counts_failures_to_ask_which_files_exist(self):
+        def has_files(filenames):
+            raise urllib2.URLError('timed out')
+        self.cache._has_files = has_files
+        self.assertRaises(urllib2.URLError, self.cache.has_files,
+                          [self.runtime_artifact.basename()])
+        self.assertEqual(self.cache.connection_failures, 1)
@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2014  Codethink Limited
+# Copyright (C) 2012-2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -47,9 +47,10 @@ class LsTreeError(cliapp.AppException):
 
 class RemoteRepoCache(object):
 
-    def __init__(self, server_url, resolver):
+    def __init__(self, server_url, resolver, http_cache=None):
         self.server_url = server_url
         self._resolver = resolver
+        self._http_cache = http_cache
 
     def resolve_ref(self, repo_name, ref):
         repo_url = self._resolver.pull_url(repo_name)
@@ -102,5 +103,8 @@ class RemoteRepoCache(object):
         if not server_url.endswith('/'):
             server_url += '/'
         url = urlparse.urljoin(server_url, '/1.0/%s' % path)
-        handle = urllib2.urlopen(url)
+        if self._http_cache is not None:
+            handle = self._http_cache.open(url)
+        else:
+            handle = urllib2.urlopen(url)
         return handle.read()
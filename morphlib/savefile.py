@@ -1,4 +1,4 @@
-# Copyright (C) 2012  Codethink Limited
+# Copyright (C) 2012, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -14,6 +14,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import fcntl
 import logging
 import os
 import tempfile
@@ -67,3 +68,69 @@ class SaveFile(file):
                       (self._savefile_tempname, self.real_filename))
         os.rename(self._savefile_tempname, self.real_filename)
         return ret
+
+
+class ResumableSaveFile(SaveFile):
+
+    '''A SaveFile whose partial contents survive an interrupted write.
+
+    Data is appended to ``partial_filename``, ``filename.partial`` by
+    default, rather than to a new temporary file, so if an earlier
+    writer stopped part-way through and called ``suspend``, writing
+    carries on from where it left off.
+    The ``offset`` attribute is the size of the data already present.
+
+    ``restart`` throws away the partial data, ``abort`` removes the
+    partial file, and ``close`` renames it to the target name.
+
+    Only one writer at a time has the partial file open, so that two
+    processes saving the same file, such as two builds on one machine
+    downloading the same artifact, wait for each other rather than
+    writing into each other's data. A writer which has one open should
+    finish with it before opening another, or two writers saving the
+    same files in different orders can wait for each other for ever.
+
+    '''
+
+    def __init__(self, filename, partial_filename=None):
+        self.real_filename = filename
+        self._savefile_tempname = (partial_filename or
+                                   '%s.partial' % filename)
+        while True:
+            file.__init__(self, self._savefile_tempname, 'ab')
+            fcntl.flock(self.fileno(), fcntl.LOCK_EX)
+            if self._is_partial_file():
+                break
+            # The writer which was waited for renamed or removed it.
+            file.close(self)
+        self.seek(0, os.SEEK_END)
+        self.offset = self.tell()
+
+    def _is_partial_file(self):
+        try:
+            st = os.stat(self._savefile_tempname)
+        except OSError:
+            return False
+        opened = os.fstat(self.fileno())
+        return (opened.st_dev, opened.st_ino) == (st.st_dev, st.st_ino)
+
+    def restart(self):
+        '''Discard any data written so far.'''
+
+        self.seek(0)
+        self.truncate()
+        self.offset = 0
+
+    def suspend(self):
+        '''Close the file, keeping the partial data for a later resume.'''
+
+        return file.close(self)
+
+    def close(self):
+        # The file is renamed before it is closed, while it is still
+        # locked, so that a writer waiting for it never appends to it.
+        self.flush()
+        logging.debug('Rename temporary file %s to %s' %
+                      (self._savefile_tempname, self.real_filename))
+        os.rename(self._savefile_tempname, self.real_filename)
+        return file.close(self)
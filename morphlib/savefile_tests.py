@@ -1,4 +1,4 @@
-# Copyright (C) 2012  Codethink Limited
+# Copyright (C) 2012, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -17,6 +17,8 @@
 import os
 import shutil
 import tempfile
+import threading
+import time
 import unittest
 
 import savefile
@@ -95,3 +97,112 @@ class SaveFileTests(unittest.TestCase):
             pass
         self.assertEqual(os.listdir(self.tempdir), [self.basename])
         self.assertEqual(self.cat(self.filename), 'foo')
+
+
+class ResumableSaveFileTests(unittest.TestCase):
+
+    def cat(self, filename):
+        with open(filename) as f:
+            return f.read()
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.basename = 'filename'
+        self.filename = os.path.join(self.tempdir, self.basename)
+        self.partial = self.filename + '.partial'
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_starts_at_offset_zero(self):
+        f = savefile.ResumableSaveFile(self.filename)
+        self.assertEqual(f.offset, 0)
+        f.abort()
+
+    def test_saves_new_file(self):
+        f = savefile.ResumableSaveFile(self.filename)
+        f.write('foo')
+        f.close()
+        self.assertEqual(os.listdir(self.tempdir), [self.basename])
+        self.assertEqual(self.cat(self.filename), 'foo')
+
+    def test_keeps_partial_data_when_suspended(self):
+        f = savefile.ResumableSaveFile(self.filename)
+        f.write('foo')
+        f.suspend()
+        self.assertEqual(os.listdir(self.tempdir),
+                         [self.basename + '.partial'])
+        self.assertEqual(self.cat(self.partial), 'foo')
+
+    def test_resumes_after_partial_data(self):
+        f = savefile.ResumableSaveFile(self.filename)
+        f.write('foo')
+        f.suspend()
+        f = savefile.ResumableSaveFile(self.filename)
+        self.assertEqual(f.offset, 3)
+        f.write('bar')
+        f.close()
+        self.assertEqual(self.cat(self.filename), 'foobar')
+
+    def test_keeps_partial_data_under_the_name_it_is_given(self):
+        partial = os.path.join(self.tempdir, '.part.' + self.basename)
+        f = savefile.ResumableSaveFile(self.filename, partial)
+        f.write('foo')
+        f.suspend()
+        self.assertEqual(os.listdir(self.tempdir), ['.part.' + self.basename])
+        f = savefile.ResumableSaveFile(self.filename, partial)
+        self.assertEqual(f.offset, 3)
+        f.write('bar')
+        f.close()
+        self.assertEqual(os.listdir(self.tempdir), [self.basename])
+        self.assertEqual(self.cat(self.filename), 'foobar')
+
+    def test_restart_discards_partial_data(self):
+        f = savefile.ResumableSaveFile(self.filename)
+        f.write('foo')
+        f.suspend()
+        f = savefile.ResumableSaveFile(self.filename)
+        f.restart()
+        self.assertEqual(f.offset, 0)
+        f.write('bar')
+        f.close()
+        self.assertEqual(self.cat(self.filename), 'bar')
+
+    def test_leaves_no_file_after_abort(self):
+        f = savefile.ResumableSaveFile(self.filename)
+        f.write('foo')
+        f.abort()
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+    def test_waits_for_another_writer(self):
+        first = savefile.ResumableSaveFile(self.filename)
+        first.write('foo')
+        opened = []
+        thread = threading.Thread(
+            target=lambda: opened.append(
+                savefile.ResumableSaveFile(self.filename)))
+        thread.start()
+        time.sleep(0.1)
+        self.assertEqual(opened, [])
+        first.close()
+        thread.join()
+        second = opened[0]
+        self.assertEqual(second.offset, 0)
+        second.write('bar')
+        second.close()
+        self.assertEqual(self.cat(self.filename), 'bar')
+
+    def test_starts_again_after_another_writer_aborts(self):
+        first = savefile.ResumableSaveFile(self.filename)
+        first.write('foo')
+        opened = []
+        thread = threading.Thread(
+            target=lambda: opened.append(
+                savefile.ResumableSaveFile(self.filename)))
+        thread.start()
+        time.sleep(0.1)
+        first.abort()
+        thread.join()
+        self.assertEqual(opened[0].offset, 0)
+        opened[0].abort()
+        self.assertEqual(os.listdir(self.tempdir), [])
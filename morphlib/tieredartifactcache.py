@@ -0,0 +1,197 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import logging
+import tarfile
+import tempfile
+
+import morphlib
+
+
+DEFAULT_MAX_FAILURES = 3
+
+
+class TieredArtifactCache(object):
+
+    '''Look for artifacts in several remote artifact caches in turn.
+
+    ``caches`` is a list of RemoteArtifactCache objects, nearest first.
+    Every lookup and download tries them in that order, and uses the
+    first one that has the file.
+
+    A cache that could not be reached ``max_failures`` times in a row is
+    left out of any further lookups, so that a server which is down only
+    costs the time of a few failed connections.
+
+    The tier each file was downloaded from is remembered, so that files
+    found in a farther cache can be copied into a nearer one, see
+    ``tier_of``.
+
+    '''
+
+    def __init__(self, caches, max_failures=DEFAULT_MAX_FAILURES):
+        self.caches = caches
+        self.max_failures = max_failures
+        self._found_in = {}
+        self._dropped = set()
+
+    def tiers(self):
+        '''Return (index, cache) for each cache which can still be used.'''
+
+        usable = []
+        for i, cache in enumerate(self.caches):
+            if i in self._dropped:
+                continue
+            if cache.connection_failures >= self.max_failures:
+                logging.warning('Not using the artifact cache %s any more: '
+                                'it could not be reached %d times in a row'
+                                % (cache, cache.connection_failures))
+                self._dropped.add(i)
+                continue
+            usable.append((i, cache))
+        return usable
+
+    def tier_of(self, filename):
+        '''Return the index of the cache a file was got from, or None.'''
+
+        return self._found_in.get(filename)
+
+    def has(self, artifact):
+        return any(cache.has(artifact) for i, cache in self.tiers())
+
+    def has_artifact_metadata(self, artifact, name):
+        return any(cache.has_artifact_metadata(artifact, name)
+                   for i, cache in self.tiers())
+
+    def has_source_metadata(self, source, cachekey, name):
+        return any(cache.has_source_metadata(source, cachekey, name)
+                   for i, cache in self.tiers())
+
+    def has_files(self, filenames):
+        locations = self._locate(filenames)
+        return dict((filename, filename in locations)
+                    for filename in filenames)
+
+    def get(self, artifact, log=logging.error, offset=0):
+        return self._get(
+            artifact.basename(),
+            lambda cache: cache.get(artifact, log=logging.debug,
+                                    offset=offset),
+            lambda: morphlib.remoteartifactcache.GetError(self, artifact),
+            log)
+
+    def get_artifact_metadata(self, artifact, name, log=logging.error):
+        return self._get(
+            artifact.metadata_basename(name),
+            lambda cache: cache.get_artifact_metadata(artifact, name,
+                                                      log=logging.debug),
+            lambda: morphlib.remoteartifactcache.GetArtifactMetadataError(
+                self, artifact, name),
+            log)
+
+    def get_source_metadata(self, source, cachekey, name):
+        return self._get(
+            '%s.%s' % (cachekey, name),
+            lambda cache: cache.get_source_metadata(source, cachekey, name),
+            lambda: morphlib.remoteartifactcache.GetSourceMetadataError(
+                self, source, cachekey, name),
+            logging.debug)
+
+    def get_files(self, filenames, log=logging.debug):
+        '''Return a tar stream of those of ``filenames`` any cache has.
+
+        Each cache is asked which of the files it has, and then for an
+        archive of those it has that no nearer cache does. If a single
+        cache has them all, its archive is returned as it is, otherwise
+        the archives are joined together into a temporary file.
+
+        '''
+        wanted = {}
+        for filename, i in self._locate(filenames).iteritems():
+            wanted.setdefault(i, []).append(filename)
+        if not wanted:
+            # There is no cache to ask, or none of them has any of the
+            # files, so the nearest cache can say so with an empty archive.
+            tiers = self.tiers()
+            if not tiers:
+                raise morphlib.remoteartifactcache.GetFilesError(
+                    self, filenames)
+            return tiers[0][1].get_files(filenames, log=log)
+
+        if len(wanted) == 1:
+            (i, found), = wanted.items()
+            handle = self.caches[i].get_files(found, log=log)
+            for filename in found:
+                self._found_in[filename] = i
+            return handle
+
+        joined = tempfile.TemporaryFile()
+        output = tarfile.open(fileobj=joined, mode='w|')
+        try:
+            for i in sorted(wanted):
+                handle = self.caches[i].get_files(wanted[i], log=log)
+                try:
+                    archive = tarfile.open(fileobj=handle, mode='r|')
+                    for member in archive:
+                        if member.isfile():
+                            output.addfile(member,
+                                           archive.extractfile(member))
+                            self._found_in[member.name] = i
+                finally:
+                    handle.close()
+            output.close()
+        except BaseException:
+            joined.close()
+            raise
+        joined.seek(0)
+        return joined
+
+    def _get(self, filename, get, make_error, log):
+        errors = []
+        for i, cache in self.tiers():
+            try:
+                handle = get(cache)
+            except morphlib.remoteartifactcache.GetError, e:
+                errors.append(str(e))
+                continue
+            self._found_in[filename] = i
+            return handle
+        for error in errors:
+            log(error)
+        raise make_error()
+
+    def _locate(self, filenames):
+        '''Return a dict of the nearest cache that has each file.'''
+
+        locations = {}
+        remaining = list(filenames)
+        for i, cache in self.tiers():
+            if not remaining:
+                break
+            try:
+                present = cache.has_files(remaining)
+            except Exception, e:
+                logging.debug('Could not ask %s which files it has: %s' %
+                              (cache, e))
+                continue
+            for filename in remaining:
+                if present.get(filename):
+                    locations[filename] = i
+            remaining = [f for f in remaining if f not in locations]
+        return locations
+
+    def __str__(self):
+        return ', '.join(str(cache) for cache in self.caches)
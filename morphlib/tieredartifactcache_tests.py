@@ -0,0 +1,261 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import BaseHTTPServer
+import json
+import socket
+import StringIO
+import tarfile
+import threading
+import unittest
+import urlparse
+
+import morphlib
+
+
+class FakeArtifact(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def basename(self):
+        return '%s.chunk.%s' % ('0' * 64, self.name)
+
+    def metadata_basename(self, name):
+        return '%s.%s' % (self.basename(), name)
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    '''Serve the parts of the artifact cache API morph uses for reading.'''
+
+    def log_message(self, *args):
+        pass
+
+    def _filename(self):
+        query = urlparse.urlparse(self.path).query
+        return urlparse.parse_qs(query).get('filename', [None])[0]
+
+    def _reply(self, code, data=''):
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_HEAD(self):
+        self.server.requests.append(('HEAD', self._filename()))
+        self._reply(200 if self._filename() in self.server.files else 404)
+
+    def do_GET(self):
+        filename = self._filename()
+        self.server.requests.append(('GET', filename))
+        if filename not in self.server.files:
+            return self._reply(404)
+        self._reply(200, self.server.files[filename])
+
+    def do_POST(self):
+        body = json.loads(
+            self.rfile.read(int(self.headers['Content-Length'])))
+        files = self.server.files
+        self.server.requests.append(('POST', self.path))
+        if self.path == '/1.0/artifacts':
+            self._reply(200, json.dumps(
+                dict((name, name in files) for name in body)))
+        elif self.path == '/1.0/archive' and self.server.archives:
+            handle = StringIO.StringIO()
+            tar = tarfile.open(fileobj=handle, mode='w|')
+            for name in body:
+                if name in files:
+                    info = tarfile.TarInfo(name)
+                    info.size = len(files[name])
+                    tar.addfile(info, StringIO.StringIO(files[name]))
+            tar.close()
+            self._reply(200, handle.getvalue())
+        else:
+            self._reply(404)
+
+
+class StandInServer(BaseHTTPServer.HTTPServer):
+
+    def __init__(self, files):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', 0), StandInHandler)
+        self.files = files
+        self.requests = []
+        self.archives = True
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       kwargs={'poll_interval': 0.01})
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self.server_port
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def unused_url():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return 'http://127.0.0.1:%d/' % port
+
+
+class TieredArtifactCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.near_artifact = FakeArtifact('near')
+        self.far_artifact = FakeArtifact('far')
+        self.both_artifact = FakeArtifact('both')
+        self.missing_artifact = FakeArtifact('missing')
+        self.near = StandInServer({
+            self.near_artifact.basename(): 'near data',
+            self.near_artifact.metadata_basename('meta'): 'near meta',
+            self.both_artifact.basename(): 'near copy',
+        })
+        self.far = StandInServer({
+            self.far_artifact.basename(): 'far data',
+            self.far_artifact.metadata_basename('meta'): 'far meta',
+            self.both_artifact.basename(): 'far copy',
+            'key.build-log': 'log',
+        })
+        self.cache = self.new_cache([self.near.url, self.far.url])
+
+    def tearDown(self):
+        self.near.stop()
+        self.far.stop()
+
+    def new_cache(self, urls, max_failures=3):
+        return morphlib.tieredartifactcache.TieredArtifactCache(
+            [morphlib.remoteartifactcache.RemoteArtifactCache(url, timeout=5)
+             for url in urls], max_failures=max_failures)
+
+    def test_has_files_in_any_tier(self):
+        self.assertTrue(self.cache.has(self.near_artifact))
+        self.assertTrue(self.cache.has(self.far_artifact))
+        self.assertFalse(self.cache.has(self.missing_artifact))
+        self.assertTrue(self.cache.has_artifact_metadata(
+            self.far_artifact, 'meta'))
+        self.assertTrue(self.cache.has_source_metadata(
+            None, 'key', 'build-log'))
+
+    def test_stops_looking_at_the_first_tier_with_the_file(self):
+        self.assertTrue(self.cache.has(self.near_artifact))
+        self.assertEqual(self.far.requests, [])
+
+    def test_gets_from_the_nearest_tier_with_the_file(self):
+        self.assertEqual(self.cache.get(self.both_artifact).read(),
+                         'near copy')
+        self.assertEqual(self.cache.tier_of(self.both_artifact.basename()),
+                         0)
+        self.assertEqual(self.far.requests, [])
+
+    def test_falls_through_to_farther_tiers(self):
+        self.assertEqual(self.cache.get(self.far_artifact).read(),
+                         'far data')
+        self.assertEqual(self.cache.tier_of(self.far_artifact.basename()), 1)
+        self.assertEqual(
+            self.near.requests, [('GET', self.far_artifact.basename())])
+        self.assertEqual(self.cache.get_artifact_metadata(
+            self.far_artifact, 'meta').read(), 'far meta')
+        self.assertEqual(self.cache.get_source_metadata(
+            None, 'key', 'build-log').read(), 'log')
+
+    def test_fails_to_get_a_file_no_tier_has(self):
+        self.assertRaises(morphlib.remoteartifactcache.GetError,
+                          self.cache.get, self.missing_artifact,
+                          log=lambda *args: None)
+        self.assertRaises(
+            morphlib.remoteartifactcache.GetArtifactMetadataError,
+            self.cache.get_artifact_metadata, self.missing_artifact, 'meta',
+            log=lambda *args: None)
+        self.assertRaises(
+            morphlib.remoteartifactcache.GetSourceMetadataError,
+            self.cache.get_source_metadata, None, 'other', 'meta')
+        self.assertEqual(self.cache.tier_of(
+            self.missing_artifact.basename()), None)
+
+    def test_has_files_asks_each_tier_for_what_is_left(self):
+        names = [self.near_artifact.basename(),
+                 self.far_artifact.basename(),
+                 self.missing_artifact.basename()]
+        self.assertEqual(self.cache.has_files(names), {
+            names[0]: True, names[1]: True, names[2]: False})
+        self.assertEqual(self.far.requests, [('POST', '/1.0/artifacts')])
+
+    def test_has_files_only_asks_farther_tiers_if_it_needs_to(self):
+        names = [self.near_artifact.basename()]
+        self.assertEqual(self.cache.has_files(names), {names[0]: True})
+        self.assertEqual(self.far.requests, [])
+
+    def read_archive(self, handle):
+        tar = tarfile.open(fileobj=handle, mode='r|')
+        return dict((member.name, tar.extractfile(member).read())
+                    for member in tar)
+
+    def test_joins_archives_from_several_tiers(self):
+        names = [self.near_artifact.metadata_basename('meta'),
+                 self.far_artifact.metadata_basename('meta'),
+                 self.missing_artifact.metadata_basename('meta')]
+        self.assertEqual(self.read_archive(self.cache.get_files(names)), {
+            names[0]: 'near meta',
+            names[1]: 'far meta',
+        })
+        self.assertEqual(self.cache.tier_of(names[0]), 0)
+        self.assertEqual(self.cache.tier_of(names[1]), 1)
+
+    def test_fails_to_join_archives_if_a_tier_refuses(self):
+        self.far.archives = False
+        names = [self.near_artifact.metadata_basename('meta'),
+                 self.far_artifact.metadata_basename('meta')]
+        self.assertRaises(morphlib.remoteartifactcache.GetFilesError,
+                          self.cache.get_files, names)
+
+    def test_gets_an_archive_from_a_single_tier(self):
+        names = [self.far_artifact.metadata_basename('meta')]
+        self.assertEqual(self.read_archive(self.cache.get_files(names)), {
+            names[0]: 'far meta',
+        })
+        self.assertEqual(self.near.requests, [('POST', '/1.0/artifacts')])
+
+    def test_gets_an_empty_archive_when_no_tier_has_the_files(self):
+        names = [self.missing_artifact.basename()]
+        self.assertEqual(self.read_archive(self.cache.get_files(names)), {})
+
+    def test_skips_a_tier_that_cannot_be_reached(self):
+        cache = self.new_cache([unused_url(), self.far.url], max_failures=2)
+        for i in xrange(3):
+            self.assertEqual(cache.get(self.far_artifact).read(), 'far data')
+        down = cache.caches[0]
+        self.assertEqual(down.connection_failures, 2)
+        self.assertEqual(cache.tiers(), [(1, cache.caches[1])])
+
+    def test_a_missing_file_does_not_count_as_a_failure(self):
+        for i in xrange(5):
+            self.cache.get(self.far_artifact)
+        self.assertEqual(self.cache.caches[0].connection_failures, 0)
+        self.assertEqual(len(self.cache.tiers()), 2)
+
+    def test_fails_to_get_files_when_no_tier_can_be_reached(self):
+        cache = self.new_cache([unused_url()], max_failures=1)
+        self.assertRaises(morphlib.remoteartifactcache.GetFilesError,
+                          cache.get_files, ['foo'])
+        self.assertRaises(morphlib.remoteartifactcache.GetFilesError,
+                          cache.get_files, ['foo'])
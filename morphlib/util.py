@@ -1,4 +1,4 @@
-# Copyright (C) 2011-2014  Codethink Limited
+# Copyright (C) 2011-2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -14,6 +14,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import contextlib
+import hashlib
 import itertools
 import os
 import pipes
@@ -112,6 +113,19 @@ def get_artifact_cache_server(settings): # pragma: no cover
     return None
 
 
+def get_artifact_cache_servers(settings): # pragma: no cover
+    if settings['artifact-cache-servers']:
+        return settings['artifact-cache-servers']
+    url = get_artifact_cache_server(settings)
+    return [url] if url else []
+
+
+def get_artifact_upload_server(settings): # pragma: no cover
+    if settings['artifact-upload-server']:
+        return settings['artifact-upload-server']
+    return get_artifact_cache_server(settings)
+
+
 def get_git_resolve_cache_server(settings): # pragma: no cover
     if settings['git-resolve-cache-server']:
         return settings['git-resolve-cache-server']
@@ -120,6 +134,30 @@ def get_git_resolve_cache_server(settings): # pragma: no cover
     return None
 
 
+def new_http_cache(settings):  # pragma: no cover
+    '''Create the cache of responses from cache servers, if wanted.'''
+
+    if settings['http-cache-size'] <= 0:
+        return None
+    http_cachedir = os.path.join(create_cachedir(settings), 'http')
+    if not os.path.exists(http_cachedir):
+        os.mkdir(http_cachedir)
+    return morphlib.httpcache.HTTPCache(
+        http_cachedir, max_size=settings['http-cache-size'] * 1024 ** 2)
+
+
+def new_membership_filter(settings, server_url):  # pragma: no cover
+    '''Create the local copy of a cache server's membership filter.'''
+
+    if settings['no-membership-filter']:
+        return None
+    membership_dir = os.path.join(create_cachedir(settings), 'membership')
+    if not os.path.exists(membership_dir):
+        os.mkdir(membership_dir)
+    return morphlib.bloomfilter.MembershipFilter(os.path.join(
+        membership_dir, hashlib.sha1(server_url).hexdigest()))
+
+
 def new_artifact_caches(settings):  # pragma: no cover
     '''Create new objects for local and remote artifact caches.
 
@@ -135,10 +173,18 @@ def new_artifact_caches(settings):  # pragma: no cover
     lac = morphlib.localartifactcache.LocalArtifactCache(
             fs.osfs.OSFS(artifact_cachedir))
 
-    rac_url = get_artifact_cache_server(settings)
+    http_cache = new_http_cache(settings)
+    racs = [morphlib.remoteartifactcache.RemoteArtifactCache(
+                url, upload_token=settings['artifact-upload-token'],
+                timeout=settings['artifact-cache-timeout'] or None,
+                http_cache=http_cache,
+                membership=new_membership_filter(settings, url))
+            for url in get_artifact_cache_servers(settings)]
     rac = None
-    if rac_url:
-        rac = morphlib.remoteartifactcache.RemoteArtifactCache(rac_url)
+    if len(racs) == 1:
+        rac = racs[0]
+    elif racs:
+        rac = morphlib.tieredartifactcache.TieredArtifactCache(racs)
     return lac, rac
 
 
@@ -214,7 +260,8 @@ def new_repo_caches(app):  # pragma: no cover
 
     url = get_git_resolve_cache_server(app.settings)
     if url:
-        rrc = morphlib.remoterepocache.RemoteRepoCache(url, repo_resolver)
+        rrc = morphlib.remoterepocache.RemoteRepoCache(
+            url, repo_resolver, http_cache=new_http_cache(app.settings))
     else:
         rrc = None
 
@@ -1,4 +1,4 @@
-# Copyright (C) 2011 - 2014  Codethink Limited
+# Copyright (C) 2011 - 2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -128,7 +128,7 @@ class Check(Command):
     def run(self):
         subprocess.check_call(['python', '-m', 'CoverageTestRunner',
                                '--ignore-missing-from=without-test-modules',
-                               'morphlib', 'distbuild'])
+                               'morphlib', 'distbuild', 'morphcacheserver'])
         os.remove('.coverage')
 
 